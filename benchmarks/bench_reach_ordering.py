@@ -0,0 +1,38 @@
+"""Timing comparison of the reach ordering methods in preproc.create_reaches,
+for long synthetic flowlines crossing fine grids.
+
+Run from the benchmarks folder:
+python bench_reach_ordering.py
+"""
+import sys
+sys.path.append('..')
+import time
+import numpy as np
+from preproc import make_mat1
+from synthetic import sinuous_line, structured_grid_geoms, grid_intersections_for
+
+
+def compare(ncells_along, delr=100.):
+
+    length = 0.8 * ncells_along * delr
+    line = sinuous_line(length, amplitude=0.05 * length, wavelength=0.2 * length,
+                        x0=0.1 * ncells_along * delr, y0=-0.5 * ncells_along * delr,
+                        spacing=delr/10.)
+    grid_geoms = structured_grid_geoms(ncells_along, ncells_along, delr, delr)
+    grid_intersections = grid_intersections_for([line], grid_geoms)
+
+    results = {}
+    for method in ['nearest', 'linear']:
+        ta = time.time()
+        m1 = make_mat1([line], [1], [1], grid_intersections, grid_geoms, tol=.001, reach_ordering=method)
+        results[method] = (time.time() - ta, m1)
+
+    identical = np.array_equal(results['nearest'][1].node.values, results['linear'][1].node.values)
+    print('{:>6d} reaches: nearest {:.2f}s, linear {:.2f}s; identical node sequence: {}'
+          .format(len(results['linear'][1]), results['nearest'][0], results['linear'][0], identical))
+    return results
+
+
+if __name__ == '__main__':
+    for n in [50, 100, 200, 400]:
+        compare(n)
@@ -0,0 +1,32 @@
+"""Timing of preproc.renumber_segments for synthetic dendritic networks.
+
+Run from the benchmarks folder:
+python bench_renumber_segments.py
+"""
+import sys
+sys.path.append('..')
+import time
+import numpy as np
+from preproc import renumber_segments, remap_segments, _in_order
+from synthetic import dendritic_network
+
+
+def run(nseg):
+
+    segments, outsegs = dendritic_network(nseg, n_outlets=max(1, nseg // 1000))
+    ta = time.time()
+    r, remap = renumber_segments(segments, outsegs, return_remap=True)
+    elapsed = time.time() - ta
+
+    new_segments = remap_segments(remap, segments)
+    new_outsegs = remap_segments(remap, outsegs)
+    order = np.argsort(new_segments)
+    valid = _in_order(new_segments[order], new_outsegs[order]) and \
+            np.array_equal(np.sort(new_segments), np.arange(1, nseg + 1))
+    print('{:>7d} segments: {:.3f}s; numbering increases downstream: {}'.format(nseg, elapsed, valid))
+    return elapsed
+
+
+if __name__ == '__main__':
+    for n in [1000, 10000, 100000]:
+        run(n)
@@ -0,0 +1,123 @@
+"""Benchmark suite for the core SFRmaker operations, on synthetic dendritic stream networks
+and structured grids (see synthetic.py), at the scales given with the --scale option
+(numbers of reaches; see conftest.py).
+
+Run from the benchmarks folder:
+pytest
+pytest --scale 1000,10000,100000,1000000
+
+The cases using polygon grids (make_mat1) are skipped for grids with more than max_grid_polygons cells.
+"""
+import os
+import numpy as np
+import pytest
+from synthetic import dendritic_flowlines, structured_grid_geoms, grid_intersections_for, sfr_tables
+from grid import StructuredGrid
+from preproc import make_mat1, make_mat1_from_grid, renumber_segments, map_segment_sequences, get_upsegs
+
+max_grid_polygons = 2e6
+reaches_per_segment = 10
+cell_size = 100.
+_models = {}
+
+
+def synthetic_model(nreaches):
+    """Flowlines, routing and tables for a network with about nreaches reaches
+    (made once for each scale)."""
+    if nreaches not in _models:
+        geoms, segments, outsegs, nrow, ncol = dendritic_flowlines(nreaches, reaches_per_segment, cell_size)
+        m1, m2 = sfr_tables(segments, outsegs, reaches_per_segment, nrow, ncol)
+        _models[nreaches] = {'geoms': geoms, 'segments': segments, 'outsegs': outsegs,
+                             'nrow': nrow, 'ncol': ncol, 'm1': m1, 'm2': m2}
+    return _models[nreaches]
+
+
+@pytest.fixture(scope='session')
+def model(nreaches):
+    return synthetic_model(nreaches)
+
+
+@pytest.fixture(scope='session')
+def polygon_grid(model):
+    if model['nrow'] * model['ncol'] > max_grid_polygons:
+        pytest.skip('{} x {} grid is too large for polygons'.format(model['nrow'], model['ncol']))
+    grid_geoms = structured_grid_geoms(model['nrow'], model['ncol'], cell_size, cell_size,
+                                       yul=model['nrow'] * cell_size)
+    return grid_geoms, grid_intersections_for(model['geoms'], grid_geoms)
+
+
+@pytest.fixture(scope='session')
+def sfrdata(model):
+    from postproc import SFRdata
+    return SFRdata(Mat1=model['m1'], Mat2=model['m2'])
+
+
+def test_make_mat1(benchmark, model, polygon_grid):
+    grid_geoms, grid_intersections = polygon_grid
+    benchmark.extra_info['items'] = len(model['geoms'])
+    m1 = benchmark(make_mat1, model['geoms'], model['segments'], model['segments'],
+                   grid_intersections, grid_geoms, tol=.001, reach_ordering='linear')
+    assert m1.segment.nunique() == len(model['geoms'])
+
+
+def test_make_mat1_from_grid(benchmark, model):
+    grid = StructuredGrid(np.ones(model['ncol']) * cell_size, np.ones(model['nrow']) * cell_size,
+                          yul=model['nrow'] * cell_size)
+    benchmark.extra_info['items'] = len(model['geoms'])
+    m1 = benchmark(make_mat1_from_grid, model['geoms'], model['segments'], model['segments'], grid)
+    assert m1.segment.nunique() == len(model['geoms'])
+
+
+def test_renumber_segments(benchmark, model):
+    benchmark.extra_info['items'] = len(model['segments'])
+    r, remap = benchmark(renumber_segments, model['segments'], model['outsegs'], return_remap=True)
+    assert len(remap) == len(model['segments']) + 1
+
+
+def test_map_segment_sequences(benchmark, model):
+    benchmark.extra_info['items'] = len(model['segments'])
+    sequences = benchmark(map_segment_sequences, model['segments'], model['outsegs'], verbose=False)
+    assert np.array_equal(sequences[0], model['segments'])
+    assert not sequences[-1].any()
+    # each column follows the routing from the segment to its outlet
+    outsegs = dict(zip(model['segments'], model['outsegs']))
+    for j, seg in enumerate(model['segments']):
+        path = [seg]
+        while path[-1] != 0:
+            path.append(outsegs[path[-1]])
+        assert sequences[:len(path), j].tolist() == path
+        assert not sequences[len(path):, j].any()
+
+
+def test_get_upsegs(benchmark, model):
+    benchmark.extra_info['items'] = len(model['segments'])
+    upsegs = benchmark(get_upsegs, model['segments'], model['outsegs'])
+    assert upsegs[0] == set(model['segments'][model['outsegs'] == 0])
+
+
+def test_map_outsegs(benchmark, sfrdata):
+    benchmark.extra_info['items'] = len(sfrdata.m2)
+    benchmark(sfrdata.map_outsegs)
+    assert (sfrdata.m2.Outlet > 0).all()
+
+
+def test_smooth_segment_interiors(benchmark, model, tmpdir):
+    from postproc import Elevations
+    report_file = os.path.join(str(tmpdir), 'smooth_segment_interiors.txt')
+
+    def setup():
+        # smoothing changes the streambed tops in place
+        return (Elevations(Mat1=model['m1'], Mat2=model['m2']),), {}
+
+    benchmark.extra_info['items'] = len(model['m1'])
+    elevations = benchmark.pedantic(lambda e: e.smooth_segment_interiors(report_file) or e,
+                                    setup=setup, rounds=3)
+    for s, sbtop in elevations.m1.groupby('segment').sbtop:
+        assert np.all(np.diff(sbtop.values) <= 1e-5)
+
+
+def test_write_sfr_package(benchmark, sfrdata, tmpdir):
+    basename = os.path.join(str(tmpdir), 'synthetic')
+    benchmark.extra_info['items'] = len(sfrdata.m1)
+    benchmark(sfrdata.write_sfr_package, basename)
+    assert os.path.getsize(basename + '.sfr') > 0
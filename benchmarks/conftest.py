@@ -0,0 +1,102 @@
+"""pytest configuration for the benchmark suite (bench_suite.py).
+
+Network sizes (numbers of reaches) are set with the --scale option, e.g.
+pytest --scale 1000,10000,100000
+
+With pytest-benchmark installed, its benchmark fixture is used, and the results can be saved
+and compared between runs with its options (e.g. --benchmark-autosave, --benchmark-compare).
+Otherwise, a minimal benchmark fixture times each case (recording wall time, CPU time and peak memory
+in a runreport.RunReport), and the results are saved to a JSON file in the results folder
+(--results-dir), which can be compared with a previous run using --compare-to.
+"""
+import os
+import sys
+import time
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, '..'))
+sys.path.insert(0, benchmarks_dir)
+import pytest
+from runreport import RunReport
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('SFRmaker benchmarks')
+    group.addoption('--scale', default='1000',
+                    help='Comma-separated list of network sizes (numbers of reaches), e.g. 1000,10000,100000')
+    if pytest_benchmark is None:
+        group.addoption('--results-dir', default=os.path.join(benchmarks_dir, 'results'),
+                        help='Folder for saving the timing results (JSON).')
+        group.addoption('--compare-to', default=None,
+                        help='Timing results (JSON) from a previous run to compare to.')
+
+
+def pytest_generate_tests(metafunc):
+    if 'nreaches' in metafunc.fixturenames:
+        scales = [int(s) for s in metafunc.config.getoption('scale').split(',')]
+        metafunc.parametrize('nreaches', scales, scope='session')
+
+
+if pytest_benchmark is None:
+
+    class Benchmark(object):
+        """Minimal stand-in for the pytest-benchmark fixture,
+        supporting benchmark(function, *args, **kwargs) and benchmark.pedantic."""
+
+        def __init__(self, name, report, rounds=3):
+            self.name = name
+            self.report = report
+            self.rounds = rounds
+            self.extra_info = {}
+
+        def __call__(self, function, *args, **kwargs):
+            return self.pedantic(function, args, kwargs, rounds=self.rounds)
+
+        def pedantic(self, target, args=(), kwargs=None, setup=None, rounds=1, iterations=1, warmup_rounds=0):
+            kwargs = {} if kwargs is None else kwargs
+            for i in range(warmup_rounds + rounds):
+                if setup is not None:
+                    arguments = setup()
+                    if arguments is not None:
+                        args, kwargs = arguments
+                if i < warmup_rounds:
+                    result = target(*args, **kwargs)
+                    continue
+                with self.report.stage(self.name, items=self.extra_info.get('items')):
+                    for j in range(iterations):
+                        result = target(*args, **kwargs)
+            return result
+
+    def pytest_configure(config):
+        config.sfrmaker_report = RunReport(verbose=False)
+
+    @pytest.fixture
+    def benchmark(request):
+        return Benchmark(request.node.name, request.config.sfrmaker_report)
+
+    def pytest_terminal_summary(terminalreporter, exitstatus, config):
+        report = config.sfrmaker_report
+        if len(report.stages) == 0:
+            return
+        summary = report.summary()
+        summary['items'] = summary['items'] / summary['count'] # per round
+        summary['mean_time'] = summary.wall_time / summary['count']
+        terminalreporter.write_sep('-', 'benchmark timings (s)')
+        terminalreporter.write_line(summary[['items', 'count', 'mean_time', 'cpu_time', 'peak_rss_mb']].to_string())
+
+        results_dir = config.getoption('results_dir')
+        if not os.path.isdir(results_dir):
+            os.makedirs(results_dir)
+        outfile = os.path.join(results_dir, 'benchmarks_{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+        report.to_json(outfile)
+        terminalreporter.write_line('results saved to {}'.format(outfile))
+
+        compare_to = config.getoption('compare_to')
+        if compare_to is not None:
+            comparison = report.compare(compare_to)
+            terminalreporter.write_sep('-', 'compared to {}'.format(compare_to))
+            terminalreporter.write_line(comparison[['wall_time', 'wall_time_other', 'wall_time_ratio']].to_string())
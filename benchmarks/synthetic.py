@@ -0,0 +1,261 @@
+"""Generators for synthetic SFRmaker inputs (flowlines and model grids),
+for benchmarking at configurable scales.
+"""
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, box
+
+
+def sinuous_line(length, amplitude=None, wavelength=None, spacing=None,
+                 x0=0., y0=0., angle=0.):
+    """Make a long, meandering LineString.
+
+    Parameters
+    ----------
+    length : float
+        Straight-line (down-valley) length of the line.
+    amplitude : float
+        Amplitude of the meanders (default 5% of length).
+    wavelength : float
+        Wavelength of the meanders (default 10% of length).
+    spacing : float
+        Down-valley spacing of the vertices (default 0.1% of length).
+    x0, y0 : float
+        Starting coordinate.
+    angle : float
+        Orientation of the valley axis, in degrees counter-clockwise from the x-axis.
+    """
+    amplitude = 0.05 * length if amplitude is None else amplitude
+    wavelength = 0.1 * length if wavelength is None else wavelength
+    spacing = 0.001 * length if spacing is None else spacing
+    s = np.arange(0, length + spacing, spacing)
+    n = amplitude * np.sin(2 * np.pi * s / wavelength)
+    a = np.radians(angle)
+    x = x0 + s * np.cos(a) - n * np.sin(a)
+    y = y0 + s * np.sin(a) + n * np.cos(a)
+    return LineString(np.column_stack([x, y]))
+
+
+def structured_grid_geoms(nrow, ncol, delr, delc, xul=0., yul=0.):
+    """Make a list of shapely Polygons for an (unrotated) structured grid,
+    in row-major (node number) order.
+    """
+    geoms = []
+    for i in range(nrow):
+        y1 = yul - i * delc
+        y0 = y1 - delc
+        for j in range(ncol):
+            x0 = xul + j * delr
+            geoms.append(box(x0, y0, x0 + delr, y1))
+    return geoms
+
+
+def grid_intersections_for(geoms, grid_geoms):
+    """Brute-force list of the grid cells intersected by each geometry
+    (stands in for GISops.intersect_rtree)."""
+    try:
+        from rtree import index
+    except ImportError:
+        return [[i for i, g in enumerate(grid_geoms) if g.intersects(f)] for f in geoms]
+    idx = index.Index()
+    for i, g in enumerate(grid_geoms):
+        idx.insert(i, g.bounds)
+    return [[i for i in idx.intersection(f.bounds) if grid_geoms[i].intersects(f)]
+            for f in geoms]
+
+
+def dendritic_network(nseg, n_outlets=1, max_upsegs=3, seed=0):
+    """Make a random dendritic segment network, with the segments numbered randomly
+    (so that renumbering is needed for numbering to increase downstream).
+
+    Parameters
+    ----------
+    nseg : int
+        Number of segments.
+    n_outlets : int
+        Number of outlet segments (outseg of 0).
+    max_upsegs : int
+        Maximum number of segments routed to each segment.
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    segments, outsegs : 1-D arrays
+    """
+    rng = np.random.RandomState(seed)
+    outsegs = _grow_network(nseg, n_outlets, max_upsegs, rng)
+    # scramble the numbering
+    numbers = rng.permutation(nseg) + 1
+    segments = numbers
+    outsegs = np.where(outsegs > 0, numbers[outsegs - 1], 0)
+    order = rng.permutation(nseg)
+    return segments[order], outsegs[order]
+
+
+def _grow_network(nseg, n_outlets, max_upsegs, rng):
+    """Outsegs for a random dendritic network, grown upstream from the outlets
+    (segments are numbered in the order they were added, so each outseg is less than its segment)."""
+    outsegs = np.zeros(nseg, dtype=int)
+    nup = np.zeros(nseg, dtype=int)
+    open_segs = list(range(n_outlets)) # segments that can receive more upsegs
+    for i in range(n_outlets, nseg):
+        k = rng.randint(len(open_segs))
+        o = open_segs[k]
+        outsegs[i] = o + 1
+        nup[o] += 1
+        if nup[o] == max_upsegs:
+            open_segs[k] = open_segs[-1]
+            open_segs.pop()
+        open_segs.append(i)
+    return outsegs
+
+
+def dendritic_flowlines(nreaches, reaches_per_segment=10, cell_size=100., n_outlets=None,
+                        max_upsegs=3, seed=0):
+    """Make a random dendritic stream network with flowline geometries, and the
+    dimensions of a structured grid covering it, so that the flowlines break into
+    about the requested number of reaches.
+
+    The network is laid out as a tree diagram (headwaters at the top, outlets at the bottom),
+    so that few of the flowlines cross. Each segment crosses about reaches_per_segment cells.
+
+    Parameters
+    ----------
+    nreaches : int
+        Approximate number of reaches (the number of segments is nreaches / reaches_per_segment).
+    reaches_per_segment : int
+        Approximate number of grid cells crossed by each segment.
+    cell_size : float
+        Grid cell spacing (along rows and columns).
+    n_outlets : int, optional
+        Number of outlets (default 1 per 1000 segments).
+    max_upsegs : int
+        Maximum number of segments routed to each segment.
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    geoms : list of LineStrings
+        Flowline for each segment (digitized in the downstream direction).
+    segments, outsegs : 1-D arrays
+        Segment numbers (1 to nseg) and routing.
+    nrow, ncol : int
+        Dimensions of a grid with spacing cell_size and its upper left corner at (0, nrow * cell_size),
+        that covers the flowlines.
+    """
+    rng = np.random.RandomState(seed)
+    nseg = max(1, int(nreaches // reaches_per_segment))
+    if n_outlets is None:
+        n_outlets = max(1, nseg // 1000)
+    n_outlets = min(n_outlets, nseg)
+    outsegs = _grow_network(nseg, n_outlets, max_upsegs, rng)
+    segments = np.arange(1, nseg + 1)
+
+    # upsegs of each segment (segments are numbered in downstream to upstream order)
+    order = np.argsort(outsegs, kind='mergesort')
+    ptr = np.searchsorted(outsegs[order], np.arange(nseg + 2))
+    depth = np.zeros(nseg, dtype=int)
+    for i in range(n_outlets, nseg):
+        depth[i] = depth[outsegs[i] - 1] + 1
+
+    # x positions: headwaters spaced evenly in depth-first order; other segments centered over their upsegs
+    x = np.zeros(nseg)
+    stack = list(range(n_outlets))[::-1]
+    nleaves = 0
+    while stack:
+        i = stack.pop()
+        upsegs = order[ptr[i + 1]:ptr[i + 2]]
+        if len(upsegs) == 0:
+            x[i] = nleaves
+            nleaves += 1
+        stack.extend(upsegs[::-1])
+    for i in range(nseg - 1, -1, -1):
+        upsegs = order[ptr[i + 1]:ptr[i + 2]]
+        if len(upsegs) > 0:
+            x[i] = x[upsegs].mean()
+
+    dx = 2. * cell_size
+    dy = 0.6 * reaches_per_segment * cell_size
+    x = (x + 0.5) * dx + rng.uniform(-0.2, 0.2, nseg) * cell_size # avoid lines along the grid lines
+    y = (depth.max() - depth + 1.5) * dy # upstream end of each segment
+    x_end = np.where(outsegs > 0, x[outsegs - 1], x)
+    y_end = np.where(outsegs > 0, y[outsegs - 1], 0.5 * dy)
+    # bend each line a bit at its midpoint
+    xm = 0.5 * (x + x_end) + rng.uniform(-0.5, 0.5, nseg) * cell_size
+    ym = 0.5 * (y + y_end)
+    geoms = [LineString([(x[i], y[i]), (xm[i], ym[i]), (x_end[i], y_end[i])]) for i in range(nseg)]
+
+    nrow = int(np.ceil((y.max() + 0.5 * dy) / cell_size))
+    ncol = int(np.ceil((nleaves + 1) * dx / cell_size))
+    return geoms, segments, outsegs, nrow, ncol
+
+
+def sfr_tables(segments, outsegs, reaches_per_segment=10, nrow=100, ncol=100, seed=0):
+    """Make Mat1 (reach) and Mat2 (segment) tables for a segment network, with
+    noisy streambed elevations that decrease downstream (so that smoothing has work to do).
+
+    Parameters
+    ----------
+    segments, outsegs : 1-D arrays
+        Segment numbers and routing (e.g. from dendritic_flowlines or dendritic_network).
+    reaches_per_segment : int
+        Average number of reaches in each segment.
+    nrow, ncol : int
+        Grid dimensions (the reaches are assigned to random cells).
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    m1, m2 : DataFrames
+    """
+    rng = np.random.RandomState(seed)
+    segments = np.asarray(segments)
+    outsegs = np.asarray(outsegs)
+    nseg = len(segments)
+    from preproc import renumber_segments, remap_segments # numbering that increases downstream
+    r, remap = renumber_segments(segments, outsegs, return_remap=True)
+    segments = remap_segments(remap, segments)
+    outsegs = remap_segments(remap, outsegs)
+    order = np.argsort(segments)
+    segments, outsegs = segments[order], outsegs[order]
+
+    # elevations decrease by 10 per segment from the headwaters
+    distance = np.zeros(nseg + 1) # segments downstream of each segment (index 0 for outlets)
+    for s in segments[::-1]:
+        distance[s] = distance[outsegs[s - 1]] + 1
+    elev_max = 100. + 10 * distance[1:]
+    elev_min = elev_max - 10.
+
+    nreach = rng.randint(1, 2 * reaches_per_segment, nseg)
+    reach_segments = np.repeat(segments, nreach)
+    start = np.cumsum(nreach) - nreach
+    reach = np.arange(nreach.sum()) - np.repeat(start, nreach) + 1
+    fraction = (reach - 0.5) / np.repeat(nreach, nreach)
+    top = np.repeat(elev_max, nreach) - 10. * fraction + rng.normal(0, 2., len(reach))
+    node = rng.randint(1, nrow * ncol + 1, len(reach))
+
+    m1 = pd.DataFrame({'node': node,
+                       'row': (node - 1) // ncol + 1,
+                       'column': (node - 1) % ncol + 1,
+                       'layer': 1,
+                       'segment': reach_segments,
+                       'reach': reach,
+                       'length': rng.uniform(10., 150., len(reach)),
+                       'width': 5.,
+                       'sbtop': top,
+                       'landsurface': top,
+                       'sbthick': 1.,
+                       'sbK': 1.,
+                       'slope': 1e-3,
+                       'roughness': 0.037,
+                       'reachID': np.arange(1, len(reach) + 1)})
+    m1['SFRlength'] = m1.length
+    m2 = pd.DataFrame({'segment': segments,
+                       'icalc': 1,
+                       'outseg': outsegs,
+                       'elevMax': elev_max,
+                       'elevMin': elev_min})
+    return m1, m2
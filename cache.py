@@ -0,0 +1,103 @@
+__author__ = 'aleaf'
+import os
+import glob
+import hashlib
+import pandas as pd
+from shapely import wkb
+from GISio import shp2df
+
+
+def read_cached(input, columns=None, cache_dir=None):
+    """Read a shapefile or DBF (or list of them) into a dataframe, through an
+    on-disk cache of the parsed tables.
+
+    Each file is parsed once with GISio.shp2df, pruned to the requested columns,
+    and saved to cache_dir in parquet (columnar) format, with any geometries stored as WKB.
+    The cache entry is keyed on the file path, size and modification time
+    (and the requested columns), so edited or replaced files are re-read automatically.
+
+    Parameters
+    ----------
+    input : str or list of strings
+        Shapefile or DBF file(s). Tables from multiple files are concatenated.
+    columns : list of strings, optional
+        Columns to keep (any that aren't in the file are skipped). The default is all columns.
+    cache_dir : str, optional
+        Folder for the cache files (created if it doesn't exist).
+        If None, the files are read with shp2df without caching.
+
+    Returns
+    -------
+    df : dataframe
+    """
+    if cache_dir is None:
+        df = shp2df(input)
+        return df if columns is None else _prune(df, columns)
+    if not isinstance(input, list):
+        input = [input]
+    dfs = [_read_cached_file(f, columns, cache_dir) for f in input]
+    if len(dfs) == 1:
+        return dfs[0]
+    return pd.concat(dfs, ignore_index=True)
+
+
+def cache_file(filename, columns=None, cache_dir='.'):
+    """Name of the cache file for a shapefile or DBF, given its current size and modification time.
+
+    Returns
+    -------
+    cachefile : str
+        Path of the parquet file in cache_dir.
+    stale : str
+        Glob pattern matching cache files for other versions of the same input file.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    pathkey = hashlib.sha1('{}|{}'.format(path, columns).encode('utf-8')).hexdigest()[:12]
+    statkey = hashlib.sha1('{}|{}'.format(stat.st_size, stat.st_mtime).encode('utf-8')).hexdigest()[:12]
+    basename = os.path.splitext(os.path.basename(path))[0]
+    stem = os.path.join(cache_dir, '{}_{}'.format(basename, pathkey))
+    return '{}_{}.parquet'.format(stem, statkey), '{}_*.parquet'.format(stem)
+
+
+def _read_cached_file(filename, columns, cache_dir):
+    cachefile, stale = cache_file(filename, columns, cache_dir)
+    if os.path.exists(cachefile):
+        return _from_parquet(cachefile)
+
+    print('caching {}...'.format(filename))
+    df = shp2df(filename)
+    if columns is not None:
+        df = _prune(df, columns)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for f in glob.glob(stale): # previous versions of the file
+        os.remove(f)
+    _to_parquet(df, cachefile)
+    return df
+
+
+def _prune(df, columns):
+    return df[[c for c in columns if c in df.columns]]
+
+
+def _to_parquet(df, filename):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Caching the input files requires pyarrow.')
+    df = df.copy()
+    if 'geometry' in df.columns:
+        df['geometry'] = [g.wkb if g is not None else None for g in df.geometry]
+    df.to_parquet(filename, engine='pyarrow')
+
+
+def _from_parquet(filename):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Caching the input files requires pyarrow.')
+    df = pd.read_parquet(filename, engine='pyarrow')
+    if 'geometry' in df.columns:
+        df['geometry'] = [wkb.loads(g) if g is not None else None for g in df.geometry]
+    return df
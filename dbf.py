@@ -0,0 +1,105 @@
+__author__ = 'aleaf'
+import struct
+import numpy as np
+import pandas as pd
+
+
+def read_dbf(filename, columns=None, filter_column=None, filter_values=None, chunksize=100000):
+    """Read a DBF file (or list of DBF files) into a dataframe, streaming through the records
+    in chunks and keeping only the requested rows and columns.
+
+    Only the filter column is decoded for every record; the other columns are only decoded
+    for the records that are kept. This allows a subset of a large table (e.g. the
+    PlusFlowlineVAA attributes for the flowlines in a model, from a whole NHDPlus
+    vector processing unit) to be read without holding the whole table in memory.
+
+    Parameters
+    ----------
+    filename : str or list of strings
+        DBF file(s). Tables from multiple files are concatenated.
+    columns : list of strings, optional
+        Columns to read (any that aren't in the file are skipped). The default is all columns.
+    filter_column : str, optional
+        Column used to select the records (e.g. 'COMID').
+    filter_values : sequence, optional
+        Values of filter_column for the records to keep.
+        The default is to keep all records.
+    chunksize : int
+        Number of records to read at a time.
+
+    Returns
+    -------
+    df : dataframe
+    """
+    if isinstance(filename, list):
+        dfs = [read_dbf(f, columns, filter_column, filter_values, chunksize) for f in filename]
+        return pd.concat(dfs, ignore_index=True)
+
+    with open(filename, 'rb') as src:
+        nrecords, header_length, record_length = struct.unpack('<xxxxIHH', src.read(12))
+        src.seek(32)
+        fields = []
+        while True:
+            descriptor = src.read(32)
+            if descriptor[:1] in (b'\r', b''):
+                break
+            name = descriptor[:11].split(b'\x00')[0].decode('latin-1').strip()
+            fields.append((name, descriptor[11:12].decode('latin-1'), descriptor[16], descriptor[17]))
+        if isinstance(fields[0][2], str): # python 2
+            fields = [(n, t, ord(l), ord(d)) for n, t, l, d in fields]
+
+        names = [f[0] for f in fields]
+        if columns is None:
+            columns = names
+        columns = [c for c in columns if c in names]
+        if filter_column is not None and filter_column not in names:
+            raise ValueError('{} not in {}'.format(filter_column, filename))
+        dtype = np.dtype([('deleted', 'S1')] + [('f{}'.format(i), 'S{}'.format(f[2]))
+                                                for i, f in enumerate(fields)])
+        if dtype.itemsize != record_length:
+            raise IOError('Unexpected record length in {}'.format(filename))
+        fieldinfo = dict((f[0], ('f{}'.format(i), f[1], f[3])) for i, f in enumerate(fields))
+        if filter_values is not None:
+            filter_values = np.unique(np.asarray(filter_values))
+
+        src.seek(header_length)
+        chunks = []
+        nread = 0
+        while nread < nrecords:
+            n = min(chunksize, nrecords - nread)
+            records = np.frombuffer(src.read(n * record_length), dtype=dtype, count=n)
+            nread += n
+            keep = records['deleted'] != b'*'
+            if filter_column is not None and filter_values is not None:
+                key, ftype, decimals = fieldinfo[filter_column]
+                keep &= np.isin(_decode(records[key], ftype, decimals), filter_values)
+            records = records[keep]
+            if len(records) == 0:
+                continue
+            chunks.append(pd.DataFrame(dict((c, _decode(records[fieldinfo[c][0]], *fieldinfo[c][1:]))
+                                            for c in columns), columns=columns))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _decode(values, ftype, decimals):
+    """Convert an array of raw DBF field values (byte strings) to numbers, strings, dates or booleans."""
+    values = np.char.strip(values)
+    if ftype in ('N', 'F'):
+        blank = values == b''
+        if decimals == 0 and ftype == 'N' and not blank.any():
+            try:
+                return values.astype(np.int64)
+            except ValueError:
+                pass
+        try:
+            numbers = np.where(blank, b'nan', values).astype(float)
+        except ValueError: # e.g. overflow values (*****)
+            numbers = pd.to_numeric(pd.Series(np.char.decode(values, 'latin-1')), errors='coerce').values
+        return numbers
+    if ftype == 'D':
+        return pd.to_datetime(pd.Series(np.char.decode(values, 'latin-1')), format='%Y%m%d', errors='coerce').values
+    if ftype == 'L':
+        return np.isin(values, [b'T', b't', b'Y', b'y'])
+    return np.char.decode(values, 'latin-1').astype(object)
@@ -24,10 +24,10 @@ class diagnostics(SFRdata):
 
     def __init__(self, sfrobject=None, Mat1=None, Mat2=None, sfr=None, node_column=None,
                      mfpath=None, mfnam=None, mfdis=None,
-                     xll=0, yll=0, outpath=os.getcwd()):
+                     xll=0, yll=0, rotation=0, outpath=os.getcwd()):
 
         SFRdata.__init__(self, sfrobject=sfrobject, Mat1=Mat1, Mat2=Mat2, sfr=sfr, node_column=node_column,
-                         mfpath=mfpath, mfnam=mfnam, mfdis=mfdis, xll=xll, yll=yll)
+                         mfpath=mfpath, mfnam=mfnam, mfdis=mfdis, xll=xll, yll=yll, rotation=rotation)
 
     def check_numbering(self):
         """checks for continuity in segment and reach numbering
@@ -50,7 +50,7 @@ class diagnostics(SFRdata):
                     break
         print('passed.')
 
-    def check_routing(self, max_levels=1000):
+    def check_routing(self, max_levels=None):
         """checks for breaks in routing and does comprehensive check for circular routing
         """
         print('\nChecking for circular routing...')
@@ -193,9 +193,7 @@ class diagnostics(SFRdata):
 
         print("\nChecking for outlets in the model interior...")
         if model_domain is None:
-            print('Need a shapefile of the model domain edge to check for interior outlets.\n' \
-                  '(rotated coordinate systems not supported; ' \
-                  'for rotated grids submit shapefile of unrotated domain in coordinates consistent with model cells.)')
+            print('Need a shapefile of the model domain edge to check for interior outlets.')
             return
         else:
             import GISio
@@ -244,9 +242,7 @@ class diagnostics(SFRdata):
         print("\nChecking for gaps in routing between segments...")
         if model_domain is None:
             print('No model_domain supplied. ' \
-                  'Routing gaps for segments intersecting model domain boundary will not be considered.\n' \
-                  '(rotated coordinate systems not supported; ' \
-                  'for rotated grids submit shapefile of unrotated domain in coordinates consistent with model cells.)')
+                  'Routing gaps for segments intersecting model domain boundary will not be considered.')
         else:
             import GISio
 
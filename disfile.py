@@ -0,0 +1,436 @@
+__author__ = 'aleaf'
+import os
+import re
+import numpy as np
+
+
+class DisFile(object):
+
+    def __init__(self, filename, namefile=None, model_ws=None):
+        """Lazy reader for a MODFLOW-2005 discretization (DIS) file.
+
+        Only the header information (dimensions, LAYCBD, DELR and DELC) is read up front.
+        For the top and bottom arrays, the location of the data is recorded, and each array
+        is read only when it is needed: binary arrays (OPEN/CLOSE or EXTERNAL files with a (BINARY) format)
+        are memory mapped, text arrays are parsed one block (layer) at a time, and constant arrays are never
+        expanded unless a full array is requested. Values for a list of cells (e.g. the SFR cells in Mat1)
+        can be gathered with top_at and elevations_at, without building the full (nlay+1, nrow, ncol)
+        array of elevations.
+
+        Parameters
+        ----------
+        filename : str
+            MODFLOW DIS file.
+        namefile : str, optional
+            MODFLOW name file, needed only to find the files for any arrays read with EXTERNAL
+            (by unit number).
+        model_ws : str, optional
+            Folder that OPEN/CLOSE and name file paths are relative to
+            (by default, the folder containing the DIS file).
+
+        Notes
+        -----
+        Arrays in the old fixed-format control records (LOCAT CNSTNT FMTIN) are only supported
+        if they are constant; files with other array layouts raise a ValueError
+        (in that case the DIS file can be loaded with flopy, and the arrays wrapped with DisFile.from_flopy).
+        """
+        self.filename = filename
+        self.model_ws = os.path.split(filename)[0] if model_ws is None else model_ws
+        self.units = _read_namefile_units(namefile, self.model_ws) if namefile is not None else {}
+        self._external_positions = {}
+        self._top = None
+        self._read_header()
+
+    @classmethod
+    def from_flopy(cls, dis):
+        """Make a DisFile from a flopy ModflowDis object (with the arrays in memory)."""
+        self = cls.__new__(cls)
+        self.filename = getattr(dis, 'fn_path', None)
+        self.model_ws = None
+        self.units = {}
+        self._external_positions = {}
+        self._top = None
+        self.nlay, self.nrow, self.ncol, self.nper = dis.nlay, dis.nrow, dis.ncol, dis.nper
+        self.itmuni, self.lenuni = dis.itmuni, dis.lenuni
+        self.laycbd = np.array(dis.laycbd.array, dtype=int)
+        self.delr = np.array(dis.delr.array, dtype=float)
+        self.delc = np.array(dis.delc.array, dtype=float)
+        self._top_record = _ArrayRecord('array', (self.nrow, self.ncol), array=dis.top.array)
+        botm = dis.botm.array
+        self._botm_records = [_ArrayRecord('array', (self.nrow, self.ncol), array=botm[i])
+                              for i in range(len(botm))]
+        return self
+
+    def __repr__(self):
+        return 'DisFile({}: {} layers, {} rows, {} columns)'.format(self.filename, self.nlay, self.nrow, self.ncol)
+
+    @property
+    def ncells(self):
+        """Number of cells in a layer."""
+        return self.nrow * self.ncol
+
+    @property
+    def top(self):
+        """Model top (nrow, ncol) array; read on first access, and kept
+        (a read-only memory map, for binary arrays)."""
+        if self._top is None:
+            self._top = self._top_record.read()
+        return self._top
+
+    def botm(self, layer):
+        """Bottom (nrow, ncol) array of a model layer (zero-based; Quasi-3D confining beds are skipped).
+        The array is read each time (or memory mapped), and isn't kept."""
+        return self._botm_records[self._botm_index[layer]].read()
+
+    @property
+    def _botm_index(self):
+        """Index of the bottom array for each model layer, skipping any confining beds."""
+        return np.arange(self.nlay) + np.concatenate(([0], np.cumsum(self.laycbd[:-1])))
+
+    @property
+    def elevations(self):
+        """(nlay+1, nrow, ncol) view of the top and layer bottoms, that reads the values
+        for the cells that are indexed (see ElevationGrid)."""
+        return ElevationGrid(self)
+
+    def top_at(self, nodes):
+        """Model top elevations at (one-based) cell numbers in the first layer."""
+        return self._top_record.values_at(self._flat_index(nodes), cached=self._top)
+
+    def elevations_at(self, layers, rows, columns):
+        """Elevations at cells, like elevs[layers, rows, columns] for the full (nlay+1, nrow, ncol)
+        array of top and bottom elevations (all zero-based; layer 0 is the model top, and layer k
+        the bottom of model layer k). Each top or bottom array is read once, and only the requested
+        values are kept."""
+        layers, rows, columns = np.broadcast_arrays(np.asarray(layers), np.asarray(rows), np.asarray(columns))
+        values = np.empty(layers.shape, dtype=float)
+        index = rows * self.ncol + columns
+        for k in np.unique(layers):
+            at_k = layers == k
+            if k == 0:
+                values[at_k] = self._top_record.values_at(index[at_k], cached=self._top)
+            else:
+                values[at_k] = self._botm_records[self._botm_index[k - 1]].values_at(index[at_k])
+        return values
+
+    def get_top(self):
+        """Copy of the model top array (e.g. for modification and writing a new DIS file)."""
+        return np.array(self.top, dtype=float)
+
+    def get_botm(self):
+        """(nlay + number of confining beds, nrow, ncol) array of all the bottom elevations in the file
+        (e.g. for modification and writing a new DIS file)."""
+        botm = np.empty((len(self._botm_records), self.nrow, self.ncol))
+        for i, record in enumerate(self._botm_records):
+            botm[i] = record.read()
+        return botm
+
+    def dense(self):
+        """Full (nlay+1, nrow, ncol) array of the top and layer bottoms (skipping any confining beds)."""
+        elevs = np.empty((self.nlay + 1, self.nrow, self.ncol))
+        elevs[0] = self.top
+        for k in range(self.nlay):
+            elevs[k + 1] = self.botm(k)
+        return elevs
+
+    def get_lrc(self, nodes):
+        """List of (layer, row, column) tuples for (one-based) cell numbers; all one-based."""
+        index = np.asarray(nodes, dtype=int) - 1
+        k, ij = np.divmod(index, self.ncells)
+        i, j = np.divmod(ij, self.ncol)
+        return list(zip((k + 1).tolist(), (i + 1).tolist(), (j + 1).tolist()))
+
+    def get_node_coordinates(self):
+        """Cell centroid y (by row) and x (by column) coordinates, in model units,
+        relative to the lower left corner of the grid."""
+        y = np.sum(self.delc) - (np.cumsum(self.delc) - 0.5 * self.delc)
+        x = np.cumsum(self.delr) - 0.5 * self.delr
+        return y, x
+
+    def _flat_index(self, nodes):
+        index = np.asarray(nodes, dtype=int) - 1
+        if len(index) > 0 and (index.min() < 0 or index.max() >= self.ncells):
+            raise ValueError('Cell numbers must be between 1 and {} (nrow * ncol)'.format(self.ncells))
+        return index
+
+    def _read_header(self):
+        with open(self.filename, 'rb') as src:
+            line = _next_line(src)
+            while line.startswith(b'#'):
+                line = _next_line(src)
+            items = line.split()
+            try:
+                self.nlay, self.nrow, self.ncol, self.nper = [int(v) for v in items[:4]]
+            except ValueError:
+                raise ValueError('Could not read the dimensions from {}:\n{}'.format(self.filename, line))
+            self.itmuni = int(items[4]) if len(items) > 4 else 4
+            self.lenuni = int(items[5]) if len(items) > 5 else 2
+
+            laycbd = []
+            while len(laycbd) < self.nlay:
+                laycbd += [int(v) for v in _next_line(src).split()]
+            self.laycbd = np.array(laycbd[:self.nlay])
+            self.laycbd[-1] = 0 # not allowed for the bottom layer
+
+            self.delr = self._read_record(src, (self.ncol,)).read().astype(float)
+            self.delc = self._read_record(src, (self.nrow,)).read().astype(float)
+            self._top_record = self._read_record(src, (self.nrow, self.ncol))
+            self._botm_records = [self._read_record(src, (self.nrow, self.ncol))
+                                  for i in range(self.nlay + np.sum(self.laycbd))]
+
+    def _read_record(self, src, shape):
+        """Read an array control record, and record where the array values are,
+        skipping over any values that follow in the DIS file."""
+        line = _next_line(src)
+        items = line.decode('ascii', 'replace').split()
+        keyword = items[0].upper() if len(items) > 0 else ''
+        if keyword == 'CONSTANT':
+            return _ArrayRecord('constant', shape, cnstnt=_float(items[1]))
+        elif keyword == 'INTERNAL':
+            cnstnt, fmtin = _float(items[1]), _item(items, 2, '(FREE)')
+            start = src.tell()
+            _skip_values(src, shape, fmtin)
+            return _ArrayRecord('text', shape, self.filename, start, src.tell(), cnstnt, fmtin)
+        elif keyword == 'OPEN/CLOSE':
+            filename = os.path.join(self.model_ws, items[1].strip('\'"'))
+            cnstnt, fmtin = _float(items[2]), _item(items, 3, '(FREE)')
+            return self._external_record(filename, shape, cnstnt, fmtin, start=0)
+        elif keyword == 'EXTERNAL':
+            unit = int(items[1])
+            if unit not in self.units:
+                raise ValueError('Array on unit {} in {}; a name file is needed to find it.'
+                                 .format(unit, self.filename))
+            cnstnt, fmtin = _float(items[2]), _item(items, 3, '(FREE)')
+            # reading continues where the last array on the same unit left off
+            filename = self.units[unit]
+            start = self._external_positions.get(filename, 0)
+            record = self._external_record(filename, shape, cnstnt, fmtin, start)
+            self._external_positions[filename] = record.end
+            return record
+        # fixed-format control record (I10, F10.0, A20, I10)
+        try:
+            locat = int(line[:10])
+            cnstnt = _float(line[10:20])
+        except ValueError:
+            raise ValueError('Could not read array control record in {}:\n{}'.format(self.filename, line))
+        if locat != 0:
+            raise ValueError('Fixed-format array control records are only supported for constants ({}:\n{})'
+                             .format(self.filename, line))
+        return _ArrayRecord('constant', shape, cnstnt=cnstnt)
+
+    def _external_record(self, filename, shape, cnstnt, fmtin, start):
+        if not os.path.isfile(filename):
+            raise IOError('Array file {} not found.'.format(filename))
+        if 'BINARY' in fmtin.upper():
+            # single or double precision, with a header record (KSTP, KPER, PERTIM, TOTIM, TEXT, NCOL, NROW, ILAY)
+            # (the header and values may differ in precision); a layout that ends the file is preferred
+            size = os.path.getsize(filename)
+            n = int(np.prod(shape))
+            layouts = []
+            for dtype, header in (np.float32, 44), (np.float64, 52), (np.float64, 44), (np.float32, 52):
+                end = start + header + n * np.dtype(dtype).itemsize
+                if end <= size and _binary_header_matches(filename, start + header - 12, shape):
+                    layouts.append((end != size, dtype, header, end))
+            if len(layouts) == 0:
+                raise ValueError('Could not find a {} binary array in {}'.format(shape, filename))
+            not_at_end, dtype, header, end = sorted(layouts, key=lambda l: l[0])[0]
+            return _ArrayRecord('binary', shape, filename, start + header, end, cnstnt, fmtin, dtype)
+        with open(filename, 'rb') as src:
+            src.seek(start)
+            _skip_values(src, shape, fmtin)
+            end = src.tell()
+        return _ArrayRecord('text', shape, filename, start, end, cnstnt, fmtin)
+
+
+class ElevationGrid(object):
+    """(nlay+1, nrow, ncol) view of the top and layer bottom elevations in a DisFile
+    (in place of a full elevs array). Indexing with a layer number returns that (nrow, ncol) array;
+    indexing with arrays of layers, rows and columns gathers the values for those cells only
+    (see DisFile.elevations_at). Any other indexing (or conversion with np.asarray) reads the full array."""
+
+    def __init__(self, dis):
+        self.dis = dis
+
+    @property
+    def shape(self):
+        return (self.dis.nlay + 1, self.dis.nrow, self.dis.ncol)
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return self.dis.nlay + 1
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.dis.top if key == 0 else self.dis.botm(key - 1)
+        if isinstance(key, tuple) and len(key) == 3 and \
+                all(np.issubdtype(np.asarray(k).dtype, np.integer) for k in key):
+            return self.dis.elevations_at(*key)
+        return self.dis.dense()[key]
+
+    def __array__(self, dtype=None, copy=None):
+        elevs = self.dis.dense()
+        return elevs if dtype is None else elevs.astype(dtype)
+
+
+class _ArrayRecord(object):
+    """Location and format of an array in a DIS (or external array) file."""
+
+    def __init__(self, kind, shape, filename=None, start=0, end=0, cnstnt=1., fmtin='', dtype=None, array=None):
+        self.kind = kind
+        self.shape = shape
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.cnstnt = cnstnt
+        self.fmtin = fmtin
+        self.dtype = dtype
+        self.array = array
+
+    @property
+    def multiplier(self):
+        # array values are multiplied by cnstnt, unless it is zero
+        return self.cnstnt if self.cnstnt != 0 else 1.
+
+    def read(self):
+        if self.kind == 'constant':
+            return np.full(self.shape, self.cnstnt)
+        elif self.kind == 'array':
+            return self.array
+        elif self.kind == 'binary':
+            values = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.start, shape=self.shape)
+            return values if self.multiplier == 1. else values * self.multiplier
+        values = _parse_values(self._read_text(), int(np.prod(self.shape)), self.fmtin, self.shape)
+        return values.reshape(self.shape) * self.multiplier
+
+    def values_at(self, index, cached=None):
+        """Values at flat (zero-based) indices into the array."""
+        if self.kind == 'constant':
+            return np.full(len(index), self.cnstnt)
+        values = self.read() if cached is None else cached
+        return np.asarray(values).ravel()[index].astype(float)
+
+    def _read_text(self):
+        with open(self.filename, 'rb') as src:
+            src.seek(self.start)
+            return src.read(self.end - self.start).decode('ascii', 'replace')
+
+
+def _next_line(src):
+    line = src.readline()
+    if len(line) == 0:
+        raise ValueError('Unexpected end of file in {}'.format(getattr(src, 'name', '')))
+    line = line.strip()
+    return line if len(line) > 0 else _next_line(src)
+
+
+def _float(text):
+    if isinstance(text, bytes):
+        text = text.decode('ascii')
+    return float(text.strip().replace('D', 'E').replace('d', 'e'))
+
+
+def _item(items, i, default):
+    return items[i] if len(items) > i else default
+
+
+def _values_per_line(fmtin):
+    """Number of values per line, and field width, from a Fortran format (e.g. (10E15.6));
+    None for free format."""
+    match = re.match(r'\(\s*(\d+)\s*[A-Z]+\s*(\d+)', fmtin.upper())
+    if match is None:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+
+def _skip_values(src, shape, fmtin):
+    """Move the file position past the values of an array."""
+    per_line, width = _values_per_line(fmtin)
+    n = int(np.prod(shape))
+    if per_line is not None:
+        # each row of a 2D array starts on a new line
+        nrow, ncol = shape if len(shape) == 2 else (1, shape[0])
+        _skip_lines(src, nrow * -(-ncol // per_line))
+        return
+    count = 0
+    while count < n:
+        line = src.readline()
+        if len(line) == 0:
+            raise ValueError('Unexpected end of file in {}'.format(getattr(src, 'name', '')))
+        for item in line.split():
+            count += int(item.split(b'*')[0]) if b'*' in item else 1
+
+
+def _skip_lines(src, nlines, chunksize=2**20):
+    """Move the file position past the next nlines lines, reading in chunks."""
+    position = src.tell()
+    while nlines > 0:
+        chunk = src.read(chunksize)
+        if len(chunk) == 0:
+            raise ValueError('Unexpected end of file in {}'.format(getattr(src, 'name', '')))
+        n = chunk.count(b'\n')
+        if n < nlines:
+            nlines -= n
+            position += len(chunk)
+            continue
+        end = -1
+        for i in range(nlines):
+            end = chunk.index(b'\n', end + 1)
+        position += end + 1
+        nlines = 0
+    src.seek(position)
+
+
+def _parse_values(text, n, fmtin, shape):
+    """Parse n values from a block of text in free or fixed format."""
+    text = text.replace('D', 'E').replace('d', 'e')
+    if '*' not in text:
+        try:
+            values = np.fromstring(text, sep=' ')
+        except ValueError:
+            values = [] # fixed width fields without spaces between them (below)
+        if len(values) == n:
+            return values
+    items = []
+    for item in text.split():
+        if '*' in item:
+            repeat, value = item.split('*')
+            items += [value] * int(repeat)
+        else:
+            items.append(item)
+    if len(items) == n:
+        return np.array(items, dtype=float)
+    # fixed width fields without spaces between them
+    per_line, width = _values_per_line(fmtin)
+    if width is None:
+        raise ValueError('Could not read {} values in format {}'.format(n, fmtin))
+    items = [line[i:i + width] for line in text.splitlines() for i in range(0, len(line.rstrip()), width)]
+    return np.array(items[:n], dtype=float)
+
+
+def _binary_header_matches(filename, offset, shape):
+    """Check the NCOL and NROW values at the end of a binary array header."""
+    nrow, ncol = shape if len(shape) == 2 else (1, shape[0])
+    with open(filename, 'rb') as src:
+        src.seek(offset)
+        header = np.fromfile(src, dtype=np.int32, count=2)
+    return len(header) == 2 and header[0] == ncol and header[1] == nrow
+
+
+def _read_namefile_units(namefile, model_ws):
+    """Files by unit number, from a MODFLOW name file."""
+    if not os.path.isfile(namefile):
+        namefile = os.path.join(model_ws, namefile)
+    units = {}
+    with open(namefile) as src:
+        for line in src:
+            items = line.split()
+            if len(items) < 3 or items[0].startswith('#'):
+                continue
+            try:
+                units[int(items[1])] = os.path.join(model_ws, items[2].strip('\'"'))
+            except ValueError:
+                continue
+    return units
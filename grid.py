@@ -0,0 +1,695 @@
+__author__ = 'aleaf'
+import os
+import numpy as np
+from shapely.geometry import LineString, Polygon
+
+
+class StructuredGrid(object):
+
+    def __init__(self, delr, delc, xul=0., yul=0., rot=0., length_mult=1.):
+        """Regular (possibly rotated) MODFLOW grid, defined by row and column spacings.
+        Flowlines can be broken into reaches by walking them across the grid lines,
+        so that the grid never has to be represented as a set of cell polygons.
+
+        Parameters
+        ----------
+        delr : 1-D array
+            Cell widths along each row (one value for each column), in model units.
+        delc : 1-D array
+            Cell widths along each column (one value for each row), in model units.
+        xul : float
+            x coordinate of upper left corner of grid, in GIS units
+        yul : float
+            y coordinate of upper left corner of grid, in GIS units
+        rot : float
+            Grid rotation, in degrees counter-clockwise about the upper left corner.
+        length_mult : float
+            Multiplier to convert delr and delc from model units to GIS units.
+        """
+        self.delr = np.atleast_1d(np.array(delr, dtype=float)) * length_mult
+        self.delc = np.atleast_1d(np.array(delc, dtype=float)) * length_mult
+        self.nrow = len(self.delc)
+        self.ncol = len(self.delr)
+        self.xul = float(xul)
+        self.yul = float(yul)
+        self.rot = float(rot)
+        self._cos = np.cos(np.radians(self.rot))
+        self._sin = np.sin(np.radians(self.rot))
+
+        # cell edges in local grid coordinates;
+        # u is distance along the rows from the left edge of the grid,
+        # v is distance along the columns down from the top edge of the grid
+        self.xedges = np.concatenate([[0.], np.cumsum(self.delr)])
+        self.yedges = np.concatenate([[0.], np.cumsum(self.delc)])
+
+    @classmethod
+    def from_dis(cls, mfdis, xul=0., yul=0., rot=0., length_mult=1.):
+        """Create a StructuredGrid from the row and column spacings in a MODFLOW DIS file (using flopy).
+        """
+        import flopy
+        print('reading grid spacing from {}...'.format(mfdis))
+        try:
+            m = flopy.modflow.Modflow(model_ws=os.path.split(mfdis)[0])
+            dis = flopy.modflow.ModflowDis.load(mfdis, m)
+        except:
+            #  Modflow.load() may load dis successfully, even if ModflowDis.load() fails
+            model_ws, mfnam = os.path.split(mfdis)
+            m = flopy.modflow.Modflow.load(mfnam[:-4] + '.nam', model_ws=model_ws, load_only='dis')
+            dis = m.dis
+        return cls(dis.delr.array, dis.delc.array, xul=xul, yul=yul, rot=rot, length_mult=length_mult)
+
+    @property
+    def ncells(self):
+        return self.nrow * self.ncol
+
+    @property
+    def corners(self):
+        """Coordinates of the upper left, upper right, lower right and lower left grid corners."""
+        u = np.array([0., self.xedges[-1], self.xedges[-1], 0.])
+        v = np.array([0., 0., self.yedges[-1], self.yedges[-1]])
+        return list(zip(*self.to_world(u, v)))
+
+    @property
+    def bounds(self):
+        """Bounding box of the grid (xmin, ymin, xmax, ymax), in GIS coordinates."""
+        x, y = np.array(self.corners).T
+        return x.min(), y.min(), x.max(), y.max()
+
+    @property
+    def outline(self):
+        """Polygon of the grid perimeter."""
+        return Polygon(self.corners)
+
+    def to_local(self, x, y):
+        """Convert GIS coordinates to local grid coordinates (u, v),
+        measured from the upper left corner along the rows and down the columns."""
+        dx = np.asarray(x, dtype=float) - self.xul
+        dy = np.asarray(y, dtype=float) - self.yul
+        u = dx * self._cos + dy * self._sin
+        v = dx * self._sin - dy * self._cos
+        return u, v
+
+    def to_world(self, u, v):
+        """Convert local grid coordinates (u, v) to GIS coordinates."""
+        u = np.asarray(u, dtype=float)
+        v = np.asarray(v, dtype=float)
+        x = self.xul + u * self._cos + v * self._sin
+        y = self.yul + u * self._sin - v * self._cos
+        return x, y
+
+    def get_node(self, i, j):
+        """Node numbers (one-based) from zero-based row and column indices."""
+        return np.asarray(i) * self.ncol + np.asarray(j) + 1
+
+    def get_rc(self, node):
+        """Zero-based row and column indices from (one-based) node numbers."""
+        return np.divmod(np.asarray(node) - 1, self.ncol)
+
+    def cell_polygon(self, node):
+        """Polygon for a (one-based) node number."""
+        i, j = self.get_rc(node)
+        u = self.xedges[[j, j + 1, j + 1, j]]
+        v = self.yedges[[i, i, i + 1, i + 1]]
+        return Polygon(list(zip(*self.to_world(u, v))))
+
+    def cell_centroids(self, nodes=None):
+        """(n, 2) array of cell centroids for a sequence of (one-based) node numbers (default all cells)."""
+        i, j = self._cells(nodes)
+        u = 0.5 * (self.xedges[j] + self.xedges[j + 1])
+        v = 0.5 * (self.yedges[i] + self.yedges[i + 1])
+        return np.column_stack(self.to_world(u, v))
+
+    def cell_corners(self, nodes=None):
+        """(n, 4, 2) array of the upper left, upper right, lower right and lower left corners
+        of the cells for a sequence of (one-based) node numbers (default all cells)."""
+        i, j = self._cells(nodes)
+        u = np.column_stack([self.xedges[j], self.xedges[j + 1], self.xedges[j + 1], self.xedges[j]])
+        v = np.column_stack([self.yedges[i], self.yedges[i], self.yedges[i + 1], self.yedges[i + 1]])
+        return np.stack(self.to_world(u, v), axis=-1)
+
+    def cell_polygons(self, nodes=None):
+        """List of Polygons for a sequence of (one-based) node numbers (default all cells)."""
+        corners = self.cell_corners(nodes)
+        try:
+            from shapely import polygons # shapely >= 2
+        except ImportError:
+            return [Polygon(c) for c in corners]
+        return list(polygons(corners))
+
+    def _cells(self, nodes):
+        if nodes is None:
+            return np.divmod(np.arange(self.ncells), self.ncol)
+        return self.get_rc(np.asarray(nodes, dtype=int))
+
+    def intersect(self, line, eps=1e-9):
+        """Break a LineString into reaches at the grid cell boundaries.
+
+        All crossings of the line with the row and column edges are located analytically
+        (grid-walking, as in the Amanatides-Woo traversal), so that only the cells
+        actually crossed by the line are visited. Consecutive pieces in the same cell
+        are merged; a line that leaves a cell and re-enters it later makes a new reach.
+        Parts of the line outside of the grid are dropped.
+
+        Parameters
+        ----------
+        line : LineString
+        eps : float
+            Crossings closer than this (as a fraction of a line segment) are considered coincident.
+
+        Returns
+        -------
+        geoms : list of LineStrings
+            Reach geometries, in order along the line.
+        nodes : list of ints
+            One-based node number for each reach.
+        """
+        xy = np.array(line.coords)[:, :2]
+        if len(xy) < 2:
+            return [], []
+        u, v = self.to_local(xy[:, 0], xy[:, 1])
+        nseg = len(u) - 1
+        du, dv = np.diff(u), np.diff(v)
+
+        # parameter (segment number + fraction along segment) of each vertex and edge crossing
+        s = [np.arange(nseg + 1, dtype=float)]
+        for c, d, edges in [(u, du, self.xedges), (v, dv, self.yedges)]:
+            lo = np.minimum(c[:-1], c[1:])
+            hi = np.maximum(c[:-1], c[1:])
+            first = np.searchsorted(edges, lo, side='right') # first edge > lo
+            last = np.searchsorted(edges, hi, side='left') # first edge >= hi
+            ncross = np.maximum(last - first, 0)
+            if ncross.sum() == 0:
+                continue
+            seg = np.repeat(np.arange(nseg), ncross)
+            offsets = np.arange(len(seg)) - np.repeat(np.cumsum(ncross) - ncross, ncross)
+            e = edges[first[seg] + offsets]
+            s.append(seg + (e - c[:-1][seg]) / d[seg])
+        s = np.sort(np.concatenate(s))
+
+        # drop coincident crossings (e.g. at cell corners), but keep the end of the line
+        keep = np.ones(len(s), dtype=bool)
+        close = np.diff(s) <= eps
+        keep[1:] = ~close
+        if close[-1]:
+            keep[-1] = True
+            keep[-2] = False
+        s = s[keep]
+
+        k = np.minimum(np.floor(s).astype(int), nseg - 1)
+        t = s - k
+        pu = u[:-1][k] + t * du[k]
+        pv = v[:-1][k] + t * dv[k]
+
+        # locate the cell containing the midpoint of each piece
+        mu = 0.5 * (pu[:-1] + pu[1:])
+        mv = 0.5 * (pv[:-1] + pv[1:])
+        j = np.searchsorted(self.xedges, mu, side='right') - 1
+        i = np.searchsorted(self.yedges, mv, side='right') - 1
+        inside = (i >= 0) & (i < self.nrow) & (j >= 0) & (j < self.ncol)
+        cells = np.where(inside, i * self.ncol + j, -1)
+
+        # merge consecutive pieces in the same cell into reaches
+        new_cell = np.ones(len(cells), dtype=bool)
+        new_cell[1:] = cells[1:] != cells[:-1]
+        starts = np.flatnonzero(new_cell & inside)
+        run_ends = np.append(np.flatnonzero(new_cell)[1:], len(cells))
+        ends = run_ends[np.searchsorted(np.flatnonzero(new_cell), starts)]
+
+        px, py = self.to_world(pu, pv)
+        coords = np.column_stack([px, py])
+        geoms = [LineString(coords[st:en + 1]) for st, en in zip(starts, ends)]
+        nodes = (cells[starts] + 1).tolist()
+        return geoms, nodes
+
+    def get_domain(self, ibound=None):
+        """Polygon of the model domain.
+
+        Parameters
+        ----------
+        ibound : 2-D array, optional
+            (nrow, ncol) array (e.g. IBOUND or IDOMAIN for layer 1); cells with non-zero values are active.
+            If None, the grid outline is returned.
+
+        Returns
+        -------
+        domain : Polygon or MultiPolygon
+        """
+        if ibound is None:
+            return self.outline
+        active = np.asarray(ibound).reshape(self.nrow, self.ncol) != 0
+        # pad with inactive cells, so that the edges of the grid are boundaries
+        padded = np.zeros((self.nrow + 2, self.ncol + 2), dtype=bool)
+        padded[1:-1, 1:-1] = active
+        starts, ends = [], []
+
+        # horizontal edges, at grid line i between rows i-1 (above) and i (below)
+        above, below = padded[:-1, 1:-1], padded[1:, 1:-1]
+        i, j = np.nonzero(above & ~below) # bottom of active cell; traverse left to right
+        starts.append(np.column_stack([i, j])); ends.append(np.column_stack([i, j + 1]))
+        i, j = np.nonzero(~above & below) # top of active cell; traverse right to left
+        starts.append(np.column_stack([i, j + 1])); ends.append(np.column_stack([i, j]))
+
+        # vertical edges, at grid line j between columns j-1 (left) and j (right)
+        left, right = padded[1:-1, :-1], padded[1:-1, 1:]
+        i, j = np.nonzero(left & ~right) # right side of active cell; traverse bottom to top
+        starts.append(np.column_stack([i + 1, j])); ends.append(np.column_stack([i, j]))
+        i, j = np.nonzero(~left & right) # left side of active cell; traverse top to bottom
+        starts.append(np.column_stack([i, j])); ends.append(np.column_stack([i + 1, j]))
+
+        starts, ends = np.vstack(starts), np.vstack(ends)
+        # number the vertices, and convert from grid line indices to GIS coordinates
+        vertices = np.vstack([starts, ends])
+        first, ids = _unique_rows(vertices)
+        vertices = vertices[first]
+        xy = np.column_stack(self.to_world(self.xedges[vertices[:, 1]], self.yedges[vertices[:, 0]]))
+        rings = _trace_rings(ids[:len(starts)].tolist(), ids[len(starts):].tolist(), xy)
+        return _polygons_from_rings([[tuple(xy[v]) for v in r] for r in rings])
+
+
+class VertexGrid(object):
+
+    def __init__(self, vertices, iverts, xoff=0., yoff=0., rot=0., length_mult=1.):
+        """Unstructured grid of polygonal cells, defined by cell vertices
+        (e.g. a quadtree-refined grid from the MODFLOW 6 DISV package).
+
+        The cell vertices are stored in flat arrays, so that cell geometries (polygons, centroids,
+        bounds) can be built with array operations for any set of cells. Cells are located with
+        a uniform bin index (a StructuredGrid of bins, with the cells overlapping each bin),
+        so that only the cells in the bins crossed by a flowline are intersected with it.
+
+        Parameters
+        ----------
+        vertices : 2-D array
+            (number of vertices, 2) array of vertex x, y coordinates, in model units
+            relative to the model origin.
+        iverts : list of lists
+            Zero-based vertex numbers for each cell (in order around the cell).
+        xoff : float
+            x coordinate of the model origin (e.g. DISV xorigin), in GIS units
+        yoff : float
+            y coordinate of the model origin (e.g. DISV yorigin), in GIS units
+        rot : float
+            Grid rotation, in degrees counter-clockwise about the model origin.
+        length_mult : float
+            Multiplier to convert the vertex coordinates from model units to GIS units.
+        """
+        v = np.asarray(vertices, dtype=float)[:, :2] * length_mult
+        cos, sin = np.cos(np.radians(rot)), np.sin(np.radians(rot))
+        self.vertices = np.column_stack([xoff + v[:, 0] * cos - v[:, 1] * sin,
+                                         yoff + v[:, 0] * sin + v[:, 1] * cos])
+        # drop any closing vertices (repeats of the first vertex)
+        iverts = [list(iv[:-1]) if len(iv) > 1 and iv[0] == iv[-1] else list(iv) for iv in iverts]
+        self.ncells = len(iverts)
+        counts = np.array([len(iv) for iv in iverts], dtype=int)
+        self._offsets = np.concatenate([[0], np.cumsum(counts)])
+        self._iverts = np.concatenate([np.asarray(iv, dtype=int) for iv in iverts])
+        # position of the next vertex around each cell, in the flat vertex array
+        self._next = np.arange(len(self._iverts)) + 1
+        self._next[self._offsets[1:] - 1] = self._offsets[:-1]
+
+        x, y = self.vertices[self._iverts].T
+        start = self._offsets[:-1]
+        self.cell_bounds = np.column_stack([np.minimum.reduceat(x, start), np.minimum.reduceat(y, start),
+                                            np.maximum.reduceat(x, start), np.maximum.reduceat(y, start)])
+        self._build_index()
+
+    @classmethod
+    def from_disv(cls, vertices, cell2d, xoff=0., yoff=0., rot=0., length_mult=1.):
+        """Create a VertexGrid from MODFLOW 6 DISV vertices and cell2d records.
+
+        Parameters
+        ----------
+        vertices : list of (iv, xv, yv) records
+            Vertex numbers (zero-based) and coordinates.
+        cell2d : list of (icell2d, xc, yc, ncvert, icvert_1, ..., icvert_n) records
+            Cell numbers (zero-based), centers, and (zero-based) vertex numbers for each cell.
+        """
+        vertices = sorted(vertices, key=lambda r: r[0])
+        xy = np.array([r[1:3] for r in vertices], dtype=float)
+        cell2d = sorted(cell2d, key=lambda r: r[0])
+        iverts = [list(r[4:4 + int(r[3])]) for r in cell2d]
+        return cls(xy, iverts, xoff=xoff, yoff=yoff, rot=rot, length_mult=length_mult)
+
+    @property
+    def bounds(self):
+        """Bounding box of the grid (xmin, ymin, xmax, ymax), in GIS coordinates."""
+        return tuple(np.append(self.cell_bounds[:, :2].min(axis=0), self.cell_bounds[:, 2:].max(axis=0)))
+
+    @property
+    def centroids(self):
+        """(ncells, 2) array of cell centroids."""
+        cell = np.repeat(np.arange(self.ncells), np.diff(self._offsets))
+        # coordinates relative to the first vertex of each cell (for precision)
+        origin = self.vertices[self._iverts[self._offsets[:-1]]]
+        x0, y0 = (self.vertices[self._iverts] - origin[cell]).T
+        x1, y1 = (self.vertices[self._iverts[self._next]] - origin[cell]).T
+        cross = x0 * y1 - x1 * y0
+        area = np.bincount(cell, weights=cross, minlength=self.ncells) / 2.
+        cx = np.bincount(cell, weights=(x0 + x1) * cross, minlength=self.ncells) / (6. * area)
+        cy = np.bincount(cell, weights=(y0 + y1) * cross, minlength=self.ncells) / (6. * area)
+        return origin + np.column_stack([cx, cy])
+
+    def cell_polygon(self, node):
+        """Polygon for a (one-based) node number."""
+        return Polygon(self.vertices[self._iverts[self._offsets[node - 1]:self._offsets[node]]])
+
+    def cell_polygons(self, nodes=None):
+        """List of Polygons for a sequence of (one-based) node numbers (default all cells)."""
+        cells = np.arange(self.ncells) if nodes is None else np.asarray(nodes, dtype=int) - 1
+        counts = np.diff(self._offsets)[cells]
+        positions = _expand(self._offsets, cells)
+        coords = self.vertices[self._iverts[positions]]
+        try:
+            from shapely import linearrings, polygons # shapely >= 2
+        except ImportError:
+            ends = np.cumsum(counts)
+            return [Polygon(coords[e - n:e]) for n, e in zip(counts, ends)]
+        rings = linearrings(coords, indices=np.repeat(np.arange(len(cells)), counts))
+        return list(polygons(rings))
+
+    def _build_index(self, cells_per_bin=4):
+        """Bin the cells into a regular grid of (square) bins, each about the size of cells_per_bin cells."""
+        x0, y0, x1, y1 = self.bounds
+        widths = self.cell_bounds[:, 2:] - self.cell_bounds[:, :2]
+        size = np.sqrt(cells_per_bin * np.median(widths[:, 0] * widths[:, 1]))
+        # limit the number of bins to a few times the number of cells
+        size = max(size, np.sqrt((x1 - x0) * (y1 - y0) / (4. * self.ncells)))
+        nrow = max(int(np.ceil((y1 - y0) / size)), 1)
+        ncol = max(int(np.ceil((x1 - x0) / size)), 1)
+        self._bins = StructuredGrid(np.ones(ncol) * size, np.ones(nrow) * size, xul=x0, yul=y1)
+
+        # rows and columns of bins overlapped by the bounding box of each cell
+        j0, i0 = self._bin_rc(self.cell_bounds[:, 0], self.cell_bounds[:, 3])
+        j1, i1 = self._bin_rc(self.cell_bounds[:, 2], self.cell_bounds[:, 1])
+        nj, ni = j1 - j0 + 1, i1 - i0 + 1
+        counts = ni * nj
+        cell = np.repeat(np.arange(self.ncells), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i = i0[cell] + k // nj[cell]
+        j = j0[cell] + k % nj[cell]
+        bins = i * ncol + j
+        order = np.argsort(bins, kind='mergesort')
+        self._bin_cells = cell[order]
+        self._bin_ptr = np.searchsorted(bins[order], np.arange(nrow * ncol + 1))
+
+    def _bin_rc(self, x, y):
+        """Zero-based bin columns and rows for x, y coordinates (clipped to the bins)."""
+        u, v = self._bins.to_local(x, y)
+        j = np.clip(np.searchsorted(self._bins.xedges, u, side='right') - 1, 0, self._bins.ncol - 1)
+        i = np.clip(np.searchsorted(self._bins.yedges, v, side='right') - 1, 0, self._bins.nrow - 1)
+        return j, i
+
+    def locate(self, x, y):
+        """Locate points in the grid.
+
+        Parameters
+        ----------
+        x, y : 1-D arrays
+            Point coordinates (GIS units).
+
+        Returns
+        -------
+        nodes : 1-D array of ints
+            One-based node number of the cell containing each point (0 for points outside of the grid).
+            Points on a boundary between cells are assigned to the lowest node number.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        j, i = self._bin_rc(x, y)
+        bins = i * self._bins.ncol + j
+        # candidate (point, cell) pairs
+        point = np.repeat(np.arange(len(x)), np.diff(self._bin_ptr)[bins])
+        cell = self._bin_cells[_expand(self._bin_ptr, bins)]
+        b = self.cell_bounds[cell]
+        px, py = x[point], y[point]
+        ok = (px >= b[:, 0]) & (px <= b[:, 2]) & (py >= b[:, 1]) & (py <= b[:, 3])
+        point, cell, px, py = point[ok], cell[ok], px[ok], py[ok]
+
+        # ray-casting test against each edge of the candidate cells
+        counts = np.diff(self._offsets)[cell]
+        pair = np.repeat(np.arange(len(cell)), counts)
+        k = _expand(self._offsets, cell)
+        xa, ya = self.vertices[self._iverts[k]].T
+        xb, yb = self.vertices[self._iverts[self._next[k]]].T
+        qx, qy = px[pair], py[pair]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            crosses = ((ya > qy) != (yb > qy)) & (qx < (xb - xa) * (qy - ya) / (yb - ya) + xa)
+        on_edge = _on_segment(qx, qy, xa, ya, xb, yb)
+        inside = (np.bincount(pair, weights=crosses, minlength=len(cell)) % 2 == 1) | \
+                 (np.bincount(pair, weights=on_edge, minlength=len(cell)) > 0)
+
+        nodes = np.zeros(len(x), dtype=int)
+        point, cell = point[inside], cell[inside]
+        order = np.lexsort([-cell, point]) # last assignment (lowest cell) wins
+        nodes[point[order]] = cell[order] + 1
+        return nodes
+
+    def intersect(self, line):
+        """Break a LineString into reaches at the grid cell boundaries.
+
+        Only the cells overlapping the bins crossed by the line are intersected with it.
+        The reaches are ordered by the positions of their midpoints along the line.
+
+        Parameters
+        ----------
+        line : LineString
+
+        Returns
+        -------
+        geoms : list of LineStrings
+            Reach geometries, in order along the line.
+        nodes : list of ints
+            One-based node number for each reach.
+        """
+        bins = np.unique(np.array(self._bins.intersect(line)[1], dtype=int) - 1)
+        if len(bins) == 0:
+            return [], []
+        cells = np.unique(self._bin_cells[_expand(self._bin_ptr, bins)])
+        x0, y0, x1, y1 = line.bounds
+        b = self.cell_bounds[cells]
+        cells = cells[(b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)]
+
+        polygons = self.cell_polygons(cells + 1)
+        try:
+            from shapely import intersection # shapely >= 2 (vectorized)
+            pieces = intersection(line, np.array(polygons, dtype=object))
+        except ImportError:
+            pieces = [line.intersection(p) for p in polygons]
+        geoms, nodes = [], []
+        for c, g in zip(cells, pieces):
+            parts = [g] if g.geom_type == 'LineString' else getattr(g, 'geoms', [])
+            parts = [p for p in parts if p.geom_type == 'LineString' and p.length > 0]
+            geoms += parts
+            nodes += [int(c) + 1] * len(parts)
+        position = [line.project(g.interpolate(0.5, normalized=True)) for g in geoms]
+        order = np.argsort(position, kind='mergesort')
+        return [geoms[i] for i in order], [nodes[i] for i in order]
+
+    def get_domain(self, ibound=None):
+        """Polygon of the model domain.
+
+        Parameters
+        ----------
+        ibound : 1-D array, optional
+            (ncells) array (e.g. IDOMAIN for layer 1); cells with non-zero values are active.
+            If None, all cells are included.
+
+        Returns
+        -------
+        domain : Polygon or MultiPolygon
+        """
+        nodes = np.arange(1, self.ncells + 1)
+        if ibound is not None:
+            nodes = nodes[np.asarray(ibound).ravel() != 0]
+        return domain_from_cells(self.cell_polygons(nodes))
+
+
+def _expand(ptr, idx):
+    """Positions ptr[i]:ptr[i+1] for each i in idx, concatenated (for CSR lookups)."""
+    counts = ptr[idx + 1] - ptr[idx]
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - ptr[idx], counts)
+
+
+def _on_segment(px, py, xa, ya, xb, yb, tol=1e-9):
+    """True for points that lie on the line segments from (xa, ya) to (xb, yb)."""
+    dx, dy = xb - xa, yb - ya
+    length2 = dx**2 + dy**2
+    cross = np.abs(dx * (py - ya) - dy * (px - xa)) # distance from the line * segment length
+    dot = (px - xa) * dx + (py - ya) * dy
+    return (cross <= tol * length2) & (dot >= 0) & (dot <= length2)
+
+
+def domain_from_cells(cell_geoms, tol=0.001):
+    """Polygon of the area covered by a set of grid cell polygons (e.g. from a grid shapefile),
+    made by tracing the cell edges that are not shared with another cell,
+    instead of performing a union of all of the cell geometries.
+
+    Cell vertices within tol of each other are considered coincident.
+    Where cells do not share complete edges (e.g. at hanging nodes in a quadtree grid),
+    the unmatched edges cancel out along the shared cell boundary.
+    If the traced polygon is not valid or does not match the total cell area
+    (e.g. if cells overlap), the union of the buffered cells is returned instead.
+
+    Parameters
+    ----------
+    cell_geoms : list of Polygons
+    tol : float
+
+    Returns
+    -------
+    domain : Polygon or MultiPolygon
+    """
+    total_area = 0.
+    starts, ends = [], []
+    for g in cell_geoms:
+        xy = np.array(g.exterior.coords)[:, :2]
+        area = 0.5 * np.sum(xy[:-1, 0] * xy[1:, 1] - xy[1:, 0] * xy[:-1, 1])
+        if area < 0: # orient the exterior counter-clockwise
+            xy = xy[::-1]
+        total_area += abs(area)
+        starts.append(xy[:-1])
+        ends.append(xy[1:])
+    starts, ends = np.vstack(starts), np.vstack(ends)
+
+    # vertex ids, with vertices within tol considered coincident
+    keys = np.round(np.vstack([starts, ends]) / tol).astype(np.int64)
+    first, ids = _unique_rows(keys)
+    xy = np.vstack([starts, ends])[first]
+    a, b = ids[:len(starts)], ids[len(starts):]
+    a, b = a[a != b], b[a != b]
+
+    # edges shared by two cells (traversed in opposite directions) are interior;
+    # edges that only occur once are on the boundary
+    undirected = np.column_stack([np.minimum(a, b), np.maximum(a, b)])
+    _, inverse = _unique_rows(undirected)
+    boundary = np.bincount(inverse)[inverse] == 1
+    if boundary.sum() > 0:
+        rings = _trace_rings(a[boundary].tolist(), b[boundary].tolist(), xy)
+        rings = [[tuple(xy[v]) for v in r] for r in rings]
+        domain = _polygons_from_rings(rings)
+        if domain.is_valid and abs(domain.area - total_area) <= 1e-6 * total_area:
+            return domain
+    print('cell edges could not be traced; ' \
+          'setting domain from unary union of grid cell geometries...')
+    from shapely.ops import unary_union
+    return unary_union([g.buffer(tol) for g in cell_geoms])
+
+
+def _unique_rows(a):
+    """Unique rows of a 2-column integer array.
+
+    Returns
+    -------
+    first : 1-D array
+        Index of the first occurrence of each unique row.
+    inverse : 1-D array
+        Unique row number for each row of a.
+    """
+    order = np.lexsort((a[:, 1], a[:, 0]))
+    a_sorted = a[order]
+    new = np.ones(len(a), dtype=bool)
+    new[1:] = np.any(a_sorted[1:] != a_sorted[:-1], axis=1)
+    inverse = np.empty(len(a), dtype=int)
+    inverse[order] = np.cumsum(new) - 1
+    return order[new], inverse
+
+
+def _trace_rings(starts, ends, xy):
+    """Chain directed boundary edges (with the domain on the left) into closed rings.
+    Where more than one edge leaves a vertex (e.g. where active cells only touch at a corner),
+    the sharpest left turn is taken, so that the rings don't cross.
+
+    Parameters
+    ----------
+    starts, ends : lists of ints
+        Vertex numbers at the start and end of each edge.
+    xy : 2-D array
+        Coordinates of each vertex number.
+
+    Returns
+    -------
+    rings : list of lists of ints
+        Vertex numbers for each closed ring, with collinear vertices removed.
+    """
+    outgoing = {}
+    for a, b in zip(starts, ends):
+        outgoing.setdefault(a, []).append(b)
+    rings = []
+    while len(outgoing) > 0:
+        start = next(iter(outgoing))
+        ring = [start]
+        current = start
+        previous = None
+        while True:
+            options = outgoing[current]
+            if len(options) == 1 or previous is None:
+                nxt = options.pop(0)
+            else:
+                d_in = xy[current] - xy[previous]
+                d_out = xy[options] - xy[current]
+                turns = np.arctan2(d_in[0] * d_out[:, 1] - d_in[1] * d_out[:, 0], d_out.dot(d_in))
+                nxt = options.pop(int(np.argmax(turns)))
+            if len(options) == 0:
+                del outgoing[current]
+            previous, current = current, nxt
+            ring.append(current)
+            if current == start:
+                break
+        rings += [_remove_collinear(loop, xy) for loop in _split_loops(ring)]
+    return rings
+
+
+def _split_loops(ring):
+    """Split a closed ring that touches itself at a vertex into simple closed loops."""
+    loops = []
+    stack = []
+    position = {}
+    for v in ring:
+        if v in position:
+            k = position[v]
+            loop = stack[k:] + [v]
+            for u in stack[k + 1:]:
+                del position[u]
+            stack = stack[:k + 1]
+            loops.append(loop)
+        else:
+            position[v] = len(stack)
+            stack.append(v)
+    return loops
+
+
+def _remove_collinear(ring, xy, tol=1e-9):
+    """Remove vertices along straight lines from a closed ring of vertex numbers."""
+    ring = np.array(ring[:-1])
+    v = xy[ring]
+    prev, nxt = np.roll(v, 1, axis=0), np.roll(v, -1, axis=0)
+    d1, d2 = v - prev, nxt - v
+    cross = d1[:, 0] * d2[:, 1] - d1[:, 1] * d2[:, 0]
+    scale = np.sqrt((d1**2).sum(axis=1) * (d2**2).sum(axis=1))
+    keep = ring[np.abs(cross) > tol * scale].tolist()
+    return keep + keep[:1]
+
+
+def _polygons_from_rings(rings):
+    """Make a Polygon or MultiPolygon from traced rings;
+    counter-clockwise rings are exteriors, clockwise rings are holes."""
+    from shapely.geometry import MultiPolygon, LinearRing
+
+    exteriors, holes = [], []
+    for r in rings:
+        if len(r) < 4:
+            continue
+        (exteriors if LinearRing(r).is_ccw else holes).append(r)
+    polygons = [Polygon(e) for e in exteriors]
+    interiors = [[] for e in exteriors]
+    for h in holes:
+        # assign each hole to the smallest exterior containing it
+        ring = LinearRing(h)
+        containing = [k for k, e in enumerate(polygons) if e.covers(ring)]
+        if len(containing) > 0:
+            k = min(containing, key=lambda k: polygons[k].area)
+            interiors[k].append(h)
+    polygons = [Polygon(e, interiors[k]) for k, e in enumerate(exteriors)]
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons)
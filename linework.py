@@ -0,0 +1,150 @@
+__author__ = 'aleaf'
+import numpy as np
+from shapely.geometry import LineString
+
+
+class LineArray(object):
+
+    def __init__(self, coords, offsets):
+        """Compact storage for a sequence of (2-D) LineStrings, such as SFR reach geometries.
+
+        The vertices of all of the lines are stored in one flat coordinate array,
+        with the start of each line given by an array of offsets, so that there is no
+        per-line object overhead, and per-line metrics (lengths, end points, midpoints)
+        can be computed with array operations. Shapely LineStrings are only created
+        when individual lines are accessed (or with to_geoms).
+
+        Parameters
+        ----------
+        coords : 2-D array
+            (n vertices, 2) array of x, y coordinates for all of the lines.
+        offsets : 1-D array
+            (n lines + 1) array of the positions in coords where each line starts;
+            the last value is the total number of vertices.
+        """
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_geoms(cls, geoms):
+        """Make a LineArray from a sequence of shapely LineStrings (z values are dropped)."""
+        geoms = list(geoms)
+        if len(geoms) == 0:
+            return cls(np.zeros((0, 2)), [0])
+        try:
+            from shapely import get_coordinates, get_num_coordinates # shapely >= 2
+        except ImportError:
+            coords = [np.asarray(g.coords)[:, :2] for g in geoms]
+            return cls(np.concatenate(coords), np.cumsum([0] + [len(c) for c in coords]))
+        geoms = np.array(geoms, dtype=object)
+        counts = get_num_coordinates(geoms)
+        return cls(get_coordinates(geoms), np.concatenate([[0], np.cumsum(counts)]))
+
+    @classmethod
+    def concatenate(cls, arrays):
+        """Join a sequence of LineArrays into one."""
+        arrays = list(arrays)
+        if len(arrays) == 0:
+            return cls(np.zeros((0, 2)), [0])
+        starts = np.cumsum([0] + [len(a.coords) for a in arrays[:-1]])
+        offsets = [a.offsets[:-1] + s for a, s in zip(arrays, starts)]
+        offsets.append([starts[-1] + len(arrays[-1].coords)])
+        return cls(np.concatenate([a.coords for a in arrays]), np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return LineString(self.coords[self.offsets[i]:self.offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def counts(self):
+        """Number of vertices in each line."""
+        return np.diff(self.offsets)
+
+    def take(self, indices):
+        """Make a new LineArray with the lines at the (zero-based) indices, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.counts[indices]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[indices], counts)
+        return LineArray(self.coords[positions], offsets)
+
+    def to_geoms(self):
+        """List of shapely LineStrings."""
+        return list(self)
+
+    @property
+    def _segment_lengths(self):
+        """Length of each line segment between consecutive vertices (in the flat coordinate array);
+        the segments between the end of one line and the start of the next are set to zero."""
+        lengths = np.zeros(len(self.coords))
+        if len(self.coords) > 1:
+            d = np.diff(self.coords, axis=0)
+            lengths[:-1] = np.sqrt(d[:, 0]**2 + d[:, 1]**2)
+        lengths[self.offsets[1:] - 1] = 0.
+        return lengths
+
+    @property
+    def lengths(self):
+        """Length of each line."""
+        line = np.repeat(np.arange(len(self)), self.counts)
+        return np.bincount(line, weights=self._segment_lengths, minlength=len(self))
+
+    @property
+    def starts(self):
+        """(n lines, 2) array of the starting point of each line."""
+        return self.coords[self.offsets[:-1]]
+
+    @property
+    def ends(self):
+        """(n lines, 2) array of the ending point of each line."""
+        return self.coords[self.offsets[1:] - 1]
+
+    @property
+    def midpoints(self):
+        """(n lines, 2) array of the point halfway along each line."""
+        segment_lengths = self._segment_lengths
+        distance = np.concatenate([[0.], np.cumsum(segment_lengths)]) # distance to each vertex
+        first = self.offsets[:-1]
+        last = self.offsets[1:] - 1
+        half = distance[first] + 0.5 * (distance[last] - distance[first])
+        # segment containing the midpoint of each line
+        k = np.searchsorted(distance, half, side='right') - 1
+        k = np.clip(k, first, np.maximum(last - 1, first))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(segment_lengths[k] > 0, (half - distance[k]) / segment_lengths[k], 0.)
+        nxt = np.minimum(k + 1, last)
+        return self.coords[k] + t[:, np.newaxis] * (self.coords[nxt] - self.coords[k])
+
+    def points_along(self, spacing):
+        """Points spaced evenly along each line (including its ends), at intervals of at most spacing.
+
+        Returns
+        -------
+        points : 2-D array
+            (n points, 2) array of x, y coordinates.
+        line : 1-D array
+            Index of the line for each point.
+        """
+        segment_lengths = self._segment_lengths
+        distance = np.concatenate([[0.], np.cumsum(segment_lengths)]) # distance to each vertex
+        first = self.offsets[:-1]
+        last = self.offsets[1:] - 1
+        lengths = distance[last] - distance[first]
+        npoints = np.maximum(np.ceil(lengths / spacing).astype(np.int64), 1) + 1
+        line = np.repeat(np.arange(len(self)), npoints)
+        k = np.arange(np.sum(npoints)) - np.repeat(np.cumsum(npoints) - npoints, npoints)
+        along = distance[first][line] + k * (lengths / (npoints - 1))[line]
+        # segment containing each point
+        seg = np.searchsorted(distance, along, side='right') - 1
+        seg = np.clip(seg, first[line], np.maximum(last - 1, first)[line])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(segment_lengths[seg] > 0, (along - distance[seg]) / segment_lengths[seg], 0.)
+        nxt = np.minimum(seg + 1, last[line])
+        points = self.coords[seg] + t[:, np.newaxis] * (self.coords[nxt] - self.coords[seg])
+        return points, line
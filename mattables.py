@@ -0,0 +1,165 @@
+__author__ = 'aleaf'
+import numpy as np
+import pandas as pd
+from shapely import wkb
+from linework import LineArray
+
+format_version = 1 # version of the binary table layout; increment if it changes
+
+
+def write_table(df, filename, reach_geoms=None, table_name='', chunksize=500000):
+    """Write a Mat1 or Mat2 table to a typed binary file (Arrow IPC format),
+    that can be read back (with read_table) by memory mapping, without any parsing.
+
+    The table is written in batches of rows, so that large tables are never converted all at once.
+    Column types are kept as they are in the dataframe. Geometries are stored either as flat
+    coordinate arrays (for reach geometries supplied as a LineArray), or as WKB
+    (for a geometry column of shapely objects).
+
+    Parameters
+    ----------
+    df : DataFrame
+        Table to write (the index isn't written). Columns of lists (e.g. upsegs) are skipped.
+    filename : str
+        Output file (by convention, with an .arrow extension).
+    reach_geoms : linework.LineArray, optional
+        Geometries for the rows of df (in the same order), written to the geometry column
+        as flat coordinates (replacing any geometry column in df). A geom_id column is also written
+        (replacing any in df), with the position of each row's geometry in the LineArray
+        returned by read_reach_geoms, so that the geometries can still be matched to the rows
+        after the table is read and sorted or filtered.
+    table_name : str
+        Name of the table (e.g. 'Mat1'), stored in the file metadata.
+    chunksize : int
+        Number of rows to write at a time.
+    """
+    pa = _import_pyarrow()
+    import pyarrow.ipc
+    columns = [c for c in df.columns if c not in ('geometry', 'centroids') and not _is_list_column(df[c])]
+    geometry = 'none'
+    if reach_geoms is not None:
+        if len(reach_geoms) != len(df):
+            raise ValueError('Number of reach geometries ({}) is not the number of rows in the table ({})'
+                             .format(len(reach_geoms), len(df)))
+        geometry = 'coords'
+        columns = [c for c in columns if c != 'geom_id']
+    elif 'geometry' in df.columns:
+        geometry = 'wkb'
+
+    writer = None
+    for start in range(0, max(len(df), 1), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        table = pa.Table.from_pandas(chunk[columns], preserve_index=False)
+        if geometry == 'coords':
+            rows = np.arange(start, start + len(chunk))
+            table = table.append_column('geom_id', pa.array(rows, type=pa.int64()))
+            table = table.append_column('geometry', _coords_column(pa, reach_geoms.take(rows)))
+        elif geometry == 'wkb':
+            table = table.append_column('geometry', pa.array([g.wkb if g is not None else None
+                                                              for g in chunk.geometry], type=pa.binary()))
+        if writer is None:
+            metadata = dict(table.schema.metadata or {})
+            metadata.update({b'sfrmaker.version': str(format_version).encode(),
+                             b'sfrmaker.table': table_name.encode(),
+                             b'sfrmaker.geometry': geometry.encode()})
+            schema = table.schema.with_metadata(metadata)
+            writer = pa.ipc.new_file(filename, schema)
+        writer.write_table(table.cast(schema))
+    writer.close()
+
+
+def read_table(filename, columns=None, geometry=False, memory_map=True):
+    """Read a table written with write_table into a dataframe.
+
+    Parameters
+    ----------
+    filename : str
+        Binary table file.
+    columns : list of strings, optional
+        Columns to read (any that aren't in the file are skipped). The default is all columns.
+    geometry : bool
+        If True, include the geometry column (if there is one), as shapely objects.
+        Use read_reach_geoms to get reach geometries as a LineArray instead.
+    memory_map : bool
+        Read the file by memory mapping (the column data are then copied directly into the dataframe).
+
+    Returns
+    -------
+    df : DataFrame
+    """
+    reader, metadata = _open(filename, memory_map)
+    table = reader.read_all()
+    names = table.column_names if columns is None else [c for c in columns if c in table.column_names]
+    if not geometry:
+        names = [c for c in names if c != 'geometry']
+    geoms = None
+    if 'geometry' in names:
+        names.remove('geometry')
+        if metadata.get(b'sfrmaker.geometry') == b'coords':
+            geoms = _line_array(table.column('geometry')).to_geoms()
+        else:
+            geoms = [wkb.loads(g) if g is not None else None for g in table.column('geometry').to_pylist()]
+    df = table.select(names).to_pandas()
+    if geoms is not None:
+        df['geometry'] = geoms
+    return df
+
+
+def read_reach_geoms(filename, memory_map=True):
+    """Read the reach geometries from a table written with write_table (with reach_geoms)
+    into a linework.LineArray, directly from the flat coordinate arrays in the file.
+    The geometries are in the order of the rows in the file; use the geom_id column of the table
+    to get the geometry for each row (e.g. reach_geoms.take(df.geom_id.values))."""
+    reader, metadata = _open(filename, memory_map)
+    if metadata.get(b'sfrmaker.geometry') != b'coords':
+        raise ValueError('No reach geometries (as coordinates) in {}'.format(filename))
+    return _line_array(reader.read_all().column('geometry'))
+
+
+def is_binary_table(filename):
+    """Check whether a file is a binary table (rather than csv), from its first bytes."""
+    with open(filename, 'rb') as src:
+        return src.read(6) == b'ARROW1'
+
+
+def _open(filename, memory_map):
+    pa = _import_pyarrow()
+    import pyarrow.ipc
+    source = pa.memory_map(filename, 'r') if memory_map else pa.OSFile(filename, 'rb')
+    reader = pa.ipc.open_file(source)
+    metadata = reader.schema.metadata or {}
+    if b'sfrmaker.version' not in metadata:
+        raise IOError('{} is not an SFRmaker binary table.'.format(filename))
+    version = int(metadata[b'sfrmaker.version'])
+    if version > format_version:
+        raise IOError('{} was written in table format version {}; this version of SFRmaker reads version {}.'
+                      .format(filename, version, format_version))
+    return reader, metadata
+
+
+def _coords_column(pa, lines):
+    """Arrow list<fixed_size_list<double, 2>> array made directly from the LineArray buffers."""
+    points = pa.FixedSizeListArray.from_arrays(pa.array(lines.coords.ravel()), 2)
+    return pa.LargeListArray.from_arrays(pa.array(lines.offsets), points)
+
+
+def _line_array(column):
+    """LineArray from the chunks of a coordinates geometry column."""
+    arrays = []
+    for chunk in column.chunks:
+        offsets = chunk.offsets.to_numpy()
+        values = chunk.values.flatten().to_numpy()
+        arrays.append(LineArray(values[2 * offsets[0]:2 * offsets[-1]], offsets - offsets[0]))
+    return LineArray.concatenate(arrays)
+
+
+def _is_list_column(series):
+    return series.dtype == object and len(series) > 0 and isinstance(series.iloc[0], (list, set, tuple))
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Binary tables require pyarrow.')
+    return pyarrow
@@ -3,17 +3,23 @@ __author__ = 'aleaf'
 import sys
 sys.path.append('/Users/aleaf/Documents/GitHub/flopy3')
 import os
+try:
+    from collections.abc import Mapping
+except ImportError: # python 2
+    from collections import Mapping
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from shapely.geometry import Polygon, LineString, MultiLineString
-try:
-    from rasterstats import zonal_stats
-except:
-    print('Warning: rasterstats not imported.')
 import flopy
 import GISio, GISops
+from routing import RoutingGraph, SegmentNetwork, DownstreamPaths
+from projection import project_geoms
+from mattables import write_table, read_table, read_reach_geoms, is_binary_table
+from disfile import DisFile
+from grid import StructuredGrid
+from rastersample import sample_cells, sample_polygons, sample_lines
 
 
 # Functions
@@ -30,6 +36,31 @@ def header(infile):
             continue
     return knt
 
+class CellValues(Mapping):
+    """Read-only mapping of (one-based) cell numbers to the values in a (nrow, ncol) array,
+    such as the model top. Values are looked up directly in the array (no dictionary is built)."""
+
+    def __init__(self, array):
+        self.array = np.asarray(array)
+        self._values = self.array.ravel()
+
+    def __getitem__(self, cellnum):
+        if not 0 < cellnum <= len(self._values):
+            raise KeyError(cellnum)
+        return self._values[cellnum - 1]
+
+    def __iter__(self):
+        return iter(range(1, len(self._values) + 1))
+
+    def __len__(self):
+        return len(self._values)
+
+
+def _upsegs(m2, segments):
+    """List of the segments routed to each segment (in Mat2 order), from the Mat2 segment and outseg columns."""
+    return RoutingGraph(m2.segment.values, m2.outseg.values).upstream(segments)
+
+
 class SFRdata(object):
 
     # dictionary to convert different variations on column names to internally consistent names
@@ -57,7 +88,7 @@ class SFRdata(object):
                  mfgridshp_row_field=None, mfgridshp_column_field=None, ncol=None, gridtype='structured',
                  dem=None, dem_units_mult=1, landsurfacefile=None, landsurface_column=None,
                  GIS_mult=1, to_meters_mult=0.3048,
-                 Mat2_out=None, xll=0.0, yll=0.0, prj=None, proj4=None, epsg=None,
+                 Mat2_out=None, xll=0.0, yll=0.0, rotation=0.0, prj=None, proj4=None, epsg=None,
                  minimum_slope=1e-4, maximum_slope=1, streamflow_file=None):
         """
         base object class for SFR information in the SFRmaker postproc module.
@@ -68,9 +99,9 @@ class SFRdata(object):
             Instantiates SFRdata with attributes from another SFRdata instance
 
         Mat1: dataframe or str
-            Mat1 table.
+            Mat1 table (csv file, or binary table written with write_tables(binary=True)).
         Mat2 : dataframe or str
-            Mat2 table.
+            Mat2 table (csv file, or binary table).
         mfgridshp : str
             Shapefile of MODFLOW grid
         mfgridshp_node_field : str
@@ -89,6 +120,12 @@ class SFRdata(object):
 
         GIS_mult: float
             Multiplier to go from model units to GIS units
+        xll : float
+            x coordinate of the model origin (lower left corner of the grid), in GIS units
+        yll : float
+            y coordinate of the model origin, in GIS units
+        rotation : float
+            Grid rotation, in degrees counter-clockwise about the model origin
 
         """
         # if an sfr object is supplied, copy all of its attributes over
@@ -109,6 +146,14 @@ class SFRdata(object):
                 if isinstance(Mat1, pd.DataFrame):
                     self.m1 = Mat1.copy()
                     self.m2 = Mat2.copy()
+                elif is_binary_table(Mat1):
+                    # typed binary tables (e.g. from preproc write_tables(binary=True));
+                    # no parsing, and geometries aren't loaded
+                    self.Mat1 = Mat1
+                    self.Mat2 = Mat2
+                    self.m1 = read_table(Mat1)
+                    self.m2 = read_table(Mat2)
+                    self.outpath = os.path.split(Mat1)[0]
                 else:
                     self.Mat1 = Mat1
                     self.Mat2 = Mat2
@@ -140,7 +185,7 @@ class SFRdata(object):
                 raise AssertionError("Please specify either Mat1 and Mat2 files or an SFR package file.")
 
             # Discretization
-            self.elevs_by_cellnum = {} # dictionary to store the model top elevation by cellnumber
+            self.elevs_by_cellnum = {} # model top elevation by cellnumber (CellValues of the DIS top array; see read_dis2)
             self.cell_geometries = {}
 
             if mfdis is not None:
@@ -159,7 +204,7 @@ class SFRdata(object):
                         self._compute_mat1_rc()
                 else:
                     pass
-                self.m1['model_top'] = [self.elevs_by_cellnum[c] for c in self.m1.node]
+                self.m1['model_top'] = self.dis.top_at(self.m1.node.values)
             else:
                 self.mfpath = ''
                 self.mfnam = None
@@ -189,6 +234,7 @@ class SFRdata(object):
             self.landsurface = None
             self.xll = xll
             self.yll = yll
+            self.rotation = rotation
             self.to_m = to_meters_mult # multiplier to convert model units to meters (used for width estimation)
             self.to_km = self.to_m / 1000.0
             self.GIS_mult = GIS_mult
@@ -210,13 +256,13 @@ class SFRdata(object):
                 self.m1['reachID'] = self.m1.index.values
 
             # assign upstream segments to Mat2
-            self.m2['upsegs'] = [self.m2.segment[self.m2.outseg == s].tolist() for s in self.segments]
+            self.m2['upsegs'] = _upsegs(self.m2, self.segments)
 
             # assign outsegs to Mat1
-            self.m1['outseg'] = [self.m2.outseg[s] for s in self.m1.segment]
+            self.m1['outseg'] = self.m2.outseg.loc[self.m1.segment.values].values
 
             # check for circular routing
-            c = [s for s in self.m2.segment if s == self.m2.outseg[s]]
+            c = self.m2.segment.values[self.m2.segment.values == self.m2.outseg.values]
             if len(c) > 0:
                 raise ValueError('Warning! Circular routing in segments {}.\n'
                                  'Fix manually in Mat2 before continuing'.format(', '.join(map(str, c))))
@@ -302,38 +348,37 @@ class SFRdata(object):
             #    self.Elevations.mfpath = os.path.split(self.mfdis)[0]
 
         print('reading {}...'.format(self.mfdis))
+        namefile = os.path.join(self.mfpath, self.mfnam) if getattr(self, 'mfnam', None) else None
         try:
-            self.m = flopy.modflow.Modflow(model_ws=self.mfpath)
-            self.dis = flopy.modflow.ModflowDis.load(self.mfdis, self.m)
-        except:
-            #  Modflow.load() may load dis successfully, even if ModflowDis.load() fails
-            model_ws, mfnam = os.path.split(self.mfdis)
-            self.mfnam = mfnam[:-4] + '.nam'
-            self.m = flopy.modflow.Modflow.load(self.mfnam, model_ws=model_ws, load_only='dis')
-            self.dis = self.m.dis
-
-        self.elevs = np.zeros((self.dis.nlay + 1, self.dis.nrow, self.dis.ncol))
-        self.elevs[0, :, :] = self.dis.top.array
-        self.elevs[1:, :, :] = self.dis.botm.array
+            # top and bottom arrays are only read when needed (see disfile.DisFile)
+            self.dis = DisFile(self.mfdis, namefile=namefile)
+            self.dis.top # (read here, so that the model top is read with flopy if it can't be parsed)
+        except (ValueError, IndexError, UnicodeDecodeError, IOError) as e:
+            print('{}\nreading {} with flopy...'.format(e, self.mfdis))
+            try:
+                self.m = flopy.modflow.Modflow(model_ws=self.mfpath)
+                dis = flopy.modflow.ModflowDis.load(self.mfdis, self.m)
+            except:
+                #  Modflow.load() may load dis successfully, even if ModflowDis.load() fails
+                model_ws, mfnam = os.path.split(self.mfdis)
+                self.mfnam = mfnam[:-4] + '.nam'
+                self.m = flopy.modflow.Modflow.load(self.mfnam, model_ws=model_ws, load_only='dis')
+                dis = self.m.dis
+            self.dis = DisFile.from_flopy(dis)
 
         # check if there Quasi-3D confining beds
-        if np.sum(self.dis.laycbd.array) > 0:
+        if np.sum(self.dis.laycbd) > 0:
             print('Quasi-3D layering found, skipping confining beds...')
-            layer_ind = 0
-            for l, laycbd in enumerate(self.dis.laycbd.array):
-                self.elevs[l + 1, :, :] = self.dis.botm.array[layer_ind, :, :]
+            for l, laycbd in enumerate(self.dis.laycbd):
                 if laycbd == 1:
                     print('\tbetween layers {} and {}'.format(l+1, l+2))
-                    layer_ind += 1
-                layer_ind += 1
-        else:
-            self.elevs[1:, :, :] = self.dis.botm.array
 
-        # make dictionary of model top elevations by cellnum
-        for c in range(self.dis.ncol):
-            for r in range(self.dis.nrow):
-                cellnum = r * self.dis.ncol + c + 1
-                self.elevs_by_cellnum[cellnum] = self.elevs[0, r, c]
+        # (nlay+1, nrow, ncol) view of the top and bottom elevations;
+        # values are read for the cells that are indexed
+        self.elevs = self.dis.elevations
+
+        # model top elevations by cellnum
+        self.elevs_by_cellnum = CellValues(self.dis.top)
 
     def _read_geoms_from_mfgridshp(self, mfgridshp, node_field=None, row_field=None, column_field=None, ncol=None):
 
@@ -359,7 +404,7 @@ class SFRdata(object):
                               'cannot compute node numbers without number of columns.' \
                               'Please provide ncol argument or row and column fields for grid shapefile.')
 
-        if self.gridtype == 'structured' and 'row' not in self.m1.columns or 'column' not in self.m1.columns:
+        if self.gridtype == 'structured' and ('row' not in self.m1.columns or 'column' not in self.m1.columns):
             if row_field is not None and column_field is not None:
                 self.m1['row'] = df.ix[self.m1.node.tolist(), row_field].tolist()
                 self.m1['column'] = df.ix[self.m1.node.tolist(), column_field].tolist()
@@ -370,105 +415,92 @@ class SFRdata(object):
                 print('SFR input for structured grid requires row and column info.')
         self.m1['geometry'] = df.iloc[self.m1.node.astype(int) -1]['geometry'].tolist() # back to zero-based!
 
+    @property
+    def structured_grid(self):
+        """grid.StructuredGrid for the model (from the DIS row and column spacings, GIS_mult,
+        and the model origin and rotation), in GIS units."""
+        if self.dis is None:
+            raise ValueError('No discretization information; please run read_dis2() with the model DIS file.')
+        # the grid is defined from its upper left corner; the model origin is the lower left
+        height = np.sum(self.dis.delc) * self.GIS_mult
+        xul = self.xll - height * np.sin(np.radians(self.rotation))
+        yul = self.yll + height * np.cos(np.radians(self.rotation))
+        return StructuredGrid(self.dis.delr, self.dis.delc, xul=xul, yul=yul, rot=self.rotation,
+                              length_mult=self.GIS_mult)
+
     def get_cell_geometries(self, mfgridshp=None, node_field='node'):
 
         if mfgridshp is None:
             print('computing cell geometries...')
-            #self.centroids = self.dis.get_node_coordinates()
-            self.get_cell_centroids()
-
-            for i, dfr in self.m1.iterrows():
-                r, c = dfr.row - 1, dfr.column - 1
-                cn = r * self.dis.ncol + c + 1
-                cx, cy = dfr.centroids
-                dx = self.dis.delr[c] * self.GIS_mult
-                dy = self.dis.delc[r] * self.GIS_mult  # this is confusing, may be a bug in flopy
-
-                # calculate vertices for parent cell
-                x0 = cx - 0.5 * dx
-                x1 = cx + 0.5 * dx
-                y0 = cy - 0.5 * dy
-                y1 = cy + 0.5 * dy
-
-                self.cell_geometries[cn] = Polygon([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)])
-            self.m1['geometry'] = [self.cell_geometries[cn] for cn in self.m1.node]
+            # polygons are made once for each SFR cell, from the cell corner coordinates
+            nodes, inverse = np.unique(self.m1.node.values.astype(int), return_inverse=True)
+            polygons = self.structured_grid.cell_polygons(nodes)
+            self.cell_geometries = dict(zip(nodes.tolist(), polygons))
+            self.m1['geometry'] = [polygons[i] for i in inverse]
         else:
             self._read_geoms_from_mfgridshp(mfgridshp=mfgridshp, node_field=node_field)
 
     def get_cell_centroids(self, mfgridshp=None, node_field='node'):
         """Adds column of cell centroids coordinates (tuples) to Mat1,
-        from flopy DIS object.
+        from the model grid (DIS file, model origin and rotation).
         """
 
         if mfgridshp is None:
             self.centroids = self.dis.get_node_coordinates()
 
-            centroids = []
-            for i, r in self.m1.iterrows():
-                r, c = r.row - 1, r.column - 1
-                cx = self.centroids[1][c] * self.GIS_mult + self.xll
-                cy = self.centroids[0][r] * self.GIS_mult + self.yll
-                centroids.append((cx, cy))
+            x, y = self.structured_grid.cell_centroids(self.m1.node.values).T
+            centroids = list(zip(x.tolist(), y.tolist()))
         else:
             self._read_geoms_from_mfgridshp(mfgridshp, node_field=node_field)
             centroids = [g.centroid for g in self.m1.geometry]
         self.m1['centroids'] = centroids
 
-    def map_outsegs(self, max_levels=1000):
+    @property
+    def outsegs(self):
+        """Dataframe showing successive outsegs from each segment (index) to its outlet.
+        Made from the routing paths (see map_outsegs) the first time it is accessed."""
+        outsegs = self.__dict__.get('_outsegs')
+        paths = self.__dict__.get('paths')
+        if outsegs is None and paths is not None:
+            table = paths.table(self.__dict__.get('max_outseg_levels'))[1:]
+            columns = ['outseg'] + ['outseg{}'.format(i) for i in range(2, len(table) + 1)]
+            outsegs = pd.DataFrame(table.T, index=self.m2.index, columns=columns)
+            self._outsegs = outsegs
+        return outsegs
+
+    @outsegs.setter
+    def outsegs(self, outsegs):
+        self._outsegs = outsegs
+
+    def map_outsegs(self, max_levels=None):
         '''
-        from Mat2, returns dataframe of all downstream segments (will not work with circular routing!)
-        '''
-        outsegsmap = pd.DataFrame(self.m2.outseg)
-        outsegs = self.m2.outseg
-        max_outseg = np.max(outsegsmap[outsegsmap.columns[-1]])
-        knt = 2
-        nsegs = len(self.m2)
-        while max_outseg > 0:
-            outsegsmap['outseg{}'.format(knt)] = [outsegs[s] if s > 0 and s < 999999 else 0
-                                                    for s in outsegsmap[outsegsmap.columns[-1]]]
-            max_outseg = np.max(outsegsmap[outsegsmap.columns[-1]].values)
-            if max_outseg == 0:
-                break
-            knt +=1
-            if knt > max_levels:
-                # subset outsegs map to all rows outseg number > 0 at iteration 1000
-                circular_segs = outsegsmap[outsegsmap[outsegsmap.columns[-1]] > 0]
-
-                # only retain one instance of each outseg number at iteration 1000
-                circular_segs.drop_duplicates(subset=outsegsmap.columns[-1], inplace=True)
-
-                # cull the dataframe again to remove duplicate instances of routing circles
-                circles = []
-                duplicates = []
-                for i in circular_segs.index:
-                    repeat_start_ind = np.where(circular_segs.ix[i, :] ==
-                                                circular_segs.ix[i, circular_segs.columns[-1:]]
-                                                .values[0])[0][-2:][0]
-                    circular_seq = circular_segs.ix[i, circular_segs.columns[repeat_start_ind:]].tolist()
-
-                    if set(circular_seq) not in circles:
-                        circles.append(set(circular_seq))
-                    else:
-                        duplicates.append(i)
-                circular_segs.drop(duplicates, axis=0, inplace=True)
+        from Mat2, maps the outlet and downstream path of each segment (see routing.DownstreamPaths).
+        The dataframe of all downstream segments (outsegs attribute) is made when it is first used.
 
-                rf = 'Circular_routing_outsegs_table.csv'
-                circular_segs.to_csv(rf)
-                return '{0} instances where an outlet was not found after {1} consecutive segments! ' \
-                       '\nThese may indicate circular routing, or if there are many segments' \
-                       '\n(~10,000 or more), some segment sequences may be longer than {1}.' \
-                       '\nIn that case, try re-running map_outsegs() and diagnostics with max_levels set higher.'\
-                       '\nSee {1} for details.'\
-                        .format(len(circular_segs), max_levels, rf)
+        Parameters
+        ----------
+        max_levels : int, optional
+            Maximum number of levels in the outsegs dataframe (default is the longest path).
+
+        Returns
+        -------
+        message : str
+            Description of any circular routing (None if there isn't any).
+        '''
+        paths = DownstreamPaths(self.m2.segment.values, self.m2.outseg.values)
+        if len(paths.cycles) > 0:
+            return '{} instances of circular routing:\n{}'\
+                .format(len(paths.cycles), '\n'.join([' '.join(map(str, c)) for c in paths.cycles]))
 
-        self.outsegs = outsegsmap
+        self.paths = paths
+        self.max_outseg_levels = max_levels
+        self.outsegs = None # reset; made from paths on demand
 
         # create new column in Mat2 listing outlets associated with each segment
-        self.m2['Outlet'] = [r[(r != 0) & (r != 999999)][-1] if len(r[(r != 0) & (r != 999999)]) > 0
-                             else i for i, r in self.outsegs.iterrows()]
+        self.m2['Outlet'] = paths.outlets
 
         # assign the outlets to each reach listed in Mat1
-        self.m1['Outlet'] = [self.m2.ix[seg, 'Outlet'] for seg in self.m1.segment]
+        self.m1['Outlet'] = self.m2.Outlet.loc[self.m1.segment.values].values
 
     def map_confluences(self, dem=None, landsurfacefile=None, landsurface_column=None):
 
@@ -486,7 +518,7 @@ class SFRdata(object):
         self.m2 = self.Elevations.m2
         self.confluences = self.Elevations.confluences
 
-    def consolidate_conductance(self, bedKmin=1e-8):
+    def consolidate_conductance(self, bedKmin=1e-8, dominant='width'):
         """For model cells with multiple SFR reaches, shift all conductance to widest reach,
         by adjusting the length, and setting the lengths in all smaller collocated reaches to 1,
         and the K-values in these to bedKmin
@@ -498,6 +530,11 @@ class SFRdata(object):
             Hydraulic conductivity value to use for collocated SFR reaches in a model cell that are not the dominant
             (widest) reach. This is used to effectively set conductance in these reaches to 0, to avoid circulation
             of water between the collocated reaches.
+        dominant : str
+            Rule for picking the dominant reach in each cell:
+            'width' (widest reach; default), 'length' (longest reach), or 'order' (reach in the
+            segment with the highest Strahler stream order, computed from the routing in Mat2).
+            Ties are broken by width, and then by the order of the reaches in Mat1.
 
         Returns
         -------
@@ -507,47 +544,50 @@ class SFRdata(object):
         Notes
         -----
             See the ConsolidateConductance notebook in the Notebooks folder.
+            The reaches are sorted once by cell (and by the dominance rule within each cell),
+            so that the dominant reaches and conductance sums are found for all cells at once.
         """
         print('Assigning total SFR conductance to dominant reach in cells with multiple reaches...')
-        # Calculate SFR conductance for each reach
-        def cond(X):
-            c = X['sbK'] * X['width'] * X['length'] / X['sbthick']
-            return c
-
-        self.m1['Cond'] = self.m1.apply(cond, axis=1)
+        if dominant not in ('width', 'length', 'order'):
+            raise ValueError("dominant must be 'width', 'length' or 'order', not {}".format(dominant))
+        node = self.m1.node.values
+        sbK = self.m1.sbK.values.astype(float)
+        width = self.m1.width.values.astype(float)
+        length = self.m1.length.values.astype(float)
+        sbthick = self.m1.sbthick.values.astype(float)
 
-        #shared_cells = np.unique(self.m1.ix[self.m1.node.duplicated(), 'node'])
+        # Calculate SFR conductance for each reach
+        cond = sbK * width * length / sbthick
+        self.m1['Cond'] = cond
 
         # make a new column that designates whether a reach is dominant in each cell
-        # dominant reaches include those not collocated with other reaches, and the longest collocated reach
-        self.m1['Dominant'] = [True] * len(self.m1)
-
-        for c in self.shared_cells:
-
-            # select the collocated reaches for this cell
-            df = self.m1[self.m1.node == c].sort_values(by='width', ascending=False)
-
-            # set all of these reaches except the largest to not Dominant
-            self.m1.loc[df.index[1:], 'Dominant'] = False
-
-        # Sum up the conductances for all of the collocated reaches
-        # returns a series of conductance sums by model cell, put these into a new column in Mat1
-        Cond_sums = self.m1[['node', 'Cond']].groupby('node').agg('sum').Cond
-        self.m1['Cond_sum'] = [Cond_sums[c] for c in self.m1.node]
-
-        # Calculate a new length for widest reaches, set length in secondary collocated reaches to 1
+        # dominant reaches include those not collocated with other reaches, and the first collocated reach
+        # after sorting by cell, and (descending) by the dominance rule
+        if dominant == 'order':
+            network = SegmentNetwork(self.m2.segment.values, self.m2.outseg.values)
+            rank = network.strahler_order()[network.index(self.m1.segment.values)]
+        else:
+            rank = length if dominant == 'length' else width
+        sequence = np.lexsort((np.arange(len(node)), -width, -rank, node))
+        first = np.ones(len(node), dtype=bool)
+        first[1:] = node[sequence][1:] != node[sequence][:-1]
+        is_dominant = np.zeros(len(node), dtype=bool)
+        is_dominant[sequence[first]] = True
+        self.m1['Dominant'] = is_dominant
+
+        # Sum up the conductances for all of the collocated reaches, and put the sums
+        # for each model cell into a new column in Mat1
+        group = np.cumsum(first) - 1
+        cond_sums = np.add.reduceat(cond[sequence], np.flatnonzero(first)) if len(node) > 0 else np.array([])
+        Cond_sum = np.empty(len(node))
+        Cond_sum[sequence] = cond_sums[group]
+        self.m1['Cond_sum'] = Cond_sum
+
+        # Calculate a new length for dominant reaches, set length in secondary collocated reaches to 1
         # also set the K values in the secondary cells to bedKmin
-        self.m1['length'] = self.m1.length
-
-        def consolidate_lengths(X):
-            if X['Dominant']:
-                lnew = X['Cond_sum'] * X['sbthick'] / (X['sbK'] * X['width'])
-            else:
-                lnew = 1.0
-            return lnew
-
-        self.m1['SFRlength'] = self.m1.apply(consolidate_lengths, axis=1)
-        self.m1['sbK'] = [r['sbK'] if r['Dominant'] else bedKmin for i, r in self.m1.iterrows()]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.m1['SFRlength'] = np.where(is_dominant, Cond_sum * sbthick / (sbK * width), 1.0)
+        self.m1['sbK'] = np.where(is_dominant, sbK, bedKmin)
 
     def smooth_segment_ends(self, landsurfacefile=None, landsurface_column=None,
                             report_file='smooth_segment_ends.txt'):
@@ -571,32 +611,63 @@ class SFRdata(object):
             self.Elevations.smooth_segment_interiors(report_file=report_file)
         self.m1 = self.Elevations.m1
 
-    def reset_m1_streambed_top_from_dem(self, dem=None, dem_units_mult=None, stat='min'):
-        """Computes streambed top elevations via zonal statistics, using the
-        rasterstats package (https://github.com/perrygeo/python-raster-stats).
+    def reset_m1_streambed_top_from_dem(self, dem=None, dem_units_mult=None, stat='min', sample='cells',
+                                        reach_geoms=None, n_workers=1):
+        """Computes streambed top elevations from a DEM, via zonal statistics for the SFR cells,
+        or from DEM values sampled along the reach linework (see the rastersample module).
 
         Parameters
         ----------
         dem : Any raster data source supported by GDAL
-            Surface from which to sample elevation values.
+            Surface from which to sample elevation values (read with rasterio).
         dem_units_mult : float
             Multiplier for converting the raster z units to the model z units
         stat : string
             min (recommended), mean, or max
+        sample : string
+            'cells' to sample the DEM over the whole model cell for each reach (default), or
+            'reaches' to sample it along the reach linework only (the stream occupies only part of each cell).
+        reach_geoms : linework.LineArray or sequence of LineStrings, optional
+            Reach geometries (in the order of the rows in m1), for sampling along the reaches.
+            By default, these are read from the Mat1 binary table, if they were written to it
+            (with preproc write_tables(binary=True)).
+        n_workers : int
+            Number of threads for sampling the DEM (default 1).
 
         Returns
         -------
-        zstats: Dataframe with dem min, max, mean and count for each model cell in Mat1
+        zstats: Dataframe with dem min, max, mean and count for each reach in Mat1
         """
-        if 'geometry' not in self.m1.columns:
-            self.get_cell_geometries()
         if dem is not None:
             self.dem = dem
         if dem_units_mult is not None:
             self.dem_units_mult = dem_units_mult
-        print('computing zonal statistics...')
-        self.dem_zstats = pd.DataFrame(zonal_stats(self.m1.geometry, self.dem))
-        self.m1['sbtop'] = self.dem_zstats['min'].values * self.dem_units_mult
+        if sample == 'reaches':
+            if reach_geoms is None:
+                if not isinstance(getattr(self, 'Mat1', None), str) or not is_binary_table(self.Mat1) \
+                        or 'geom_id' not in self.m1.columns:
+                    raise ValueError('Sampling along the reaches requires reach geometries '
+                                     '(reach_geoms, or a binary Mat1 table written with them).')
+                # geometries for the rows of m1, by their position in the table (geom_id)
+                reach_geoms = read_reach_geoms(self.Mat1).take(self.m1.geom_id.values)
+            print('sampling DEM along reaches...')
+            self.dem_zstats = sample_lines(self.dem, reach_geoms, n_workers=n_workers)
+        elif sample == 'cells':
+            print('computing zonal statistics...')
+            if self.dis is not None:
+                self.dem_zstats = sample_cells(self.dem, self.structured_grid, self.m1.node.values,
+                                               n_workers=n_workers)
+            elif 'geometry' in self.m1.columns:
+                # cell polygons (e.g. from a grid shapefile); sampled once for each cell
+                nodes, first, inverse = np.unique(self.m1.node.values, return_index=True, return_inverse=True)
+                self.dem_zstats = sample_polygons(self.dem, self.m1.geometry.values[first], n_workers=n_workers)\
+                    .iloc[inverse].reset_index(drop=True)
+            else:
+                raise ValueError('No cell geometries; please run read_dis2() with the model DIS file, '
+                                 'or get_cell_geometries() with a grid shapefile.')
+        else:
+            raise ValueError("sample must be 'cells' or 'reaches', not {}".format(sample))
+        self.m1['sbtop'] = self.dem_zstats[stat].values * self.dem_units_mult
         DEM_col_name = 'DEM{}'.format(stat)
         self.m1[DEM_col_name] = self.m1['sbtop'].values
         print('DEM {} elevations assigned to sbtop column in m1'.format(stat))
@@ -613,40 +684,18 @@ class SFRdata(object):
         dem_min = np.array([self.m1.ix[self.m1.segment == s, 'DEMmin'].min() for s in nseg])
         dem_reach1 = np.array([self.m1.ix[(self.m1.segment.values == s) &
                                       (self.m1.reach.values ==1), 'DEMmin'].values[0] for s in nseg])
-        def get_nextupsegs(upsegs):
-            nextupsegs = []
-            for s in upsegs:
-                nextupsegs += nseg[outseg == s].tolist()
-            return nextupsegs
-
-        def get_upsegs(seg):
-            upsegs = nseg[outseg == seg].tolist()
-            all_upsegs = upsegs
-            for i in range(len(nseg)):
-                upsegs = get_nextupsegs(upsegs)
-                if len(upsegs) > 0:
-                    all_upsegs.extend(upsegs)
-                else:
-                    break
-            return all_upsegs
-
-        def get_upseg_levels(seg):
-            upsegs = nseg[outseg == seg].tolist()
-            all_upsegs = [upsegs]
-            for i in range(len(nseg)):
-                upsegs = get_nextupsegs(upsegs)
-                if len(upsegs) > 0:
-                    all_upsegs.append(upsegs)
-                else:
-                    break
-            return all_upsegs
+        network = SegmentNetwork(nseg, outseg)
+        # minimum elevations at and upstream of each segment
+        # (segments are reset from the outlets upstream, so the elevations
+        # upstream of each segment haven't been changed yet when it is reset)
+        upstream_elevmin = network.upstream_reduce(elevmin, np.minimum)
+        upstream_dem_min = network.upstream_reduce(dem_min, np.minimum)
 
         def reset_elevations(seg):
             # reset segment elevations above (upsegs) and below (outseg) a node
             oseg = outseg[seg -1]
-            all_upsegs = np.array(get_upsegs(seg) + [seg]) # all segments upstream of node
-            oldmin = elevmin[(all_upsegs-1)].min() # minimum current elevation upstream of node
-            smin = dem_min[(all_upsegs-1)].min() # minimum sampled DEM elevation upstream of node
+            oldmin = upstream_elevmin[seg - 1] # minimum current elevation upstream of node
+            smin = upstream_dem_min[seg - 1] # minimum sampled DEM elevation upstream of node
             if oseg > 0:
                 outseg_max = elevmax[oseg - 1] # outseg reach 1 elevation (already updated)
                 smin = np.min([outseg_max, smin])
@@ -654,11 +703,11 @@ class SFRdata(object):
                 elevmin[seg - 1] = smin
             if oseg > 0: # if the node is not an outlet, reset the outseg max
                 elevmax[outseg[seg -1] -1] = np.min([smin, oldmin, outseg_max])
-            if len(all_upsegs) == 1:
+            if network.upstream_counts[seg - 1] == 0:
                 elevmax[seg -1] = np.min([elevmax[seg-1], dem_reach1[seg-1]])
 
-        # get list of segments at each level, starting with 0 (outlet)
-        segment_levels = get_upseg_levels(0)
+        # get list of segments at each level, starting with the outlets
+        segment_levels = network.levels()
         # at each level, reset all of the segment elevations as necessary
         for level in segment_levels:
             [reset_elevations(s) for s in level]
@@ -755,7 +804,7 @@ class SFRdata(object):
         self.Segments.renumber_SFR_cells(nodes_list)
         self.__dict__ = self.Segments.__dict__.copy()
 
-    def run_diagnostics(self, max_routing_levels=1000, routing_distance_tol=None,
+    def run_diagnostics(self, max_routing_levels=None, routing_distance_tol=None,
                         model_domain=None, sfr_linework_shapefile=None):
         """Run diagnostic suite on Mat1 and Mat2, including:
         * segment numbering
@@ -1007,7 +1056,16 @@ class SFRdata(object):
         self.Streamflow.read_streamflow_file(streamflow_file=streamflow_file)
         self.Streamflow.write_streamflow_shp(lines_shapefile=lines_shapefile, node_col=node_col)
 
-    def write_tables(self, basename='SFR'):
+    def write_tables(self, basename='SFR', binary=False):
+        """Write Mat1 and Mat2 to <basename>mat1.csv and <basename>mat2.csv,
+        or if binary=True, to typed binary tables (<basename>mat1.arrow and <basename>mat2.arrow;
+        see mattables.write_table), which can be loaded much faster. Binary tables require pyarrow.
+        """
+        if binary:
+            write_table(self.m1, '{}mat1.arrow'.format(basename), table_name='Mat1')
+            write_table(self.m2, '{}mat2.arrow'.format(basename), table_name='Mat2')
+            print('Mat1 and 2 saved to {fname}mat1.arrow and {fname}mat2.arrow'.format(fname=basename))
+            return
         m1, m2 = self.m1.copy(), self.m2.copy()
         for col in ['geometry', 'centroids']:
             if col in m1.columns:
@@ -1132,7 +1190,7 @@ class SFRdata(object):
                 r.roughch
                 ))
 
-            width = m1.ix[m1.segment == r.segment, 'width'].values
+            width = m1.loc[m1.segment == r.segment, 'width'].values
             if width[0] > 0 and r.icalc == 1:
                 ofp.write('{0:e}\n'.format(width[0]))
                 ofp.write('{0:e}\n'.format(width[-1]))
@@ -1377,9 +1435,9 @@ class Elevations(SFRdata):
             df = self.m1[self.m1.segment == seg].sort_values(by='reach')
 
             # start with land surface elevations along segment
-            self.segelevs = df.landsurface.values
+            self.segelevs = df.landsurface.values.copy()
 
-            start, end = self.m2.ix[seg, ['Max', 'Min']]
+            start, end = self.m2.loc[seg, ['Max', 'Min']]
 
             # get start and end elevations from Mat2; if they are equal, continue
             if start == end:
@@ -1503,12 +1561,13 @@ class Elevations(SFRdata):
             self.m1.loc[df.index, 'lowest_top'] = np.min(df.sbtop)
 
         # make a new model top array; assign lowest streambed tops to it
-        newtop = self.dis.top.array.copy()
+        # (the full top and bottom arrays are read here, to write the new DIS file)
+        newtop = self.dis.get_top()
         newtop[self.m1.row.values-1, self.m1.column.values-1] = self.m1.lowest_top.values
 
         # Now straighten out the other layers, removing any negative thicknesses
         # do layer 1 first
-        newbots = self.dis.botm.array.copy()
+        newbots = self.dis.get_botm()
         conflicts = newbots[0, :, :] > newtop - minimum_thickness
         newbots[0, conflicts] = newtop[conflicts] - minimum_thickness
 
@@ -1524,10 +1583,6 @@ class Elevations(SFRdata):
         # update the model top in Mat1
         self.m1['model_top'] = self.m1.lowest_top
 
-        # update the elevs array
-        self.elevs[0, :, :] = newtop
-        self.elevs[1:, :, :] = newbots
-
         # update the layer in Mat1 to 1 for all SFR cells
         self.m1['layer'] = 1
 
@@ -1539,6 +1594,11 @@ class Elevations(SFRdata):
         if isinstance(newdis.fn_path, list):
             newdis.fn_path = newdis.fn_path[0]
         self.mfdis = outdisfile
+
+        # update the discretization (with the new arrays in memory)
+        self.dis = DisFile.from_flopy(newdis)
+        self.elevs = self.dis.elevations
+        self.elevs_by_cellnum = CellValues(self.dis.top)
         print('writing new discretization file {} using flopy...'.format(outdisfile))
         newdis.write_file()
         print('Done.')
@@ -1716,30 +1776,9 @@ class Widths(SFRdata):
         '''
         from Mat2, returns dataframe of all upstream segments (will not work with circular routing!)
         '''
-        # make a list of adjacent upsegments keyed to outseg list in Mat2
-        upsegs = dict([(o, self.m2.segment[self.m2.outseg == o].tolist()) for o in np.unique(self.m2.outseg)])
-        self.outsegs = [k for k in list(upsegs.keys()) if k > 0] # exclude 0, which is the outlet designator
-
-        # for each outseg key, for each upseg, check for more upsegs, append until headwaters has been reached
-        for outseg in self.outsegs:
-
-            up = True
-            upsegslist = upsegs[outseg]
-            while up:
-                added_upsegs = []
-                for us in upsegslist:
-                    if us in self.outsegs:
-                        added_upsegs += upsegs[us]
-                if len(added_upsegs) == 0:
-                    up = False
-                    break
-                else:
-                    upsegslist = added_upsegs
-                    upsegs[outseg] += added_upsegs
-
-        # the above algorithm is recursive, so lower order streams get duplicated many times
-        # use a set to get unique upsegs
-        self.upsegs = dict([(u, list(set(upsegs[u]))) for u in self.outsegs])
+        network = SegmentNetwork(self.m2.segment.values, self.m2.outseg.values)
+        self.outsegs = [o for o in np.unique(self.m2.outseg) if o > 0] # exclude 0, which is the outlet designator
+        self.upsegs = {o: network.upstream(o).tolist() for o in self.outsegs}
 
 
     def estimate_from_arbolate(self):
@@ -1748,35 +1787,25 @@ class Widths(SFRdata):
 
         self.m2.in_arbolate = self.m2.in_arbolate.fillna(0) # replace any nan values with zeros
 
-        # map upsegments for each outlet segment
-        self.map_upsegs()
-
-        # compute starting arbolate sum values for all segments (sum lengths of all mapped upsegs)
-        asum_start = {}
-        for oseg in self.outsegs:
-            asum_start[oseg] = 0
-            for us in self.upsegs[oseg]:
-                # add the sum of all lengths for the upsegment
-                asum_start[oseg] += self.m1.ix[self.m1.segment == us, 'length'].sum() * self.to_km
-
-                # add on any starting arbolate sum values from outside the model (will add zero if nothing was entered)
-                asum_start[oseg] += self.m2.in_arbolate[us]
-            #print 'outseg: {}, starting arbolate sum: {}'.format(oseg, asum_start[oseg])
+        # compute starting arbolate sum values for all segments, by summing
+        # the lengths of all upstream segments (in one pass over the network),
+        # plus any starting arbolate sum values from outside the model (zero if nothing was entered)
+        network = SegmentNetwork(self.m2.segment.values, self.m2.outseg.values)
+        seglengths = self.m1.groupby('segment').length.sum().reindex(self.m2.segment.values).fillna(0).values
+        upstream_asums = network.upstream_sums(seglengths * self.to_km + self.m2.in_arbolate.values)
 
         # assign the starting arbolate sum values to Mat2
-        asum_starts = [asum_start[i] if i in self.outsegs
-                       else self.m2.ix[i, 'in_arbolate'] for i, r in self.m2.iterrows()]
-        self.m2['starting_arbolate'] = asum_starts
-
-        for s in self.segments:
-
-            segdata = self.m1[self.m1.segment == s] # shouldn't need to sort, as that was done in __init__
+        # (headwater segments start with their own starting arbolate sum values)
+        self.m2['starting_arbolate'] = np.where(network.upstream_counts > 0,
+                                                upstream_asums, self.m2.in_arbolate.values)
 
-            # compute arbolate sum at each reach, in km, including starting values from upstream segments
-            asums = segdata.length.cumsum() * self.to_km + self.m2.ix[s, 'starting_arbolate']
+        # compute arbolate sum at each reach, in km, including starting values from upstream segments
+        # (m1 is sorted by segment and reach in __init__)
+        asums = self.m1.groupby('segment').length.cumsum().values * self.to_km + \
+                self.m2.starting_arbolate.loc[self.m1.segment.values].values
 
-            # compute width, assign to Mat1
-            self.m1.loc[self.m1.segment == s, 'width'] = [self.widthcorrelation(asum) for asum in asums]
+        # compute width, assign to Mat1
+        self.m1['width'] = self.widthcorrelation(asums)
 
         #self.m1.to_csv(self.Mat1_out, index=False)
         print('Done')
@@ -2033,8 +2062,7 @@ class Streamflow(SFRdata):
                     # assign the reach geometry to the streamflow results at that index
                     df.loc[ind, 'geometry'] = r.geometry
             '''
-        # otherwise get the geometries from the dis file and model origin
-        # (right now this does not support rotated grids)
+        # otherwise get the geometries from the dis file and model origin (and rotation)
         # the geometries are for the model cells- collocated reaches will be represented by
         # one model cell polygon for each reach
         else:
@@ -2248,21 +2276,21 @@ class Segments(SFRdata):
         self.m2 = m2
 
         # update upseg references in Mat2
-        self.m2['upsegs'] = [self.m2.segment[self.m2.outseg == s].tolist() for s in self.m2.segment.values]
+        self.m2['upsegs'] = _upsegs(self.m2, self.m2.segment.values)
 
         # update outseg references in Mat1
-        self.m1['outseg'] = [self.m2.outseg[s] for s in self.m1.segment]
+        self.m1['outseg'] = self.m2.outseg.loc[self.m1.segment.values].values
 
         print('\nDone')
 
 
 class Spatial(SFRdata):
 
-    def __init__(self, sfrobject=None, Mat1=None, Mat2=None, sfr=None, xll=0.0, yll=0.0,
+    def __init__(self, sfrobject=None, Mat1=None, Mat2=None, sfr=None, xll=0.0, yll=0.0, rotation=0.0,
                  GIS_mult=0.3048, prj=None, proj4=None, epsg=None):
 
         SFRdata.__init__(self, sfrobject=sfrobject, Mat1=Mat1, Mat2=Mat2, sfr=sfr, xll=xll, yll=yll,
-                         GIS_mult=GIS_mult, prj=prj, proj4=proj4, epsg=epsg)
+                         rotation=rotation, GIS_mult=GIS_mult, prj=prj, proj4=proj4, epsg=epsg)
 
     def intersect_with_SFR_cells(self, intersect_df=None, intersect_shapefile=None, intersect_prj=None,
                                  sfr_shapefile=None,
@@ -2276,7 +2304,6 @@ class Spatial(SFRdata):
 
             self.get_cell_geometries()
 
-            self.m1['geometry'] = [self.cell_geometries[n] for n in self.m1.node]
             if self.proj4 is None:
                 print('No coordinate projection supplied for SFR cells.')
 
@@ -2313,7 +2340,7 @@ class Spatial(SFRdata):
                 intersect_proj4 = GISio.get_proj4(intersect_prj)
 
             print('Reprojecting from:\n{}\nto:\n{}\n...'.format(intersect_proj4, self.proj4))
-            dfi['geometry'] = GISops.projectdf(dfi, intersect_proj4, self.proj4)
+            dfi['geometry'] = project_geoms(dfi.geometry, intersect_proj4, self.proj4)
         else:
             print('SFR cells are assumed to be in same coordinate system as {}.'.format(intersect_name))
 
@@ -2321,9 +2348,12 @@ class Spatial(SFRdata):
         # note that because this uses cell centroids,
         # it may miss intersect features that only nick the outside of the grid
         print('Discarding features outside of SFR network bounding box...')
-        geom = self.m1.geometry.tolist()
-        xmin, ymin = np.min([p.centroid.xy[0] for p in geom]), np.min([p.centroid.xy[1] for p in geom])
-        xmax, ymax = np.max([p.centroid.xy[0] for p in geom]), np.max([p.centroid.xy[1] for p in geom])
+        if sfr_shapefile is None:
+            centroids = self.structured_grid.cell_centroids(self.m1.node.values)
+        else:
+            centroids = np.array([p.centroid.coords[0] for p in self.m1.geometry])
+        xmin, ymin = centroids.min(axis=0)
+        xmax, ymax = centroids.max(axis=0)
         bbox = Polygon([(xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin)])
         dfi = dfi.ix[[f.intersects(bbox) for f in dfi.geometry], :].copy()
 
@@ -2,14 +2,23 @@ __author__ = 'aleaf'
 import warnings
 import time
 import operator
+import hashlib
 import numpy as np
 import pandas as pd
 import fiona
-from shapely.geometry import Point, LineString, Polygon, shape
-from shapely.ops import unary_union
+from shapely.geometry import Point, LineString, Polygon, MultiPolygon, shape
+from shapely.prepared import prep
 from GISio import shp2df, df2shp, get_proj4
-from GISops import project, projectdf, build_rtree_index, intersect_rtree
+from GISops import build_rtree_index, intersect_rtree
 import GISops
+from grid import StructuredGrid, VertexGrid, domain_from_cells
+from routing import RoutingGraph, SegmentNetwork, DownstreamPaths, breadth_first_order
+from cache import read_cached
+from dbf import read_dbf
+from projection import project_geoms
+from linework import LineArray
+from runreport import RunReport
+from mattables import write_table
 
 class linesBase(object):
 
@@ -17,9 +26,9 @@ class linesBase(object):
                  mf_grid=None, mf_grid_node_col=None,
                  nrows=None, ncols=None,
                  mfdis=None, xul=None, yul=None, rot=0,
-                 model_domain=None,
+                 model_domain=None, ibound=None,
                  lines_proj4=None, mfgrid_proj4=None, domain_proj4=None,
-                 mf_units='feet'):
+                 mf_units='feet', report=None):
         """Class for working with information from NHDPlus v2.
         See the user's guide for more information:
         <http://www.horizon-systems.com/NHDPlus/NHDPlusV2_documentation.php#NHDPlusV2 User Guide>
@@ -29,8 +38,10 @@ class linesBase(object):
         lines : str, list of strings or dataframe
             Shapefile, list of shapefiles, or dataframe with linework defining SFR network;
             assigned to the Flowline attribute.
-        mf_grid : str or dataframe
-            Shapefile or dataframe containing MODFLOW grid
+        mf_grid : str, dataframe, grid.StructuredGrid or grid.VertexGrid
+            Shapefile or dataframe containing MODFLOW grid polygons,
+            StructuredGrid instance defining a regular (possibly rotated) grid,
+            or VertexGrid instance defining an unstructured (e.g. DISV or quadtree) grid
         mf_grid_node_col : str
             Column in grid shapefile or dataframe with unique node numbers.
             In case the grid isn't sorted!
@@ -40,16 +51,24 @@ class linesBase(object):
         ncols : int
             (structured grids) Number of model columns
         mfdis : str
-            MODFLOW discretization file (not yet supported for this class)
+            MODFLOW discretization file, used instead of a grid shapefile to define a structured grid
+            (see grid.StructuredGrid). Flowlines are then broken into reaches by walking them across
+            the grid, without building cell polygons. Requires mfgrid_proj4.
         xul : float, optional
             x offset of upper left corner of grid. Only needed if using mfdis instead of shapefile
         yul : float, optional
             y offset of upper left corner of grid. Only needed if using mfdis instead of shapefile
         rot : float, optional (default 0)
-            Grid rotation; only needed if using mfdis instead of shapefile.
+            Grid rotation (degrees counter-clockwise about the upper left corner);
+            only needed if using mfdis instead of shapefile.
         model_domain : str (shapefile) or shapely polygon, optional
             Polygon defining area in which to create SFR cells.
             Default is to create SFR at all intersections between the model grid and NHD flowlines.
+        ibound : 2-D array, optional
+            (nrows, ncols) array (e.g. IBOUND, or IDOMAIN for layer 1) of active cells (non-zero values),
+            or (ncells) array for a VertexGrid;
+            used to set the model domain if model_domain isn't supplied.
+            The default is the extent of the grid.
         lines_proj4 : str, optional
             Proj4 string for coordinate system of NHDFlowlines.
             Only needed if flowlines are supplied in a dataframe.
@@ -58,9 +77,16 @@ class linesBase(object):
             Only needed if model_domain is supplied as a polygon.
         mf_units : str, 'feet' or 'meters'
             Length units of MODFLOW model
+        report : runreport.RunReport, optional
+            Report for recording the time, CPU time, memory use and item counts for each stage
+            of reading the input and building the SFR dataset (report attribute);
+            supply one to set up profiling of the stages. By default, a new RunReport is created.
         """
         self.df = lines
         self.mf_grid = mf_grid
+        self.structured_grid = None # grid.StructuredGrid (or VertexGrid) instance, if grid isn't defined by polygons
+        self.reach_geoms = None # linework.LineArray of reach geometries (see m1 geom_id column)
+        self.report = report if report is not None else RunReport()
         self.model_domain = model_domain
         self.nrows = nrows
         self.ncols = ncols
@@ -79,38 +105,40 @@ class linesBase(object):
         self.mf_grid_proj4 = mfgrid_proj4
         self.domain_proj4 = domain_proj4
 
-        print("Reading input...")
-        # handle dataframes or shapefiles as arguments
-        # get proj4 for any shapefiles that are submitted
-        for attr, input in {'df': lines,
-                            'grid': mf_grid}.items():
-            if isinstance(input, pd.DataFrame):
-                self.__dict__[attr] = input
+        with self.report.stage('read') as stage:
+            print("Reading input...")
+            # handle dataframes or shapefiles as arguments
+            # get proj4 for any shapefiles that are submitted
+            for attr, input in {'df': lines,
+                                'grid': mf_grid}.items():
+                if attr == 'grid' and (isinstance(input, (StructuredGrid, VertexGrid)) or input is None and mfdis is not None):
+                    self.structured_grid = input # (StructuredGrid is created from mfdis below)
+                    self.grid = None
+                elif isinstance(input, pd.DataFrame):
+                    self.__dict__[attr] = input
+                else:
+                    self.__dict__[attr] = shp2df(input)
+            if isinstance(model_domain, Polygon):
+                self.domain = model_domain
+            elif isinstance(model_domain, str):
+                self.domain = shape(fiona.open(model_domain).next()['geometry'])
+                self.domain_proj4 = get_proj4(model_domain)
             else:
-                self.__dict__[attr] = shp2df(input)
-        if isinstance(model_domain, Polygon):
-            self.domain = model_domain
-        elif isinstance(model_domain, str):
-            self.domain = shape(fiona.open(model_domain).next()['geometry'])
-            self.domain_proj4 = get_proj4(model_domain)
-        else:
-            print('setting model domain to extent of grid ' \
-                  'by performing unary union of grid cell geometries...\n' \
-                  '(may take a few minutes for large grids)')
-            # add tiny buffer to overcome floating point errors in gridcell geometries
-            # (otherwise a multipolygon feature may be returned)
-            geoms = [g.buffer(0.001) for g in self.grid.geometry.tolist()]
-            self.domain = unary_union(geoms)
+                self.domain = None # set from the grid (below)
+            stage['items'] = len(self.df)
 
         # sort and pair down the grid
-        if mf_grid_node_col is not None:
+        if self.grid is None:
+            pass
+        elif mf_grid_node_col is not None:
             self.grid.sort_values(by=mf_grid_node_col, inplace=True)
             if len(self.grid) != self.grid[mf_grid_node_col].max():
                 warnings.warn(NodeIndexWarning(mf_grid, mf_grid_node_col))
             self.grid.index = self.grid[mf_grid_node_col].values
         else:
             warnings.warn(NodeIndexWarning(mf_grid))
-        self.grid = self.grid[['geometry']]
+        if self.grid is not None:
+            self.grid = self.grid[['geometry']]
 
         # get projections
         if self.mf_grid_proj4 is None and not isinstance(mf_grid, pd.DataFrame):
@@ -122,6 +150,8 @@ class linesBase(object):
                 self.proj4 = get_proj4(lines)
 
         # first check that grid is in projected units
+        if self.mf_grid_proj4 is None:
+            raise ValueError('mfgrid_proj4 must be supplied if the grid is not read from a shapefile.')
         if self.mf_grid_proj4.split('proj=')[1].split()[0].strip() == 'longlat':
             raise ProjectionError(self.mf_grid)
 
@@ -136,38 +166,74 @@ class linesBase(object):
                              else 1.0
         self.to_km = 0.001 if self.GISunits == 'm' else 0.001/0.3048
 
+        # set up structured grid from the MODFLOW DIS file (in model units)
+        if self.grid is None:
+            if self.structured_grid is None:
+                self.structured_grid = StructuredGrid.from_dis(mfdis, xul=xul, yul=yul, rot=rot,
+                                                               length_mult=1/self.mf_units_mult)
+            if isinstance(self.structured_grid, StructuredGrid):
+                self.nrows, self.ncols = self.structured_grid.nrow, self.structured_grid.ncol
+
+        if self.domain is None:
+            self.domain = model_domain_from_grid(self.grid, self.structured_grid, ibound)
 
-        if different_projections(self.proj4, self.mf_grid_proj4):
-            print("reprojecting NHDFlowlines from\n{}\nto\n{}...".format(self.proj4, self.mf_grid_proj4))
-            self.df['geometry'] = projectdf(self.df, self.proj4, self.mf_grid_proj4)
 
-        if model_domain is not None \
-                and different_projections(self.domain_proj4, self.mf_grid_proj4):
-            print("reprojecting model domain from\n{}\nto\n{}...".format(self.domain_proj4, self.mf_grid_proj4))
-            self.domain = project(self.domain, self.domain_proj4, self.mf_grid_proj4)
+        with self.report.stage('reproject') as stage:
+            if different_projections(self.proj4, self.mf_grid_proj4):
+                print("reprojecting NHDFlowlines from\n{}\nto\n{}...".format(self.proj4, self.mf_grid_proj4))
+                self.df['geometry'] = project_geoms(self.df.geometry, self.proj4, self.mf_grid_proj4)
+
+            if model_domain is not None \
+                    and different_projections(self.domain_proj4, self.mf_grid_proj4):
+                print("reprojecting model domain from\n{}\nto\n{}...".format(self.domain_proj4, self.mf_grid_proj4))
+                self.domain = project_geoms([self.domain], self.domain_proj4, self.mf_grid_proj4)[0]
+            stage['items'] = len(self.df)
+        self.prepared_domain = prep(self.domain) # for fast intersects tests in clipping the lines
 
     def renumber_segments(self):
         """Renumber segments so that segment numbering is continuous and always increases
         in the downstream direction. Experience suggests that this can substantially speed
         convergence for some models using the NWT solver."""
-        r = renumber_segments(self.m2.segment.values, self.m2.outseg.values)
+        r, remap = renumber_segments(self.m2.segment.values, self.m2.outseg.values, return_remap=True)
 
-        self.m2['segment'] = [r.get(s, s) for s in self.m2.segment]
-        self.m2['outseg'] = [r.get(s, s) for s in self.m2.outseg]
+        self.m2['segment'] = remap_segments(remap, self.m2.segment.values)
+        self.m2['outseg'] = remap_segments(remap, self.m2.outseg.values)
         self.m2.sort_values(by=['segment'], inplace=True)
         self.m2.index = self.m2.segment.values # reset the index to new segment numbers
         assert _in_order(self.m2.segment.values, self.m2.outseg.values)
         assert len(self.m2.segment) == self.m2.segment.max()
-        self.m1['segment'] = [r.get(s, s) for s in self.m1.segment]
-        self.m1['outseg'] = [r.get(s, s) for s in self.m1.outseg]
+        self.m1['segment'] = remap_segments(remap, self.m1.segment.values)
+        self.m1['outseg'] = remap_segments(remap, self.m1.outseg.values)
+
+    def append(self, other):
+        """Append the SFR dataset (m1, m2 and reach_geoms) of another NHDdata or lines instance
+        (e.g. lines set up with append2sfr) to this one, and renumber the segments.
+
+        The geom_id column of the appended Mat1 is offset by the number of reach geometries
+        in this dataset, so that it refers to the combined reach_geoms.
 
-    def write_tables(self, basename='SFR'):
+        Parameters
+        ----------
+        other : NHDdata or lines instance
+        """
+        self.m1, self.m2, self.reach_geoms = _append_sfr(self, other)
+        self.renumber_segments()
+        self.m1.sort_values(by=['segment', 'reach'], inplace=True)
+        self.m1.index = np.arange(len(self.m1))
+        if 'ReachID' in self.m1.columns:
+            self.m1['ReachID'] = np.arange(1, len(self.m1) + 1)
+
+    def write_tables(self, basename='SFR', binary=False):
         """Write tables with SFR reach (Mat1) and segment (Mat2) information out to csv files.
 
         Parameters
         ----------
         basename: string
             e.g. Mat1 is written to <basename>Mat1.csv
+        binary : bool
+            Write the tables in typed binary format instead (<basename>Mat1.arrow, <basename>Mat2.arrow;
+            see mattables.write_table), with the reach geometries in Mat1. These can be loaded
+            by postproc.SFRdata much faster than csv files. Requires pyarrow.
         """
         m1_cols = ['node', 'layer', 'segment', 'reach', 'sbtop', 'width', 'length', 'sbthick',
                    'sbK', 'roughness', 'asum', 'reachID']
@@ -177,9 +243,17 @@ class linesBase(object):
 
         if self.ncols is not None:
             m1_cols.insert(2, 'column')
-        print("writing Mat1 to {0}{1}, Mat2 to {0}{2}".format(basename, 'Mat1.csv', 'Mat2.csv'))
-        self.m1[m1_cols].to_csv(basename + 'Mat1.csv', index=False)
-        self.m2[m2_cols].to_csv(basename + 'Mat2.csv', index=False)
+        with self.report.stage('write') as stage:
+            if binary:
+                print("writing Mat1 to {0}{1}, Mat2 to {0}{2}".format(basename, 'Mat1.arrow', 'Mat2.arrow'))
+                write_table(self.m1[m1_cols], basename + 'Mat1.arrow', table_name='Mat1',
+                            reach_geoms=self.reach_geoms.take(self.m1.geom_id.values))
+                write_table(self.m2[m2_cols], basename + 'Mat2.arrow', table_name='Mat2')
+            else:
+                print("writing Mat1 to {0}{1}, Mat2 to {0}{2}".format(basename, 'Mat1.csv', 'Mat2.csv'))
+                self.m1[m1_cols].to_csv(basename + 'Mat1.csv', index=False)
+                self.m2[m2_cols].to_csv(basename + 'Mat2.csv', index=False)
+            stage['items'] = len(self.m1)
 
     def write_linework_shapefile(self, basename='SFR'):
         """Write a shapefile containing linework for each SFR reach,
@@ -190,9 +264,12 @@ class linesBase(object):
         basename: string
             Output will be written to <basename>.shp
         """
-        print("writing reach geometries to {}".format(basename+'.shp'))
-        df2shp(self.m1[['reachID', 'node', 'segment', 'reach', 'outseg', 'comid', 'asum', 'width', 'geometry']],
-               basename+'.shp', proj4=self.mf_grid_proj4)
+        with self.report.stage('write') as stage:
+            print("writing reach geometries to {}".format(basename+'.shp'))
+            df = self.m1[['reachID', 'node', 'segment', 'reach', 'outseg', 'comid', 'asum', 'width']].copy()
+            df['geometry'] = self.reach_geoms.take(self.m1.geom_id.values).to_geoms()
+            df2shp(df, basename+'.shp', proj4=self.mf_grid_proj4)
+            stage['items'] = len(df)
 
 
 class NHDdata(object):
@@ -205,9 +282,9 @@ class NHDdata(object):
                  mf_grid=None, mf_grid_node_col=None,
                  nrows=None, ncols=None,
                  mfdis=None, xul=None, yul=None, rot=0,
-                 model_domain=None,
+                 model_domain=None, ibound=None,
                  flowlines_proj4=None, mfgrid_proj4=None, domain_proj4=None,
-                 mf_units='feet'):
+                 mf_units='feet', cache_dir=None, report=None):
         """Class for working with information from NHDPlus v2.
         See the user's guide for more information:
         <http://www.horizon-systems.com/NHDPlus/NHDPlusV2_documentation.php#NHDPlusV2 User Guide>
@@ -223,8 +300,10 @@ class NHDdata(object):
         PlusFlow : str, list of strings or dataframe
             DBF file, list of DBF files with routing information;
             assigned to PlusFlow attribute.
-        mf_grid : str or dataframe
-            Shapefile or dataframe containing MODFLOW grid
+        mf_grid : str, dataframe, grid.StructuredGrid or grid.VertexGrid
+            Shapefile or dataframe containing MODFLOW grid polygons,
+            StructuredGrid instance defining a regular (possibly rotated) grid,
+            or VertexGrid instance defining an unstructured (e.g. DISV or quadtree) grid
         mf_grid_node_col : str
             Column in grid shapefile or dataframe with unique node numbers.
             In case the grid isn't sorted!
@@ -234,16 +313,24 @@ class NHDdata(object):
         ncols : int
             (structured grids) Number of model columns
         mfdis : str
-            MODFLOW discretization file (not yet supported for this class)
+            MODFLOW discretization file, used instead of a grid shapefile to define a structured grid
+            (see grid.StructuredGrid). Flowlines are then broken into reaches by walking them across
+            the grid, without building cell polygons. Requires mfgrid_proj4.
         xul : float, optional
             x offset of upper left corner of grid. Only needed if using mfdis instead of shapefile
         yul : float, optional
             y offset of upper left corner of grid. Only needed if using mfdis instead of shapefile
         rot : float, optional (default 0)
-            Grid rotation; only needed if using mfdis instead of shapefile.
+            Grid rotation (degrees counter-clockwise about the upper left corner);
+            only needed if using mfdis instead of shapefile.
         model_domain : str (shapefile) or shapely polygon, optional
             Polygon defining area in which to create SFR cells.
             Default is to create SFR at all intersections between the model grid and NHD flowlines.
+        ibound : 2-D array, optional
+            (nrows, ncols) array (e.g. IBOUND, or IDOMAIN for layer 1) of active cells (non-zero values),
+            or (ncells) array for a VertexGrid;
+            used to set the model domain if model_domain isn't supplied.
+            The default is the extent of the grid.
         flowlines_proj4 : str, optional
             Proj4 string for coordinate system of NHDFlowlines.
             Only needed if flowlines are supplied in a dataframe.
@@ -252,6 +339,15 @@ class NHDdata(object):
             Only needed if model_domain is supplied as a polygon.
         mf_units : str, 'feet' or 'meters'
             Length units of MODFLOW model
+        cache_dir : str, optional
+            Folder for caching the NHDPlus files (pruned to the columns used by SFRmaker),
+            so that subsequent runs don't have to re-parse them (see cache.read_cached).
+            The cache is refreshed when a file's size or modification time changes.
+            Requires pyarrow. By default, the files are read without caching.
+        report : runreport.RunReport, optional
+            Report for recording the time, CPU time, memory use and item counts for each stage
+            of reading the input and building the SFR dataset (report attribute);
+            supply one to set up profiling of the stages. By default, a new RunReport is created.
         """
         self.Flowline = NHDFlowline
         self.PlusFlowlineVAA = PlusFlowlineVAA
@@ -263,8 +359,26 @@ class NHDdata(object):
                           'REACHCODE', 'RESOLUTION', 'WBAREACOMI', 'geometry']
         self.pfvaa_cols = ['ArbolateSu', 'Hydroseq', 'DnHydroseq',
                       'LevelPathI', 'StreamOrde']
+        # columns read from the input tables
+        input_cols = {'fl': self.fl_cols,
+                      'pf': ['FROMCOMID', 'TOCOMID'],
+                      'pfvaa': ['ComID'] + self.pfvaa_cols,
+                      'elevs': ['COMID', 'MAXELEVSMO', 'MINELEVSMO']}
 
         self.mf_grid = mf_grid
+        self.structured_grid = None # grid.StructuredGrid (or VertexGrid) instance, if grid isn't defined by polygons
+        self.routing = None # routing.RoutingGraph of PlusFlow table (built in list_updown_comids)
+        self.m1 = None
+        self.m2 = None
+        self.reach_geoms = None # linework.LineArray of reach geometries (see m1 geom_id column)
+        self.fl_hashes = None # hash of each flowline geometry (clipped), by COMID (set in to_sfr)
+        self._reach_cache = None # hashes and reaches from previous build (see update_sfr)
+        self._clip_results = None # clipping status, clipped geometry and hash of each flowline, by COMID
+        self._clip_cache = None # clipping results from previous build, for unedited flowlines (see update_sfr)
+        self._crawl_results = None # next COMID in the model for each PlusFlow TOCOMID outside of it
+        self._crawl_cache = None # crawl results from previous build, that are still valid (see update_sfr)
+        self._grid_index = None # spatial index of the grid cell polygons (built in _make_mat1)
+        self.report = report if report is not None else RunReport()
         self.model_domain = model_domain
         self.nrows = nrows
         self.ncols = ncols
@@ -283,34 +397,42 @@ class NHDdata(object):
         self.mf_grid_proj4 = mfgrid_proj4
         self.domain_proj4 = domain_proj4
 
-        print("Reading input...")
-        # handle dataframes or shapefiles as arguments
-        # get proj4 for any shapefiles that are submitted
-        for attr, input in {'fl': NHDFlowline,
-                            'pf': PlusFlow,
-                            'pfvaa': PlusFlowlineVAA,
-                            'elevs': elevslope,
-                            'grid': mf_grid}.items():
-            if isinstance(input, pd.DataFrame):
-                self.__dict__[attr] = input
+        with self.report.stage('read') as stage:
+            print("Reading input...")
+            # handle dataframes or shapefiles as arguments
+            # get proj4 for any shapefiles that are submitted
+            pending = {}
+            for attr, input in {'fl': NHDFlowline,
+                                'pf': PlusFlow,
+                                'pfvaa': PlusFlowlineVAA,
+                                'elevs': elevslope,
+                                'grid': mf_grid}.items():
+                if attr == 'grid' and (isinstance(input, (StructuredGrid, VertexGrid)) or input is None and mfdis is not None):
+                    self.structured_grid = input # (StructuredGrid is created from mfdis below)
+                    self.grid = None
+                elif isinstance(input, pd.DataFrame):
+                    self.__dict__[attr] = input
+                elif cache_dir is not None and attr in input_cols:
+                    self.__dict__[attr] = read_cached(input, input_cols[attr], cache_dir)
+                elif attr == 'pf' and _is_dbf(input):
+                    self.__dict__[attr] = read_dbf(input, input_cols[attr])
+                elif attr in ['pfvaa', 'elevs'] and _is_dbf(input):
+                    pending[attr] = input # only read records for flowlines in the model domain (below)
+                else:
+                    self.__dict__[attr] = shp2df(input)
+            if isinstance(model_domain, Polygon):
+                self.domain = model_domain
+            elif isinstance(model_domain, str):
+                self.domain = shape(fiona.open(model_domain).next()['geometry'])
+                self.domain_proj4 = get_proj4(model_domain)
             else:
-                self.__dict__[attr] = shp2df(input)
-        if isinstance(model_domain, Polygon):
-            self.domain = model_domain
-        elif isinstance(model_domain, str):
-            self.domain = shape(fiona.open(model_domain).next()['geometry'])
-            self.domain_proj4 = get_proj4(model_domain)
-        else:
-            print('setting model domain to extent of grid ' \
-                  'by performing unary union of grid cell geometries...\n' \
-                  '(may take a few minutes for large grids)')
-            # add tiny buffer to overcome floating point errors in gridcell geometries
-            # (otherwise a multipolygon feature may be returned)
-            geoms = [g.buffer(0.001) for g in self.grid.geometry.tolist()]
-            self.domain = unary_union(geoms)
+                self.domain = None # set from the grid (below)
+            stage['items'] = len(self.fl)
 
         # sort and pair down the grid
-        if mf_grid_node_col is not None:
+        if self.grid is None:
+            pass
+        elif mf_grid_node_col is not None:
             self.grid.sort_values(by=mf_grid_node_col, inplace=True)
             if len(self.grid) != self.grid[mf_grid_node_col].max():
                 warnings.warn(NodeIndexWarning(mf_grid, mf_grid_node_col))
@@ -331,10 +453,14 @@ class NHDdata(object):
         for attr, index in {'fl': 'COMID',
                             'pfvaa': 'ComID',
                             'elevs': 'COMID'}.items():
+            if attr in pending:
+                continue
             if not self.__dict__[attr].index.name == index:
                 self.__dict__[attr].index = self.__dict__[attr][index]
 
         # first check that grid is in projected units
+        if self.mf_grid_proj4 is None:
+            raise ValueError('mfgrid_proj4 must be supplied if the grid is not read from a shapefile.')
         if self.mf_grid_proj4.split('proj=')[1].split()[0].strip() == 'longlat':
             raise ProjectionError(self.mf_grid)
 
@@ -349,44 +475,79 @@ class NHDdata(object):
                              else 1.0
         self.to_km = 0.001 if self.GISunits == 'm' else 0.001 * 0.3048
 
+        # set up structured grid from the MODFLOW DIS file (in model units)
+        if self.grid is None:
+            if self.structured_grid is None:
+                self.structured_grid = StructuredGrid.from_dis(mfdis, xul=xul, yul=yul, rot=rot,
+                                                               length_mult=1/self.mf_units_mult)
+            if isinstance(self.structured_grid, StructuredGrid):
+                self.nrows, self.ncols = self.structured_grid.nrow, self.structured_grid.ncol
+
+        if self.domain is None:
+            self.domain = model_domain_from_grid(self.grid, self.structured_grid, ibound)
+
+        with self.report.stage('reproject') as stage:
+            if different_projections(self.fl_proj4, self.mf_grid_proj4):
+                print("reprojecting NHDFlowlines from\n{}\nto\n{}...".format(self.fl_proj4, self.mf_grid_proj4))
+                self.fl['geometry'] = project_geoms(self.fl.geometry, self.fl_proj4, self.mf_grid_proj4)
+
+            if model_domain is not None \
+                    and different_projections(self.domain_proj4, self.mf_grid_proj4):
+                print("reprojecting model domain from\n{}\nto\n{}...".format(self.domain_proj4, self.mf_grid_proj4))
+                self.domain = project_geoms([self.domain], self.domain_proj4, self.mf_grid_proj4)[0]
+            stage['items'] = len(self.fl)
+        self.prepared_domain = prep(self.domain) # for fast intersects tests in clipping the lines
+
+        # read the attribute tables for the flowlines within the bounding box of the model domain
+        if len(pending) > 0:
+            with self.report.stage('read_attributes') as stage:
+                bounds = np.array([g.bounds for g in self.fl.geometry])
+                x0, y0, x1, y1 = self.domain.bounds
+                in_bbox = (bounds[:, 0] <= x1) & (bounds[:, 2] >= x0) & \
+                          (bounds[:, 1] <= y1) & (bounds[:, 3] >= y0)
+                comids = self.fl.COMID.values[in_bbox]
+                for attr, input in pending.items():
+                    index = input_cols[attr][0]
+                    self.__dict__[attr] = read_dbf(input, input_cols[attr], index, comids)
+                    self.__dict__[attr].index = self.__dict__[attr][index]
+                stage['items'] = len(comids)
+
         # convert the elevations from elevslope table
         self.elevs['Max'] = self.elevs.MAXELEVSMO * self.convert_elevslope_to_model_units[self.mf_units]
         self.elevs['Min'] = self.elevs.MINELEVSMO * self.convert_elevslope_to_model_units[self.mf_units]
 
-        if different_projections(self.fl_proj4, self.mf_grid_proj4):
-            print("reprojecting NHDFlowlines from\n{}\nto\n{}...".format(self.fl_proj4, self.mf_grid_proj4))
-            self.fl['geometry'] = projectdf(self.fl, self.fl_proj4, self.mf_grid_proj4)
-
-        if model_domain is not None \
-                and different_projections(self.domain_proj4, self.mf_grid_proj4):
-            print("reprojecting model domain from\n{}\nto\n{}...".format(self.domain_proj4, self.mf_grid_proj4))
-            self.domain = project(self.domain, self.domain_proj4, self.mf_grid_proj4)
-
     def list_updown_comids(self):
         print('getting routing information from NHDPlus Plusflow table...')
         # setup local variables and cull plusflow table to comids in model
         comids = self.df.index.tolist()
-        pf = self.pf.ix[(self.pf.FROMCOMID.isin(comids)) |
-                        (self.pf.TOCOMID.isin(comids))].copy()
+        pf = self.pf.loc[(self.pf.FROMCOMID.isin(comids)) |
+                         (self.pf.TOCOMID.isin(comids))].copy()
 
         # subset PlusFlow entries for comids that are not in flowlines dataset
         # comids may be missing because they are outside of the model
         # or if the flowlines dataset was edited (resulting in breaks in the routing)
         missing_tocomids = ~pf.TOCOMID.isin(comids) & (pf.TOCOMID != 0)
-        missing = pf.ix[missing_tocomids, ['FROMCOMID', 'TOCOMID']].copy()
-        # recursively crawl the PlusFlow table
+        # crawl the PlusFlow routing graph (for all missing comids at once)
         # to try to find a downstream comid in the flowlines dataest
-        missing['nextCOMID'] = [find_next(tc, self.pf, comids) for tc in missing.TOCOMID]
-        pf.loc[missing_tocomids, 'TOCOMID'] = missing.nextCOMID
+        # (only for missing comids that weren't crawled in the previous build; see update_sfr)
+        if self.routing is None:
+            self.routing = RoutingGraph.from_plusflow(self.pf)
+        tocomids = pf.TOCOMID.values[missing_tocomids.values]
+        crawled = self._crawl_cache if self._crawl_cache is not None else pd.Series(dtype=np.int64)
+        self._crawl_cache = None
+        new = np.setdiff1d(tocomids, crawled.index.values)
+        if len(new) > 0:
+            crawled = pd.concat([crawled, pd.Series(self.routing.next_in_set(new, comids), index=new)])
+        self._crawl_results = crawled.loc[np.unique(tocomids)]
+        pf.loc[missing_tocomids, 'TOCOMID'] = crawled.loc[tocomids].values
 
         # set any remaining comids not in model to zero
         # (outlets or inlets from outside model)
         #pf.loc[~pf.TOCOMID.isin(comids), 'TOCOMID'] = 0 (these should all be handled above)
         pf.loc[~pf.FROMCOMID.isin(comids), 'FROMCOMID'] = 0
-        tocomid = pf.TOCOMID.values
-        fromcomid = pf.FROMCOMID.values
-        self.df['dncomids'] = [tocomid[fromcomid == c].tolist() for c in comids]
-        self.df['upcomids'] = [fromcomid[tocomid == c].tolist() for c in comids]
+        model_routing = RoutingGraph.from_plusflow(pf)
+        self.df['dncomids'] = model_routing.downstream(comids)
+        self.df['upcomids'] = model_routing.upstream(comids)
 
     def assign_segments(self):
         print('assigning segment numbers...')
@@ -397,14 +558,14 @@ class NHDdata(object):
         braids = self.df[np.array([len(d) for d in self.df.dncomids]) > 1]
         for i, r in braids.iterrows():
             # select the dncomid that has a matching levelpath
-            levelpath_matches = self.df.ix[r.dncomids, 'LevelPathI'].values == r.LevelPathI
+            levelpath_matches = self.df.loc[r.dncomids, 'LevelPathI'].values == r.LevelPathI
             in_same_levelpath = np.array(r.dncomids)[levelpath_matches]
             # if none match, select the first dncomid
             if len(in_same_levelpath) == 0:
                 dncomid = [r.dncomids[0]]
             else:
                 dncomid = np.unique(in_same_levelpath).tolist()
-            self.df.set_value(i, 'dncomids', dncomid)
+            self.df.at[i, 'dncomids'] = dncomid
 
         # assign upsegs and outsegs based on NHDPlus routing
         self.df['upsegs'] = [[self.df.segment[c] if c != 0 else 0 for c in comids] for comids in self.df.upcomids]
@@ -416,8 +577,30 @@ class NHDdata(object):
     def to_sfr(self, roughness=0.037, streambed_thickness=1, streambedK=1,
                icalc=1,
                iupseg=0, iprior=0, nstrpts=0, flow=0, runoff=0, etsw=0, pptsw=0,
-               roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0):
+               roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0,
+               reach_ordering='nearest', n_workers=1, tile_shape=None):
+        """Convert NHDPlus flowlines to SFR input.
 
+        Creates Mat1 (m1) and Mat2 (m2) attributes.
+
+        Parameters
+        ----------
+        reach_ordering : str, 'nearest' or 'linear'
+            Method used to order reaches within each segment (see create_reaches).
+            'linear' orders reaches by their position along the flowline,
+            and is much faster for long flowlines crossing many cells.
+        n_workers : int
+            Number of processes to use in setting up the reaches (default 1).
+            Results are identical to those produced with a single process.
+        tile_shape : tuple of ints, optional
+            (rows, columns) of model cells in each tile, for intersecting the flowlines with
+            the grid cell polygons one tile at a time (see make_mat1_tiled), so that the spatial index
+            and intersection results are only built for one tile at a time. For grids defined by mfdis
+            (or a StructuredGrid), the cell polygons are also only made for one tile at a time;
+            polygons read from a grid shapefile are held in memory in full.
+            Reaches are ordered by linear referencing.
+            Requires nrows and ncols for grids read from a shapefile.
+        """
 
         # create a working dataframe
         self.df = self.fl[self.fl_cols].join(self.pfvaa[self.pfvaa_cols], how='inner')
@@ -426,51 +609,106 @@ class NHDdata(object):
         self.df = self.df.join(self.elevs[['Max', 'Min']], how='inner')
         self.df.rename(columns={'Max': 'elevMax', 'Min': 'elevMin'}, inplace=True)
 
-        print('\nclipping flowlines to active area...')
-        inside = np.array([g.intersects(self.domain) for g in self.df.geometry])
-        self.df = self.df.ix[inside].copy()
-        self.df.sort_values(by='COMID', inplace=True)
-        flowline_geoms = [g.intersection(self.domain) for g in self.df.geometry]
-        grid_geoms = self.grid.geometry.tolist()
-
-        print("intersecting flowlines with grid cells...") # this part crawls in debug mode
-        grid_intersections = GISops.intersect_rtree(grid_geoms, flowline_geoms)
-
-        print("setting up segments... (may take a few minutes for large networks)")
-        ta = time.time()
-        self.list_updown_comids()
-        self.assign_segments()
-        fl_segments = self.df.segment.tolist()
-        fl_comids = self.df.COMID.tolist()
-        print("finished in {:.2f}s\n".format(time.time() - ta))
-
-        print("setting up reaches and Mat1... (may take a few minutes for large grids)")
-        ta = time.time()
-        m1 = make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_geoms, tol=.001)
-        print("finished in {:.2f}s\n".format(time.time() - ta))
-
-        print("computing widths...")
-        m1['length'] = np.array([g.length for g in m1.geometry])
-        lengths = m1[['segment', 'length']].copy()
-        groups = lengths.groupby('segment')
-        # compute arbolate sum at reach midpoints
-        reach_asums = np.concatenate([np.cumsum(grp.length.values[::-1])[::-1] - 0.5*grp.length.values
-                                      for s, grp in groups])
-        segment_asums = np.array([self.df.ArbolateSu.values[s-1] for s in m1.segment.values])
-        reach_asums = -1 * self.to_km * reach_asums + segment_asums # arbolate sums are computed in km
-        m1['asum'] = reach_asums
-        width = width_from_arbolate(reach_asums) # widths are returned in m
-        if self.GISunits != 'm':
-            width = width / 0.3048
-
-        print("multiplying length units by {} to convert from GIS to MODFLOW...".format(self.mf_units_mult))
-        m1['width'] = width * self.mf_units_mult
-        m1['length'] = m1.length * self.mf_units_mult
-
-        m1['roughness'] = roughness
-        m1['sbthick'] = streambed_thickness
-        m1['sbK'] = streambedK
-        m1['sbtop'] = 0
+        with self.report.stage('clip') as stage:
+            print('\nclipping flowlines to active area...')
+            self.df.sort_index(inplace=True) # (indexed by COMID)
+            comids = self.df.index.values
+            status = np.zeros(len(comids), dtype=int)
+            clipped = [None] * len(comids)
+            hashes = [None] * len(comids)
+            to_clip = np.ones(len(comids), dtype=bool)
+            if self._clip_cache is not None:
+                # reuse the clipped flowlines that weren't edited since the last build (see update_sfr)
+                to_clip = ~np.isin(comids, self._clip_cache.index.values)
+                cached = self._clip_cache.loc[comids[~to_clip]]
+                self._clip_cache = None
+                status[~to_clip] = cached.status.values
+                for i, g, h in zip(np.flatnonzero(~to_clip), cached.geometry, cached.hash):
+                    clipped[i], hashes[i] = g, h
+                print('reusing {} clipped flowlines...'.format(len(cached)))
+            new = np.flatnonzero(to_clip)
+            new_clipped, status[new] = clip_to_domain(self.df.geometry.values[new], self.domain,
+                                                      self.prepared_domain, return_status=True)
+            for i, g in zip(new, new_clipped):
+                clipped[i] = g
+                # hash of each clipped flowline, for reusing its reaches in update_sfr
+                hashes[i] = hashlib.sha1(g.wkb).hexdigest() if status[i] > 0 else None
+            self._clip_results = pd.DataFrame({'status': status, 'geometry': clipped, 'hash': hashes},
+                                              index=comids)
+            inside = status > 0
+            self.df = self.df.loc[inside].copy()
+            self.df['clipped'] = status[inside] == 2 # flowlines crossing the domain boundary
+            flowline_geoms = [g for g, i in zip(clipped, inside) if i]
+            self.fl_hashes = pd.Series([h for h, i in zip(hashes, inside) if i], index=comids[inside])
+            stage['items'] = len(flowline_geoms)
+
+        with self.report.stage('routing') as stage:
+            print("setting up segments... (may take a few minutes for large networks)")
+            self.list_updown_comids()
+            self.assign_segments()
+            fl_segments = self.df.segment.tolist()
+            fl_comids = self.df.COMID.tolist()
+            stage['items'] = len(fl_segments)
+
+        with self.report.stage('make_mat1') as stage:
+            print("setting up reaches and Mat1... (may take a few minutes for large grids)")
+            if self._reach_cache is not None:
+                # only make reaches for flowlines that are new or changed since the last build (see update_sfr)
+                old_hashes, old_reaches, old_geoms = self._reach_cache
+                self._reach_cache = None
+                unchanged = (self.fl_hashes == old_hashes.reindex(self.fl_hashes.index)).values
+                print('reusing reaches for {} unchanged flowlines...'.format(unchanged.sum()))
+            else:
+                unchanged = np.zeros(len(flowline_geoms), dtype=bool)
+            changed = np.flatnonzero(~unchanged)
+            m1, reach_geoms = self._make_mat1([flowline_geoms[i] for i in changed],
+                                              [fl_segments[i] for i in changed],
+                                              [fl_comids[i] for i in changed],
+                                              reach_ordering=reach_ordering, n_workers=n_workers,
+                                              tile_shape=tile_shape)
+            if unchanged.any():
+                reused = old_reaches.loc[old_reaches.comid.isin(np.array(fl_comids)[unchanged])].copy()
+                reused['segment'] = self.df.segment.loc[reused.comid.values].values
+                reused_geoms = old_geoms.take(reused.geom_id.values)
+                if m1 is not None:
+                    reused['geom_id'] = np.arange(len(reused)) + len(reach_geoms)
+                    m1 = pd.concat([m1, reused])
+                    reach_geoms = LineArray.concatenate([reach_geoms, reused_geoms])
+                else:
+                    reused['geom_id'] = np.arange(len(reused))
+                    m1, reach_geoms = reused, reused_geoms
+                m1.sort_values(by=['segment', 'reach'], inplace=True)
+                m1.index = np.arange(len(m1))
+                m1['reachID'] = np.arange(len(m1)) + 1
+            # store the reach geometries in Mat1 order
+            self.reach_geoms = reach_geoms.take(m1.geom_id.values)
+            m1['geom_id'] = np.arange(len(m1))
+            stage['items'] = len(m1)
+
+        with self.report.stage('widths') as stage:
+            print("computing widths...")
+            m1['length'] = self.reach_geoms.lengths
+            lengths = m1[['segment', 'length']].copy()
+            groups = lengths.groupby('segment')
+            # compute arbolate sum at reach midpoints
+            reach_asums = np.concatenate([np.cumsum(grp.length.values[::-1])[::-1] - 0.5*grp.length.values
+                                          for s, grp in groups])
+            segment_asums = np.array([self.df.ArbolateSu.values[s-1] for s in m1.segment.values])
+            reach_asums = -1 * self.to_km * reach_asums + segment_asums # arbolate sums are computed in km
+            m1['asum'] = reach_asums
+            width = width_from_arbolate(reach_asums) # widths are returned in m
+            if self.GISunits != 'm':
+                width = width / 0.3048
+
+            print("multiplying length units by {} to convert from GIS to MODFLOW...".format(self.mf_units_mult))
+            m1['width'] = width * self.mf_units_mult
+            m1['length'] = m1.length * self.mf_units_mult
+
+            m1['roughness'] = roughness
+            m1['sbthick'] = streambed_thickness
+            m1['sbK'] = streambedK
+            m1['sbtop'] = 0
+            stage['items'] = len(m1)
 
         if self.nrows is not None:
             m1['row'] = np.floor(m1.node / self.ncols) + 1
@@ -482,43 +720,171 @@ class NHDdata(object):
 
         self.m1 = m1
 
-        print("\nsetting up Mat2...")
-        ta = time.time()
-        self.m2 = self.df[['segment', 'outseg', 'elevMax', 'elevMin']].copy()
-        self.m2['icalc'] = icalc
-        self.m2.index = self.m2.segment
-        print("finished in {:.2f}s\n".format(time.time() - ta))
+        with self.report.stage('make_mat2') as stage:
+            print("\nsetting up Mat2...")
+            self.m2 = self.df[['segment', 'outseg', 'elevMax', 'elevMin']].copy()
+            self.m2['icalc'] = icalc
+            self.m2.index = self.m2.segment.values
+            stage['items'] = len(self.m2)
 
-        # add outseg information to Mat1
-        self.m1['outseg'] = [self.m2.outseg[s] for s in self.m1.segment]
+        with self.report.stage('renumber') as stage:
+            # add outseg information to Mat1
+            self.m1['outseg'] = [self.m2.outseg[s] for s in self.m1.segment]
+
+            self.renumber_segments() # enforce best segment numbering
+            self.m1.sort_values(by=['segment', 'reach'], inplace=True)
+            self.m1['ReachID'] = np.arange(1, len(self.m1) + 1)
+            stage['items'] = len(self.m2)
 
-        self.renumber_segments() # enforce best segment numbering
-        self.m1.sort_values(by=['segment', 'reach'], inplace=True)
-        self.m1['ReachID'] = np.arange(1, len(self.m1) + 1)
         print('\nDone creating SFR dataset.')
 
+    def _make_mat1(self, flowline_geoms, fl_segments, fl_comids, reach_ordering='nearest', n_workers=1,
+                   tile_shape=None):
+        """Create Mat1 for a list of (clipped) flowlines, using the grid intersection method for
+        the type of grid and options (see to_sfr). Returns Mat1 and a LineArray of the reach geometries,
+        or None, None if there are no flowlines."""
+        if len(flowline_geoms) == 0:
+            return None, None
+        if tile_shape is not None:
+            if isinstance(self.structured_grid, StructuredGrid):
+                # cell polygons are made from the grid definition, one tile at a time
+                grid = self.structured_grid
+            elif self.grid is not None:
+                if self.nrows is None or self.ncols is None:
+                    raise ValueError('nrows and ncols are needed for tiled processing.')
+                grid = self.grid.geometry.tolist()
+            else:
+                raise ValueError('tiled processing requires a structured grid.')
+            return make_mat1_tiled(flowline_geoms, fl_segments, fl_comids, grid, self.nrows, self.ncols,
+                                   tile_shape=tile_shape, n_workers=n_workers, geometry_array=True)
+        if self.structured_grid is not None:
+            return make_mat1_from_grid(flowline_geoms, fl_segments, fl_comids, self.structured_grid,
+                                       n_workers=n_workers, geometry_array=True)
+        grid_geoms = self.grid.geometry.tolist()
+        with self.report.stage('intersect') as stage:
+            print("intersecting flowlines with grid cells...") # this part crawls in debug mode
+            if self._grid_index is None:
+                # spatial index of the grid cells (kept for update_sfr)
+                self._grid_index = build_rtree_index(grid_geoms)
+            grid_intersections = [[i for i in self._grid_index.intersection(g.bounds) if grid_geoms[i].intersects(g)]
+                                  for g in flowline_geoms]
+            stage['items'] = len(flowline_geoms)
+        return make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_geoms, tol=.001,
+                         reach_ordering=reach_ordering, n_workers=n_workers, geometry_array=True)
+
+    def update_sfr(self, NHDFlowline=None, PlusFlowlineVAA=None, PlusFlow=None, elevslope=None,
+                   remove_comids=None, **kwargs):
+        """Update the SFR dataset (m1 and m2) after edits to the NHDPlus input,
+        only re-clipping and re-intersecting the flowlines that are new, or whose geometry has changed.
+
+        Each flowline geometry (clipped to the model domain) is hashed when the SFR dataset is built
+        (fl_hashes attribute); the reaches for flowlines with the same hash are reused from m1,
+        and the clipped geometries of flowlines that weren't edited are reused. The PlusFlow routing
+        graph is only crawled again (see list_updown_comids) for connections leaving the model within
+        10 connections upstream of an edited COMID; the spatial index of the grid cells is also reused.
+        Segment numbering, widths and elevations are then set up again for the whole network,
+        as in to_sfr (these don't involve the grid, and are fast). The model grid and domain must be
+        the same as those used to create the existing dataset.
+
+        Parameters
+        ==========
+        NHDFlowline : str, list of strings or dataframe, optional
+            New or edited flowlines; replace any existing flowlines with the same COMID.
+            Must be in the same coordinate system as the original flowlines.
+        PlusFlowlineVAA : str, list of strings or dataframe, optional
+            New or edited attribute records; replace any existing records with the same ComID.
+        PlusFlow : str, list of strings or dataframe, optional
+            New or edited routing records; replace any existing records with the same FROMCOMID.
+        elevslope : str, list of strings or dataframe, optional
+            New or edited elevation records; replace any existing records with the same COMID.
+        remove_comids : list of ints, optional
+            COMIDs of flowlines to remove.
+        **kwargs : keyword arguments to to_sfr
+        """
+        if self.m1 is None or self.fl_hashes is None:
+            raise ValueError('No existing SFR dataset to update; run to_sfr first.')
+
+        edited = {} # edited COMIDs in each table
+        for attr, input, index in [('fl', NHDFlowline, 'COMID'),
+                                   ('pfvaa', PlusFlowlineVAA, 'ComID'),
+                                   ('elevs', elevslope, 'COMID'),
+                                   ('pf', PlusFlow, 'FROMCOMID')]:
+            if input is None:
+                continue
+            edits = input.copy() if isinstance(input, pd.DataFrame) else shp2df(input)
+            if attr == 'fl' and different_projections(self.fl_proj4, self.mf_grid_proj4):
+                edits['geometry'] = project_geoms(edits.geometry, self.fl_proj4, self.mf_grid_proj4)
+            if attr == 'elevs':
+                edits['Max'] = edits.MAXELEVSMO * self.convert_elevslope_to_model_units[self.mf_units]
+                edits['Min'] = edits.MINELEVSMO * self.convert_elevslope_to_model_units[self.mf_units]
+            edited[attr] = edits[index].values
+            df = self.__dict__[attr]
+            df = df.loc[~df[index].isin(edits[index]).values]
+            if attr != 'pf':
+                edits.index = edits[index]
+            self.__dict__[attr] = pd.concat([df, edits])
+        if PlusFlow is not None:
+            self.routing = RoutingGraph.from_plusflow(self.pf)
+        if remove_comids is not None:
+            self.fl = self.fl.loc[~self.fl.COMID.isin(remove_comids).values]
+            edited['fl'] = np.append(edited.get('fl', []), remove_comids)
+
+        # reuse the clipped flowlines that weren't edited
+        fl_edited = edited.get('fl', [])
+        self._clip_cache = self._clip_results.loc[~self._clip_results.index.isin(fl_edited)]
+        # reuse the crawls of the routing graph that can't pass through an edited COMID
+        # (which may have been added to or removed from the model, or have new connections)
+        if self.routing is not None and self._crawl_results is not None:
+            stale = self.routing.upstream_within([c for e in edited.values() for c in e])
+            self._crawl_cache = self._crawl_results.loc[~self._crawl_results.index.isin(stale)]
+
+        self._reach_cache = (self.fl_hashes, self.m1[['comid', 'reach', 'node', 'geom_id']], self.reach_geoms)
+        self.to_sfr(**kwargs)
+
     def renumber_segments(self):
         """Renumber segments so that segment numbering is continuous and always increases
         in the downstream direction. Experience suggests that this can substantially speed
         convergence for some models using the NWT solver."""
-        r = renumber_segments(self.m2.segment.values, self.m2.outseg.values)
+        r, remap = renumber_segments(self.m2.segment.values, self.m2.outseg.values, return_remap=True)
 
-        self.m2['segment'] = [r.get(s, s) for s in self.m2.segment]
-        self.m2['outseg'] = [r.get(s, s) for s in self.m2.outseg]
+        self.m2['segment'] = remap_segments(remap, self.m2.segment.values)
+        self.m2['outseg'] = remap_segments(remap, self.m2.outseg.values)
         self.m2.sort_values(by=['segment'], inplace=True)
         self.m2.index = self.m2.segment.values # reset the index to new segment numbers
         assert _in_order(self.m2.segment.values, self.m2.outseg.values)
         assert len(self.m2.segment) == self.m2.segment.max()
-        self.m1['segment'] = [r.get(s, s) for s in self.m1.segment]
-        self.m1['outseg'] = [r.get(s, s) for s in self.m1.outseg]
+        self.m1['segment'] = remap_segments(remap, self.m1.segment.values)
+        self.m1['outseg'] = remap_segments(remap, self.m1.outseg.values)
+
+    def append(self, other):
+        """Append the SFR dataset (m1, m2 and reach_geoms) of another NHDdata or lines instance
+        (e.g. lines set up with append2sfr) to this one, and renumber the segments.
+
+        The geom_id column of the appended Mat1 is offset by the number of reach geometries
+        in this dataset, so that it refers to the combined reach_geoms.
+
+        Parameters
+        ----------
+        other : NHDdata or lines instance
+        """
+        self.m1, self.m2, self.reach_geoms = _append_sfr(self, other)
+        self.renumber_segments()
+        self.m1.sort_values(by=['segment', 'reach'], inplace=True)
+        self.m1.index = np.arange(len(self.m1))
+        if 'ReachID' in self.m1.columns:
+            self.m1['ReachID'] = np.arange(1, len(self.m1) + 1)
 
-    def write_tables(self, basename='SFR'):
+    def write_tables(self, basename='SFR', binary=False):
         """Write tables with SFR reach (Mat1) and segment (Mat2) information out to csv files.
 
         Parameters
         ----------
         basename: string
             e.g. Mat1 is written to <basename>Mat1.csv
+        binary : bool
+            Write the tables in typed binary format instead (<basename>Mat1.arrow, <basename>Mat2.arrow;
+            see mattables.write_table), with the reach geometries in Mat1. These can be loaded
+            by postproc.SFRdata much faster than csv files. Requires pyarrow.
         """
         m1_cols = ['node', 'layer', 'segment', 'reach', 'sbtop', 'width', 'length', 'sbthick',
                    'sbK', 'roughness', 'asum', 'reachID']
@@ -528,9 +894,17 @@ class NHDdata(object):
 
         if self.ncols is not None:
             m1_cols.insert(2, 'column')
-        print("writing Mat1 to {0}{1}, Mat2 to {0}{2}".format(basename, 'Mat1.csv', 'Mat2.csv'))
-        self.m1[m1_cols].to_csv(basename + 'Mat1.csv', index=False)
-        self.m2[m2_cols].to_csv(basename + 'Mat2.csv', index=False)
+        with self.report.stage('write') as stage:
+            if binary:
+                print("writing Mat1 to {0}{1}, Mat2 to {0}{2}".format(basename, 'Mat1.arrow', 'Mat2.arrow'))
+                write_table(self.m1[m1_cols], basename + 'Mat1.arrow', table_name='Mat1',
+                            reach_geoms=self.reach_geoms.take(self.m1.geom_id.values))
+                write_table(self.m2[m2_cols], basename + 'Mat2.arrow', table_name='Mat2')
+            else:
+                print("writing Mat1 to {0}{1}, Mat2 to {0}{2}".format(basename, 'Mat1.csv', 'Mat2.csv'))
+                self.m1[m1_cols].to_csv(basename + 'Mat1.csv', index=False)
+                self.m2[m2_cols].to_csv(basename + 'Mat2.csv', index=False)
+            stage['items'] = len(self.m1)
 
     def write_linework_shapefile(self, basename='SFR'):
         """Write a shapefile containing linework for each SFR reach,
@@ -541,21 +915,26 @@ class NHDdata(object):
         basename: string
             Output will be written to <basename>.shp
         """
-        print("writing reach geometries to {}".format(basename+'.shp'))
-        df2shp(self.m1[['reachID', 'node', 'segment', 'reach', 'outseg', 'comid', 'asum', 'geometry']],
-               basename+'.shp', proj4=self.mf_grid_proj4)
+        with self.report.stage('write') as stage:
+            print("writing reach geometries to {}".format(basename+'.shp'))
+            df = self.m1[['reachID', 'node', 'segment', 'reach', 'outseg', 'comid', 'asum']].copy()
+            df['geometry'] = self.reach_geoms.take(self.m1.geom_id.values).to_geoms()
+            df2shp(df, basename+'.shp', proj4=self.mf_grid_proj4)
+            stage['items'] = len(df)
 
 
 class lines(linesBase):
     """Class for building SFR from generic GIS linework."""
 
     def __init__(self, lines, minElev_field=None, maxElev_field=None,
-                 model_domain=None,
+                 model_domain=None, ibound=None,
                  mf_grid=None, mf_grid_node_col=None,
+                 mfdis=None, xul=None, yul=None, rot=0, mfgrid_proj4=None,
                  routing_tol=200):
 
-        linesBase.__init__(self, lines=lines, model_domain=model_domain,
-                           mf_grid=mf_grid, mf_grid_node_col=mf_grid_node_col)
+        linesBase.__init__(self, lines=lines, model_domain=model_domain, ibound=ibound,
+                           mf_grid=mf_grid, mf_grid_node_col=mf_grid_node_col,
+                           mfdis=mfdis, xul=xul, yul=yul, rot=rot, mfgrid_proj4=mfgrid_proj4)
 
         self.start_cds = [(g.xy[0][0], g.xy[1][0]) for g in self.df.geometry]
         self.end_cds = [(g.xy[0][-1], g.xy[1][-1]) for g in self.df.geometry]
@@ -567,23 +946,44 @@ class lines(linesBase):
         self.df['outseg'] = 0
         self.df['upsegs'] = [[]] * len(self.df)
 
-        self.allupsegs = {} # dict containing set of all upstream segments for each segment
+        self.network = None # routing.SegmentNetwork of segments and outsegs (set in routing)
+
+    @property
+    def allupsegs(self):
+        """Dictionary of sets of all upstream segments for each segment."""
+        if self.network is None:
+            return {}
+        return self.network.upstream_sets()
 
     def append2sfr(self, sfrlinework, route2reach1=True,
                    trim_buffer=20, routing_tol=None,
                    roughness=0.037, streambed_thickness=1, streambedK=1,
                    icalc=1,
                    iupseg=0, iprior=0, nstrpts=0, flow=0, runoff=0, etsw=0, pptsw=0,
-                   roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0):
+                   roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0,
+                   reach_ordering='nearest', n_workers=1, reach_geoms=None):
         """Convert linework to input that can be appended to an existing SFR dataset.
 
-        Creates Mat1 (m1) and Mat2 (m2) attributes.
-        """
+        Creates Mat1 (m1) and Mat2 (m2) attributes, with segment numbers following those in the
+        existing dataset, and the lines routed to it. These can then be added to the existing
+        NHDdata or lines instance with its append method (e.g. ``nhd.append(lns)``), which
+        combines the reach geometries and renumbers the segments.
 
-        if not isinstance(sfrlinework, pd.DataFrame):
-            self.sfr = shp2df(sfrlinework)
-        else:
-            self.sfr = sfrlinework.copy()
+        Parameters
+        ----------
+        sfrlinework : str (shapefile path), dataframe, or NHDdata or lines instance
+            Linework representing the existing SFR package (see route_lines_to_sfr).
+        reach_geoms : linework.LineArray, optional
+            Reach geometries, if sfrlinework is a Mat1 dataframe without a geometry column
+            (see route_lines_to_sfr).
+
+        Returns
+        -------
+        m1, m2 : DataFrames
+            Mat1 and Mat2 for the appended lines (also the m1 and m2 attributes); the geom_id column
+            of m1 refers to the reach_geoms attribute of this instance.
+        """
+        self.sfr = _sfr_linework(sfrlinework, reach_geoms)
 
         self.sfr.sort_values(by=['segment', 'reach'], inplace=True)
         # assign reachIDs if they don't exist
@@ -597,7 +997,8 @@ class lines(linesBase):
                     roughness=roughness, streambed_thickness=streambed_thickness, streambedK=streambedK,
                     icalc=icalc,
                     iupseg=iupseg, iprior=iprior, nstrpts=nstrpts, flow=flow, runoff=runoff, etsw=etsw, pptsw=pptsw,
-                    roughch=roughch, roughbk=roughbk, cdepth=cdepth, fdepth=fdepth, awdth=awdth, bwdth=bwdth)
+                    roughch=roughch, roughbk=roughbk, cdepth=cdepth, fdepth=fdepth, awdth=awdth, bwdth=bwdth,
+                    reach_ordering=reach_ordering, n_workers=n_workers, renumber=False)
 
     def get_end_elevs_from_dem(self, dem):
 
@@ -606,7 +1007,7 @@ class lines(linesBase):
         self.df['elevMin'] = get_values_at_points(dem, self.end_cds)
 
     def get_segment_asums(self):
-        """Using allupsegs dictionary, sum lengths of all upstream segments for each segment
+        """Using the segment network, sum lengths of all upstream segments for each segment
 
         Returns
         -------
@@ -615,23 +1016,29 @@ class lines(linesBase):
         """
         if 'length' not in self.df.columns:
             self.df['length'] = [g.length for g in self.df.geometry]
-        return {s: self.df.length[self.df.segment.isin(self.allupsegs[s])].sum() * self.to_km
-                if s in self.allupsegs.keys() else 0
-                for s in self.df.segment.tolist()}
+        if self.network is None:
+            self.network = SegmentNetwork(self.df.segment.values, self.df.outseg.values)
+        # segments in the network that are no longer in df (e.g. outside of the model domain)
+        # don't contribute to the sums
+        lengths = pd.Series(self.df.length.values, index=self.df.segment.values)
+        lengths = lengths.reindex(self.network.segments).fillna(0).values
+        asums = dict(zip(self.network.segments, self.network.upstream_sums(lengths) * self.to_km))
+        return {s: asums.get(s, 0) for s in self.df.segment.tolist()}
 
     def renumber_segments(self):
         """Renumber segments so that segment numbering is continuous and always increases
         in the downstream direction. Experience suggests that this can substantially speed
         convergence for some models using the NWT solver."""
-        r = renumber_segments(self.m2.segment.values, self.m2.outseg.values)
+        r, remap = renumber_segments(self.m2.segment.values, self.m2.outseg.values, return_remap=True)
 
-        self.m2['segment'] = [r.get(s, s) for s in self.m2.segment]
-        self.m2['outseg'] = [r.get(s, s) for s in self.m2.outseg]
+        self.m2['segment'] = remap_segments(remap, self.m2.segment.values)
+        self.m2['outseg'] = remap_segments(remap, self.m2.outseg.values)
         self.m2.sort_values(by='segment', inplace=True)
+        self.m2.index = self.m2.segment.values # reset the index to new segment numbers
         assert _in_order(self.m2.segment.values, self.m2.outseg.values)
         assert len(self.m2.segment) == self.m2.segment.max()
-        self.m1['segment'] = [r.get(s, s) for s in self.m1.segment]
-        self.m1['outseg'] = [r.get(s, s) for s in self.m1.outseg]
+        self.m1['segment'] = remap_segments(remap, self.m1.segment.values)
+        self.m1['outseg'] = remap_segments(remap, self.m1.outseg.values)
 
     def route_lines_by_proximity(self, tol=50):
         """Route lines based on proximity of starts and ends.
@@ -642,24 +1049,18 @@ class lines(linesBase):
             Only consider starting coordinates within tol of each end coordinate. This
             number should be fairly small, otherwise circular routing may occur.
         """
-        nearest_start = get_nearest(self.start_cds, self.end_cds)
+        nearest_start, distance = nearest_starts(self.start_cds, self.end_cds)
 
         # record the preliminary seg. number of nearest start if within tol
-        self.df['outseg'] = [self.df.segment[n]
-                             if Point(*self.start_cds[n]).distance(\
-                                Point(*self.end_cds[i])) < tol
-                 else 0 for i, n in enumerate(nearest_start)]
+        self.df['outseg'] = np.where(distance < tol, self.df.segment.values[nearest_start], 0)
 
         self.df['upsegs'] = [self.df.segment[self.df.outseg == s].tolist() for s in self.df.segment]
 
-        self.allupsegs = get_upsegs(self.df.segment.values, self.df.outseg.values)
-
-        #check for circular routing (a segment shouldn't be upstream of itself)
-        for k, v in self.allupsegs.items():
-            assert len({k}.intersection(v)) == 0
+        # (raises a ValueError in the case of circular routing)
+        self.network = SegmentNetwork(self.df.segment.values, self.df.outseg.values)
 
     def route_lines_to_sfr(self, sfrlinework, route2reach1=False,
-                           trim_buffer=20, routing_tol=None):
+                           trim_buffer=20, routing_tol=None, reach_geoms=None):
         """Route the linework in the lines class to an existing
         set of lines representing an SFR package.
 
@@ -669,26 +1070,31 @@ class lines(linesBase):
 
         Parameters
         ----------
-        sfrlinework : str (shapefile path) or dataframe
-            Contains linework representing SFR package (e.g. already broken by grid)
+        sfrlinework : str (shapefile path), dataframe, or NHDdata or lines instance
+            Contains linework representing SFR package (e.g. already broken by grid).
+            Mat1 tables made by to_sfr don't have a geometry column (the reach geometries are
+            in the reach_geoms attribute); the NHDdata or lines instance can be supplied instead,
+            or the Mat1 dataframe along with its reach_geoms.
         route2reach1 : boolean
             If true, linework is routed to closest starting coordinate of an SFR segment.
             Otherwise, routing is to closest starting coordinate of an SFR reach
             (existing SFR segment in that location will have to be subdivided).
+        reach_geoms : linework.LineArray, optional
+            Reach geometries for a sfrlinework dataframe without a geometry column
+            (indexed by its geom_id column, if it has one).
         """
-        if not isinstance(sfrlinework, pd.DataFrame):
-            self.sfr = shp2df(sfrlinework)
-        else:
-            self.sfr = sfrlinework.copy()
+        self.sfr = _sfr_linework(sfrlinework, reach_geoms)
 
         tol = self.routing_tol if routing_tol is None else routing_tol
 
         if route2reach1:
-            segments = self.sfr.ix[self.sfr.reach == 1, 'segment'].tolist()
-            geoms = self.sfr.ix[self.sfr.reach == 1, 'geometry'].tolist()
+            segments = self.sfr.loc[self.sfr.reach == 1, 'segment'].tolist()
+            geoms = self.sfr.loc[self.sfr.reach == 1, 'geometry'].tolist()
+            reaches = self.sfr.loc[self.sfr.reach == 1, 'reachID'].values
         else:
             segments = self.sfr.segment.tolist()
             geoms = [g for g in self.sfr.geometry]
+            reaches = self.sfr.reachID.values
 
         # update segment numbering so that it starts after highest seg in sfr dataset
         if len(set(self.df.segment).intersection(self.sfr.segment)) != 0:
@@ -696,9 +1102,7 @@ class lines(linesBase):
             self.df['segment'] += maxseg
             self.df.loc[self.df.outseg > 0, 'outseg'] += maxseg
             self.df['upsegs'] = [[u + maxseg for u in us] for us in self.df.upsegs.tolist()]
-            self.allupsegs = get_upsegs(self.df.segment.values, self.df.outseg.values)
-            #self.allupsegs = {s + maxseg: {ss + maxseg if ss > 0 else ss for ss in v}
-            #                  for s, v in self.allupsegs.items()}
+            self.network = SegmentNetwork(self.df.segment.values, self.df.outseg.values)
 
         sfr_start_cds = [(g.xy[0][0], g.xy[1][0]) for g in geoms]
 
@@ -709,20 +1113,14 @@ class lines(linesBase):
 
         # get index of nearest start to each end
 
-        nearest_sfr = get_nearest(sfr_start_cds, new_lines_outlet_cds)
+        # (the SFR starts and new line outlets are different sets of lines,
+        # so none of the starts are excluded)
+        nearest_sfr, distance = nearest_starts(sfr_start_cds, new_lines_outlet_cds, exclude_self=False)
+        within_tol = distance < tol
 
         # record the preliminary seg. number of nearest start if within tol
-        self.df.loc[is_outlet, 'outseg'] = [segments[n]
-                                       if Point(*sfr_start_cds[n]).distance(\
-                                          Point(*new_lines_outlet_cds[i])) < tol
-                                       else 0 for i, n in enumerate(nearest_sfr)]
-        #if not route2reach1:
-        #reaches = self.sfr.reach.tolist()
-        reaches = self.sfr.reachID.tolist()
-        self.df.loc[is_outlet, 'outreachID'] = [reaches[n]
-                                   if Point(*sfr_start_cds[n]).distance(\
-                                      Point(*new_lines_outlet_cds[i])) < tol
-                                   else 0 for i, n in enumerate(nearest_sfr)]
+        self.df.loc[is_outlet, 'outseg'] = np.where(within_tol, np.array(segments)[nearest_sfr], 0)
+        self.df.loc[is_outlet, 'outreachID'] = np.where(within_tol, reaches[nearest_sfr], 0)
 
         def fix_newline_end(line, sfr_start_coord, trim_buffer=20):
             # trim the ends of the new lines (in case of overlap)
@@ -734,7 +1132,7 @@ class lines(linesBase):
             return LineString([line.coords[0], sfr_start_coord])
 
         # only connect the lines that are within the routing tolerance
-        geoms = self.df.geometry.values
+        geoms = self.df.geometry.values.copy()
         geoms[is_outlet] = [fix_newline_end(l, sfr_start_cds[nearest_sfr[i]], trim_buffer=trim_buffer)
                             if Point(l.coords[-1]).distance(\
                                Point(sfr_start_cds[nearest_sfr[i]])) < tol
@@ -747,63 +1145,92 @@ class lines(linesBase):
                icalc=1,
                iupseg=0, iprior=0, nstrpts=0, flow=0, runoff=0, etsw=0, pptsw=0,
                roughch=0, roughbk=0, cdepth=0, fdepth=0, awdth=0, bwdth=0,
-               tol=0.01):
+               tol=0.01, reach_ordering='nearest', n_workers=1, renumber=True):
         """Convert linework to SFR input.
 
         Creates Mat1 (m1) and Mat2 (m2) attributes.
+
+        Parameters
+        ----------
+        reach_ordering : str, 'nearest' or 'linear'
+            Method used to order reaches within each segment (see create_reaches).
+        n_workers : int
+            Number of processes to use in setting up the reaches (default 1).
+        renumber : bool
+            Renumber the segments (see renumber_segments). append2sfr turns this off, so that
+            the segment numbers follow those of the existing SFR dataset, and the outsegs of the
+            lines routed to it are kept until the datasets are combined (see append).
         """
 
-        print('\nclipping lines to active area...')
-        inside = np.array([g.intersects(self.domain) for g in self.df.geometry])
-        self.df = self.df.loc[inside].copy()
-        self.df.sort_values(by='segment', inplace=True)
-        line_geoms = [g.intersection(self.domain) for g in self.df.geometry]
-        grid_geoms = self.grid.geometry.tolist()
+        with self.report.stage('clip') as stage:
+            print('\nclipping lines to active area...')
+            self.df.sort_values(by='segment', inplace=True)
+            clipped, status = clip_to_domain(self.df.geometry, self.domain, self.prepared_domain,
+                                             return_status=True)
+            inside = status > 0
+            self.df = self.df.loc[inside].copy()
+            self.df['clipped'] = status[inside] == 2 # lines crossing the domain boundary
+            line_geoms = [g for g, i in zip(clipped, inside) if i]
+            # line ends for routing the lines that are kept
+            self.start_cds = [(g.xy[0][0], g.xy[1][0]) for g in self.df.geometry]
+            self.end_cds = [(g.xy[0][-1], g.xy[1][-1]) for g in self.df.geometry]
+            stage['items'] = len(line_geoms)
 
         # segments may already be routed if appending to SFR
         if self.df.outseg.sum() == 0:
-            print("establishing routing...")
-            self.route_lines_by_proximity()
-
-        print("intersecting lines with grid cells...") # this part crawls in debug mode
-        grid_intersections = GISops.intersect_rtree(grid_geoms, line_geoms)
-
-        print("setting up reaches and Mat1... (may take a few minutes for large grids)")
-        ta = time.time()
-        segments = self.df.segment.tolist()
-        m1 = make_mat1(line_geoms, segments, segments, grid_intersections, grid_geoms, tol=tol)
-        m1.sort_values(by=['segment', 'reach'], inplace=True)
-        m1['reachID'] = np.arange(starting_reachID, len(m1) + starting_reachID)
-        print("finished in {:.2f}s\n".format(time.time() - ta))
-
-        print("computing lengths...")
-        m1['length'] = np.array([g.length for g in m1.geometry])
-        lengths = m1[['segment', 'length']].copy()
-        groups = lengths.groupby('segment')
-
-        print("computing arbolate sums at reach midpoints...")
-        ta = time.time()
-        reach_asums = np.concatenate([np.cumsum(grp.length.values[::-1])[::-1] - 0.5*grp.length.values
-                                      for s, grp in groups])
-        segment_asums_d = self.get_segment_asums()
-        segment_asums = np.array([segment_asums_d[s] for s in m1.segment.values])
-        reach_asums = -1 * self.to_km * reach_asums + segment_asums # arbolate sums are computed in km
-        m1['asum'] = reach_asums
-        print("finished in {:.2f}s\n".format(time.time() - ta))
-
-        print("computing widths...")
-        width = width_from_arbolate(reach_asums) # widths are returned in m
-        if self.GISunits != 'm':
-            width = width / 0.3048
-
-        print("multiplying length units by {} to convert from GIS to MODFLOW...".format(self.mf_units_mult))
-        m1['width'] = width * self.mf_units_mult
-        m1['length'] = m1.length * self.mf_units_mult
-
-        m1['roughness'] = roughness
-        m1['sbthick'] = streambed_thickness
-        m1['sbK'] = streambedK
-        m1['sbtop'] = 0
+            with self.report.stage('routing') as stage:
+                print("establishing routing...")
+                self.route_lines_by_proximity()
+                stage['items'] = len(self.df)
+
+        if self.structured_grid is None:
+            with self.report.stage('intersect') as stage:
+                grid_geoms = self.grid.geometry.tolist()
+                print("intersecting lines with grid cells...") # this part crawls in debug mode
+                grid_intersections = GISops.intersect_rtree(grid_geoms, line_geoms)
+                stage['items'] = len(line_geoms)
+
+        with self.report.stage('make_mat1') as stage:
+            print("setting up reaches and Mat1... (may take a few minutes for large grids)")
+            segments = self.df.segment.tolist()
+            if self.structured_grid is not None:
+                m1, reach_geoms = make_mat1_from_grid(line_geoms, segments, segments, self.structured_grid,
+                                                      n_workers=n_workers, geometry_array=True)
+            else:
+                m1, reach_geoms = make_mat1(line_geoms, segments, segments, grid_intersections, grid_geoms, tol=tol,
+                                            reach_ordering=reach_ordering, n_workers=n_workers, geometry_array=True)
+            m1.sort_values(by=['segment', 'reach'], inplace=True)
+            m1['reachID'] = np.arange(starting_reachID, len(m1) + starting_reachID)
+            stage['items'] = len(m1)
+
+        with self.report.stage('widths') as stage:
+            print("computing lengths...")
+            m1['length'] = reach_geoms.lengths[m1.geom_id.values]
+            lengths = m1[['segment', 'length']].copy()
+            groups = lengths.groupby('segment')
+
+            print("computing arbolate sums at reach midpoints...")
+            reach_asums = np.concatenate([np.cumsum(grp.length.values[::-1])[::-1] - 0.5*grp.length.values
+                                          for s, grp in groups])
+            segment_asums_d = self.get_segment_asums()
+            segment_asums = np.array([segment_asums_d[s] for s in m1.segment.values])
+            reach_asums = -1 * self.to_km * reach_asums + segment_asums # arbolate sums are computed in km
+            m1['asum'] = reach_asums
+
+            print("computing widths...")
+            width = width_from_arbolate(reach_asums) # widths are returned in m
+            if self.GISunits != 'm':
+                width = width / 0.3048
+
+            print("multiplying length units by {} to convert from GIS to MODFLOW...".format(self.mf_units_mult))
+            m1['width'] = width * self.mf_units_mult
+            m1['length'] = m1.length * self.mf_units_mult
+
+            m1['roughness'] = roughness
+            m1['sbthick'] = streambed_thickness
+            m1['sbK'] = streambedK
+            m1['sbtop'] = 0
+            stage['items'] = len(m1)
 
         if self.nrows is not None:
             m1['row'] = np.floor(m1.node / self.ncols) + 1
@@ -813,22 +1240,26 @@ class lines(linesBase):
             m1['column'] = column
         m1['layer'] = 1
 
-        print("\nsetting up Mat2...")
-        ta = time.time()
-        write_columns = list(set(['segment', 'outseg', 'outreachID', 'elevMax', 'elevMin'])\
-                             .intersection(set(self.df.columns)))
-        m2 = self.df[write_columns].copy()
-        m2['icalc'] = icalc
-        m2.index = m2.segment
-        print("finished in {:.2f}s\n".format(time.time() - ta))
-
-        # add outseg information to Mat1
-        m1['outseg'] = [m2.outseg[s] for s in m1.segment]
-        m1.sort_values(by=['segment', 'reach'], inplace=True)
-        m1['ReachID'] = np.arange(1, len(m1) + 1)
-        self.m1 = m1
-        self.m2 = m2
-        self.renumber_segments() # enforce best segment numbering
+        with self.report.stage('make_mat2') as stage:
+            print("\nsetting up Mat2...")
+            write_columns = list(set(['segment', 'outseg', 'outreachID', 'elevMax', 'elevMin'])\
+                                 .intersection(set(self.df.columns)))
+            m2 = self.df[write_columns].copy()
+            m2['icalc'] = icalc
+            m2.index = m2.segment.values
+            stage['items'] = len(m2)
+
+        with self.report.stage('renumber') as stage:
+            # add outseg information to Mat1
+            m1['outseg'] = [m2.outseg[s] for s in m1.segment]
+            m1.sort_values(by=['segment', 'reach'], inplace=True)
+            m1['ReachID'] = np.arange(1, len(m1) + 1)
+            self.m1 = m1
+            self.m2 = m2
+            self.reach_geoms = reach_geoms
+            if renumber:
+                self.renumber_segments() # enforce best segment numbering
+            stage['items'] = len(m2)
         print('\nDone creating SFR dataset.')
         return m1, m2
 
@@ -870,6 +1301,40 @@ class SFRdata(object):
     def __init__(self, reach_data, segment_data):
         pass
 
+def _append_sfr(sfr, other):
+    """Mat1, Mat2 and reach geometries (LineArray) of two SFR datasets (NHDdata or lines instances) combined,
+    with the geom_id column of the appended Mat1 offset to refer to the combined reach geometries."""
+    if other.m1 is None or other.reach_geoms is None:
+        raise ValueError('No SFR dataset to append; run to_sfr or append2sfr first.')
+    if other.m1.geom_id.max() >= len(other.reach_geoms):
+        raise ValueError('geom_id column of the appended Mat1 refers to reach geometries '
+                         'that are not in its reach_geoms.')
+    duplicated = set(sfr.m2.segment).intersection(other.m2.segment)
+    if len(duplicated) > 0:
+        raise ValueError('Appended segment numbers {} are already in the SFR dataset; '
+                         'set up the appended lines with append2sfr.'.format(sorted(duplicated)[:10]))
+    m1 = other.m1.copy()
+    m1['geom_id'] = m1.geom_id.values + len(sfr.reach_geoms)
+    return (pd.concat([sfr.m1, m1]), pd.concat([sfr.m2, other.m2]),
+            LineArray.concatenate([sfr.reach_geoms, other.reach_geoms]))
+
+def _sfr_linework(sfrlinework, reach_geoms=None):
+    """Dataframe of existing SFR linework (with a geometry column), from a shapefile,
+    a dataframe, or an NHDdata or lines instance (Mat1 with geometries from its reach_geoms)."""
+    if hasattr(sfrlinework, 'm1') and hasattr(sfrlinework, 'reach_geoms'):
+        sfrlinework, reach_geoms = sfrlinework.m1, sfrlinework.reach_geoms
+    if not isinstance(sfrlinework, pd.DataFrame):
+        return shp2df(sfrlinework)
+    df = sfrlinework.copy()
+    if 'geometry' not in df.columns:
+        if reach_geoms is None:
+            raise ValueError('No geometry column in SFR linework; supply the reach geometries (reach_geoms), '
+                             'or the NHDdata or lines instance that made the Mat1 table.')
+        geom_id = df.geom_id.values if 'geom_id' in df.columns else np.arange(len(df))
+        df['geometry'] = reach_geoms.take(geom_id).to_geoms()
+    return df
+
+
 def _in_order(nseg, outseg):
     """Check that segment numbering increases in downstream direction.
 
@@ -922,7 +1387,7 @@ def _get_outlets(segment_seguences_array):
             else i + 1
             for i, r in enumerate(segment_seguences_array.T)}
 
-def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
+def create_reaches(part, segment_nodes, grid_geoms, tol=0.01, ordering='nearest'):
     """Creates SFR reaches for a segment by ordering model cells intersected by a LineString
 
     Parameters
@@ -936,6 +1401,13 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     grid_geoms: list of Polygons
         List of shapely Polygon objects for the model grid cells, sorted by node number
 
+    ordering: str, 'nearest' or 'linear'
+        Method for ordering the reach fragments along *part*.
+        'nearest' successively picks the fragment closest to the previous one
+        (original method; O(n^2 log n) in the number of fragments).
+        'linear' locates the midpoint of each fragment along *part*
+        (linear referencing), and orders all fragments with a single sort.
+
     Returns
     -------
     ordered_reach_geoms: list of LineStrings
@@ -943,25 +1415,23 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
 
     ordered_node_numbers: list of model cells containing the SFR reaches for the segment
     """
-    reach_nodes = {}
-    reach_geoms = {}
     # interesct flowline part with grid nodes
     reach_intersections = [part.intersection(grid_geoms[c]) for c in segment_nodes]
-    reach_intersections = [g for g in reach_intersections if g.length > 0] #drops points and empty geometries
-    # empty geometries are created when segment_nodes variable includes nodes intersected by
-    # other parts of a multipart line. Not sure what causes points besides duplicate vertices.
 
     # "flatten" all grid cell intersections to single part geometries
-    n = 1
-    for i, g in enumerate(reach_intersections):
-        if g.type == 'LineString':
-            reach_nodes[n] = segment_nodes[i]
-            reach_geoms[n] = g
-            n += 1
-        else:
-            reach_nodes.update({n+nn: segment_nodes[i] for nn, gg in enumerate(g.geoms)})
-            reach_geoms.update({n+nn: gg for nn, gg in enumerate(g.geoms)})
-            n += len(g.geoms)
+    # points and empty geometries are dropped; empty geometries are created when segment_nodes
+    # includes nodes intersected by other parts of a multipart line,
+    # points where a cell only touches the line (or by duplicate vertices).
+    geoms, nodes = _flatten_reach_intersections(reach_intersections, segment_nodes)
+
+    if ordering == 'linear':
+        order = order_reaches_along_line(part, geoms)
+        return [geoms[i] for i in order], [nodes[i] + 1 for i in order]
+    elif ordering != 'nearest':
+        raise ValueError("ordering must be 'nearest' or 'linear'; got {}".format(ordering))
+
+    reach_nodes = {n: node for n, node in enumerate(nodes, 1)}
+    reach_geoms = {n: g for n, g in enumerate(geoms, 1)}
 
     # make point features for start and end of flowline part
     start = Point(part.coords[0])
@@ -995,6 +1465,156 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     assert len(ordered_node_numbers) == nreaches # new list of ordered node numbers must include all flowline parts
     return ordered_reach_geoms, ordered_node_numbers
 
+def _flatten_reach_intersections(reach_intersections, segment_nodes):
+    """Flatten grid cell intersections with a flowline part to single part LineStrings,
+    keeping track of the (zero-based) node that each LineString came from.
+    Points and empty geometries are dropped.
+    """
+    geoms = []
+    nodes = []
+    for g, node in zip(reach_intersections, segment_nodes):
+        if g.length == 0:
+            continue
+        parts = [g] if g.geom_type == 'LineString' else \
+            [gg for gg in g.geoms if gg.geom_type == 'LineString' and gg.length > 0]
+        geoms += parts
+        nodes += [node] * len(parts)
+    return geoms, nodes
+
+def order_reaches_along_line(line, fragments):
+    """Order fragments of a LineString by their position along it.
+
+    The midpoint of each fragment is located along *line* (linear referencing),
+    so that all fragments are ordered with a single sort, instead of repeated
+    distance calculations and sorts against the remaining fragments.
+
+    Parameters
+    ----------
+    line : LineString
+        Parent LineString (e.g. flowline part).
+    fragments : list of LineStrings
+        Pieces of *line* (e.g. from intersection with grid cells).
+
+    Returns
+    -------
+    order : 1-D array of ints
+        Indices that sort *fragments* from the start to the end of *line*.
+    """
+    if len(fragments) == 0:
+        return np.array([], dtype=int)
+    midpoints = [f.interpolate(0.5, normalized=True) for f in fragments]
+    position = np.array([line.project(p) for p in midpoints])
+    return np.argsort(position, kind='mergesort')
+
+def model_domain_from_grid(grid=None, structured_grid=None, ibound=None):
+    """Polygon of the active area of the model grid, made by tracing the boundary
+    of the active cells (instead of a unary union of all of the cell geometries).
+
+    Parameters
+    ----------
+    grid : dataframe, optional
+        Grid cell polygons (geometry column), sorted by node number.
+    structured_grid : grid.StructuredGrid or grid.VertexGrid, optional
+        Used instead of grid, if supplied.
+    ibound : 2-D (or 1-D for a VertexGrid) array, optional
+        Array of active cells (non-zero values). Default is to include all cells.
+
+    Returns
+    -------
+    domain : Polygon or MultiPolygon
+    """
+    print('setting model domain to extent of {}grid cells...'.format('' if ibound is None else 'active '))
+    ta = time.time()
+    if structured_grid is not None:
+        domain = structured_grid.get_domain(ibound)
+    else:
+        geoms = np.array(grid.geometry.tolist(), dtype=object)
+        if ibound is not None:
+            active = np.asarray(ibound).ravel() != 0
+            if len(active) != len(geoms):
+                raise ValueError('ibound has {} cells; grid has {}'.format(len(active), len(geoms)))
+            geoms = geoms[active]
+        domain = domain_from_cells(geoms)
+    print("finished in {:.2f}s\n".format(time.time() - ta))
+    return domain
+
+
+def clip_to_domain(geoms, domain, prepared_domain=None, return_status=False):
+    """Clip geometries to the model domain. Geometries that are completely
+    within the domain are returned as-is, so that only the geometries
+    crossing the domain boundary are intersected.
+
+    With shapely >= 2, the geometries are classified as outside, inside or crossing
+    the domain with vectorized predicates, against the (prepared) polygon parts of the domain
+    that their bounding boxes intersect (from an STRtree); crossing geometries are only intersected
+    with those parts. Otherwise, each geometry is tested against the prepared domain.
+
+    Parameters
+    ----------
+    geoms : sequence of shapely geometries
+    domain : Polygon or MultiPolygon
+    prepared_domain : shapely.prepared.PreparedGeometry, optional
+        Prepared version of domain (made if not supplied, and needed).
+    return_status : bool
+        If True, also return the location of each geometry relative to the domain.
+
+    Returns
+    -------
+    clipped : list of shapely geometries
+        Geometries clipped to the domain (empty for geometries outside of the domain).
+    status : 1-D array of ints
+        (only if return_status=True) 0 for geometries outside of the domain,
+        1 for geometries inside, and 2 for geometries that were clipped at the domain boundary.
+    """
+    geoms = list(geoms)
+    try:
+        from shapely import STRtree, prepare, intersects, contains # shapely >= 2
+    except ImportError:
+        STRtree = None
+
+    if STRtree is None:
+        if prepared_domain is None:
+            prepared_domain = prep(domain)
+        status = np.array([1 if prepared_domain.contains(g) else 2 if prepared_domain.intersects(g) else 0
+                           for g in geoms], dtype=int)
+        parts = [domain]
+        candidates = dict((i, [0]) for i in np.flatnonzero(status == 2))
+    else:
+        parts = np.array(list(domain.geoms) if hasattr(domain, 'geoms') else [domain], dtype=object)
+        prepare(parts)
+        garr = np.array(geoms, dtype=object)
+        g_idx, p_idx = STRtree(parts).query(garr) # bounding box intersections
+        hit = intersects(parts[p_idx], garr[g_idx])
+        inside = contains(parts[p_idx], garr[g_idx])
+        status = np.zeros(len(geoms), dtype=int)
+        status[g_idx[hit]] = 2
+        status[g_idx[inside]] = 1
+        candidates = {}
+        for i, p in zip(g_idx[hit], p_idx[hit]):
+            if status[i] == 2:
+                candidates.setdefault(i, []).append(p)
+        # multipart geometries with parts in more than one part of the domain may still be within it
+        split = np.array([i for i, p in candidates.items() if len(p) > 1], dtype=int)
+        if len(split) > 0:
+            for i in split[contains(domain, garr[split])]:
+                status[i] = 1
+                del candidates[i]
+
+    clipped = [g if s == 1 else LineString() for g, s in zip(geoms, status)]
+    for i, p in candidates.items():
+        clip_to = parts[p[0]] if len(p) == 1 else MultiPolygon([parts[k] for k in p])
+        clipped[i] = geoms[i].intersection(clip_to)
+    if return_status:
+        return clipped, status
+    return clipped
+
+
+def _is_dbf(input):
+    """True if input is a DBF file name, or list of DBF file names."""
+    files = input if isinstance(input, list) else [input]
+    return all(isinstance(f, str) and f.lower().endswith('.dbf') for f in files)
+
+
 def different_projections(proj4, common_proj4):
     if not proj4 == common_proj4 \
         and not proj4 is None \
@@ -1010,21 +1630,17 @@ def find_next(comid, pftable, comids, max_levels=10):
     """Crawls the PlusFlow table to find the next downstream comid that
     is in the set comids. Looks up subsequent downstream comids to a
     maximum number of iterations, specified by max_levels (default 10).
+
+    For many comids, use routing.RoutingGraph.next_in_set, which builds the
+    routing index once and searches all of the comids together.
     """
-    pftable = pftable.copy()
-    nextocomid = [comid]
-    comids = set(comids)
-    for i in range(max_levels):
-        nextocomid = pftable.ix[pftable.FROMCOMID.isin(nextocomid), 'TOCOMID'].tolist()
-        if len(set(nextocomid).intersection(comids)) > 0:
-            # if more than one comid is found, simply take the first
-            # (often these will be in different levelpaths,
-            # so there is no way to determine a preferred routing path)
-            return list(set(nextocomid).intersection(comids))[0]
-    return 0
+    graph = RoutingGraph.from_plusflow(pftable)
+    return graph.next_in_set([comid], comids, max_levels=max_levels)[0]
 
 def get_nearest(starts, ends):
     """Returns index of nearest start coordinate to each coordinate in ends.
+    The start with the same index as each end (e.g. the start of the same LineString)
+    is excluded.
 
     Parameters
     ----------
@@ -1033,21 +1649,57 @@ def get_nearest(starts, ends):
     ends : list of tuples
         Could be ending coordinates of each LineString.
     """
-    try:
-        from rtree import index
-    except:
-        raise ImportError("This method requires the rtree package.")
+    return nearest_starts(starts, ends)[0].tolist()
 
-    idx = index.Index()
-    for i, start in enumerate(starts):
-        idx.insert(i, start)
-    return [list(idx.nearest(end, 2))[0] if list(idx.nearest(end, 1))[0] != i
-            else list(idx.nearest(end, 2))[1]
-            for i, end in enumerate(ends)]
+def nearest_starts(starts, ends, exclude_self=True):
+    """Find the nearest start coordinate to each coordinate in ends,
+    with a single batched query of a KD-tree.
+
+    Parameters
+    ----------
+    starts : list of tuples or (n, 2) array
+        Could be starting coordinates of each LineString.
+    ends : list of tuples or (m, 2) array
+        Could be ending coordinates of each LineString.
+    exclude_self : bool
+        If True, the start with the same index as each end (e.g. the start of the same LineString)
+        is excluded, and the next nearest start is returned.
+
+    Returns
+    -------
+    index : 1-D array
+        Index of the nearest start to each end
+        (-1 if there is none, e.g. if the only start is excluded).
+    distance : 1-D array
+        Distance from each end to the nearest start (inf if there is none).
+    """
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        raise ImportError("This method requires scipy.")
+
+    starts = np.array(starts, dtype=float).reshape(-1, 2)
+    ends = np.array(ends, dtype=float).reshape(-1, 2)
+    k = 2 if exclude_self else 1
+    index = np.full((len(ends), k + 1), -1, dtype=int)
+    distance = np.full((len(ends), k + 1), np.inf)
+    if len(starts) > 0 and len(ends) > 0:
+        # (with fewer than k starts, the missing neighbors are returned as index len(starts))
+        d, i = cKDTree(starts).query(ends, k=k)
+        d, i = d.reshape(len(ends), k), i.reshape(len(ends), k)
+        found = i < len(starts)
+        index[:, :k][found] = i[found]
+        distance[:, :k][found] = d[found]
+    rows = np.arange(len(ends))
+    col = np.zeros(len(ends), dtype=int)
+    if exclude_self:
+        # where the nearest start is the end's own, take the next nearest (if there is one)
+        col[index[:, 0] == rows] = 1
+    return index[rows, col], distance[rows, col]
 
 def get_upsegs(nseg, outseg):
-    """From segment_data, returns nested dict of containing sets of all
-    segments upstream of each segment.
+    """From segment_data, returns dict containing sets of all
+    segments upstream of each segment that is an outseg.
 
     Parameters
     ----------
@@ -1057,25 +1709,31 @@ def get_upsegs(nseg, outseg):
     Returns
     -------
     upsegs : dict
-        Nested dictionary of form {stress period: {segment: [set of upsegs]}}
+        Dictionary of form {outseg: {set of upsegs}}.
+        The set for outseg 0 (the outlet designator) only contains the outlet segments.
+
+    Notes
+    -----
+    Upstream sets are slices of the depth-first sequence in routing.SegmentNetwork,
+    which is built in a single pass over the network (raises a ValueError for circular routing).
+    For sums or counts over everything upstream, use SegmentNetwork directly.
     """
-
-    # make a list of adjacent upsegments keyed to outseg list in Mat2
-    upsegs = {o: set(nseg[outseg == o]) for o in np.unique(outseg)}
-
-    outsegs = outseg[outseg != 0].tolist() # exclude 0, the outlet designator
-
-    # for each outseg key, for each upseg, check for more upsegs, append until headwaters has been reached
-    for s in outsegs:
-        upsegslist = upsegs[s]
-        for i in range(len(nseg)): # limit iterations to number of segments
-            added_upsegs = set()
-            [added_upsegs.update(set(upsegs[us])) for us in upsegslist if us in outsegs]
-            if len(added_upsegs) == 0:
-                break
-            else:
-                upsegslist = added_upsegs
-                upsegs[s].update(added_upsegs)
+    nseg = np.asarray(nseg)
+    outseg = np.asarray(outseg)
+    network = SegmentNetwork(nseg, outseg)
+
+    upsegs = {}
+    for o in np.unique(outseg):
+        direct = nseg[outseg == o]
+        if o == 0:
+            upsegs[o] = set(direct)
+        elif network.index([o])[0] >= 0:
+            upsegs[o] = set(network.upstream(o))
+        else:
+            # outseg isn't in nseg (e.g. routed to another network)
+            upsegs[o] = set(direct)
+            for s in direct:
+                upsegs[o].update(network.upstream(s))
     return upsegs
 
 def map_segment_sequences(segments, outsegs, verbose=True):
@@ -1086,70 +1744,126 @@ def map_segment_sequences(segments, outsegs, verbose=True):
     ----------
     nseg : 1-D array of segment numbers
     outseg : 1-D array of outseg numbers for segments in nseg.
+    verbose : bool
+        Print any instances of circular routing.
 
     Returns
     -------
+    segment_sequences : 2-D array
+        First row contains the segment numbers, second row the outsegs,
+        third row the outsegs of the outsegs, etc., ending with a row of zeros.
+        Segments in circular routing go once around the circle.
+
+    Notes
+    -----
+    The outlets, depths and circular routing are found by pointer doubling
+    (see routing.DownstreamPaths), and the array is then made in a single pass.
+    Use DownstreamPaths directly to get outlets, depths or individual paths
+    without making the full array.
     """
-    all_outsegs = np.vstack([segments, outsegs])
-    nseg = len(segments)
-    max_outseg = all_outsegs[-1].max()
-    knt = 1
-    txt = '' # text recording circular routing instances, if encountered
-    while max_outseg > 0:
-
-        nextlevel = np.array([outsegs[s - 1] if s > 0 and s < 999999 else 0
-                              for s in all_outsegs[-1]])
-
-        all_outsegs = np.vstack([all_outsegs, nextlevel])
-        max_outseg = nextlevel.max()
-        if max_outseg == 0:
-            break
-        knt += 1
-        if knt > nseg:
-            # subset outsegs map to only include rows with outseg number > 0 in last column
-            circular_segs = all_outsegs.T[all_outsegs[-1] > 0]
-
-            # only retain one instance of each outseg number at iteration=nss
-            vals = []  # append outseg values to vals after they've appeared once
-            mask = [(True, vals.append(v))[0]
-                    if v not in vals
-                    else False for v in circular_segs[-1]]
-            circular_segs = circular_segs[:, np.array(mask)]
-
-            # cull the circular segments array to remove duplicate instances of routing circles
-            circles = []
-            duplicates = []
-            for i in range(np.shape(circular_segs)[0]):
-                # find where values in the row equal the last value;
-                # record the index of the second to last instance of last value
-                repeat_start_ind = np.where(circular_segs[i] == circular_segs[i, -1])[0][-2:][0]
-                # use that index to slice out the repeated segment sequence
-                circular_seq = circular_segs[i, repeat_start_ind:].tolist()
-                # keep track of unique sequences of repeated segments
-                if set(circular_seq) not in circles:
-                    circles.append(set(circular_seq))
-                    duplicates.append(False)
-                else:
-                    duplicates.append(True)
-            circular_segs = circular_segs[~np.array(duplicates), :]
-
-            txt += '{0} instances where an outlet was not found after {1} consecutive segments!\n' \
-                .format(len(circular_segs), nseg)
-            txt += '\n'.join([' '.join(map(str, row)) for row in circular_segs]) + '\n'
-
-            f = 'circular_routing.csv'
-            np.savetxt(f, circular_segs, fmt='%d', delimiter=',', header=txt)
-            txt += 'See {} for details.'.format(f)
-            if verbose:
-                print(txt)
-            break
+    paths = DownstreamPaths(segments, outsegs)
+    if verbose and len(paths.cycles) > 0:
+        print('{} instances of circular routing:\n{}'
+              .format(len(paths.cycles), '\n'.join([' '.join(map(str, c)) for c in paths.cycles])))
 
     # the array of segment sequence is useful for other other operations,
     # such as plotting elevation profiles
-    return all_outsegs
+    return paths.table()
 
-def make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_geoms, tol=0.01):
+def make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_geoms, tol=0.01,
+              reach_ordering='nearest', n_workers=1, geometry_array=False):
+    """Create Mat1 (reach information) by breaking flowlines into reaches at grid cell boundaries.
 
+    Parameters
+    ----------
+    flowline_geoms : list of LineStrings or MultiLineStrings
+        Flowlines clipped to the model domain.
+    fl_segments : list of ints
+        Segment number for each flowline.
+    fl_comids : list of ints
+        COMID (or other identifier) for each flowline.
+    grid_intersections : list of lists
+        (zero-based) indices of the grid cells intersected by each flowline
+    grid_geoms : list of Polygons
+        Grid cell geometries, sorted by node number
+    tol : float
+        Tolerance for determining the end of a flowline part.
+    reach_ordering : str, 'nearest' or 'linear'
+        Method used to order reaches within each flowline part (see create_reaches).
+    n_workers : int
+        Number of processes to use for creating the reaches (default 1; see _make_reaches_parallel).
+    geometry_array : bool
+        If True, return the reach geometries in a linework.LineArray instead of a geometry column
+        of LineStrings, with a geom_id column in m1 giving the position of each reach in the LineArray.
+
+    Returns
+    -------
+    m1 : DataFrame
+    reach_geoms : linework.LineArray
+        (only if geometry_array=True)
+    """
+    if n_workers > 1:
+        reaches_for_part = _make_reaches_parallel(flowline_geoms, n_workers,
+                                                  grid_intersections=grid_intersections,
+                                                  grid_geoms=grid_geoms, tol=tol,
+                                                  reach_ordering=reach_ordering)
+    else:
+        def reaches_for_part(i, part):
+            return create_reaches(part, grid_intersections[i], grid_geoms, tol=tol, ordering=reach_ordering)
+
+    return _assemble_mat1(flowline_geoms, fl_segments, fl_comids, reaches_for_part, geometry_array)
+
+def make_mat1_from_grid(flowline_geoms, fl_segments, fl_comids, grid, n_workers=1, geometry_array=False):
+    """Create Mat1 (reach information) by walking flowlines across a structured grid
+    (see grid.StructuredGrid.intersect), without intersecting them with cell polygons;
+    or, for an unstructured grid, by intersecting them with only the cells near each line
+    (see grid.VertexGrid.intersect).
+    Reaches are returned in order along each flowline, so no reach ordering is needed.
+
+    Parameters
+    ----------
+    flowline_geoms : list of LineStrings or MultiLineStrings
+        Flowlines clipped to the model domain.
+    fl_segments : list of ints
+        Segment number for each flowline.
+    fl_comids : list of ints
+        COMID (or other identifier) for each flowline.
+    grid : grid.StructuredGrid or grid.VertexGrid instance
+    n_workers : int
+        Number of processes to use for creating the reaches (default 1; see _make_reaches_parallel).
+    geometry_array : bool
+        If True, return the reach geometries in a linework.LineArray instead of a geometry column
+        of LineStrings, with a geom_id column in m1 giving the position of each reach in the LineArray.
+
+    Returns
+    -------
+    m1 : DataFrame
+    reach_geoms : linework.LineArray
+        (only if geometry_array=True)
+    """
+    if n_workers > 1:
+        reaches_for_part = _make_reaches_parallel(flowline_geoms, n_workers, grid=grid)
+    else:
+        def reaches_for_part(i, part):
+            return grid.intersect(part)
+
+    return _assemble_mat1(flowline_geoms, fl_segments, fl_comids, reaches_for_part, geometry_array)
+
+def _line_parts(geom):
+    """List the LineString parts of a (Multi)LineString or GeometryCollection."""
+    if geom.geom_type in ['MultiLineString', 'GeometryCollection']:
+        return [p for p in geom.geoms if p.geom_type == 'LineString']
+    return [geom]
+
+def _assemble_mat1(flowline_geoms, fl_segments, fl_comids, reaches_for_part, geometry_array=False):
+    """Assemble Mat1 from the reaches created for each (part of each) flowline.
+
+    reaches_for_part is a function of the flowline index and a LineString part,
+    that returns lists of ordered reach geometries and (one-based) node numbers.
+    If geometry_array is True, the reach geometries are collected in a LineArray
+    (one for each part, so that the LineStrings for all reaches never exist at once),
+    which is returned with Mat1 (see make_mat1).
+    """
     reach = []
     segment = []
     node = []
@@ -1157,37 +1871,270 @@ def make_mat1(flowline_geoms, fl_segments, fl_comids, grid_intersections, grid_g
     comids = []
 
     for i in range(len(flowline_geoms)):
-        segment_geom = flowline_geoms[i]
-        segment_nodes = grid_intersections[i]
-        if segment_geom.type != 'MultiLineString' and segment_geom.type != 'GeometryCollection':
-            ordered_reach_geoms, ordered_node_numbers = create_reaches(segment_geom, segment_nodes, grid_geoms, tol=tol)
-            reach += list(np.arange(len(ordered_reach_geoms)) + 1)
-            geometry += ordered_reach_geoms
-            node += ordered_node_numbers
-            segment += [fl_segments[i]] * len(ordered_reach_geoms)
-            comids += [fl_comids[i]] * len(ordered_reach_geoms)
-        else:
-            start_reach = 0
-            for j, part in enumerate(list(segment_geom.geoms)):
-                geoms, node_numbers = create_reaches(part, segment_nodes, grid_geoms)
-                if j > 0:
-                    start_reach = reach[-1]
-                reach += list(np.arange(start_reach, start_reach+len(geoms)) + 1)
-                geometry += geoms
-                node += node_numbers
-                segment += [fl_segments[i]] * len(geoms)
-                comids += [fl_comids[i]] * len(geoms)
+        # reach numbering is continuous across the parts of a multipart line
+        start_reach = 0
+        for part in _line_parts(flowline_geoms[i]):
+            geoms, node_numbers = reaches_for_part(i, part)
+            reach += list(np.arange(start_reach, start_reach + len(geoms)) + 1)
+            start_reach += len(geoms)
+            geometry += [LineArray.from_geoms(geoms)] if geometry_array else geoms
+            node += list(node_numbers)
+            segment += [fl_segments[i]] * len(geoms)
+            comids += [fl_comids[i]] * len(geoms)
         if len(reach) != len(segment):
             print('bad reach assignment!')
             break
 
-    m1 = pd.DataFrame({'reach': reach, 'segment': segment, 'node': node,
-                            'geometry': geometry, 'comid': comids})
+    if geometry_array:
+        reach_geoms = LineArray.concatenate(geometry)
+        m1 = pd.DataFrame({'reach': reach, 'segment': segment, 'node': node,
+                           'geom_id': np.arange(len(reach_geoms)), 'comid': comids})
+    else:
+        m1 = pd.DataFrame({'reach': reach, 'segment': segment, 'node': node,
+                                'geometry': geometry, 'comid': comids})
     m1.sort_values(by=['segment', 'reach'], inplace=True)
     m1['reachID'] = np.arange(len(m1)) + 1
+    if geometry_array:
+        return m1, reach_geoms
     return m1
 
-def renumber_segments(nseg, outseg):
+def _make_reaches_parallel(flowline_geoms, n_workers, grid_intersections=None, grid_geoms=None,
+                           grid=None, tol=0.01, reach_ordering='nearest', chunks_per_worker=4):
+    """Create the reaches for each flowline with a pool of worker processes.
+
+    The flowlines are partitioned into contiguous chunks; each chunk is sent to a worker
+    as WKB, along with only the grid cell geometries that its flowlines intersect
+    (or the StructuredGrid instance, which is small). Results are returned in chunk order,
+    so the reaches (and Mat1) are identical to those produced serially.
+
+    On platforms that spawn new processes (Windows), the calling script must be protected
+    by an ``if __name__ == '__main__':`` block.
+
+    Returns
+    -------
+    reaches_for_part : function
+        Function of the flowline index and part (see _assemble_mat1),
+        that returns the precomputed reaches for each part, in order.
+    """
+    from multiprocessing import Pool
+
+    nchunks = min(len(flowline_geoms), n_workers * chunks_per_worker)
+    chunks = [c for c in np.array_split(np.arange(len(flowline_geoms)), max(nchunks, 1)) if len(c) > 0]
+    tasks = []
+    for c in chunks:
+        flowline_wkbs = [flowline_geoms[i].wkb for i in c]
+        if grid is not None:
+            tasks.append((flowline_wkbs, None, None, None, grid, tol, reach_ordering))
+            continue
+        # renumber the intersected cells to the subset shipped with the chunk
+        cells = np.unique(np.concatenate([np.array(grid_intersections[i], dtype=int) for i in c]))
+        local = {n: j for j, n in enumerate(cells)}
+        local_intersections = [[local[n] for n in grid_intersections[i]] for i in c]
+        cell_wkbs = [grid_geoms[n].wkb for n in cells]
+        tasks.append((flowline_wkbs, local_intersections, cell_wkbs, cells, None, tol, reach_ordering))
+
+    print('creating reaches for {} chunks of flowlines with {} processes...'.format(len(tasks), n_workers))
+    pool = Pool(n_workers)
+    try:
+        results = pool.map(_reaches_for_chunk, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    from shapely import wkb
+    # results for each flowline, as lists of (reach geometries, nodes) for each part
+    flowline_results = [iter(r) for chunk in results for r in chunk]
+
+    def reaches_for_part(i, part):
+        reach_wkbs, nodes = next(flowline_results[i])
+        return [wkb.loads(g) for g in reach_wkbs], nodes
+    return reaches_for_part
+
+def _reaches_for_chunk(args):
+    """Worker function for _make_reaches_parallel; creates the reaches for a chunk of flowlines."""
+    from shapely import wkb
+    flowline_wkbs, local_intersections, cell_wkbs, cells, grid, tol, reach_ordering = args
+    if grid is None:
+        grid_geoms = [wkb.loads(g) for g in cell_wkbs]
+    results = []
+    for i, flowline_wkb in enumerate(flowline_wkbs):
+        part_results = []
+        for part in _line_parts(wkb.loads(flowline_wkb)):
+            if grid is not None:
+                geoms, nodes = grid.intersect(part)
+            else:
+                geoms, local_nodes = create_reaches(part, local_intersections[i], grid_geoms,
+                                                    tol=tol, ordering=reach_ordering)
+                # convert from one-based local cell numbers to one-based node numbers
+                nodes = [int(cells[n - 1]) + 1 for n in local_nodes]
+            part_results.append(([g.wkb for g in geoms], nodes))
+        results.append(part_results)
+    return results
+
+def make_mat1_tiled(flowline_geoms, fl_segments, fl_comids, grid, nrow=None, ncol=None,
+                    tile_shape=(500, 500), n_workers=1, geometry_array=False):
+    """Create Mat1 (reach information) by breaking flowlines into reaches at grid cell boundaries,
+    one tile (block of rows and columns) of the grid at a time.
+
+    For each tile, the flowline parts overlapping the tile are clipped to it, and the clipped
+    pieces are intersected with the cells of the tile. For a grid defined by a StructuredGrid,
+    the cell polygons are built from the grid definition for one tile at a time (in the worker
+    processes, with n_workers > 1), so that the cell polygons, their spatial index and the
+    intersection results only exist for one tile at a time. The results from each tile are
+    collected as they are finished. The reaches created in each tile are located along their
+    flowline parts (linear referencing; see order_reaches_along_line), so that the reaches of
+    flowlines crossing the tile seams are stitched back together in order. The result is the same
+    as make_mat1 with reach_ordering='linear'.
+
+    Parameters
+    ----------
+    flowline_geoms : list of LineStrings or MultiLineStrings
+        Flowlines clipped to the model domain.
+    fl_segments : list of ints
+        Segment number for each flowline.
+    fl_comids : list of ints
+        COMID (or other identifier) for each flowline.
+    grid : grid.StructuredGrid, or list of Polygons
+        Grid definition, or grid cell geometries sorted by node number (row-major order).
+        Cell polygons that are supplied are sliced by tile (they are already in memory).
+    nrow, ncol : int
+        Number of rows and columns in the grid (only needed if grid is a list of Polygons).
+    tile_shape : tuple of ints
+        Number of rows and columns in each tile.
+    n_workers : int
+        Number of processes to use for processing the tiles (default 1).
+        On platforms that spawn new processes (Windows), the calling script must be protected
+        by an ``if __name__ == '__main__':`` block.
+    geometry_array : bool
+        If True, return the reach geometries in a linework.LineArray instead of a geometry column
+        of LineStrings, with a geom_id column in m1 giving the position of each reach in the LineArray.
+
+    Returns
+    -------
+    m1 : DataFrame
+    reach_geoms : linework.LineArray
+        (only if geometry_array=True)
+    """
+    if isinstance(grid, StructuredGrid):
+        structured_grid, grid_geoms = grid, None
+        nrow, ncol = grid.nrow, grid.ncol
+    else:
+        structured_grid, grid_geoms = None, grid
+        if nrow is None or ncol is None:
+            raise ValueError('nrow and ncol are needed for a grid of polygons.')
+        if len(grid_geoms) != nrow * ncol:
+            raise ValueError('Number of grid cells ({}) is not nrow * ncol ({} x {})'.format(len(grid_geoms), nrow, ncol))
+
+    # flowline parts, and their bounding boxes
+    part_ids = []
+    parts = []
+    for i, g in enumerate(flowline_geoms):
+        n = len(parts)
+        parts += _line_parts(g)
+        part_ids.append(list(range(n, len(parts))))
+    part_bounds = np.array([p.bounds for p in parts]).reshape(-1, 4)
+
+    def tasks():
+        for i0 in range(0, nrow, tile_shape[0]):
+            for j0 in range(0, ncol, tile_shape[1]):
+                i1, j1 = min(i0 + tile_shape[0], nrow), min(j0 + tile_shape[1], ncol)
+                nodes = (np.arange(i0, i1)[:, np.newaxis] * ncol + np.arange(j0, j1)).ravel()
+                if structured_grid is not None:
+                    # tile outline from the grid edges
+                    u = structured_grid.xedges[[j0, j1, j1, j0]]
+                    v = structured_grid.yedges[[i0, i0, i1, i1]]
+                    tile = Polygon(list(zip(*structured_grid.to_world(u, v))))
+                    cell_wkbs = None
+                else:
+                    cells = [grid_geoms[n] for n in nodes]
+                    tile = _bounding_box(cells)
+                    cell_wkbs = [c.wkb for c in cells]
+                x0, y0, x1, y1 = tile.bounds
+                in_tile = np.flatnonzero((part_bounds[:, 0] <= x1) & (part_bounds[:, 2] >= x0) &
+                                         (part_bounds[:, 1] <= y1) & (part_bounds[:, 3] >= y0))
+                # clip the flowline parts to the tile
+                pieces = [parts[k].intersection(tile) for k in in_tile]
+                keep = np.array([p.length > 0 for p in pieces], dtype=bool)
+                if not keep.any():
+                    continue
+                yield (in_tile[keep], [p.wkb for p, k in zip(pieces, keep) if k],
+                       nodes, cell_wkbs, structured_grid)
+
+    ntiles = int(np.ceil(nrow / float(tile_shape[0])) * np.ceil(ncol / float(tile_shape[1])))
+    print('creating reaches for {} tiles of {} x {} cells...'.format(ntiles, *tile_shape))
+    pool = None
+    if n_workers > 1:
+        from multiprocessing import Pool
+        pool = Pool(n_workers)
+        results = pool.imap(_reaches_for_tile, tasks())
+    else:
+        results = (_reaches_for_tile(t) for t in tasks())
+
+    # collect the reaches from each tile by flowline part as the tiles are finished,
+    # with the position of each reach along its part
+    from shapely import wkb
+    part_reaches = [[] for p in parts]
+    try:
+        for tile_results in results:
+            for k, reach_wkbs, nodes in tile_results:
+                midpoints = [wkb.loads(g).interpolate(0.5, normalized=True) for g in reach_wkbs]
+                positions = [parts[k].project(p) for p in midpoints]
+                part_reaches[k] += zip(positions, reach_wkbs, nodes)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def reaches_for_part(i, part):
+        k = part_ids[i].pop(0)
+        # reaches at the same position (along a cell edge) are in node order
+        reaches = sorted(part_reaches[k], key=operator.itemgetter(0, 2))
+        part_reaches[k] = None
+        return [wkb.loads(g) for p, g, n in reaches], [n for p, g, n in reaches]
+
+    return _assemble_mat1(flowline_geoms, fl_segments, fl_comids, reaches_for_part, geometry_array)
+
+def _bounding_box(geoms):
+    """Polygon of the bounding box of a list of geometries."""
+    try:
+        from shapely import total_bounds # shapely >= 2
+    except ImportError:
+        bounds = np.array([g.bounds for g in geoms])
+        x0, y0 = bounds[:, :2].min(axis=0)
+        x1, y1 = bounds[:, 2:].max(axis=0)
+    else:
+        x0, y0, x1, y1 = total_bounds(np.array(geoms, dtype=object))
+    return Polygon([(x0, y0), (x0, y1), (x1, y1), (x1, y0)])
+
+def _reaches_for_tile(args):
+    """Worker function for make_mat1_tiled; creates the reaches for the flowline pieces in a tile.
+
+    Returns
+    -------
+    results : list of tuples
+        (part index, reach geometries (WKB), one-based node numbers)
+        for each part with reaches in the tile.
+    """
+    from shapely import wkb
+    part_indices, piece_wkbs, nodes, cell_wkbs, structured_grid = args
+    pieces = [wkb.loads(g) for g in piece_wkbs]
+    if structured_grid is not None:
+        cells = structured_grid.cell_polygons(nodes + 1)
+    else:
+        cells = [wkb.loads(g) for g in cell_wkbs]
+    intersections = GISops.intersect_rtree(cells, pieces)
+    results = []
+    for k, piece, local_nodes in zip(part_indices, pieces, intersections):
+        if len(local_nodes) == 0:
+            continue
+        geoms, local = _flatten_reach_intersections([piece.intersection(cells[c]) for c in local_nodes],
+                                                    local_nodes)
+        if len(geoms) == 0:
+            continue
+        results.append((k, [g.wkb for g in geoms], [int(nodes[c]) + 1 for c in local]))
+    return results
+
+def renumber_segments(nseg, outseg, return_remap=False):
     """Renumber segments so that segment numbering is continuous, starts at 1, and always increases
         in the downstream direction. Experience suggests that this can substantially speed
         convergence for some models using the NWT solver.
@@ -1198,42 +2145,59 @@ def renumber_segments(nseg, outseg):
         Array of segment numbers
     outseg : 1-D array
         Array of outsegs for segments in nseg.
+    return_remap : bool
+        If True, also return the remapping as an array (see remap_segments).
 
     Returns
     -------
     r : dict
         Dictionary mapping old segment numbers (keys) to new segment numbers (values). r only
         contains entries for number that were remapped.
+    remap : 1-D array (if return_remap=True)
+        New segment number for each old segment number (index).
+        Numbers that aren't remapped map to themselves.
     """
-    def reassign_upsegs(r, nexts, upsegs):
-        nextupsegs = []
-        for u in upsegs:
-            r[u] = nexts if u > 0 else u # handle lakes
-            nexts -= 1
-            nextupsegs += list(nseg[outseg == u])
-        return r, nexts, nextupsegs
-
     print('enforcing best segment numbering...')
+    nseg = np.asarray(nseg)
+    outseg = np.asarray(outseg)
+
     # enforce that all outsegs not listed in nseg are converted to 0
     # but leave lakes alone
-    r = {0: 0}
-    r.update({o: 0 for o in outseg if o > 0 and o not in nseg})
-    outseg = np.array([o if o in nseg or o < 0 else 0 for o in outseg])
-
+    not_in_nseg = ~np.isin(outseg, nseg) & (outseg > 0)
+    removed = np.unique(outseg[not_in_nseg])
+    outseg = np.where(not_in_nseg, 0, outseg)
 
     # if reach data are supplied, segment/outseg pairs may be listed more than once
+    # (keep the last outseg listed for each segment, in order of first occurrence)
     if len(nseg) != len(np.unique(nseg)):
-        d = dict(zip(nseg, outseg))
-        nseg, outseg = np.array(d.keys()), np.array(d.values())
+        last = len(nseg) - 1 - np.unique(nseg[::-1], return_index=True)[1]
+        first = np.unique(nseg, return_index=True)[1]
+        order = np.argsort(first, kind='mergesort')
+        nseg, outseg = nseg[first[order]], outseg[last[order]]
     ns = len(nseg)
 
-    nexts = ns
-    nextupsegs = nseg[outseg == 0]
-    for i in range(ns):
-        r, nexts, nextupsegs = reassign_upsegs(r, nexts, nextupsegs)
-        if len(nextupsegs) == 0:
-            break
-    return r
+    # number the segments from the outlets upstream (highest numbers at the outlets)
+    bfs = breadth_first_order(nseg, outseg)
+    renumbered = nseg[bfs]
+    new_numbers = ns - np.arange(len(bfs))
+
+    r = {0: 0}
+    r.update({o: 0 for o in removed})
+    r.update(zip(renumbered.tolist(), new_numbers.tolist()))
+    if not return_remap:
+        return r
+
+    remap = np.arange(np.max(np.concatenate([[0], nseg, outseg, removed])) + 1)
+    remap[removed] = 0
+    remap[renumbered] = new_numbers
+    return r, remap
+
+def remap_segments(remap, segments):
+    """Apply a remapping array from renumber_segments to an array of segment numbers.
+    Numbers outside of the remapping (e.g. negative numbers for lakes) are left as-is."""
+    segments = np.asarray(segments)
+    inside = (segments >= 0) & (segments < len(remap))
+    return np.where(inside, remap[np.where(inside, segments, 0)], segments)
 
 def parse_proj4_units(proj4string):
     """Determine units from proj4 string. Not tested extensively.
@@ -0,0 +1,83 @@
+__author__ = 'aleaf'
+import numpy as np
+import pyproj
+from shapely.geometry import LineString
+from shapely.ops import transform as transform_geom
+
+_transformers = {} # transform functions, cached by (source proj4, destination proj4)
+
+
+def get_transformer(proj4, dest_proj4):
+    """Get a function that transforms x, y coordinate arrays from proj4 to dest_proj4.
+
+    The function is created once for each pair of coordinate systems and cached.
+
+    Parameters
+    ----------
+    proj4 : str
+        Proj4 string for the coordinate system of the input coordinates.
+    dest_proj4 : str
+        Proj4 string for the destination coordinate system.
+
+    Returns
+    -------
+    transform : function
+        transform(x, y) returns the transformed x, y arrays.
+    """
+    key = (proj4, dest_proj4)
+    if key not in _transformers:
+        if hasattr(pyproj, 'Transformer'): # pyproj >= 2
+            transformer = pyproj.Transformer.from_crs(pyproj.CRS.from_user_input(proj4),
+                                                      pyproj.CRS.from_user_input(dest_proj4),
+                                                      always_xy=True)
+            transform = transformer.transform
+        else:
+            source, dest = pyproj.Proj(proj4), pyproj.Proj(dest_proj4)
+
+            def transform(x, y):
+                return pyproj.transform(source, dest, x, y)
+        _transformers[key] = transform
+    return _transformers[key]
+
+
+def project_geoms(geoms, proj4, dest_proj4):
+    """Reproject a sequence of shapely geometries with a single (vectorized) call
+    to the coordinate transformation.
+
+    The coordinates of all of the geometries are flattened into one array,
+    transformed, and the geometries rebuilt from the offsets of their coordinates.
+
+    Parameters
+    ----------
+    geoms : sequence of shapely geometries
+    proj4 : str
+        Proj4 string for the coordinate system of geoms.
+    dest_proj4 : str
+        Proj4 string for the destination coordinate system.
+
+    Returns
+    -------
+    projected : list of shapely geometries
+    """
+    transform = get_transformer(proj4, dest_proj4)
+    geoms = list(geoms)
+    if len(geoms) == 0:
+        return geoms
+    try:
+        from shapely import get_coordinates, set_coordinates # shapely >= 2
+    except ImportError:
+        get_coordinates = None
+
+    if get_coordinates is not None:
+        geoms = np.array(geoms, dtype=object)
+        xyz = get_coordinates(geoms, include_z=True) # z values are kept as is
+        xyz[:, 0], xyz[:, 1] = transform(xyz[:, 0], xyz[:, 1])
+        return list(set_coordinates(geoms, xyz))
+
+    if not all(g.geom_type == 'LineString' for g in geoms) or len(set(g.has_z for g in geoms)) > 1:
+        return [transform_geom(transform, g) for g in geoms]
+    coords = [np.asarray(g.coords) for g in geoms]
+    offsets = np.cumsum([0] + [len(c) for c in coords])
+    xyz = np.concatenate(coords)
+    xyz[:, 0], xyz[:, 1] = transform(xyz[:, 0], xyz[:, 1])
+    return [LineString(xyz[offsets[i]:offsets[i+1]]) for i in range(len(geoms))]
@@ -0,0 +1,278 @@
+__author__ = 'aleaf'
+import numpy as np
+import pandas as pd
+from linework import LineArray
+
+stat_columns = ['min', 'max', 'mean', 'count']
+
+
+def sample_cells(raster, grid, nodes, band=1, block_size=1024, n_workers=1):
+    """Zonal statistics (min, max, mean and count) of the raster pixels in structured grid cells
+    (e.g. the SFR cells in Mat1), computed block by block.
+
+    The cells are grouped by the raster blocks (block_size x block_size pixel windows) that they cover,
+    and each block is read only once (trimmed to the cells in it). Pixels are assigned to cells by locating
+    their centers in the grid (from the grid row and column edges, so that rotated grids are handled without
+    rasterizing any polygons), and the statistics for all of the cells in a block are then computed at once,
+    by sorting the pixels by cell and reducing. A pixel centered exactly on a cell boundary is assigned
+    to one cell only (the cell to the right of, or below, the boundary).
+
+    Parameters
+    ----------
+    raster : str
+        Raster file (any format readable by rasterio), in the same coordinate system as the grid,
+        and not rotated.
+    grid : grid.StructuredGrid
+        Model grid (in GIS units).
+    nodes : 1-D array
+        (One-based) node numbers of the cells to sample (may include repeats, e.g. for collocated reaches).
+    band : int
+        Raster band to sample.
+    block_size : int
+        Size (in pixels) of the raster blocks.
+    n_workers : int
+        Number of threads for reading and reducing the blocks (default 1).
+
+    Returns
+    -------
+    stats : DataFrame
+        min, max, mean and count (number of pixels with data) for each node in nodes (in the same order);
+        the statistics are NaN for cells without any pixels with data.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    cells, inverse = np.unique(nodes, return_inverse=True)
+    corners = grid.cell_corners(cells)
+    bounds = np.column_stack([corners[:, :, 0].min(axis=1), corners[:, :, 1].min(axis=1),
+                              corners[:, :, 0].max(axis=1), corners[:, :, 1].max(axis=1)])
+
+    def label(window_transform, shape, candidates):
+        # locate the pixel centers in the grid, and then among the sampled cells
+        x, y = _pixel_centers(window_transform, shape)
+        u, v = grid.to_local(x, y)
+        j = np.searchsorted(grid.xedges, u, side='right') - 1
+        i = np.searchsorted(grid.yedges, v, side='right') - 1
+        in_grid = (i >= 0) & (i < grid.nrow) & (j >= 0) & (j < grid.ncol)
+        node = np.where(in_grid, i * grid.ncol + j + 1, 0)
+        loc = np.minimum(np.searchsorted(cells, node), len(cells) - 1)
+        return np.where(in_grid & (cells[loc] == node), loc, -1)
+
+    stats = _sample_areas(raster, bounds, label, band, block_size, n_workers)
+    return stats.iloc[inverse].reset_index(drop=True)
+
+
+def sample_polygons(raster, polygons, band=1, block_size=1024, n_workers=1):
+    """Zonal statistics (min, max, mean and count) of the raster pixels in polygons (e.g. model cells
+    read from a grid shapefile), computed block by block, as in sample_cells. The polygons in each block
+    are rasterized together (by pixel center), so the polygons shouldn't overlap.
+
+    Parameters
+    ----------
+    raster : str
+        Raster file (any format readable by rasterio), in the same coordinate system as the polygons.
+    polygons : sequence of shapely Polygons
+    band, block_size, n_workers
+        See sample_cells.
+
+    Returns
+    -------
+    stats : DataFrame
+        min, max, mean and count for each polygon (in the same order).
+    """
+    polygons = np.array(list(polygons), dtype=object)
+    bounds = np.array([p.bounds for p in polygons]).reshape(-1, 4)
+
+    def label(window_transform, shape, candidates):
+        from rasterio import features
+        return features.rasterize(zip(polygons[candidates], candidates.tolist()), out_shape=shape,
+                                  transform=window_transform, fill=-1, dtype='int32')
+
+    return _sample_areas(raster, bounds, label, band, block_size, n_workers)
+
+
+def sample_lines(raster, lines, spacing=None, band=1, block_size=1024, n_workers=1):
+    """Statistics (min, max, mean and count) of raster values sampled along lines
+    (e.g. SFR reach linework, which occupies only part of each model cell).
+
+    Each line is sampled at evenly spaced points (including its ends); the points are grouped by raster block,
+    and each block is read only once (trimmed to the points in it). The mean is therefore weighted by the length
+    of line in each pixel.
+
+    Parameters
+    ----------
+    raster : str
+        Raster file (any format readable by rasterio), in the same coordinate system as the lines.
+    lines : linework.LineArray or sequence of shapely LineStrings
+    spacing : float, optional
+        Distance between sample points (by default, half of the raster pixel size).
+    band, block_size, n_workers
+        See sample_cells.
+
+    Returns
+    -------
+    stats : DataFrame
+        min, max, mean and count (number of sample points with data) for each line (in the same order).
+    """
+    rasterio = _import_rasterio()
+    if not isinstance(lines, LineArray):
+        lines = LineArray.from_geoms(lines)
+    with rasterio.open(_raster_path(raster)) as src:
+        transform, height, width = _check_transform(src), src.height, src.width
+    if spacing is None:
+        spacing = 0.5 * min(abs(transform.a), abs(transform.e))
+    points, line = lines.points_along(spacing)
+
+    # pixel containing each point
+    col = np.floor((points[:, 0] - transform.c) / transform.a).astype(np.int64)
+    row = np.floor((points[:, 1] - transform.f) / transform.e).astype(np.int64)
+    inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+    row, col, line = row[inside], col[inside], line[inside]
+
+    nblock_cols = -(-width // block_size)
+    block = (row // block_size) * nblock_cols + col // block_size
+    tasks = []
+    for b, members in _groups(block):
+        r0, c0 = row[members].min(), col[members].min()
+        window = (r0, row[members].max() + 1, c0, col[members].max() + 1)
+        tasks.append((window, (row[members] - r0, col[members] - c0, line[members])))
+
+    def reduce_block(data, task):
+        rows, cols, labels = task[1]
+        values = data[rows, cols]
+        valid = ~np.ma.getmaskarray(values)
+        return _reduce(labels[valid], np.ma.getdata(values)[valid].astype(float))
+
+    return _combine(_run(raster, band, tasks, reduce_block, n_workers), len(lines))
+
+
+def _sample_areas(raster, bounds, label, band, block_size, n_workers):
+    """Read the blocks covered by areas with the given bounds (xmin, ymin, xmax, ymax),
+    label the pixels in each block with the (zero-based) area that they are in (label function),
+    and reduce the values by label."""
+    rasterio = _import_rasterio()
+    with rasterio.open(_raster_path(raster)) as src:
+        transform, height, width = _check_transform(src), src.height, src.width
+
+    # pixel rows and columns covered by each area
+    col0 = np.floor((bounds[:, 0] - transform.c) / transform.a).astype(np.int64)
+    col1 = np.ceil((bounds[:, 2] - transform.c) / transform.a).astype(np.int64)
+    row0 = np.floor((bounds[:, 3] - transform.f) / transform.e).astype(np.int64)
+    row1 = np.ceil((bounds[:, 1] - transform.f) / transform.e).astype(np.int64)
+    row0, row1 = np.clip(row0, 0, height), np.clip(row1, 0, height)
+    col0, col1 = np.clip(col0, 0, width), np.clip(col1, 0, width)
+    area = np.arange(len(bounds))[(row1 > row0) & (col1 > col0)]
+
+    # blocks covered by each area (most areas are in one block)
+    br0, br1 = row0[area] // block_size, (row1[area] - 1) // block_size
+    bc0, bc1 = col0[area] // block_size, (col1[area] - 1) // block_size
+    nrows, ncols = br1 - br0 + 1, bc1 - bc0 + 1
+    counts = nrows * ncols
+    k = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    block_row = np.repeat(br0, counts) + k // np.repeat(ncols, counts)
+    block_col = np.repeat(bc0, counts) + k % np.repeat(ncols, counts)
+    area = np.repeat(area, counts)
+    nblock_cols = -(-width // block_size)
+
+    tasks = []
+    for b, members in _groups(block_row * nblock_cols + block_col):
+        candidates = area[members]
+        # window covering the areas in the block, trimmed to the block
+        br, bc = divmod(b, nblock_cols)
+        window = (max(row0[candidates].min(), br * block_size),
+                  min(row1[candidates].max(), (br + 1) * block_size),
+                  max(col0[candidates].min(), bc * block_size),
+                  min(col1[candidates].max(), (bc + 1) * block_size))
+        tasks.append((window, candidates))
+
+    def reduce_block(data, task):
+        (r0, r1, c0, c1), candidates = task
+        window_transform = transform * transform.translation(c0, r0)
+        labels = np.asarray(label(window_transform, data.shape, candidates)).ravel()
+        valid = (labels >= 0) & ~np.ma.getmaskarray(data).ravel()
+        return _reduce(labels[valid], np.ma.getdata(data).ravel()[valid].astype(float))
+
+    return _combine(_run(raster, band, tasks, reduce_block, n_workers), len(bounds))
+
+
+def _run(raster, band, tasks, reduce_block, n_workers):
+    """Read the window for each task, and reduce it, with a pool of threads
+    (each opening the raster once, for a contiguous chunk of tasks)."""
+    def run_chunk(chunk):
+        rasterio = _import_rasterio()
+        from rasterio.windows import Window
+        results = []
+        with rasterio.open(_raster_path(raster)) as src:
+            for task in chunk:
+                r0, r1, c0, c1 = task[0]
+                data = src.read(band, window=Window(c0, r0, c1 - c0, r1 - r0), masked=True)
+                results.append(reduce_block(data, task))
+        return results
+
+    if n_workers <= 1 or len(tasks) <= 1:
+        return run_chunk(tasks)
+    from concurrent.futures import ThreadPoolExecutor
+    bounds = np.linspace(0, len(tasks), min(n_workers * 4, len(tasks)) + 1).astype(int)
+    chunks = [tasks[b0:b1] for b0, b1 in zip(bounds[:-1], bounds[1:])]
+    with ThreadPoolExecutor(n_workers) as pool:
+        return [r for results in pool.map(run_chunk, chunks) for r in results]
+
+
+def _reduce(labels, values):
+    """Min, max, sum and count of values for each unique label."""
+    order = np.argsort(labels, kind='mergesort')
+    labels, values = labels[order], values[order]
+    if len(labels) == 0:
+        return labels, values, values, values, labels
+    starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+    return (labels[starts], np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts),
+            np.add.reduceat(values, starts), np.diff(np.append(starts, len(labels))))
+
+
+def _combine(partials, n):
+    """Combine the reductions from each block into a table of statistics for n areas or lines."""
+    mins, maxs = np.full(n, np.inf), np.full(n, -np.inf)
+    sums, counts = np.zeros(n), np.zeros(n, dtype=np.int64)
+    for labels, bmin, bmax, bsum, bcount in partials:
+        np.minimum.at(mins, labels, bmin)
+        np.maximum.at(maxs, labels, bmax)
+        np.add.at(sums, labels, bsum)
+        np.add.at(counts, labels, bcount)
+    nodata = counts == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats = pd.DataFrame({'min': mins, 'max': maxs, 'mean': sums / counts, 'count': counts},
+                             columns=stat_columns)
+    stats.loc[nodata, ['min', 'max', 'mean']] = np.nan
+    return stats
+
+
+def _groups(keys):
+    """(key, positions) for each unique key."""
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])) if len(keys) > 0 else []
+    return [(sorted_keys[s], g) for s, g in zip(starts, np.split(order, starts[1:]))]
+
+
+def _pixel_centers(transform, shape):
+    """x, y coordinates of the pixel centers in a (north-up) raster window."""
+    x = transform.c + transform.a * (np.arange(shape[1]) + 0.5)
+    y = transform.f + transform.e * (np.arange(shape[0]) + 0.5)
+    return np.meshgrid(x, y)
+
+
+def _check_transform(src):
+    transform = src.transform
+    if transform.b != 0 or transform.d != 0:
+        raise ValueError('Rotated rasters are not supported ({}).'.format(src.name))
+    return transform
+
+
+def _raster_path(raster):
+    return getattr(raster, 'name', raster)
+
+
+def _import_rasterio():
+    try:
+        import rasterio
+    except ImportError:
+        raise ImportError('Raster sampling requires rasterio.')
+    return rasterio
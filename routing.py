@@ -0,0 +1,500 @@
+__author__ = 'aleaf'
+import numpy as np
+
+
+class RoutingGraph(object):
+
+    def __init__(self, fromids, toids):
+        """Directed graph of routing connections (e.g. from the NHDPlus PlusFlow table),
+        indexed for fast lookups of upstream and downstream neighbors.
+
+        The ids are stored in a sorted array, and the connections in compressed sparse row (CSR)
+        form in both directions, so that the neighbors of any batch of ids can be
+        looked up with array operations (instead of scanning the table for each id).
+
+        Parameters
+        ----------
+        fromids : 1-D array
+            Id (e.g. COMID) at the start of each connection (e.g. PlusFlow FROMCOMID column).
+        toids : 1-D array
+            Id at the end of each connection (e.g. PlusFlow TOCOMID column).
+            Zero indicates no connection (e.g. an outlet).
+        """
+        self.fromids = np.asarray(fromids, dtype=np.int64)
+        self.toids = np.asarray(toids, dtype=np.int64)
+        self.ids = np.unique(np.concatenate([self.fromids, self.toids]))
+        self.nids = len(self.ids)
+
+        from_idx = np.searchsorted(self.ids, self.fromids)
+        to_idx = np.searchsorted(self.ids, self.toids)
+        # connections sorted by start (downstream lookups) and end (upstream lookups);
+        # stable sorts preserve the order of the connections in the input table
+        self._dn_order = np.argsort(from_idx, kind='mergesort')
+        self._dn_ptr = _pointers(from_idx, self.nids)
+        self._up_order = np.argsort(to_idx, kind='mergesort')
+        self._up_ptr = _pointers(to_idx, self.nids)
+
+    @classmethod
+    def from_plusflow(cls, pftable):
+        """Make a RoutingGraph from a dataframe of the NHDPlus PlusFlow table."""
+        return cls(pftable.FROMCOMID.values, pftable.TOCOMID.values)
+
+    def index(self, ids):
+        """Positions of ids in the sorted id array (-1 for ids that aren't in the graph)."""
+        ids = np.asarray(ids, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.ids, ids), max(self.nids - 1, 0))
+        found = self.ids[idx] == ids if self.nids > 0 else np.zeros(len(ids), dtype=bool)
+        return np.where(found, idx, -1)
+
+    def downstream(self, ids):
+        """List of the ids immediately downstream of each id (in the order of the input table)."""
+        return self._neighbor_lists(ids, self._dn_ptr, self.toids[self._dn_order])
+
+    def upstream(self, ids):
+        """List of the ids immediately upstream of each id (in the order of the input table)."""
+        return self._neighbor_lists(ids, self._up_ptr, self.fromids[self._up_order])
+
+    def _neighbor_lists(self, ids, ptr, values):
+        idx = self.index(ids)
+        start = np.where(idx >= 0, ptr[np.maximum(idx, 0)], 0)
+        end = np.where(idx >= 0, ptr[np.maximum(idx, 0) + 1], 0)
+        return [values[s:e].tolist() for s, e in zip(start, end)]
+
+    def next_in_set(self, ids, members, max_levels=10):
+        """Find the next id downstream of each id that is in members
+        (e.g. the next COMID downstream that is in the model), looking
+        at most max_levels connections downstream.
+        All ids are searched together, one level at a time.
+
+        Parameters
+        ----------
+        ids : 1-D array
+            Starting ids (not included in the search).
+        members : 1-D array
+            Set of ids to search for.
+        max_levels : int
+            Maximum number of connections to follow downstream.
+
+        Returns
+        -------
+        next_ids : 1-D array
+            Next id in members for each starting id (0 if none was found).
+            If more than one is found at the same level (e.g. at a divergence),
+            the smallest is taken, as there is no way to determine a preferred routing path.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        members = np.unique(np.asarray(members, dtype=np.int64))
+        next_ids = np.zeros(len(ids), dtype=np.int64)
+        unresolved = np.ones(len(ids), dtype=bool)
+        dn_values = self.toids[self._dn_order]
+
+        # search front of (starting position, current graph index) pairs
+        source = np.arange(len(ids))
+        current = self.index(ids)
+        # zero denotes an outlet, so the search doesn't continue past it
+        valid = (current >= 0) & (ids != 0)
+        source, current = source[valid], current[valid]
+        for level in range(max_levels):
+            if len(source) == 0:
+                break
+            pos, rows = _expand(self._dn_ptr, current)
+            source, nextids = source[pos], dn_values[rows]
+            found = np.isin(nextids, members) & unresolved[source]
+            if np.any(found):
+                fs, fi = source[found], nextids[found]
+                order = np.lexsort((fi, fs))
+                fs, fi = fs[order], fi[order]
+                first = np.unique(fs, return_index=True)[1]
+                next_ids[fs[first]] = fi[first]
+                unresolved[fs[first]] = False
+            keep = unresolved[source] & (nextids != 0)
+            pairs = np.unique(np.column_stack([source[keep], nextids[keep]]), axis=0)
+            source, current = pairs[:, 0], self.index(pairs[:, 1])
+            valid = current >= 0
+            source, current = source[valid], current[valid]
+        return next_ids
+
+    def upstream_within(self, ids, max_levels=10):
+        """Find all ids within max_levels connections upstream of any of ids
+        (e.g. the ids whose next_in_set search may pass through ids).
+
+        Parameters
+        ----------
+        ids : 1-D array
+            Starting ids (included in the result).
+        max_levels : int
+            Maximum number of connections to follow upstream.
+
+        Returns
+        -------
+        upstream_ids : 1-D array
+            Sorted array of the starting ids, and the ids upstream of them.
+        """
+        found = np.unique(np.asarray(ids, dtype=np.int64))
+        up_values = self.fromids[self._up_order]
+        current = self.index(found)
+        current = current[current >= 0]
+        for level in range(max_levels):
+            if len(current) == 0:
+                break
+            pos, rows = _expand(self._up_ptr, current)
+            upids = np.unique(up_values[rows])
+            # zero denotes no connection (e.g. an inlet)
+            upids = upids[(upids != 0) & ~np.isin(upids, found)]
+            found = np.union1d(found, upids)
+            current = self.index(upids)
+        return found
+
+
+def _pointers(idx, n):
+    """CSR row pointers for a set of (sorted-on) row indices."""
+    return np.concatenate([[0], np.cumsum(np.bincount(idx, minlength=n))]).astype(np.int64)
+
+
+def _expand(ptr, idx):
+    """Expand CSR rows idx into (position in idx, entry number) pairs for all of their entries."""
+    counts = ptr[idx + 1] - ptr[idx]
+    pos = np.repeat(np.arange(len(idx)), counts)
+    offsets = np.arange(len(pos)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return pos, ptr[idx][pos] + offsets
+
+
+class SegmentNetwork(object):
+
+    def __init__(self, segments, outsegs):
+        """Network of stream segments, each routed to a single downstream segment (outseg),
+        indexed so that everything upstream of each segment can be accumulated in one pass.
+
+        The segments are put in depth-first (preorder) sequence, starting at the outlets,
+        so that the segments upstream of each segment form a contiguous block in the sequence.
+        Upstream sums and counts are then differences of a cumulative sum, and upstream
+        sets are slices of the sequence (instead of being built by repeatedly
+        walking up the outseg lists).
+
+        Parameters
+        ----------
+        segments : 1-D array
+            Segment numbers.
+        outsegs : 1-D array
+            Outseg for each segment; zero (or any number not in segments)
+            denotes an outlet.
+
+        Attributes
+        ----------
+        order : 1-D array
+            Positions of the segments (in segments) in depth-first sequence.
+        start, stop : 1-D arrays
+            For each segment, the slice of order containing the segment (at start)
+            and everything upstream of it.
+        depth : 1-D array
+            Number of segments downstream of each segment.
+        """
+        self.segments = np.asarray(segments, dtype=np.int64)
+        self.outsegs = np.asarray(outsegs, dtype=np.int64)
+        self.nseg = len(self.segments)
+
+        # position of each outseg in segments (-1 for outlets)
+        self._sorted = np.argsort(self.segments, kind='mergesort')
+        self.out_idx = self.index(self.outsegs)
+
+        # CSR adjacency of upsegs for each segment (in input order)
+        routed = self.out_idx >= 0
+        up_order = np.argsort(self.out_idx[routed], kind='mergesort')
+        self._up = np.arange(self.nseg)[routed][up_order]
+        self._up_ptr = _pointers(self.out_idx[routed], self.nseg)
+
+        # depth-first sequence from the outlets
+        order = []
+        start = np.zeros(self.nseg, dtype=np.int64)
+        stop = np.zeros(self.nseg, dtype=np.int64)
+        depth = np.zeros(self.nseg, dtype=np.int64)
+        up, ptr = self._up, self._up_ptr
+        stack = [(i, False) for i in np.where(~routed)[0][::-1]]
+        while len(stack) > 0:
+            i, visited = stack.pop()
+            if visited:
+                stop[i] = len(order)
+                continue
+            start[i] = len(order)
+            order.append(i)
+            stack.append((i, True))
+            upsegs = up[ptr[i]:ptr[i + 1]]
+            depth[upsegs] = depth[i] + 1
+            stack += [(u, False) for u in upsegs[::-1]]
+        if len(order) < self.nseg:
+            # segments in circular routing are never reached from an outlet
+            visited = np.zeros(self.nseg, dtype=bool)
+            visited[order] = True
+            raise ValueError('Circular routing; segments not connected to an outlet: {}'
+                             .format(self.segments[~visited].tolist()))
+        self.order = np.array(order, dtype=np.int64)
+        self.start = start
+        self.stop = stop
+        self.depth = depth
+
+    def index(self, segments):
+        """Positions of segment numbers in segments (-1 for numbers not in segments)."""
+        segments = np.asarray(segments, dtype=np.int64)
+        if self.nseg == 0:
+            return -np.ones(len(segments), dtype=np.int64)
+        loc = np.minimum(np.searchsorted(self.segments[self._sorted], segments), self.nseg - 1)
+        idx = self._sorted[loc]
+        return np.where(self.segments[idx] == segments, idx, -1)
+
+    @property
+    def upstream_counts(self):
+        """Number of segments upstream of each segment."""
+        return self.stop - self.start - 1
+
+    def upsegs(self, segment):
+        """Segments immediately upstream of a segment."""
+        i = self.index([segment])[0]
+        return self.segments[self._up[self._up_ptr[i]:self._up_ptr[i + 1]]]
+
+    def upstream(self, segment):
+        """All segments upstream of a segment (in depth-first sequence)."""
+        i = self.index([segment])[0]
+        return self.segments[self.order[self.start[i] + 1:self.stop[i]]]
+
+    def upstream_sums(self, values):
+        """Sum a value (e.g. segment length) over all segments upstream of each segment,
+        not including the segment itself.
+
+        Parameters
+        ----------
+        values : 1-D array
+            Value for each segment (in the order of segments).
+
+        Returns
+        -------
+        sums : 1-D array
+        """
+        values = np.asarray(values, dtype=float)
+        csum = np.concatenate([[0.], np.cumsum(values[self.order])])
+        return csum[self.stop] - csum[self.start + 1]
+
+    def upstream_sets(self):
+        """Dictionary of sets of all segments upstream of each segment."""
+        segs = self.segments[self.order]
+        return {s: set(segs[b + 1:e]) for s, b, e in zip(self.segments, self.start, self.stop)}
+
+    def levels(self):
+        """Lists of segments at each level upstream of the outlets (level 0),
+        in breadth-first order."""
+        seq = self.order[np.argsort(self.depth[self.order], kind='mergesort')]
+        depths = self.depth[seq]
+        breaks = np.where(np.diff(depths) != 0)[0] + 1
+        return [self.segments[l].tolist() for l in np.split(seq, breaks)] if self.nseg > 0 else []
+
+    def upstream_reduce(self, values, ufunc=np.minimum):
+        """Reduce a value (e.g. minimum elevation) over each segment and all segments upstream of it,
+        one level at a time, starting with the segments farthest from the outlets.
+
+        Parameters
+        ----------
+        values : 1-D array
+            Value for each segment (in the order of segments).
+        ufunc : numpy ufunc
+            Binary function used for the reduction (default np.minimum).
+
+        Returns
+        -------
+        reduced : 1-D array
+        """
+        reduced = np.array(values, copy=True)
+        depth_order = np.argsort(self.depth, kind='mergesort')
+        depths = self.depth[depth_order]
+        breaks = np.where(np.diff(depths) != 0)[0] + 1
+        for level in np.split(depth_order, breaks)[::-1]:
+            routed = level[self.out_idx[level] >= 0]
+            ufunc.at(reduced, self.out_idx[routed], reduced[routed])
+        return reduced
+
+    def strahler_order(self):
+        """Strahler stream order of each segment (in the order of segments), computed one level
+        at a time, starting with the segments farthest from the outlets. Headwater segments are order 1;
+        a segment is one order higher than its highest-order upsegs if there are two or more of them,
+        and otherwise the same order."""
+        order = np.ones(self.nseg, dtype=np.int64)
+        highest = np.zeros(self.nseg, dtype=np.int64) # highest order of the upsegs of each segment
+        count = np.zeros(self.nseg, dtype=np.int64) # number of upsegs with that order
+        depth_order = np.argsort(self.depth, kind='mergesort')
+        depths = self.depth[depth_order]
+        breaks = np.where(np.diff(depths) != 0)[0] + 1
+        for level in np.split(depth_order, breaks)[::-1]:
+            # all upsegs of the segments in this level are in the level above, and are done
+            has_upsegs = highest[level] > 0
+            order[level] = np.where(has_upsegs, highest[level] + (count[level] > 1), 1)
+            routed = level[self.out_idx[level] >= 0]
+            out = self.out_idx[routed]
+            np.maximum.at(highest, out, order[routed])
+            np.add.at(count, out, order[routed] == highest[out])
+        return order
+
+
+class DownstreamPaths(object):
+
+    def __init__(self, segments, outsegs):
+        """Outlet, depth and downstream path of each segment in a routed network,
+        computed by pointer doubling (each pass follows twice as many outsegs as the previous),
+        so that only log2(number of segments) array operations are needed,
+        regardless of the length of the longest path.
+
+        The full table of downstream segments (one row per level) is only made on demand
+        (see table()), as its size is the number of segments times the longest path.
+
+        Parameters
+        ----------
+        segments : 1-D array
+            Segment numbers.
+        outsegs : 1-D array
+            Outseg for each segment; zero (or any number not in segments)
+            denotes an outlet.
+
+        Attributes
+        ----------
+        outlets : 1-D array
+            Outlet segment for each segment; the lake (negative outseg) for segments routed to a lake,
+            and 0 for segments in or leading to circular routing.
+        depth : 1-D array
+            Number of segments downstream of each segment (-1 for segments in or leading to circular routing).
+        cycles : list of lists
+            Segment sequence in each instance of circular routing.
+        """
+        self.segments = np.asarray(segments, dtype=np.int64)
+        self.outsegs = np.asarray(outsegs, dtype=np.int64)
+        n = len(self.segments)
+        self.nseg = n
+        self._sorted = np.argsort(self.segments, kind='mergesort')
+        self.parent = self.index(self.outsegs)
+
+        # position n is a sentinel beyond the outlets, which points to itself
+        jump = np.append(np.where(self.parent >= 0, self.parent, n), n)
+        hops = np.append((self.parent >= 0).astype(np.int64), 0)
+        last = np.arange(n + 1) # last segment (position) before the sentinel, within the current jump
+        for i in range(int(np.ceil(np.log2(max(n, 1)))) + 1):
+            beyond = jump[jump]
+            last = np.where(jump != n, last[jump], last)
+            hops = hops + hops[jump]
+            jump = beyond
+        jump, hops, last = jump[:-1], hops[:-1], last[:-1]
+
+        # after at least n steps, segments that still haven't reached the sentinel
+        # are in (or lead to) circular routing
+        circular = jump != n
+        self.outlets = np.where(circular, 0, self.segments[last])
+        # segments routed to a lake (negative outseg) have the lake as their outlet
+        lake = ~circular & (self.outsegs[last] < 0)
+        self.outlets[lake] = self.outsegs[last][lake]
+        self.depth = np.where(circular, -1, hops)
+        self.cycles = self._find_cycles(np.unique(jump[circular]))
+
+    def index(self, segments):
+        """Positions of segment numbers in segments (-1 for numbers not in segments)."""
+        segments = np.asarray(segments, dtype=np.int64)
+        if self.nseg == 0:
+            return -np.ones(len(segments), dtype=np.int64)
+        loc = np.minimum(np.searchsorted(self.segments[self._sorted], segments), self.nseg - 1)
+        idx = self._sorted[loc]
+        return np.where(self.segments[idx] == segments, idx, -1)
+
+    def _find_cycles(self, on_cycle):
+        """Walk each instance of circular routing, starting from positions known to be in a cycle."""
+        cycles = []
+        visited = set()
+        for i in on_cycle:
+            if i in visited:
+                continue
+            cycle = [i]
+            j = self.parent[i]
+            while j != i:
+                cycle.append(j)
+                j = self.parent[j]
+            visited.update(cycle)
+            cycles.append(self.segments[cycle].tolist())
+        return cycles
+
+    def path(self, segment):
+        """Sequence of segments from a segment to its outlet
+        (for circular routing, until the first repeated segment)."""
+        i = self.index([segment])[0]
+        path = []
+        seen = set()
+        while i >= 0 and i not in seen:
+            seen.add(i)
+            path.append(i)
+            i = self.parent[i]
+        return self.segments[path].tolist()
+
+    def table(self, max_levels=None):
+        """Dense table of the segment routing sequences from each segment to its outlet.
+
+        Parameters
+        ----------
+        max_levels : int, optional
+            Maximum number of levels (rows) below the segment numbers.
+            By default, the table extends to the longest path (plus one level around
+            each instance of circular routing).
+
+        Returns
+        -------
+        table : 2-D array
+            First row contains the segment numbers, second row the outsegs,
+            third row the outsegs of the outsegs, etc., ending with a row of zeros
+            (unless truncated by max_levels).
+        """
+        if max_levels is None:
+            max_levels = self.depth.max() + 2 if self.nseg > 0 else 1
+            if len(self.cycles) > 0:
+                max_levels += max(len(c) for c in self.cycles)
+        rows = [self.segments]
+        for level in range(max_levels):
+            idx = self.index(rows[-1])
+            rows.append(np.where(idx >= 0, self.outsegs[np.maximum(idx, 0)], 0))
+            if rows[-1].max() <= 0:
+                break
+        return np.vstack(rows)
+
+
+def breadth_first_order(segments, outsegs):
+    """Order segments breadth-first, starting at the outlets (outseg of 0) and moving upstream.
+    Segments at each level are listed by the order of their outsegs in the previous level,
+    then by their order in segments. The upstream connections are put in compressed sparse row (CSR)
+    form once, so each level is gathered with array operations.
+
+    Parameters
+    ----------
+    segments : 1-D array
+        Segment numbers.
+    outsegs : 1-D array
+        Outseg for each segment.
+
+    Returns
+    -------
+    order : 1-D array
+        Positions (in segments) of the segments that can be reached from an outlet, in breadth-first order.
+    """
+    segments = np.asarray(segments, dtype=np.int64)
+    outsegs = np.asarray(outsegs, dtype=np.int64)
+    n = len(segments)
+    if n == 0:
+        return np.array([], dtype=np.int64)
+    srt = np.argsort(segments, kind='mergesort')
+    loc = np.minimum(np.searchsorted(segments[srt], outsegs), n - 1)
+    out_idx = np.where(segments[srt[loc]] == outsegs, srt[loc], -1)
+
+    routed = out_idx >= 0
+    up = np.arange(n)[routed][np.argsort(out_idx[routed], kind='mergesort')]
+    ptr = _pointers(out_idx[routed], n)
+
+    visited = np.zeros(n, dtype=bool)
+    level = np.where(outsegs == 0)[0]
+    order = []
+    for i in range(n):
+        level = level[~visited[level]] # guards against circular routing
+        if len(level) == 0:
+            break
+        visited[level] = True
+        order.append(level)
+        level = up[_expand(ptr, level)[1]]
+    return np.concatenate(order) if len(order) > 0 else np.array([], dtype=np.int64)
@@ -0,0 +1,194 @@
+__author__ = 'aleaf'
+import os
+import sys
+import json
+import time
+import platform
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+columns = ['stage', 'level', 'wall_time', 'cpu_time', 'peak_rss_mb', 'rss_growth_mb', 'items']
+
+
+class RunReport(object):
+
+    def __init__(self, profile=None, profile_dir=None, verbose=True):
+        """Record of the wall time, CPU time, peak memory use and item counts
+        for each stage of an SFRmaker run (e.g. read, reproject, clip, make_mat1),
+        that can be saved to JSON or csv and compared between runs
+        (for example, before and after upgrading shapely or pandas).
+
+        Stages are recorded with the stage context manager:
+
+        >>> report = RunReport()
+        >>> with report.stage('clip') as stage:
+        ...     clipped = clip_to_domain(geoms, domain)
+        ...     stage['items'] = len(clipped)
+
+        Parameters
+        ----------
+        profile : bool or list of strings, optional
+            Stages to run under cProfile (True for all stages).
+            The profile statistics are kept in the profiles attribute (pstats.Stats instances, by stage).
+        profile_dir : str, optional
+            Folder for saving the profile statistics for each stage to <stage>.prof
+            (for viewing with pstats, snakeviz, etc.).
+        verbose : bool
+            Print the time taken by each stage.
+        """
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.verbose = verbose
+        self.stages = []
+        self.profiles = {}
+        self.info = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'versions': _versions()}
+        self._level = 0
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """Context manager that records a stage of the run.
+
+        Yields the record (a dict) for the stage, so that the number of items processed
+        (flowlines, reaches, etc.) can be set with stage['items'] = n.
+        Stages can be nested (e.g. intersect within make_mat1); the level of nesting
+        is recorded with each stage.
+        """
+        record = {'stage': name, 'level': self._level, 'items': items}
+        profiler = None
+        if self.profile is True or self.profile is not None and name in self.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+        rss0 = peak_rss()
+        cpu0 = cpu_time()
+        t0 = time.time()
+        self._level += 1
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self._level -= 1
+            record['wall_time'] = time.time() - t0
+            record['cpu_time'] = cpu_time() - cpu0
+            record['peak_rss_mb'] = peak_rss()
+            record['rss_growth_mb'] = record['peak_rss_mb'] - rss0 if rss0 is not None else None
+            self.stages.append(record)
+            if profiler is not None:
+                self._save_profile(name, profiler)
+            if self.verbose:
+                print("finished in {:.2f}s\n".format(record['wall_time']))
+
+    def _save_profile(self, name, profiler):
+        import pstats
+        self.profiles[name] = pstats.Stats(profiler)
+        if self.profile_dir is not None:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            profiler.dump_stats(os.path.join(self.profile_dir, '{}.prof'.format(name)))
+
+    def to_dataframe(self):
+        """Table of the recorded stages, in the order that they finished."""
+        return pd.DataFrame(self.stages, columns=columns)
+
+    def summary(self):
+        """Totals for each stage name (summing stages that were run more than once,
+        e.g. in update_sfr), in the order that the stages first finished."""
+        df = self.to_dataframe()
+        if len(df) == 0:
+            return df.set_index('stage')
+        summary = df.groupby('stage', sort=False).agg({'level': 'min', 'wall_time': 'sum', 'cpu_time': 'sum',
+                                                      'peak_rss_mb': 'max', 'rss_growth_mb': 'sum',
+                                                      'items': 'sum'})
+        summary['count'] = df.groupby('stage', sort=False).size()
+        return summary
+
+    def to_csv(self, filename):
+        """Write the recorded stages to a csv file."""
+        self.to_dataframe().to_csv(filename, index=False)
+
+    def to_json(self, filename):
+        """Write the recorded stages, with the run information
+        (time created, python version, package versions) to a JSON file."""
+        with open(filename, 'w') as output:
+            json.dump({'info': self.info,
+                       'stages': [dict((k, _to_builtin(v)) for k, v in s.items()) for s in self.stages]},
+                      output, indent=2)
+
+    @classmethod
+    def from_json(cls, filename):
+        """Load a RunReport saved with to_json."""
+        with open(filename) as src:
+            data = json.load(src)
+        report = cls(verbose=False)
+        report.info = data['info']
+        report.stages = data['stages']
+        return report
+
+    def compare(self, other):
+        """Compare the stage totals for this run with another (e.g. a baseline run).
+
+        Parameters
+        ----------
+        other : RunReport, or str
+            Report (or JSON file saved with to_json) to compare to.
+
+        Returns
+        -------
+        comparison : DataFrame
+            Wall time, CPU time and peak memory of each stage in both runs,
+            and the ratios of this run to the other (values > 1 are slower / larger).
+        """
+        if not isinstance(other, RunReport):
+            other = RunReport.from_json(other)
+        cols = ['wall_time', 'cpu_time', 'peak_rss_mb', 'items']
+        this, other = self.summary()[cols], other.summary()[cols]
+        stages = list(this.index) + [s for s in other.index if s not in this.index]
+        df = this.join(other, how='outer', rsuffix='_other').reindex(stages)
+        for c in ['wall_time', 'cpu_time', 'peak_rss_mb']:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                df[c + '_ratio'] = df[c].astype(float) / df[c + '_other'].astype(float)
+        return df
+
+
+def cpu_time():
+    """User + system CPU time (s) of this process and any child processes that have finished
+    (e.g. from multiprocessing pools)."""
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def peak_rss():
+    """Peak resident memory (MB) of this process, or None if it can't be determined."""
+    try:
+        import resource
+    except ImportError: # windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2.**20
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2.**20 if sys.platform == 'darwin' else maxrss / 2.**10 # bytes on mac, kB on linux
+
+
+def _versions():
+    versions = {}
+    for package in ['numpy', 'pandas', 'shapely', 'pyproj', 'fiona', 'rtree', 'scipy']:
+        try:
+            versions[package] = __import__(package).__version__
+        except (ImportError, AttributeError):
+            versions[package] = None
+    return versions
+
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -0,0 +1,243 @@
+__author__ = 'aleaf'
+"""
+Tests for disfile.DisFile, comparing the arrays to those loaded by flopy
+for each form of array control record.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+
+flopy = pytest.importorskip('flopy')
+from disfile import DisFile
+
+nrow, ncol = 7, 5
+
+
+def flopy_dis(model_ws, name, nlay=3, laycbd=0, top=None, botm=None, external_path=None):
+    """Write a DIS file with flopy; returns the top and bottom arrays that were written."""
+    rs = np.random.RandomState(1)
+    m = flopy.modflow.Modflow(name, model_ws=model_ws, external_path=external_path)
+    if top is None:
+        top = rs.uniform(100, 200, (nrow, ncol))
+    if botm is None:
+        nbotm = nlay + np.sum(np.atleast_1d(laycbd)[:nlay - 1])
+        botm = np.array([top - 10 * (i + 1) for i in range(nbotm)])
+    flopy.modflow.ModflowDis(m, nlay=nlay, nrow=nrow, ncol=ncol, laycbd=laycbd, top=top, botm=botm,
+                             delr=rs.uniform(1, 5, ncol), delc=rs.uniform(1, 5, nrow))
+    m.write_input()
+    return top, botm
+
+
+def load_flopy(model_ws, disfile, namefile=None):
+    if namefile is not None:
+        m = flopy.modflow.Modflow.load(namefile, model_ws=model_ws, load_only=['dis'], check=False)
+        return m.dis
+    m = flopy.modflow.Modflow(model_ws=model_ws)
+    return flopy.modflow.ModflowDis.load(os.path.join(model_ws, disfile), m, check=False)
+
+
+def check_dis(d, f):
+    """Compare a DisFile instance to a flopy ModflowDis instance."""
+    assert (d.nlay, d.nrow, d.ncol) == (f.nlay, f.nrow, f.ncol)
+    assert np.array_equal(d.laycbd, f.laycbd.array)
+    assert np.allclose(d.delr, f.delr.array)
+    assert np.allclose(d.delc, f.delc.array)
+    assert np.allclose(d.get_top(), f.top.array, rtol=1e-6)
+    assert np.allclose(d.get_botm(), f.botm.array, rtol=1e-6)
+
+    # top and bottoms of the model layers (confining beds are skipped)
+    elevs = np.concatenate([[f.top.array], f.botm.array[d._botm_index]])
+    assert np.allclose(d.dense(), elevs, rtol=1e-6)
+    rs = np.random.RandomState(2)
+    l, r, c = rs.randint(0, d.nlay + 1, 20), rs.randint(0, d.nrow, 20), rs.randint(0, d.ncol, 20)
+    assert np.allclose(d.elevations[l, r, c], elevs[l, r, c], rtol=1e-6)
+    assert np.allclose(d.elevations_at(l, r, c), elevs[l, r, c], rtol=1e-6)
+    assert np.allclose(d.top_at(r * d.ncol + c + 1), elevs[0, r, c], rtol=1e-6)
+
+    y, x = d.get_node_coordinates()
+    yf, xf, _ = f.get_node_coordinates()
+    assert np.allclose(y, yf)
+    assert np.allclose(x, xf)
+
+
+def test_internal(tmpdir):
+    model_ws = str(tmpdir)
+    flopy_dis(model_ws, 'internal')
+    d = DisFile(os.path.join(model_ws, 'internal.dis'))
+    assert d._top_record.kind == 'text'
+    check_dis(d, load_flopy(model_ws, 'internal.dis'))
+
+
+def test_laycbd(tmpdir):
+    model_ws = str(tmpdir)
+    flopy_dis(model_ws, 'laycbd', laycbd=[1, 0, 0])
+    d = DisFile(os.path.join(model_ws, 'laycbd.dis'))
+    assert len(d._botm_records) == 4
+    assert list(d._botm_index) == [0, 2, 3]
+    check_dis(d, load_flopy(model_ws, 'laycbd.dis'))
+
+
+def test_constant(tmpdir):
+    model_ws = str(tmpdir)
+    flopy_dis(model_ws, 'constant', top=150., botm=[100., 50., 0.])
+    d = DisFile(os.path.join(model_ws, 'constant.dis'))
+    assert d._top_record.kind == 'constant'
+    check_dis(d, load_flopy(model_ws, 'constant.dis'))
+
+
+def test_open_close(tmpdir):
+    model_ws = str(tmpdir)
+    flopy_dis(model_ws, 'openclose', external_path='ext')
+    with open(os.path.join(model_ws, 'openclose.dis')) as src:
+        assert 'OPEN/CLOSE' in src.read()
+    d = DisFile(os.path.join(model_ws, 'openclose.dis'))
+    check_dis(d, load_flopy(model_ws, 'openclose.dis'))
+
+
+def test_binary(tmpdir):
+    model_ws = str(tmpdir)
+    flopy_dis(model_ws, 'internal')
+    top = np.random.RandomState(3).uniform(100, 200, (nrow, ncol)).astype(np.float32)
+    flopy.utils.Util2d.write_bin((nrow, ncol), os.path.join(model_ws, 'top.bin'), top, bintype='head')
+
+    # replace the top array with an OPEN/CLOSE binary file (with a header)
+    with open(os.path.join(model_ws, 'internal.dis')) as src:
+        lines = src.readlines()
+    records = [i for i, line in enumerate(lines) if line.upper().startswith('INTERNAL')]
+    lines = lines[:records[2]] + ['OPEN/CLOSE top.bin 1.0 (BINARY) -1\n'] + lines[records[3]:]
+    with open(os.path.join(model_ws, 'binary.dis'), 'w') as dest:
+        dest.writelines(lines)
+
+    d = DisFile(os.path.join(model_ws, 'binary.dis'))
+    assert d._top_record.kind == 'binary'
+    assert np.allclose(d.top, top, rtol=1e-6)
+    check_dis(d, load_flopy(model_ws, 'binary.dis'))
+
+
+
+@pytest.mark.parametrize('real, dtype', [(np.float32, np.float32), (np.float64, np.float64),
+                                         (np.float32, np.float64)])
+def test_binary_header(tmpdir, real, dtype):
+    # single and double precision arrays, and double precision values after a single precision header
+    model_ws = str(tmpdir)
+    flopy_dis(model_ws, 'internal')
+    top = np.random.RandomState(3).uniform(100, 200, (nrow, ncol))
+    with open(os.path.join(model_ws, 'top.bin'), 'wb') as dest:
+        np.array([1, 1], dtype=np.int32).tofile(dest) # kstp, kper
+        np.array([1., 1.], dtype=real).tofile(dest) # pertim, totim
+        dest.write('{:>16}'.format('TOP').encode('ascii'))
+        np.array([ncol, nrow, 1], dtype=np.int32).tofile(dest)
+        top.astype(dtype).tofile(dest)
+
+    with open(os.path.join(model_ws, 'internal.dis')) as src:
+        lines = src.readlines()
+    records = [i for i, line in enumerate(lines) if line.upper().startswith('INTERNAL')]
+    lines = lines[:records[2]] + ['OPEN/CLOSE top.bin 2.0 (BINARY) -1\n'] + lines[records[3]:]
+    with open(os.path.join(model_ws, 'binary.dis'), 'w') as dest:
+        dest.writelines(lines)
+
+    d = DisFile(os.path.join(model_ws, 'binary.dis'))
+    assert d._top_record.dtype == dtype
+    assert np.allclose(d.get_top(), 2 * top.astype(dtype))
+    f = load_flopy(model_ws, 'internal.dis')
+    assert np.allclose(d.get_botm(), f.botm.array, rtol=1e-6)
+
+
+free_dis = """# hand written, free format
+2 {nrow} {ncol} 1 4 2
+0 0
+CONSTANT 10.0
+INTERNAL 1.0 (FREE) 0
+{delc}
+INTERNAL 2.0 (FREE) 0
+{top}
+EXTERNAL 31 1.0 (FREE) 0
+EXTERNAL 31 -1.0 (FREE) 0
+ 1.0 1 1.0 TR
+"""
+
+free_nam = """LIST 2 {0}.list
+DIS 11 {0}.dis
+DATA 31 {0}_botm.txt
+"""
+
+
+def write_free(model_ws, name, exponent='E'):
+    """Hand-write a free-format DIS file, with repeat counts (n*value) and the given exponent character,
+    and a file of two bottom arrays read by EXTERNAL on the same unit."""
+    n = nrow * ncol
+    delc = ' '.join(['{}*2.5{}+00'.format(nrow - 1, exponent), '3'])
+    top = np.arange(n, dtype=float).reshape(nrow, ncol)
+    top[-1, -3:] = 7.5
+    # values across lines that don't match the rows
+    values = ['{:.1f}{}+01'.format(v / 10., exponent) for v in top.ravel()[:-3]]
+    lines = [' '.join(values[i:i + 8]) for i in range(0, len(values), 8)]
+    lines.append('3*0.75{}1'.format(exponent))
+    with open(os.path.join(model_ws, name + '.dis'), 'w') as dest:
+        dest.write(free_dis.format(nrow=nrow, ncol=ncol, delc=delc, top='\n'.join(lines)))
+    with open(os.path.join(model_ws, name + '.nam'), 'w') as dest:
+        dest.write(free_nam.format(name))
+    with open(os.path.join(model_ws, name + '_botm.txt'), 'w') as dest:
+        for i in range(nrow):
+            dest.write(' '.join(['{:.1f}'.format(-i - j) for j in range(ncol)]) + '\n')
+        dest.write('{}*1.0\n'.format(n))
+
+
+def test_free_format(tmpdir):
+    model_ws = str(tmpdir)
+    write_free(model_ws, 'free')
+    d = DisFile(os.path.join(model_ws, 'free.dis'), namefile=os.path.join(model_ws, 'free.nam'))
+    f = load_flopy(model_ws, 'free.dis', 'free.nam')
+    assert np.allclose(d.get_top()[-1, -3:], 15.)
+    assert np.allclose(d.botm(1), -1.)
+    check_dis(d, f)
+
+
+def test_free_format_d_exponents(tmpdir):
+    # flopy doesn't read D exponents; compare to the same file written with E exponents
+    model_ws = str(tmpdir)
+    write_free(model_ws, 'free')
+    write_free(model_ws, 'free_d', exponent='D')
+    with open(os.path.join(model_ws, 'free_d.dis')) as src:
+        assert 'D+01' in src.read()
+    d = DisFile(os.path.join(model_ws, 'free_d.dis'), namefile=os.path.join(model_ws, 'free_d.nam'))
+    check_dis(d, load_flopy(model_ws, 'free.dis', 'free.nam'))
+
+
+fixed_dis = """# hand written, fixed format
+1 3 4 1 4 0
+0
+CONSTANT 10.0
+INTERNAL 1.0 (3F5.1) 0
+  5.0  5.0  6.0
+INTERNAL 1.0 (4F5.0) 0
+  1.0  2.0  3.0  4.0
+  5.0  6.0  7.0  8.0
+  9.0 10.0 11.0 12.0
+INTERNAL 1.0 (4E10.3) 0
+ 1.000{0}+00 2.000{0}+00 3.000{0}+00 4.000{0}+00
+ 5.000{0}+00 6.000{0}+00 7.000{0}+00 8.000{0}+00
+ 9.000{0}+00-1.000{0}+00-2.000{0}+00-3.000{0}+00
+ 1.0 1 1.0 TR
+"""
+
+
+def test_fixed_format(tmpdir):
+    # fixed width fields, including negative values without spaces between them
+    model_ws = str(tmpdir)
+    for name, exponent in [('fixed', 'E'), ('fixed_d', 'D')]:
+        with open(os.path.join(model_ws, name + '.dis'), 'w') as dest:
+            dest.write(fixed_dis.format(exponent))
+    f = load_flopy(model_ws, 'fixed.dis')
+    assert np.allclose(f.botm.array[0, -1], [9, -1, -2, -3])
+    check_dis(DisFile(os.path.join(model_ws, 'fixed.dis')), f)
+    check_dis(DisFile(os.path.join(model_ws, 'fixed_d.dis')), f)
+
+
+def test_external_needs_namefile(tmpdir):
+    model_ws = str(tmpdir)
+    write_free(model_ws, 'free')
+    with pytest.raises(ValueError):
+        DisFile(os.path.join(model_ws, 'free.dis'))
@@ -0,0 +1,159 @@
+__author__ = 'aleaf'
+"""
+Tests for breaking flowlines into reaches with grid.StructuredGrid.intersect
+and grid.VertexGrid.intersect, comparing Mat1 to that made by intersecting the lines with the cell polygons (preproc.make_mat1).
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+from shapely.geometry import LineString, MultiLineString
+
+pytest.importorskip('fiona')
+pytest.importorskip('GISio')
+from preproc import make_mat1, make_mat1_from_grid
+from grid import StructuredGrid, VertexGrid
+
+delr = np.array([10., 12., 8., 10., 15.])
+delc = np.array([9., 10., 11., 10.])
+
+
+def structured_grid(rot):
+    return StructuredGrid(delr, delc, xul=100., yul=200., rot=rot)
+
+
+def line(grid, u, v):
+    """LineString from coordinates relative to the upper left corner of the grid
+    (u along the rows, v down the columns)."""
+    x, y = grid.to_world(np.array(u, dtype=float), np.array(v, dtype=float))
+    return LineString(list(zip(x, y)))
+
+
+def polygon_mat1(geom, grid):
+    polygons = grid.cell_polygons()
+    intersections = [[k for k, p in enumerate(polygons) if p.intersects(geom)]]
+    return make_mat1([geom], [1], [1], intersections, polygons, tol=0.001,
+                     reach_ordering='linear', geometry_array=True)
+
+
+def check_same_as_polygons(geom, grid):
+    m1, reach_geoms = make_mat1_from_grid([geom], [1], [1], grid, geometry_array=True)
+    m1p, reach_geomsp = polygon_mat1(geom, grid)
+    assert m1.node.tolist() == m1p.node.tolist()
+    assert m1.reach.tolist() == m1p.reach.tolist()
+    assert np.allclose(reach_geoms.lengths, reach_geomsp.lengths)
+    assert np.allclose(reach_geoms.starts, reach_geomsp.starts)
+    assert np.allclose(reach_geoms.ends, reach_geomsp.ends)
+    return m1, reach_geoms
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_structured_grid(rot):
+    grid = structured_grid(rot)
+    # starts and ends outside of the grid
+    geom = line(grid, [-5, 17, 33, 51, 60], [3, 25, 12, 37, 45])
+    m1, reach_geoms = check_same_as_polygons(geom, grid)
+    assert len(m1) > 5
+    assert np.isclose(reach_geoms.lengths.sum(), geom.intersection(grid.outline).length)
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_structured_grid_through_vertex(rot):
+    grid = structured_grid(rot)
+    # diagonal through the corner shared by cells 1, 2, 6 and 7
+    check_same_as_polygons(line(grid, [5, 15], [4.5, 13.5]), grid)
+    # line with a vertex on the corner
+    check_same_as_polygons(line(grid, [5, 10, 16], [2, 9, 12]), grid)
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_structured_grid_multilinestring(rot):
+    grid = structured_grid(rot)
+    part1 = line(grid, [1, 20], [1, 15])
+    part2 = line(grid, [25, 50], [30, 5])
+    m1, reach_geoms = check_same_as_polygons(MultiLineString([part1, part2]), grid)
+    # reach numbering is continuous across the parts
+    nreaches1 = len(grid.intersect(part1)[0])
+    assert m1.reach.tolist() == list(range(1, len(m1) + 1))
+    assert np.allclose(reach_geoms.starts[nreaches1], part2.coords[0])
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+@pytest.mark.parametrize('u, v, adjacent', [([5, 35], [9, 9], [1, 2, 3, 4, 6, 7, 8, 9]), # along a row edge
+                                            ([22, 22], [3, 25], [2, 3, 7, 8, 12, 13])]) # along a column edge
+def test_structured_grid_on_edge(rot, u, v, adjacent):
+    grid = structured_grid(rot)
+    geom = line(grid, u, v)
+    m1, reach_geoms = make_mat1_from_grid([geom], [1], [1], grid, geometry_array=True)
+    m1p, reach_geomsp = polygon_mat1(geom, grid)
+    # intersecting with the polygons assigns the line to the cells on both sides of the edge
+    # (or in the rotated grid, to either side, depending on round-off), while walking the grid
+    # assigns each piece of the line to one of the cells
+    assert set(m1p.node).issubset(adjacent)
+    assert set(m1.node).issubset(adjacent)
+    assert len(m1) == len(np.unique(m1.node))
+    assert np.isclose(reach_geoms.lengths.sum(), geom.length)
+    assert reach_geomsp.lengths.sum() >= geom.length - 1e-6
+    assert np.allclose(reach_geoms.starts[1:], reach_geoms.ends[:-1])
+
+
+def quadtree_grid(rot):
+    """4 x 4 grid of 10 x 10 cells, with the cell at x 10-20, y 20-30 refined into 4 cells
+    (the neighboring cells include the vertices at the middle of their shared edges)."""
+    cells = []
+    for i in range(4):
+        for j in range(4):
+            x0, y0 = 10. * j, 30. - 10. * i
+            if (x0, y0) == (10., 20.):
+                cells += [[(x, y), (x, y + 5), (x + 5, y + 5), (x + 5, y)]
+                          for y in (25., 20.) for x in (10., 15.)]
+                continue
+            ring = [(x0, y0), (x0, y0 + 10), (x0 + 10, y0 + 10), (x0 + 10, y0)]
+            # hanging vertices on the edges shared with the refined cell
+            if (x0, y0) == (0., 20.):
+                ring.insert(3, (10., 25.))
+            elif (x0, y0) == (20., 20.):
+                ring.insert(1, (20., 25.))
+            elif (x0, y0) == (10., 30.):
+                ring.insert(0, (15., 30.))
+            elif (x0, y0) == (10., 10.):
+                ring.insert(2, (15., 20.))
+            cells.append(ring)
+    vertices = sorted(set(v for ring in cells for v in ring))
+    number = {v: n for n, v in enumerate(vertices)}
+    iverts = [[number[v] for v in ring] for ring in cells]
+    return VertexGrid(vertices, iverts, xoff=100., yoff=200., rot=rot)
+
+
+def vertex_line(rot, x, y):
+    """LineString from coordinates relative to the origin of the grid made by quadtree_grid(rot)."""
+    rot = np.radians(rot)
+    x, y = np.array(x, dtype=float), np.array(y, dtype=float)
+    return LineString(list(zip(100. + x * np.cos(rot) - y * np.sin(rot),
+                               200. + x * np.sin(rot) + y * np.cos(rot))))
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_vertex_grid(rot):
+    grid = quadtree_grid(rot)
+    assert grid.ncells == 19
+    # across the refined cells; starts and ends outside of the grid
+    geom = vertex_line(rot, [-5, 12, 17, 33, 45], [33, 27, 21, 14, -2])
+    m1, reach_geoms = check_same_as_polygons(geom, grid)
+    assert len(m1) > 5
+    # through the corner shared by the refined cells, and a hanging vertex
+    check_same_as_polygons(vertex_line(rot, [5, 25], [15, 35]), grid)
+    check_same_as_polygons(vertex_line(rot, [2, 10, 14], [29, 25, 23]), grid)
+    # MultiLineString
+    check_same_as_polygons(MultiLineString([vertex_line(rot, [1, 18], [1, 28]),
+                                            vertex_line(rot, [22, 39], [39, 3])]), grid)
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_vertex_grid_on_edge(rot):
+    # VertexGrid.intersect intersects the line with the cell polygons near it,
+    # so the reaches along an edge are the same as with the polygon path (in the cells on both sides)
+    grid = quadtree_grid(rot)
+    check_same_as_polygons(vertex_line(rot, [3, 37], [20, 20]), grid)
+    check_same_as_polygons(vertex_line(rot, [15, 15], [22, 38]), grid)
@@ -0,0 +1,442 @@
+__author__ = 'aleaf'
+"""
+Tests for routing.RoutingGraph, routing.SegmentNetwork, routing.DownstreamPaths,
+routing.breadth_first_order and preproc.renumber_segments on small hand-built
+and random networks, comparing the results to those of the loops that they replaced.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import numpy as np
+import pytest
+from routing import RoutingGraph, SegmentNetwork, DownstreamPaths, breadth_first_order
+from synthetic import dendritic_network
+
+segments = np.arange(1, 13)
+lengths = np.array([1.5, 2., 3., 1., 2.5, 4., 1., 2., 3.5, 1., 2., 0.5])
+elevations = np.array([110., 105., 100., 120., 95., 90., 80., 85., 70., 75., 60., 65.])
+
+#         1   2   3   4   5   6   7   8   9  10  11  12
+tree = [3,  3,  6,  5,  6,  0,  8,  0, 10, 11, 12,  0]
+lake = [3,  3, -1,  5,  6,  0,  8,  0, 10, 11, 12,  0] # segment 3 goes to lake 1
+circular = [3,  3,  6,  5,  6,  0,  8,  0, 10, 11,  9,  9] # 9 -> 10 -> 11 -> 9, and 12 -> 9
+
+
+# loops replaced by SegmentNetwork and DownstreamPaths
+def loop_upsegs(nseg, outseg):
+    """preproc.get_upsegs"""
+    upsegs = {o: set(nseg[outseg == o]) for o in np.unique(outseg)}
+    outsegs = outseg[outseg != 0].tolist()
+    for s in outsegs:
+        upsegslist = upsegs[s]
+        for i in range(len(nseg)):
+            added_upsegs = set()
+            [added_upsegs.update(set(upsegs[us])) for us in upsegslist if us in outsegs]
+            if len(added_upsegs) == 0:
+                break
+            else:
+                upsegslist = added_upsegs
+                upsegs[s].update(added_upsegs)
+    return upsegs
+
+
+def loop_upstream_min(nseg, outseg, values):
+    """Minimum over each segment and all of its upsegs (SFRdata.reset_segment_ends_from_dem)."""
+    def get_nextupsegs(upsegs):
+        nextupsegs = []
+        for s in upsegs:
+            nextupsegs += nseg[outseg == s].tolist()
+        return nextupsegs
+
+    def get_upsegs(seg):
+        upsegs = nseg[outseg == seg].tolist()
+        all_upsegs = upsegs
+        for i in range(len(nseg)):
+            upsegs = get_nextupsegs(upsegs)
+            if len(upsegs) > 0:
+                all_upsegs.extend(upsegs)
+            else:
+                break
+        return all_upsegs
+
+    return np.array([values[np.array(get_upsegs(s) + [s]) - 1].min() for s in nseg])
+
+
+def loop_levels(nseg, outseg):
+    """Segments at each level upstream of the outlets (SFRdata.reset_segment_ends_from_dem)."""
+    upsegs = nseg[outseg == 0].tolist()
+    levels = [upsegs]
+    for i in range(len(nseg)):
+        upsegs = [u for s in upsegs for u in nseg[outseg == s].tolist()]
+        if len(upsegs) == 0:
+            break
+        levels.append(upsegs)
+    return levels
+
+
+def loop_renumber(nseg, outseg):
+    """preproc.renumber_segments (level walk from the outlets)"""
+    def reassign_upsegs(r, nexts, upsegs):
+        nextupsegs = []
+        for u in upsegs:
+            r[u] = nexts if u > 0 else u # handle lakes
+            nexts -= 1
+            nextupsegs += list(nseg[outseg == u])
+        return r, nexts, nextupsegs
+
+    r = {0: 0}
+    r.update({o: 0 for o in outseg if o > 0 and o not in nseg})
+    outseg = np.array([o if o in nseg or o < 0 else 0 for o in outseg])
+
+    if len(nseg) != len(np.unique(nseg)):
+        d = dict(zip(nseg, outseg))
+        nseg, outseg = np.array(list(d.keys())), np.array(list(d.values()))
+    ns = len(nseg)
+
+    nexts = ns
+    nextupsegs = nseg[outseg == 0]
+    for i in range(ns):
+        r, nexts, nextupsegs = reassign_upsegs(r, nexts, nextupsegs)
+        if len(nextupsegs) == 0:
+            break
+    return r
+
+
+def loop_sequences(segments, outsegs):
+    """preproc.map_segment_sequences; returns the array of segment sequences,
+    and the sets of segments in each instance of circular routing."""
+    all_outsegs = np.vstack([segments, outsegs])
+    nseg = len(segments)
+    max_outseg = all_outsegs[-1].max()
+    knt = 1
+    circles = []
+    while max_outseg > 0:
+        nextlevel = np.array([outsegs[s - 1] if s > 0 and s < 999999 else 0
+                              for s in all_outsegs[-1]])
+        all_outsegs = np.vstack([all_outsegs, nextlevel])
+        max_outseg = nextlevel.max()
+        if max_outseg == 0:
+            break
+        knt += 1
+        if knt > nseg:
+            for row in all_outsegs.T[all_outsegs[-1] > 0]:
+                repeat_start_ind = np.where(row == row[-1])[0][-2:][0]
+                circular_seq = set(row[repeat_start_ind:].tolist())
+                if circular_seq not in circles:
+                    circles.append(circular_seq)
+            break
+    return all_outsegs, circles
+
+
+def loop_outlets(all_outsegs):
+    """Outlet column from SFRdata.map_outsegs (the last value in each sequence that is != 0 or 999999)."""
+    return np.array([r[(r != 0) & (r != 999999)][-1] for r in all_outsegs.T])
+
+
+@pytest.mark.parametrize('outsegs', [tree, lake], ids=['tree', 'lake'])
+def test_segment_network(outsegs):
+    outsegs = np.array(outsegs)
+    network = SegmentNetwork(segments, outsegs)
+
+    upsegs = loop_upsegs(segments, outsegs)
+    upstream_sets = network.upstream_sets()
+    for s in segments:
+        assert upstream_sets[s] == upsegs.get(s, set())
+        assert set(network.upstream(s)) == upsegs.get(s, set())
+    assert np.array_equal(network.upstream_counts, [len(upsegs.get(s, [])) for s in segments])
+
+    # arbolate sums (lengths of everything upstream)
+    asums = [lengths[np.array(sorted(upsegs[s]), dtype=int) - 1].sum() if s in upsegs else 0.
+             for s in segments]
+    assert np.allclose(network.upstream_sums(lengths), asums)
+
+    assert np.array_equal(network.upstream_reduce(elevations, np.minimum),
+                          loop_upstream_min(segments, outsegs, elevations))
+
+
+def test_segment_network_levels():
+    outsegs = np.array(tree)
+    assert SegmentNetwork(segments, outsegs).levels() == loop_levels(segments, outsegs)
+
+
+def random_network():
+    """Randomly numbered network with several outlets, a segment routed to a lake,
+    and segments in circular routing (which can't be reached from an outlet)."""
+    nseg, outseg = dendritic_network(200, n_outlets=4, seed=2)
+    outseg = outseg.copy()
+    outseg[nseg == nseg[outseg == 0][1]] = -1 # an outlet routed to lake 1, with its upsegs
+    circle = np.array([201, 202, 203])
+    return np.concatenate([nseg, circle]), np.concatenate([outseg, [202, 203, 201]])
+
+
+@pytest.mark.parametrize('network', ['tree', 'random'])
+def test_breadth_first_order(network):
+    if network == 'tree':
+        nseg, outseg = segments, np.array(tree)
+    else:
+        nseg, outseg = random_network()
+    position = {s: i for i, s in enumerate(nseg)}
+    levels = loop_levels(nseg, outseg)
+    expected = [position[s] for level in levels for s in level]
+    order = breadth_first_order(nseg, outseg)
+    assert order.tolist() == expected
+    if network == 'random':
+        assert len(levels[0]) == 3
+        assert len(order) < len(nseg) - 3
+
+
+@pytest.mark.parametrize('network', ['tree', 'lake', 'random', 'duplicates', 'missing'])
+def test_renumber_segments(network):
+    pytest.importorskip('fiona')
+    pytest.importorskip('GISio')
+    from preproc import renumber_segments, remap_segments
+    if network in ['tree', 'lake']:
+        nseg, outseg = segments, np.array(tree if network == 'tree' else lake)
+    else:
+        nseg, outseg = random_network()
+    if network == 'duplicates':
+        # segment/outseg pairs listed for each reach; the last outseg listed for each segment is used
+        rs = np.random.RandomState(3)
+        reps = rs.randint(1, 4, len(nseg))
+        nseg, outseg = np.repeat(nseg, reps), np.repeat(outseg, reps)
+        shuffle = rs.permutation(len(nseg))
+        nseg, outseg = nseg[shuffle], outseg[shuffle]
+    elif network == 'missing':
+        # outsegs that aren't in the network are outlets
+        outseg = np.where(np.isin(outseg, nseg[:20]), outseg + 1000, outseg)
+    r, remap = renumber_segments(nseg, outseg, return_remap=True)
+    expected = loop_renumber(nseg, outseg)
+    assert r == expected
+    assert renumber_segments(nseg, outseg) == expected
+    # the remap array gives the same numbers, and leaves the others alone
+    keys = np.array(sorted(expected.keys()))
+    assert np.array_equal(remap[keys], [expected[k] for k in keys])
+    others = np.setdiff1d(np.arange(len(remap)), keys)
+    assert np.array_equal(remap[others], others)
+    assert np.array_equal(remap_segments(remap, nseg), [expected.get(s, s) for s in nseg])
+
+
+def test_segment_network_order():
+    # results are in the order of the input segments, which don't have to be sorted or consecutive
+    order = np.random.RandomState(1).permutation(len(segments))
+    renumber = dict(zip(segments, segments * 10))
+    renumber[0] = 0
+    nseg = np.array([renumber[s] for s in segments])[order]
+    outseg = np.array([renumber[s] for s in tree])[order]
+    network = SegmentNetwork(nseg, outseg)
+    upsegs = loop_upsegs(nseg, outseg)
+    assert network.upstream_sets() == {s: upsegs.get(s, set()) for s in nseg}
+    assert np.allclose(network.upstream_sums(lengths[order]),
+                       [lengths[order][np.isin(nseg, list(upsegs.get(s, [])))].sum() for s in nseg])
+
+
+def test_segment_network_circular():
+    with pytest.raises(ValueError) as e:
+        SegmentNetwork(segments, np.array(circular))
+    assert '[9, 10, 11, 12]' in str(e.value)
+
+
+def loop_strahler(nseg, outseg):
+    """Strahler order of each segment, from the definition (recursively, up the upsegs)."""
+    upsegs = {s: nseg[outseg == s].tolist() for s in nseg}
+    order = {}
+
+    def strahler(s):
+        if s not in order:
+            orders = [strahler(u) for u in upsegs[s]]
+            if len(orders) == 0:
+                order[s] = 1
+            else:
+                highest = max(orders)
+                order[s] = highest + 1 if orders.count(highest) > 1 else highest
+        return order[s]
+    return [strahler(s) for s in nseg]
+
+
+def test_strahler_order():
+    # two order 1 segments join (5), then an order 1 segment with one upseg (6) and another order 1
+    # tributary (8) don't raise the order (7, 9), until it meets another order 2 segment (12) at 14;
+    # a third (order 1) upseg of 14 is ignored. 15 is routed to a segment that isn't in the network.
+    nseg = np.array([1, 2, 3, 5, 6, 7, 8, 9, 10, 11, 12, 14, 15, 16])
+    outseg = np.array([5, 5, 6, 7, 7, 9, 9, 14, 12, 12, 14, 0, 99, 14])
+    expected = [1, 1, 1, 2, 1, 2, 1, 2, 1, 1, 2, 3, 1, 1]
+    assert SegmentNetwork(nseg, outseg).strahler_order().tolist() == expected
+    assert loop_strahler(nseg, outseg) == expected
+    # in any order of the segments
+    order = np.random.RandomState(0).permutation(len(nseg))
+    assert SegmentNetwork(nseg[order], outseg[order]).strahler_order().tolist() == [expected[i] for i in order]
+
+
+def test_strahler_order_random():
+    nseg, outseg = dendritic_network(500, n_outlets=3, seed=4)
+    order = SegmentNetwork(nseg, outseg).strahler_order()
+    assert order.tolist() == loop_strahler(nseg, outseg)
+    assert order.max() > 2
+
+
+@pytest.mark.parametrize('outsegs', [tree, lake], ids=['tree', 'lake'])
+def test_downstream_paths(outsegs):
+    outsegs = np.array(outsegs)
+    paths = DownstreamPaths(segments, outsegs)
+    table, circles = loop_sequences(segments, outsegs)
+    assert len(paths.cycles) == 0 and len(circles) == 0
+    assert np.array_equal(paths.table(), table)
+    assert np.array_equal(paths.table(max_levels=2), table[:3])
+
+    # segments routed to a lake have the lake as their outlet
+    assert np.array_equal(paths.outlets, loop_outlets(table))
+
+    depth = [np.sum((r > 0) & (r < 999999)) - 1 for r in table.T]
+    assert np.array_equal(paths.depth, depth)
+    for s, r in zip(segments, table.T):
+        assert paths.path(s) == r[(r > 0) & (r < 999999)].tolist()
+
+
+def test_downstream_paths_circular():
+    outsegs = np.array(circular)
+    paths = DownstreamPaths(segments, outsegs)
+    table, circles = loop_sequences(segments, outsegs)
+    assert [set(c) for c in paths.cycles] == circles == [{9, 10, 11}]
+    assert paths.cycles[0] == [9, 10, 11]
+
+    # segments in or leading to the circular routing have no outlet
+    circular_segs = np.isin(segments, [9, 10, 11, 12])
+    assert np.all(paths.outlets[circular_segs] == 0)
+    assert np.all(paths.depth[circular_segs] == -1)
+    assert np.array_equal(paths.outlets[~circular_segs], loop_outlets(table[:, ~circular_segs]))
+    assert paths.path(12) == [12, 9, 10, 11]
+
+    # the table is the same as the one from the loop (which continues around the circle until
+    # it is longer than the number of segments), down to the last level needed to show each circle
+    new_table = paths.table()
+    assert len(new_table) >= paths.depth.max() + 1 + len(paths.cycles[0])
+    assert np.array_equal(new_table, table[:len(new_table)])
+
+
+# PlusFlow table with a divergence (101 -> 102 and 103), a confluence (104), inlets from outside
+# of the network (FROMCOMID 0) and outlets (TOCOMID 0)
+fromcomid = np.array([0, 0, 101, 101, 102, 103, 104, 105, 106, 107, 200, 201, 202, 203])
+tocomid = np.array([101, 200, 103, 102, 104, 104, 105, 106, 107, 0, 201, 202, 203, 0])
+
+
+def loop_updown(fromcomid, tocomid, comids):
+    """preproc.NHDdata.list_updown_comids"""
+    dncomids = [tocomid[fromcomid == c].tolist() for c in comids]
+    upcomids = [fromcomid[tocomid == c].tolist() for c in comids]
+    return dncomids, upcomids
+
+
+def loop_find_next(comid, fromcomid, tocomid, comids, max_levels=10):
+    """preproc.find_next (per-comid crawl of the PlusFlow table), with two changes:
+    the smallest comid is taken if more than one is found at the same level
+    (instead of the first one in an unordered set), and the crawl stops at outlets
+    (instead of continuing from comid 0 into the PlusFlow rows for the inlets)."""
+    nextocomid = [comid]
+    comids = set(comids)
+    for i in range(max_levels):
+        nextocomid = tocomid[np.isin(fromcomid, [c for c in nextocomid if c != 0])].tolist()
+        if len(set(nextocomid).intersection(comids)) > 0:
+            return min(set(nextocomid).intersection(comids))
+    return 0
+
+
+def random_plusflow(ncomids=300, seed=0):
+    """PlusFlow table for a random network of unsorted comids, flowing from lower to higher levels,
+    with about 10% divergences and 5% outlets."""
+    rs = np.random.RandomState(seed)
+    comids = rs.choice(np.arange(1000, 100000), ncomids, replace=False)
+    fromids, toids = [], []
+    for i, c in enumerate(comids[:-1]):
+        ndn = 0 if rs.uniform() < 0.05 else (2 if rs.uniform() < 0.1 else 1)
+        dn = rs.choice(comids[i + 1:], min(ndn, ncomids - i - 1), replace=False).tolist()
+        for d in dn or [0]:
+            fromids.append(c)
+            toids.append(d)
+    fromids.append(comids[-1])
+    toids.append(0)
+    order = rs.permutation(len(fromids))
+    return comids, np.array(fromids)[order], np.array(toids)[order]
+
+
+def test_routing_graph_updown():
+    graph = RoutingGraph(fromcomid, tocomid)
+    comids = [101, 102, 103, 104, 107, 200, 203, 999, 0]
+    dncomids, upcomids = loop_updown(fromcomid, tocomid, comids)
+    assert graph.downstream(comids) == dncomids
+    assert graph.upstream(comids) == upcomids
+    # the neighbors are in the order of the table
+    assert graph.downstream([101]) == [[103, 102]]
+    assert graph.upstream([104]) == [[102, 103]]
+    assert graph.downstream([999]) == graph.upstream([999]) == [[]]
+    assert list(graph.index([999, 101, 0])) == [-1, 1, 0]
+
+    comids, fromids, toids = random_plusflow()
+    graph = RoutingGraph(fromids, toids)
+    dncomids, upcomids = loop_updown(fromids, toids, comids)
+    assert graph.downstream(comids) == dncomids
+    assert graph.upstream(comids) == upcomids
+
+
+def test_routing_graph_next_in_set():
+    graph = RoutingGraph(fromcomid, tocomid)
+    # at the divergence, both 102 and 103 are one level down; the smallest is taken
+    assert list(graph.next_in_set([101], [102, 103, 105])) == [102]
+    assert list(graph.next_in_set([101], [103, 105])) == [103]
+    # the starting comid isn't included in the search
+    assert list(graph.next_in_set([101, 104], [101, 104])) == [104, 0]
+    # max_levels
+    assert list(graph.next_in_set([101, 101, 101], [107])) == [107] * 3
+    assert list(graph.next_in_set([101], [107], max_levels=5)) == [107]
+    assert list(graph.next_in_set([101], [107], max_levels=4)) == [0]
+    # the search stops at outlets; the comids after the inlets (FROMCOMID 0) aren't reached
+    assert list(graph.next_in_set([107, 203, 0, 999], [101, 200])) == [0, 0, 0, 0]
+
+    for ids, members in [([101, 104, 105, 200], [105, 107, 203]), ([101, 200, 201], [102, 103, 202])]:
+        for max_levels in [1, 2, 10]:
+            expected = [loop_find_next(c, fromcomid, tocomid, members, max_levels) for c in ids]
+            assert list(graph.next_in_set(ids, members, max_levels=max_levels)) == expected
+
+
+@pytest.mark.parametrize('max_levels', [1, 3, 10])
+def test_routing_graph_next_in_set_random(max_levels):
+    comids, fromids, toids = random_plusflow()
+    graph = RoutingGraph(fromids, toids)
+    members = np.random.RandomState(1).choice(comids, 60, replace=False)
+    expected = [loop_find_next(c, fromids, toids, members, max_levels) for c in comids]
+    next_ids = graph.next_in_set(comids, members, max_levels=max_levels)
+    assert list(next_ids) == expected
+    assert np.sum(next_ids > 0) > 10
+
+
+def loop_reaches(comid, fromcomid, tocomid, targets, max_levels=10):
+    """True if any of targets is comid, or is within max_levels connections downstream of it."""
+    current = [comid]
+    if comid in targets:
+        return True
+    for i in range(max_levels):
+        current = tocomid[np.isin(fromcomid, [c for c in current if c != 0])].tolist()
+        if len(set(current).intersection(targets)) > 0:
+            return True
+    return False
+
+
+def test_routing_graph_upstream_within():
+    graph = RoutingGraph(fromcomid, tocomid)
+    assert list(graph.upstream_within([104], max_levels=1)) == [102, 103, 104]
+    assert list(graph.upstream_within([104])) == [101, 102, 103, 104]
+    # inlets (FROMCOMID 0) aren't included; ids that aren't in the graph are
+    assert list(graph.upstream_within([203, 999], max_levels=2)) == [201, 202, 203, 999]
+    assert len(graph.upstream_within([])) == 0
+
+    comids, fromids, toids = random_plusflow()
+    graph = RoutingGraph(fromids, toids)
+    targets = np.random.RandomState(1).choice(comids, 5, replace=False)
+    for max_levels in [1, 3, 10]:
+        expected = [c for c in comids if loop_reaches(c, fromids, toids, set(targets), max_levels)]
+        upstream = graph.upstream_within(targets, max_levels=max_levels)
+        assert list(upstream) == sorted(expected)
+        assert len(upstream) > 5
+        # the next_in_set searches from any other id don't find the targets
+        others = np.setdiff1d(comids, upstream)
+        assert not np.any(np.isin(graph.next_in_set(others, targets, max_levels=max_levels), targets))
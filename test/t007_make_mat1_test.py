@@ -0,0 +1,129 @@
+__author__ = 'aleaf'
+"""
+Tests for creating Mat1 with a pool of worker processes (preproc._make_reaches_parallel),
+and one tile of the grid at a time (preproc.make_mat1_tiled), comparing the results to those
+made serially from all of the grid cells at once.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import numpy as np
+import pytest
+from shapely.geometry import LineString, MultiLineString
+
+pytest.importorskip('fiona')
+pytest.importorskip('GISio')
+from preproc import make_mat1, make_mat1_from_grid, make_mat1_tiled
+from grid import StructuredGrid
+from synthetic import dendritic_flowlines, structured_grid_geoms, grid_intersections_for
+
+cell_size = 100.
+
+
+@pytest.fixture(scope='module')
+def flowlines():
+    geoms, segments, outsegs, nrow, ncol = dendritic_flowlines(600, cell_size=cell_size, seed=1)
+    # a flowline with two parts, so that the reaches of each part are stitched together
+    geoms[1] = MultiLineString([geoms[1], geoms[2]])
+    comids = segments * 10
+    grid_geoms = structured_grid_geoms(nrow, ncol, cell_size, cell_size, yul=nrow * cell_size)
+    return geoms, segments, comids, nrow, ncol, grid_geoms
+
+
+def check_same(serial, parallel):
+    m1, reach_geoms = serial
+    m1p, reach_geomsp = parallel
+    assert len(m1) > 500
+    assert m1[['segment', 'reach', 'comid', 'node', 'geom_id']].equals(
+        m1p[['segment', 'reach', 'comid', 'node', 'geom_id']])
+    assert np.array_equal(reach_geoms.offsets, reach_geomsp.offsets)
+    assert np.array_equal(reach_geoms.coords, reach_geomsp.coords)
+
+
+@pytest.mark.parametrize('reach_ordering', ['linear', 'nearest'])
+def test_make_mat1_parallel(flowlines, reach_ordering):
+    geoms, segments, comids, nrow, ncol, grid_geoms = flowlines
+    intersections = grid_intersections_for(geoms, grid_geoms)
+    kwargs = dict(tol=0.001, reach_ordering=reach_ordering, geometry_array=True)
+    serial = make_mat1(geoms, segments, comids, intersections, grid_geoms, **kwargs)
+    parallel = make_mat1(geoms, segments, comids, intersections, grid_geoms, n_workers=3, **kwargs)
+    check_same(serial, parallel)
+
+
+def test_make_mat1_from_grid_parallel(flowlines):
+    geoms, segments, comids, nrow, ncol, grid_geoms = flowlines
+    grid = StructuredGrid(np.ones(ncol) * cell_size, np.ones(nrow) * cell_size, yul=nrow * cell_size)
+    serial = make_mat1_from_grid(geoms, segments, comids, grid, geometry_array=True)
+    parallel = make_mat1_from_grid(geoms, segments, comids, grid, n_workers=3, geometry_array=True)
+    check_same(serial, parallel)
+
+    # the geometry column is the same as the LineArray
+    m1 = make_mat1_from_grid(geoms, segments, comids, grid, n_workers=3)
+    assert all(g.equals_exact(r, 0) for g, r in zip(m1.geometry, serial[1].to_geoms()))
+
+
+def tiled_flowlines(grid, seam_offset=0.):
+    """Flowlines from dendritic_flowlines, with a line along a grid line
+    (the seam between tiles of 5 rows), and one crossing the seams back and forth."""
+    geoms, segments, outsegs, nrow, ncol = dendritic_flowlines(600, cell_size=cell_size, seed=1)
+    u = np.array([120., 1450., 1450., 1830., 2600.])
+    v = np.array([500., 500., 470., 530., 520.])
+    v[:2] += seam_offset
+    geoms.append(LineString(list(zip(*grid.to_world(u, v)))))
+    geoms.append(MultiLineString([geoms[1], geoms[2]]))
+    segments = np.arange(1, len(geoms) + 1)
+    return geoms, segments, segments * 10
+
+
+def check_same_as_untiled(untiled, tiled):
+    m1, reach_geoms = untiled
+    m1t, reach_geomst = tiled
+    cols = ['segment', 'reach', 'comid', 'node', 'geom_id', 'reachID']
+    assert m1[cols].equals(m1t[cols])
+    assert np.array_equal(reach_geoms.offsets, reach_geomst.offsets)
+    # the flowlines are clipped at the tile boundaries, so the intersections with the cells
+    # along the seams can differ by round-off
+    assert np.allclose(reach_geoms.coords, reach_geomst.coords, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+@pytest.mark.parametrize('tile_shape, n_workers', [((5, 7), 1), ((5, 7), 3), ((1000, 1000), 1)])
+def test_make_mat1_tiled(rot, tile_shape, n_workers):
+    # the grid only needs to cover the flowlines in the unrotated case
+    nrow, ncol = 60, 52
+    grid = StructuredGrid(np.ones(ncol) * cell_size, np.ones(nrow) * cell_size,
+                          xul=0., yul=nrow * cell_size, rot=rot)
+    # on the rotated grid, a line exactly along a grid line is only along it to within round-off,
+    # so that the cells it is in are arbitrary; the line is moved just off of the seam instead
+    geoms, segments, comids = tiled_flowlines(grid, seam_offset=0. if rot == 0. else 0.5)
+    grid_geoms = grid.cell_polygons()
+    # the reaches of the line along the seam are at the same positions along it in the cells
+    # on both sides; make_mat1_tiled orders these by node number
+    intersections = [sorted(i) for i in grid_intersections_for(geoms, grid_geoms)]
+    untiled = make_mat1(geoms, segments, comids, intersections, grid_geoms, tol=0.001,
+                        reach_ordering='linear', geometry_array=True)
+    assert len(untiled[0]) > 500
+    if rot == 0.:
+        # reaches along the seam are in the cells on both sides of it
+        assert np.sum(untiled[0].comid == comids[-2]) > 2 * 13
+
+    # cell polygons from the grid, for each tile
+    tiled = make_mat1_tiled(geoms, segments, comids, grid, tile_shape=tile_shape,
+                            n_workers=n_workers, geometry_array=True)
+    check_same_as_untiled(untiled, tiled)
+    # cell polygons supplied
+    tiled = make_mat1_tiled(geoms, segments, comids, grid_geoms, nrow, ncol, tile_shape=tile_shape,
+                            n_workers=n_workers, geometry_array=True)
+    check_same_as_untiled(untiled, tiled)
+
+    m1 = make_mat1_tiled(geoms, segments, comids, grid, tile_shape=tile_shape)
+    assert all(g.equals_exact(r, 1e-6) for g, r in zip(m1.geometry, untiled[1].to_geoms()))
+
+
+def test_make_mat1_tiled_bad_grid():
+    grid_geoms = structured_grid_geoms(4, 5, cell_size, cell_size)
+    with pytest.raises(ValueError):
+        make_mat1_tiled([], [], [], grid_geoms, 4, 6)
+    with pytest.raises(ValueError):
+        make_mat1_tiled([], [], [], grid_geoms)
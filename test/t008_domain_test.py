@@ -0,0 +1,213 @@
+__author__ = 'aleaf'
+"""
+Tests for grid.StructuredGrid.get_domain, grid.VertexGrid.get_domain and grid.domain_from_cells,
+comparing the domains to the unary union of the (active) cell polygons,
+and for clipping lines to a multipart domain (preproc.clip_to_domain).
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.ops import unary_union
+from grid import StructuredGrid, VertexGrid, domain_from_cells
+
+delr = np.array([10., 12., 8., 10., 15.])
+delc = np.array([9., 10., 11., 10.])
+
+# active cells with a hole (row 1, column 2), and a cell that only touches the others at a corner
+ibound = np.array([[1, 1, 1, 1, 0],
+                   [1, 1, 0, 1, 0],
+                   [1, 1, 1, 1, 0],
+                   [0, 0, 0, 0, 1]])
+
+
+def structured_grid(rot):
+    return StructuredGrid(delr, delc, xul=100., yul=200., rot=rot)
+
+
+def check_same_as_union(domain, cell_geoms, tol=1e-6):
+    union = unary_union(cell_geoms)
+    assert np.isclose(domain.area, sum(g.area for g in cell_geoms))
+    assert domain.symmetric_difference(union).area < tol
+    return union
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_structured_grid_domain(rot):
+    grid = structured_grid(rot)
+    # the whole grid
+    domain = grid.get_domain()
+    assert isinstance(domain, Polygon)
+    assert np.isclose(domain.area, delr.sum() * delc.sum())
+    assert domain.equals(grid.outline)
+    all_active = grid.get_domain(np.ones((len(delc), len(delr))))
+    assert isinstance(all_active, Polygon)
+    assert len(all_active.exterior.coords) == 5
+    assert all_active.symmetric_difference(domain).area < 1e-6
+    check_same_as_union(domain_from_cells(grid.cell_polygons()), grid.cell_polygons())
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_structured_grid_domain_ibound(rot):
+    grid = structured_grid(rot)
+    active = grid.cell_polygons(np.flatnonzero(ibound) + 1)
+    domain = grid.get_domain(ibound)
+    check_same_as_union(domain, active)
+    # the cell touching at a corner is a separate polygon; the inactive cell is a hole
+    assert isinstance(domain, MultiPolygon)
+    assert sorted(len(p.interiors) for p in domain.geoms) == [0, 1]
+    assert np.isclose(min(p.area for p in domain.geoms), delr[4] * delc[3])
+    # the ibound array can also be flattened
+    assert grid.get_domain(ibound.ravel()).equals(domain)
+
+    # the same, from the cell polygons
+    traced = domain_from_cells(active)
+    check_same_as_union(traced, active)
+    assert isinstance(traced, MultiPolygon)
+
+
+def quadtree_grid(rot, hanging_vertices=True):
+    """4 x 4 grid of 10 x 10 cells, with the cell at x 10-20, y 20-30 refined into 4 cells.
+    If hanging_vertices is True, the neighboring cells include the vertices at the middle of their
+    shared edges; otherwise the refined cells don't share complete edges with their neighbors."""
+    cells = []
+    for i in range(4):
+        for j in range(4):
+            x0, y0 = 10. * j, 30. - 10. * i
+            if (x0, y0) == (10., 20.):
+                cells += [[(x, y), (x, y + 5), (x + 5, y + 5), (x + 5, y)]
+                          for y in (25., 20.) for x in (10., 15.)]
+                continue
+            ring = [(x0, y0), (x0, y0 + 10), (x0 + 10, y0 + 10), (x0 + 10, y0)]
+            if hanging_vertices:
+                if (x0, y0) == (0., 20.):
+                    ring.insert(3, (10., 25.))
+                elif (x0, y0) == (20., 20.):
+                    ring.insert(1, (20., 25.))
+                elif (x0, y0) == (10., 30.):
+                    ring.insert(0, (15., 30.))
+                elif (x0, y0) == (10., 10.):
+                    ring.insert(2, (15., 20.))
+            cells.append(ring)
+    vertices = sorted(set(v for ring in cells for v in ring))
+    number = {v: n for n, v in enumerate(vertices)}
+    iverts = [[number[v] for v in ring] for ring in cells]
+    return VertexGrid(vertices, iverts, xoff=100., yoff=200., rot=rot)
+
+
+@pytest.mark.parametrize('rot', [0., 30.])
+def test_vertex_grid_domain(rot):
+    grid = quadtree_grid(rot)
+    domain = grid.get_domain()
+    check_same_as_union(domain, grid.cell_polygons())
+    assert np.isclose(domain.area, 1600.)
+    assert len(domain.interiors) == 0
+
+    # inactive refined cell (node 6) and corner cell (node 19)
+    idomain = np.ones(grid.ncells, dtype=int)
+    idomain[[5, 18]] = 0
+    domain = grid.get_domain(idomain)
+    check_same_as_union(domain, grid.cell_polygons(np.flatnonzero(idomain) + 1))
+    assert np.isclose(domain.area, 1600. - 25. - 100.)
+
+
+@pytest.mark.parametrize('hanging_vertices', [True, False])
+def test_domain_from_cells_hanging_nodes(capsys, hanging_vertices):
+    # where the coarse cells don't include the hanging vertices, the unmatched edges
+    # along the refined cells cancel out
+    cell_geoms = quadtree_grid(30., hanging_vertices).cell_polygons()
+    domain = domain_from_cells(cell_geoms)
+    assert 'could not be traced' not in capsys.readouterr().out
+    check_same_as_union(domain, cell_geoms)
+    assert len(domain.exterior.coords) == 5
+
+
+@pytest.mark.parametrize('hanging_vertices', [True, False])
+def test_domain_from_cells_fallback(capsys, hanging_vertices):
+    # a refined cell that is also included with its children overlaps them,
+    # so the traced boundary isn't valid; the buffered union is returned instead
+    grid = quadtree_grid(0., hanging_vertices)
+    cell_geoms = grid.cell_polygons() + [Polygon([(110, 220), (110, 230), (120, 230), (120, 220)])]
+    tol = 0.001
+    domain = domain_from_cells(cell_geoms, tol=tol)
+    assert 'could not be traced' in capsys.readouterr().out
+    assert isinstance(domain, Polygon) and domain.is_valid
+    assert domain.equals(unary_union([g.buffer(tol) for g in cell_geoms]))
+    # differs from the union of the cells only by the buffer around the outside
+    union = unary_union(cell_geoms)
+    assert domain.covers(union)
+    assert domain.difference(union).area < 4 * 40. * tol * 1.01
+
+
+def multipart_domain():
+    """Domain with two parts, the second with a hole."""
+    return MultiPolygon([Polygon([(0, 0), (0, 100), (100, 100), (100, 0)]),
+                         Polygon([(200, 0), (200, 100), (300, 100), (300, 0)],
+                                 [[(230, 30), (230, 70), (270, 70), (270, 30)]])])
+
+
+def test_clip_to_domain():
+    pytest.importorskip('fiona')
+    pytest.importorskip('GISio')
+    from shapely.geometry import LineString, MultiLineString
+    from preproc import clip_to_domain
+    domain = multipart_domain()
+    geoms = [LineString([(10, 10), (90, 90)]), # inside the first part
+             LineString([(210, 10), (220, 90), (290, 90)]), # inside the second part, around the hole
+             LineString([(50, 50), (150, 50)]), # crossing out of the first part
+             LineString([(50, 20), (250, 20)]), # crossing from the first part to the second
+             LineString([(250, 10), (250, 90)]), # crossing the hole
+             LineString([(240, 40), (260, 60)]), # in the hole
+             LineString([(120, 10), (180, 90)]), # between the parts
+             LineString([(1000, 1000), (1100, 1000)]), # far outside
+             MultiLineString([[(10, 10), (20, 20)], [(210, 10), (220, 20)]]), # parts in both parts
+             MultiLineString([[(10, 10), (20, 20)], [(110, 10), (120, 20)]])] # one part outside
+    expected_status = [1, 1, 2, 2, 2, 0, 0, 0, 1, 2]
+    clipped, status = clip_to_domain(geoms, domain, return_status=True)
+    assert status.tolist() == expected_status
+    # the status is the same as that from the shapely predicates for the whole domain
+    assert status.tolist() == [1 if domain.contains(g) else 2 if domain.intersects(g) else 0 for g in geoms]
+    for g, c, s in zip(geoms, clipped, status):
+        if s == 1:
+            assert c is g
+        elif s == 2:
+            assert c.equals(g.intersection(domain))
+            assert 0 < c.length < g.length
+        else:
+            assert c.is_empty
+    # the line from the first part to the second is clipped to both parts
+    assert np.isclose(clipped[3].length, 100.) and len(clipped[3].geoms) == 2
+    assert np.isclose(clipped[4].length, 40.)
+    # without the status
+    assert all(c.equals(e) for c, e in zip(clip_to_domain(geoms, domain), clipped))
+
+
+def test_clipped_column():
+    pytest.importorskip('fiona')
+    pytest.importorskip('GISio')
+    import pandas as pd
+    from shapely.geometry import LineString
+    from preproc import lines
+    # two blocks of active cells, the second with an inactive cell in the middle
+    grid = StructuredGrid(np.ones(8) * 100., np.ones(5) * 100., xul=0., yul=500.)
+    ibound = np.zeros((5, 8), dtype=int)
+    ibound[1:4, 0:3] = 1
+    ibound[1:4, 5:8] = 1
+    ibound[2, 6] = 0
+    geoms = [LineString([(20, 220), (280, 380)]), # inside
+             LineString([(150, 250), (450, 250)]), # crossing out of the first block
+             LineString([(150, 150), (750, 150)]), # crossing from the first block to the second
+             LineString([(650, 120), (650, 380)]), # crossing the inactive cell
+             LineString([(320, 20), (480, 480)])] # between the blocks
+    lns = lines(pd.DataFrame({'geometry': geoms}), mf_grid=grid, ibound=ibound,
+                mfgrid_proj4='+proj=utm +zone=15 +datum=NAD83 +units=m +no_defs')
+    assert lns.domain.geom_type == 'MultiPolygon'
+    lns.to_sfr()
+    assert lns.df.segment.tolist() == [1, 2, 3, 4]
+    assert lns.df.clipped.tolist() == [False, True, True, True]
+    # the reaches are all in active cells
+    row, column = (lns.m1.node.values - 1) // 8, (lns.m1.node.values - 1) % 8
+    assert np.all(ibound[row, column] == 1)
+    assert 2 * 8 + 6 + 1 not in lns.m1.node.values
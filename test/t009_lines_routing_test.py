@@ -0,0 +1,188 @@
+__author__ = 'aleaf'
+"""
+Tests for routing linework by the proximity of line ends to line starts
+(preproc.nearest_starts, lines.route_lines_by_proximity and lines.route_lines_to_sfr),
+comparing the nearest starts to those found by brute force.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+pytest.importorskip('fiona')
+pytest.importorskip('GISio')
+pytest.importorskip('scipy')
+from preproc import lines, nearest_starts, get_nearest
+from grid import StructuredGrid
+
+proj4 = '+proj=utm +zone=15 +datum=NAD83 +units=m +no_defs'
+
+
+def brute_force_nearest(starts, ends, exclude_self=True):
+    starts, ends = np.array(starts, dtype=float), np.array(ends, dtype=float)
+    index, distance = [], []
+    for i, end in enumerate(ends):
+        d = np.sqrt(((starts - end)**2).sum(axis=1))
+        if exclude_self and i < len(d):
+            d[i] = np.inf
+        if len(d) == 0 or np.isinf(d.min()):
+            index.append(-1)
+            distance.append(np.inf)
+            continue
+        index.append(int(np.argmin(d)))
+        distance.append(d.min())
+    return np.array(index), np.array(distance)
+
+
+@pytest.mark.parametrize('exclude_self', [True, False])
+def test_nearest_starts(exclude_self):
+    rs = np.random.RandomState(0)
+    starts = rs.uniform(0, 1000, (200, 2))
+    ends = starts + rs.uniform(-20, 20, (200, 2))
+    index, distance = nearest_starts(starts, ends, exclude_self=exclude_self)
+    expected_index, expected_distance = brute_force_nearest(starts, ends, exclude_self=exclude_self)
+    assert np.array_equal(index, expected_index)
+    assert np.allclose(distance, expected_distance)
+    if not exclude_self:
+        assert np.sum(index == np.arange(len(ends))) > 100
+    else:
+        assert np.all(index != np.arange(len(ends)))
+        assert get_nearest(list(map(tuple, starts)), list(map(tuple, ends))) == index.tolist()
+
+    # more ends than starts
+    index, distance = nearest_starts(starts[:50], ends, exclude_self=exclude_self)
+    expected_index, expected_distance = brute_force_nearest(starts[:50], ends, exclude_self=exclude_self)
+    assert np.array_equal(index, expected_index)
+    assert np.allclose(distance, expected_distance)
+
+
+def test_nearest_starts_self_only():
+    # the only start is the end's own, so there is no match
+    index, distance = nearest_starts([(0., 0.)], [(10., 0.)])
+    assert index.tolist() == [-1]
+    assert np.isinf(distance[0])
+    # the second end doesn't have a start of its own
+    index, distance = nearest_starts([(0., 0.)], [(10., 0.), (3., 4.)])
+    assert index.tolist() == [-1, 0]
+    assert distance[1] == 5.
+    index, distance = nearest_starts([(0., 0.)], [(10., 0.)], exclude_self=False)
+    assert index.tolist() == [0]
+    assert distance[0] == 10.
+    # no starts
+    index, distance = nearest_starts([], [(10., 0.)], exclude_self=False)
+    assert index.tolist() == [-1]
+    assert np.isinf(distance[0])
+
+
+def test_nearest_starts_coincident():
+    # the starts of lines 0 and 1 are in the same place, at the end of line 0;
+    # each is the nearest start to the other, regardless of the order of the tie
+    starts = [(0., 0.), (0., 0.), (100., 0.)]
+    ends = [(0., 0.), (0., 0.), (5., 0.)]
+    index, distance = nearest_starts(starts, ends)
+    assert index.tolist() == [1, 0, 0] or index.tolist() == [1, 0, 1]
+    assert np.allclose(distance, [0., 0., 5.])
+    index, distance = nearest_starts(starts, ends, exclude_self=False)
+    assert set(index[:2]) <= {0, 1}
+    assert np.allclose(distance, [0., 0., 5.])
+
+
+def make_lines(geoms, routing_tol=200):
+    grid = StructuredGrid(np.ones(20) * 100., np.ones(10) * 100., xul=0., yul=1000.)
+    df = pd.DataFrame({'geometry': geoms})
+    return lines(df, mf_grid=grid, mfgrid_proj4=proj4, routing_tol=routing_tol)
+
+
+def test_route_lines_by_proximity():
+    geoms = [LineString([(100, 100), (300, 300)]), # ends 10 from the start of line 2
+             LineString([(310, 300), (500, 500)]), # ends 40 from the start of line 3
+             LineString([(540, 500), (800, 500)]),
+             LineString([(100, 900), (300, 900)])] # no other starts nearby
+    lns = make_lines(geoms)
+    lns.route_lines_by_proximity(tol=50)
+    assert lns.df.outseg.tolist() == [2, 3, 0, 0]
+    assert lns.df.upsegs.tolist() == [[], [1], [2], []]
+    lns = make_lines(geoms)
+    lns.route_lines_by_proximity(tol=20)
+    assert lns.df.outseg.tolist() == [2, 0, 0, 0]
+
+
+def test_route_lines_by_proximity_single_line():
+    # a line that ends at its own start isn't routed to itself
+    lns = make_lines([LineString([(100, 100), (300, 300), (110, 100)])])
+    lns.route_lines_by_proximity(tol=50)
+    assert lns.df.outseg.tolist() == [0]
+    assert lns.network.upstream_sets() == {1: set()}
+
+
+def test_route_lines_to_sfr():
+    sfr = pd.DataFrame({'segment': [1, 1, 2], 'reach': [1, 2, 1], 'reachID': [1, 2, 3],
+                        'geometry': [LineString([(1000, 500), (1100, 500)]),
+                                     LineString([(1100, 500), (1200, 500)]),
+                                     LineString([(1000, 800), (1200, 800)])]})
+    geoms = [LineString([(900, 300), (1095, 480)]), # 20.6 from the start of reach 2
+             LineString([(900, 900), (1000, 860)]), # 60 from the start of segment 2
+             LineString([(400, 100), (500, 100)])] # outside of routing_tol
+    for routing_tol, outsegs, outreaches in [(100, [1, 2, 0], [2, 3, 0]),
+                                             (50, [1, 0, 0], [2, 0, 0])]:
+        lns = make_lines(geoms, routing_tol=routing_tol)
+        lns.route_lines_by_proximity(tol=1)
+        lns.route_lines_to_sfr(sfr, route2reach1=False)
+        # the new segments are numbered after those in the SFR dataset
+        assert lns.df.segment.tolist() == [3, 4, 5]
+        assert lns.df.outseg.tolist() == outsegs
+        assert lns.df.outreachID.tolist() == outreaches
+        # the routed lines are connected to the start of the reach
+        routed = np.array(outreaches) > 0
+        ends = [g.coords[-1] for g in lns.df.geometry]
+        sfr_starts = {r: g.coords[0] for r, g in zip(sfr.reachID, sfr.geometry)}
+        assert all(ends[i] == sfr_starts[r] for i, r in enumerate(outreaches) if r > 0)
+        assert all(ends[i] == geoms[i].coords[-1] for i in np.flatnonzero(~routed))
+
+    # the routing_tol argument overrides the routing_tol attribute
+    lns = make_lines(geoms, routing_tol=100)
+    lns.route_lines_by_proximity(tol=1)
+    lns.route_lines_to_sfr(sfr, route2reach1=False, routing_tol=10)
+    assert lns.df.outseg.tolist() == [0, 0, 0]
+
+
+def reach_geoms_by_id(sfr):
+    """Reach geometry for each reachID of an SFR dataset."""
+    return dict(zip(sfr.m1.reachID, sfr.reach_geoms.take(sfr.m1.geom_id.values).to_geoms()))
+
+
+def test_append2sfr():
+    sfr = make_lines([LineString([(50, 550), (650, 560)]),
+                      LineString([(650, 560), (1250, 540)]),
+                      LineString([(300, 900), (640, 570)])])
+    sfr.to_sfr()
+    lns = make_lines([LineString([(900, 100), (950, 400), (1010, 530)]),
+                      LineString([(1500, 100), (1300, 300)]),
+                      LineString([(1300, 300), (1200, 300), (700, 600)])]) # ends 64 from the start of segment 2
+    m1, m2 = lns.append2sfr(sfr, routing_tol=200)
+    # the appended segments follow those in the SFR dataset, and are routed to it
+    assert sorted(m2.segment) == [4, 5, 6]
+    outlet = sfr.m2.segment[sfr.m2.outseg == 0].tolist() # the second line
+    assert m2.loc[6, 'outseg'] == outlet[0] and len(outlet) == 1
+    assert m1.reachID.min() == sfr.m1.reachID.max() + 1
+    expected = reach_geoms_by_id(sfr)
+    expected.update(reach_geoms_by_id(lns))
+
+    sfr.append(lns)
+    assert len(sfr.reach_geoms) == len(sfr.m1) == len(expected)
+    # the reach geometries follow their reaches
+    assert all(g.equals_exact(expected[r], 0) for r, g in reach_geoms_by_id(sfr).items())
+    # the combined segments are renumbered
+    assert sfr.m2.segment.tolist() == list(range(1, 7))
+    assert np.all((sfr.m2.outseg.values > sfr.m2.segment.values) | (sfr.m2.outseg.values == 0))
+    assert sfr.m1.groupby('segment').reach.apply(lambda r: r.tolist() == list(range(1, len(r) + 1))).all()
+    assert sfr.m1.ReachID.tolist() == list(range(1, len(sfr.m1) + 1))
+    outsegs = dict(zip(sfr.m2.segment, sfr.m2.outseg))
+    assert (sfr.m1.outseg == sfr.m1.segment.map(outsegs)).all()
+
+    # appending it again duplicates the segment numbers
+    with pytest.raises(ValueError):
+        sfr.append(sfr)
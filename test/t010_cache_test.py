@@ -0,0 +1,98 @@
+__author__ = 'aleaf'
+"""
+Tests for cache.read_cached, comparing the cached tables to those read with GISio.shp2df.
+"""
+import sys
+import os
+import glob
+import shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pytest
+
+pytest.importorskip('GISio')
+pytest.importorskip('pyarrow')
+from GISio import shp2df
+import cache
+from cache import read_cached
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Examples', 'data')
+
+
+@pytest.fixture
+def shapefile(tmpdir):
+    """Copy of the example SFR linework shapefile (so that it can be touched)."""
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        shutil.copy(os.path.join(data_path, 'SFRlines' + ext), str(tmpdir))
+    return os.path.join(str(tmpdir), 'SFRlines.shp')
+
+
+def check_same(df, expected):
+    assert list(df.columns) == list(expected.columns)
+    assert len(df) == len(expected) > 0
+    attributes = [c for c in df.columns if c != 'geometry']
+    assert df[attributes].reset_index(drop=True).equals(expected[attributes].reset_index(drop=True))
+    if 'geometry' in expected.columns:
+        assert all(g.equals_exact(e, 0) for g, e in zip(df.geometry, expected.geometry))
+
+
+def fail_to_read(filename):
+    raise AssertionError('{} was read instead of the cache'.format(filename))
+
+
+def test_cache_hit(shapefile, tmpdir, capsys, monkeypatch):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    expected = shp2df(shapefile)
+    df = read_cached(shapefile, cache_dir=cache_dir)
+    assert 'caching' in capsys.readouterr().out
+    check_same(df, expected)
+    assert len(glob.glob(os.path.join(cache_dir, '*.parquet'))) == 1
+
+    # the second read comes from the cache, with the geometries intact
+    monkeypatch.setattr(cache, 'shp2df', fail_to_read)
+    cached = read_cached(shapefile, cache_dir=cache_dir)
+    assert 'caching' not in capsys.readouterr().out
+    check_same(cached, expected)
+    assert cached.geometry.iloc[0].geom_type == 'LineString'
+
+
+def test_cache_columns(shapefile, tmpdir):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    expected = shp2df(shapefile)
+    # columns that aren't in the file are skipped
+    df = read_cached(shapefile, columns=['segment', 'reach', 'geometry', 'width'], cache_dir=cache_dir)
+    check_same(df, expected[['segment', 'reach', 'geometry']])
+    # each set of columns is cached separately
+    df = read_cached(shapefile, columns=['node'], cache_dir=cache_dir)
+    check_same(df, expected[['node']])
+    assert len(glob.glob(os.path.join(cache_dir, '*.parquet'))) == 2
+    # no cache
+    check_same(read_cached(shapefile, columns=['node'], cache_dir=None), expected[['node']])
+
+
+def test_cache_invalidated(shapefile, tmpdir, capsys):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    read_cached(shapefile, cache_dir=cache_dir)
+    capsys.readouterr()
+    first = glob.glob(os.path.join(cache_dir, '*.parquet'))
+
+    # touching the file invalidates the cache; the stale cache file is removed
+    stat = os.stat(shapefile)
+    os.utime(shapefile, (stat.st_atime + 10, stat.st_mtime + 10))
+    df = read_cached(shapefile, cache_dir=cache_dir)
+    assert 'caching' in capsys.readouterr().out
+    check_same(df, shp2df(shapefile))
+    second = glob.glob(os.path.join(cache_dir, '*.parquet'))
+    assert len(second) == 1 and second != first
+
+    read_cached(shapefile, cache_dir=cache_dir)
+    assert 'caching' not in capsys.readouterr().out
+
+
+def test_cache_list(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    files = [os.path.join(data_path, 'SFRlines.dbf'), os.path.join(data_path, 'SFRlines.dbf')]
+    expected = shp2df(files[0])
+    df = read_cached(files, cache_dir=cache_dir)
+    assert len(df) == 2 * len(expected)
+    assert list(df.index) == list(range(len(df)))
+    check_same(df.iloc[len(expected):], expected)
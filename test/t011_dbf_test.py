@@ -0,0 +1,92 @@
+__author__ = 'aleaf'
+"""
+Tests for dbf.read_dbf, comparing the tables to those read with dbfread and GISio.shp2df
+from the DBF files in Examples/data.
+"""
+import sys
+import os
+import glob
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+from dbf import read_dbf
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Examples', 'data')
+dbf_files = sorted(glob.glob(os.path.join(data_path, '*.dbf')))
+
+
+def dbfread_df(filename):
+    dbfread = pytest.importorskip('dbfread')
+    table = dbfread.DBF(filename)
+    return pd.DataFrame(list(iter(table)), columns=table.field_names)
+
+
+def check_same(df, expected):
+    assert list(df.columns) == list(expected.columns)
+    assert len(df) == len(expected)
+    for c in expected.columns:
+        if expected[c].dtype.kind in 'if':
+            assert np.allclose(df[c].values.astype(float), expected[c].values.astype(float), equal_nan=True)
+        else:
+            assert df[c].tolist() == expected[c].tolist()
+
+
+@pytest.mark.parametrize('filename', dbf_files, ids=os.path.basename)
+def test_read_dbf(filename):
+    expected = dbfread_df(filename)
+    df = read_dbf(filename)
+    check_same(df, expected)
+    assert df[expected.columns[0]].dtype == np.int64
+
+    # columns that aren't in the file are skipped
+    columns = [expected.columns[2], 'junk', expected.columns[0]]
+    check_same(read_dbf(filename, columns=columns), expected[columns[::2]])
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 1000, 3797, 3798, 100000]) # 3798 records
+def test_read_dbf_filter(chunksize):
+    filename = os.path.join(data_path, 'SFRlines.dbf')
+    expected = dbfread_df(filename)
+    # segments that are split between chunks, and one that isn't in the file
+    segments = np.unique(expected.segment.values)
+    filter_values = segments[::3].tolist() + [segments.max() + 1]
+    df = read_dbf(filename, columns=['segment', 'reach', 'node'], filter_column='segment',
+                  filter_values=filter_values, chunksize=chunksize)
+    kept = expected.loc[expected.segment.isin(filter_values), ['segment', 'reach', 'node']]
+    assert len(kept) > 100
+    check_same(df, kept.reset_index(drop=True))
+
+    # all records, in chunks
+    check_same(read_dbf(filename, chunksize=chunksize), expected)
+
+
+def test_read_dbf_no_records():
+    filename = os.path.join(data_path, 'SFRlines.dbf')
+    df = read_dbf(filename, columns=['segment', 'reach'], filter_column='segment', filter_values=[-1])
+    assert len(df) == 0
+    assert list(df.columns) == ['segment', 'reach']
+    with pytest.raises(ValueError):
+        read_dbf(filename, filter_column='COMID', filter_values=[1])
+
+
+def test_read_dbf_list():
+    expected = [dbfread_df(f) for f in dbf_files]
+    columns = ['segment', 'HYDROID']
+    df = read_dbf(dbf_files, columns=columns)
+    assert len(df) == sum(len(e) for e in expected)
+    assert list(df.index) == list(range(len(df)))
+    offset = 0
+    for e in expected:
+        check_same(df.iloc[offset:offset + len(e)][[c for c in columns if c in e.columns]],
+                   e[[c for c in columns if c in e.columns]])
+        offset += len(e)
+
+
+@pytest.mark.parametrize('filename', dbf_files, ids=os.path.basename)
+def test_read_dbf_shp2df(filename):
+    pytest.importorskip('GISio')
+    from GISio import shp2df
+    expected = shp2df(filename)
+    expected = expected[[c for c in expected.columns if c != 'geometry']]
+    check_same(read_dbf(filename), expected)
@@ -0,0 +1,69 @@
+__author__ = 'aleaf'
+"""
+Tests for projection.project_geoms, comparing the reprojected geometries
+to those transformed one at a time with pyproj.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pytest
+from shapely.geometry import LineString, MultiLineString, Polygon, Point
+from shapely.ops import transform
+
+pyproj = pytest.importorskip('pyproj')
+from projection import project_geoms
+
+utm = '+proj=utm +zone=15 +datum=NAD83 +units=m +no_defs'
+wtm = '+proj=tmerc +lat_0=0 +lon_0=-90 +k=0.9996 +x_0=520000 +y_0=-4480000 +datum=NAD83 +units=m +no_defs'
+latlon = '+proj=longlat +datum=NAD83 +no_defs'
+
+
+def pyproj_transform(geom, proj4, dest_proj4):
+    transformer = pyproj.Transformer.from_crs(pyproj.CRS.from_user_input(proj4),
+                                              pyproj.CRS.from_user_input(dest_proj4), always_xy=True)
+    return transform(transformer.transform, geom)
+
+
+def utm_geoms():
+    x0, y0 = 680000., 5150000.
+    line = LineString([(x0, y0), (x0 + 1000., y0 + 500.), (x0 + 2500., y0 - 300.)])
+    multiline = MultiLineString([[(x0 + 5000., y0), (x0 + 5500., y0 + 800.)],
+                                 [(x0 + 6000., y0 + 100.), (x0 + 6200., y0 - 900.), (x0 + 7000., y0)]])
+    polygon = Polygon([(x0, y0), (x0, y0 + 2000.), (x0 + 3000., y0 + 2000.), (x0 + 3000., y0)],
+                      [[(x0 + 100., y0 + 100.), (x0 + 500., y0 + 100.), (x0 + 500., y0 + 400.)]])
+    return [line, multiline, polygon, Point(x0, y0)]
+
+
+@pytest.mark.parametrize('dest_proj4', [wtm, latlon], ids=['wtm', 'latlon'])
+def test_project_geoms(dest_proj4):
+    geoms = utm_geoms()
+    projected = project_geoms(geoms, utm, dest_proj4)
+    assert len(projected) == len(geoms)
+    for g, p in zip(geoms, projected):
+        expected = pyproj_transform(g, utm, dest_proj4)
+        assert p.geom_type == g.geom_type
+        assert not p.has_z
+        assert p.equals_exact(expected, 1e-9)
+    # the polygon keeps its hole
+    assert len(projected[2].interiors) == 1
+    # the input geometries aren't changed
+    assert geoms[0].equals_exact(utm_geoms()[0], 0)
+
+    # and back
+    for g, p in zip(geoms, project_geoms(projected, dest_proj4, utm)):
+        assert p.equals_exact(g, 1e-3)
+
+
+def test_project_geoms_z():
+    # z values are kept as is
+    line = LineString([(680000., 5150000., 10.), (681000., 5150500., 12.5)])
+    projected = project_geoms([line, utm_geoms()[0]], utm, wtm)
+    assert projected[0].has_z and not projected[1].has_z
+    assert np.allclose(np.array(projected[0].coords)[:, 2], [10., 12.5])
+    expected = pyproj_transform(LineString([c[:2] for c in line.coords]), utm, wtm)
+    assert np.allclose(np.array(projected[0].coords)[:, :2], np.array(expected.coords))
+
+
+def test_project_geoms_empty():
+    assert project_geoms([], utm, wtm) == []
@@ -0,0 +1,186 @@
+__author__ = 'aleaf'
+"""
+Tests for NHDdata.update_sfr, comparing the updated SFR dataset to one built from scratch
+with the edited NHDPlus input.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+pytest.importorskip('fiona')
+pytest.importorskip('GISio')
+import preproc
+from preproc import NHDdata
+from grid import StructuredGrid
+from routing import RoutingGraph
+
+proj4 = '+proj=utm +zone=15 +datum=NAD83 +units=m +no_defs'
+fl_cols = ['FCODE', 'FDATE', 'FLOWDIR', 'FTYPE', 'GNIS_ID', 'GNIS_NAME', 'REACHCODE', 'RESOLUTION', 'WBAREACOMI']
+
+
+def flowlines(comids, geoms):
+    fl = pd.DataFrame({'COMID': comids, 'geometry': geoms})
+    for c in fl_cols:
+        fl[c] = 0
+    fl['LENGTHKM'] = [g.length / 1000. for g in geoms]
+    return fl
+
+
+def nhd_tables():
+    """Small NHDPlus dataset on a 10 x 20 grid of 100 m cells: a main stem of 6 flowlines going east,
+    with a braid around comid 44, a tributary, an inflow from outside of the grid,
+    and flowlines outside of the grid. Comid 22 is routed to 33 through comids 500 and 501,
+    and 66 to an outlet through 600, which aren't in the flowlines."""
+    geoms = [LineString([(100. + 300 * i, 500.), (400. + 300 * i, 520.)]) for i in range(6)] # 11-66
+    geoms += [LineString([(700., 520.), (850., 300.), (1000., 520.)]), # 77 braid of 44
+              LineString([(1250., 950.), (1150., 700.), (1300., 520.)]), # 88 tributary to 55
+              LineString([(-300., 700.), (100., 500.)])] # 99 inflow to 11
+    geoms += [LineString([(1e5 + 10 * i, 1e5), (1e5 + 10 * i + 5, 1e5)]) for i in range(20)]
+    comids = np.arange(1, len(geoms) + 1) * 11
+    fl = flowlines(comids, geoms)
+    pf = pd.DataFrame({'FROMCOMID': [11, 22, 500, 501, 33, 33, 77, 44, 55, 88, 99, 66, 600] + comids[9:].tolist(),
+                       'TOCOMID': [22, 500, 501, 33, 44, 77, 55, 55, 66, 55, 11, 600, 0] + [0] * 20})
+    levelpaths = np.ones(len(comids), dtype=int)
+    levelpaths[6:9] = [2, 3, 1]
+    vaa = pd.DataFrame({'ComID': comids, 'ArbolateSu': np.cumsum(fl.LENGTHKM.values) + 1.,
+                        'Hydroseq': 0, 'DnHydroseq': 0, 'LevelPathI': levelpaths, 'StreamOrde': 1})
+    el = pd.DataFrame({'COMID': comids, 'MAXELEVSMO': 10000. - 10 * np.arange(len(comids)),
+                       'MINELEVSMO': 9990. - 10 * np.arange(len(comids))})
+    return fl, pf, vaa, el
+
+
+def build(fl, pf, vaa, el, polygon_grid=False, **kwargs):
+    grid = StructuredGrid(np.ones(20) * 100., np.ones(10) * 100., xul=0., yul=1000.)
+    if polygon_grid:
+        grid = pd.DataFrame({'node': np.arange(1, 201), 'geometry': grid.cell_polygons()})
+    nhd = NHDdata(NHDFlowline=fl.copy(), PlusFlow=pf.copy(), PlusFlowlineVAA=vaa.copy(), elevslope=el.copy(),
+                  mf_grid=grid, mf_grid_node_col='node', mfgrid_proj4=proj4, flowlines_proj4=proj4,
+                  mf_units='meters', nrows=10, ncols=20)
+    nhd.to_sfr(**kwargs)
+    return nhd
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Record the flowlines that are clipped, the COMIDs that the routing graph is crawled from,
+    and the number of spatial indexes built for the grid."""
+    calls = {'clip': [], 'crawl': [], 'index': 0}
+    clip_to_domain = preproc.clip_to_domain
+    next_in_set = RoutingGraph.next_in_set
+    build_rtree_index = preproc.build_rtree_index
+
+    def clip(geoms, *args, **kwargs):
+        calls['clip'].append(len(geoms))
+        return clip_to_domain(geoms, *args, **kwargs)
+
+    def crawl(self, ids, *args, **kwargs):
+        calls['crawl'] += list(ids)
+        return next_in_set(self, ids, *args, **kwargs)
+
+    def index(geoms):
+        calls['index'] += 1
+        return build_rtree_index(geoms)
+
+    monkeypatch.setattr(preproc, 'clip_to_domain', clip)
+    monkeypatch.setattr(RoutingGraph, 'next_in_set', crawl)
+    monkeypatch.setattr(preproc, 'build_rtree_index', index)
+    return calls
+
+
+def check_same(nhd, expected):
+    m1 = nhd.m1.reset_index(drop=True)
+    m1e = expected.m1.reset_index(drop=True)
+    assert len(m1) > 20
+    assert m1.equals(m1e[m1.columns])
+    assert all(g.equals_exact(e, 0) for g, e in zip(nhd.reach_geoms.take(m1.geom_id.values).to_geoms(),
+                                                     expected.reach_geoms.take(m1e.geom_id.values).to_geoms()))
+    assert nhd.m2.equals(expected.m2)
+
+
+def test_to_sfr():
+    fl, pf, vaa, el = nhd_tables()
+    nhd = build(fl, pf, vaa, el)
+    # flowlines outside of the grid are dropped; the inflow is clipped
+    assert sorted(nhd.df.COMID) == list(range(11, 100, 11))
+    assert nhd.df.clipped.sum() == 1 and nhd.df.clipped[99]
+    # the braid is routed along the levelpath of the main stem
+    assert nhd.df.dncomids[33] == [44]
+    # routing through comids that aren't in the model
+    assert nhd.df.dncomids[22] == [33]
+    assert nhd.df.dncomids[66] == [0]
+    assert len(nhd.m2) == 9
+    assert nhd.m2.outseg.max() <= len(nhd.m2)
+
+
+@pytest.mark.parametrize('polygon_grid', [False, True], ids=['structured', 'polygons'])
+@pytest.mark.parametrize('edit, n_clipped, crawled', [('geometry', 1, [500]),
+                                                      ('add', 1, []),
+                                                      ('remove', 0, []),
+                                                      ('attributes', 0, [500]),
+                                                      ('gap', 1, [500])])
+def test_update_sfr(edit, n_clipped, crawled, polygon_grid, calls):
+    fl, pf, vaa, el = nhd_tables()
+    nhd = build(fl, pf, vaa, el, polygon_grid=polygon_grid, reach_ordering='linear')
+    assert sorted(calls['crawl']) == [500, 600]
+    assert calls['index'] == (1 if polygon_grid else 0)
+    calls['clip'], calls['crawl'] = [], []
+    kwargs = {}
+    if edit == 'geometry':
+        # move the middle of comid 33
+        edits = fl.loc[fl.COMID == 33].copy()
+        edits['geometry'] = [LineString([(700., 500.), (850., 750.), (1000., 540.)])]
+        kwargs['NHDFlowline'] = edits
+        fl = pd.concat([fl.loc[fl.COMID != 33], edits])
+    elif edit == 'add':
+        # a new tributary to comid 22
+        edits = flowlines([111], [LineString([(600., 100.), (550., 300.), (650., 500.)])])
+        pf_edits = pd.DataFrame({'FROMCOMID': [111], 'TOCOMID': [22]})
+        vaa_edits = vaa.loc[vaa.ComID == 88].copy()
+        vaa_edits['ComID'] = 111
+        vaa_edits['LevelPathI'] = 4
+        el_edits = el.loc[el.COMID == 88].copy()
+        el_edits['COMID'] = 111
+        kwargs.update(NHDFlowline=edits, PlusFlow=pf_edits, PlusFlowlineVAA=vaa_edits, elevslope=el_edits)
+        fl, pf = pd.concat([fl, edits]), pd.concat([pf, pf_edits])
+        vaa, el = pd.concat([vaa, vaa_edits]), pd.concat([el, el_edits])
+    elif edit == 'remove':
+        kwargs['remove_comids'] = [88]
+        fl = fl.loc[fl.COMID != 88]
+    elif edit == 'attributes':
+        edits = el.loc[el.COMID == 44].copy()
+        edits['MAXELEVSMO'] -= 5.
+        kwargs['elevslope'] = edits
+        el = pd.concat([el.loc[el.COMID != 44], edits])
+    elif edit == 'gap':
+        # add comid 501 (so that 22 is routed to it, instead of through it to 33)
+        edits = flowlines([501], [LineString([(700., 520.), (700., 500.)])])
+        vaa_edits = vaa.loc[vaa.ComID == 22].copy()
+        vaa_edits['ComID'] = 501
+        el_edits = el.loc[el.COMID == 22].copy()
+        el_edits['COMID'] = 501
+        kwargs.update(NHDFlowline=edits, PlusFlowlineVAA=vaa_edits, elevslope=el_edits)
+        fl, vaa, el = pd.concat([fl, edits]), pd.concat([vaa, vaa_edits]), pd.concat([el, el_edits])
+    nhd.update_sfr(reach_ordering='linear', **kwargs)
+    # only the edited flowlines are clipped, and the routing graph is only crawled again
+    # from comids that are upstream of edited comids; the grid index is reused
+    assert sum(calls['clip']) == n_clipped
+    assert sorted(calls['crawl']) == crawled
+    assert calls['index'] == (1 if polygon_grid else 0)
+
+    expected = build(fl.reset_index(drop=True), pf, vaa, el, polygon_grid=polygon_grid, reach_ordering='linear')
+    check_same(nhd, expected)
+    if edit == 'gap':
+        assert nhd.df.dncomids[22] == [501]
+
+
+def test_update_sfr_no_dataset():
+    fl, pf, vaa, el = nhd_tables()
+    grid = StructuredGrid(np.ones(20) * 100., np.ones(10) * 100., xul=0., yul=1000.)
+    nhd = NHDdata(NHDFlowline=fl, PlusFlow=pf, PlusFlowlineVAA=vaa, elevslope=el,
+                  mf_grid=grid, mfgrid_proj4=proj4, flowlines_proj4=proj4, mf_units='meters')
+    with pytest.raises(ValueError):
+        nhd.update_sfr(remove_comids=[11])
@@ -0,0 +1,79 @@
+__author__ = 'aleaf'
+"""
+Tests for linework.LineArray, comparing the lengths, end points and midpoints,
+and the lines from take and concatenate, to those from the shapely LineStrings.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from shapely.geometry import LineString
+from linework import LineArray
+
+
+def random_lines(n=200, seed=0):
+    """Random LineStrings with 2 to 10 vertices, including lines with repeated vertices
+    (zero-length segments)."""
+    rs = np.random.RandomState(seed)
+    geoms = []
+    for i in range(n):
+        xy = rs.uniform(0, 1000, 2) + np.cumsum(rs.uniform(-100, 100, (rs.randint(2, 11), 2)), axis=0)
+        if i % 10 == 0:
+            xy = np.insert(xy, 1, xy[0], axis=0)
+        if i % 15 == 0:
+            xy = np.append(xy, xy[-1:], axis=0)
+        geoms.append(LineString(xy))
+    return geoms
+
+
+def check_same(lines, geoms):
+    assert len(lines) == len(geoms)
+    assert all(l.equals_exact(g, 0) for l, g in zip(lines.to_geoms(), geoms))
+
+
+def test_line_array():
+    geoms = random_lines()
+    lines = LineArray.from_geoms(geoms)
+    check_same(lines, geoms)
+    assert np.array_equal(lines.counts, [len(g.coords) for g in geoms])
+    assert np.allclose(lines.lengths, [g.length for g in geoms])
+    assert np.array_equal(lines.starts, [g.coords[0] for g in geoms])
+    assert np.array_equal(lines.ends, [g.coords[-1] for g in geoms])
+    midpoints = [g.interpolate(0.5, normalized=True).coords[0] for g in geoms]
+    assert np.allclose(lines.midpoints, midpoints)
+    # lines are also made one at a time
+    assert lines[3].equals_exact(geoms[3], 0)
+    assert [len(g.coords) for g in lines] == lines.counts.tolist()
+
+
+def test_line_array_z():
+    # z values are dropped
+    geoms = [LineString([(0, 0, 5), (3, 4, 6)]), LineString([(1, 1), (2, 2), (3, 1)])]
+    lines = LineArray.from_geoms(geoms)
+    assert lines.coords.shape == (5, 2)
+    assert np.allclose(lines.lengths, [5., 2. * np.sqrt(2)])
+    assert np.allclose(lines.midpoints, [(1.5, 2.), (2., 2.)])
+
+
+def test_take():
+    geoms = random_lines()
+    lines = LineArray.from_geoms(geoms)
+    rs = np.random.RandomState(1)
+    for indices in [rs.permutation(len(geoms)), rs.choice(len(geoms), 50), [5, 5, 0], [len(geoms) - 1]]:
+        taken = lines.take(indices)
+        check_same(taken, [geoms[i] for i in indices])
+        assert np.allclose(taken.lengths, lines.lengths[indices])
+    empty = lines.take([])
+    assert len(empty) == 0 and len(empty.lengths) == 0
+
+
+def test_concatenate():
+    geoms = random_lines()
+    parts = [geoms[:10], geoms[10:11], [], geoms[11:]]
+    lines = LineArray.concatenate([LineArray.from_geoms(p) for p in parts])
+    check_same(lines, geoms)
+    assert np.array_equal(lines.offsets, LineArray.from_geoms(geoms).offsets)
+    assert np.allclose(lines.midpoints, LineArray.from_geoms(geoms).midpoints)
+    assert len(LineArray.concatenate([])) == 0
+    # take and concatenate together
+    check_same(LineArray.concatenate([lines.take([3, 1]), lines.take([0])]), [geoms[3], geoms[1], geoms[0]])
@@ -0,0 +1,129 @@
+__author__ = 'aleaf'
+"""
+Tests for runreport.RunReport: nesting of stages, the stage totals from summary and compare,
+and saving and loading reports with to_json and from_json.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from runreport import RunReport
+
+
+def run(report, n=3):
+    """Record a run with a nested stage that is repeated, and a stage that is run twice."""
+    with report.stage('read') as stage:
+        stage['items'] = np.int64(10)
+    for i in range(2):
+        with report.stage('make_mat1') as stage:
+            for j in range(n):
+                with report.stage('intersect', items=j + 1):
+                    with report.stage('flatten'):
+                        pass
+            stage['items'] = 5
+    return report
+
+
+def test_stage_levels():
+    report = run(RunReport(verbose=False))
+    df = report.to_dataframe()
+    assert list(df.columns) == ['stage', 'level', 'wall_time', 'cpu_time', 'peak_rss_mb', 'rss_growth_mb', 'items']
+    # stages are listed in the order that they finished (inner stages before the stages containing them)
+    assert df.stage.tolist() == ['read'] + (['flatten', 'intersect'] * 3 + ['make_mat1']) * 2
+    levels = dict(zip(df.stage, df.level))
+    assert levels == {'read': 0, 'make_mat1': 0, 'intersect': 1, 'flatten': 2}
+    assert (df.wall_time >= 0).all() and (df.cpu_time >= 0).all()
+    # an outer stage takes at least as long as the stages within it
+    make_mat1 = df.loc[df.stage == 'make_mat1'].wall_time.values
+    intersect = df.loc[df.stage == 'intersect'].wall_time.values.reshape(2, 3).sum(axis=1)
+    assert (make_mat1 >= intersect).all()
+
+
+def test_stage_error():
+    # a stage that raises is still recorded, and the level is reset for the stages that follow
+    report = RunReport(verbose=False)
+    with pytest.raises(ValueError):
+        with report.stage('outer'):
+            with report.stage('inner'):
+                raise ValueError('bad flowline')
+    with report.stage('next'):
+        pass
+    df = report.to_dataframe()
+    assert df.stage.tolist() == ['inner', 'outer', 'next']
+    assert df.level.tolist() == [1, 0, 0]
+
+
+def test_summary():
+    report = run(RunReport(verbose=False))
+    df = report.to_dataframe()
+    summary = report.summary()
+    # totals by stage name, in the order that the stages first finished
+    assert summary.index.tolist() == ['read', 'flatten', 'intersect', 'make_mat1']
+    assert summary['count'].tolist() == [1, 6, 6, 2]
+    assert summary.level.tolist() == [0, 2, 1, 0]
+    assert summary.loc['intersect', 'items'] == 2 * (1 + 2 + 3)
+    assert summary.loc['make_mat1', 'items'] == 10
+    for stage in summary.index:
+        rows = df.loc[df.stage == stage]
+        assert np.isclose(summary.loc[stage, 'wall_time'], rows.wall_time.sum())
+        assert np.isclose(summary.loc[stage, 'cpu_time'], rows.cpu_time.sum())
+        assert summary.loc[stage, 'peak_rss_mb'] == rows.peak_rss_mb.max()
+    # an empty report
+    assert len(RunReport(verbose=False).summary()) == 0
+
+
+def test_compare():
+    report = run(RunReport(verbose=False))
+    baseline = RunReport(verbose=False)
+    with baseline.stage('read', items=10):
+        pass
+    with baseline.stage('reproject', items=10):
+        pass
+    baseline.stages[0]['wall_time'] = report.summary().loc['read', 'wall_time'] / 2.
+    comparison = report.compare(baseline)
+    # stages in this run, then the stages that are only in the other run
+    assert comparison.index.tolist() == ['read', 'flatten', 'intersect', 'make_mat1', 'reproject']
+    for c in ['wall_time', 'cpu_time', 'peak_rss_mb']:
+        assert c + '_other' in comparison.columns and c + '_ratio' in comparison.columns
+    assert np.isclose(comparison.loc['read', 'wall_time_ratio'], 2.)
+    assert comparison.loc['read', 'items_other'] == 10
+    # stages that are missing from either run have no ratio
+    assert np.isnan(comparison.loc['intersect', 'wall_time_other'])
+    assert np.isnan(comparison.loc['intersect', 'wall_time_ratio'])
+    assert np.isnan(comparison.loc['reproject', 'wall_time'])
+    assert np.isnan(comparison.loc['reproject', 'wall_time_ratio'])
+    # a run compared to itself
+    same = report.compare(report)
+    assert np.allclose(same.loc[same.wall_time > 0, 'wall_time_ratio'], 1.)
+
+
+def test_json_round_trip(tmpdir):
+    report = run(RunReport(verbose=False))
+    filename = os.path.join(str(tmpdir), 'report.json')
+    report.to_json(filename)
+    with open(filename) as src:
+        data = json.load(src)
+    assert sorted(data.keys()) == ['info', 'stages']
+    assert data['info']['versions']['numpy'] == np.__version__
+
+    loaded = RunReport.from_json(filename)
+    assert loaded.info == report.info
+    assert loaded.stages == report.stages
+    assert loaded.to_dataframe().equals(report.to_dataframe())
+    assert loaded.summary().equals(report.summary())
+    # comparing to a saved run (by filename)
+    comparison = report.compare(filename)
+    assert np.allclose(comparison.loc[comparison.wall_time > 0, 'wall_time_ratio'], 1.)
+    assert (comparison['items'] == comparison['items_other']).all()
+
+
+def test_csv(tmpdir):
+    report = run(RunReport(verbose=False))
+    filename = os.path.join(str(tmpdir), 'report.csv')
+    report.to_csv(filename)
+    df = pd.read_csv(filename)
+    assert df.stage.tolist() == report.to_dataframe().stage.tolist()
+    assert np.allclose(df.wall_time, report.to_dataframe().wall_time)
@@ -0,0 +1,176 @@
+__author__ = 'aleaf'
+"""
+Tests for the binary Mat1 and Mat2 tables (mattables.write_table and read_table),
+and loading them with postproc.SFRdata.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+pa = pytest.importorskip('pyarrow')
+from linework import LineArray
+from mattables import write_table, read_table, read_reach_geoms, is_binary_table, format_version
+
+
+def mat1(n=23):
+    """Mat1 table with integer, float and string columns, a column of lists,
+    and a reach geometry for each row."""
+    rs = np.random.RandomState(0)
+    geoms = [LineString(rs.uniform(0, 1000, (rs.randint(2, 6), 2))) for i in range(n)]
+    m1 = pd.DataFrame({'node': rs.randint(1, 200, n),
+                       'segment': np.repeat(np.arange(1, n // 3 + 2), 3)[:n],
+                       'reach': np.tile([1, 2, 3], n // 3 + 1)[:n],
+                       'sbtop': rs.uniform(100, 200, n),
+                       'width': rs.uniform(1, 10, n).astype(np.float32),
+                       'name': ['reach{}'.format(i) for i in range(n)],
+                       'upsegs': [[i, i + 1] for i in range(n)],
+                       'geometry': geoms})
+    m1['length'] = [g.length for g in geoms]
+    return m1
+
+
+@pytest.mark.parametrize('chunksize', [500000, 7, 1])
+def test_round_trip(tmpdir, chunksize):
+    m1 = mat1()
+    filename = os.path.join(str(tmpdir), 'Mat1.arrow')
+    write_table(m1, filename, reach_geoms=LineArray.from_geoms(m1.geometry), table_name='Mat1',
+                chunksize=chunksize)
+    assert is_binary_table(filename)
+
+    df = read_table(filename)
+    # the column of lists is skipped; the other columns keep their types,
+    # and the position of each geometry is added
+    columns = [c for c in m1.columns if c not in ('upsegs', 'geometry')]
+    assert df.columns.tolist() == columns + ['geom_id']
+    assert df.dtypes.node == m1.dtypes.node and df.dtypes.width == np.float32
+    pd.testing.assert_frame_equal(df[columns], m1[columns], check_dtype=False)
+    assert df.sbtop.equals(m1.sbtop)
+    assert np.array_equal(df.geom_id, np.arange(len(m1)))
+
+    # reach geometries
+    geoms = read_reach_geoms(filename)
+    assert len(geoms) == len(m1)
+    assert all(g.equals_exact(e, 0) for g, e in zip(geoms.to_geoms(), m1.geometry))
+    df = read_table(filename, columns=['segment', 'geometry', 'missing'], geometry=True)
+    assert df.columns.tolist() == ['segment', 'geometry']
+    assert all(g.equals_exact(e, 0) for g, e in zip(df.geometry, m1.geometry))
+    for memory_map in [True, False]:
+        assert read_table(filename, memory_map=memory_map).equals(read_table(filename))
+
+
+def test_geom_id(tmpdir):
+    # the geometries are matched to the rows by geom_id after the table is sorted and filtered,
+    # and any geom_id column in the table is replaced
+    m1 = mat1()
+    m1['geom_id'] = -1
+    filename = os.path.join(str(tmpdir), 'Mat1.arrow')
+    write_table(m1, filename, reach_geoms=LineArray.from_geoms(m1.geometry), chunksize=5)
+    df = read_table(filename).sort_values(by='sbtop').reset_index(drop=True)
+    df = df.loc[df.width > 3.]
+    assert len(df) < len(m1)
+    geoms = read_reach_geoms(filename).take(df.geom_id.values)
+    expected = m1.set_index('name').geometry.loc[df.name]
+    assert all(g.equals_exact(e, 0) for g, e in zip(geoms.to_geoms(), expected))
+    # without reach geometries, the column is written as it is
+    write_table(m1, filename)
+    assert (read_table(filename).geom_id == -1).all()
+
+
+def test_round_trip_wkb(tmpdir):
+    # geometry column of shapely objects, written as WKB
+    m1 = mat1()
+    m1.loc[4, 'geometry'] = None
+    filename = os.path.join(str(tmpdir), 'Mat1.arrow')
+    write_table(m1, filename, chunksize=10)
+    df = read_table(filename, geometry=True)
+    assert df.geometry[4] is None
+    assert all(g.equals_exact(e, 0) for g, e in zip(df.geometry, m1.geometry) if e is not None)
+    assert 'geometry' not in read_table(filename).columns
+    with pytest.raises(ValueError):
+        read_reach_geoms(filename)
+
+
+def test_empty_table(tmpdir):
+    m1 = mat1().iloc[:0]
+    filename = os.path.join(str(tmpdir), 'Mat1.arrow')
+    write_table(m1, filename, reach_geoms=LineArray.from_geoms([]), chunksize=5)
+    df = read_table(filename)
+    assert len(df) == 0
+    # the list column is skipped by type, which can't be told without rows
+    assert df.columns.tolist() == [c for c in m1.columns if c != 'geometry'] + ['geom_id']
+    assert len(read_reach_geoms(filename)) == 0
+
+
+def test_wrong_number_of_geoms(tmpdir):
+    m1 = mat1()
+    with pytest.raises(ValueError):
+        write_table(m1, os.path.join(str(tmpdir), 'Mat1.arrow'), reach_geoms=LineArray.from_geoms(m1.geometry[:-1]))
+
+
+def test_format_version(tmpdir):
+    import pyarrow.ipc
+    filename = os.path.join(str(tmpdir), 'Mat1.arrow')
+    write_table(mat1(), filename)
+    table = read_table(filename)
+
+    def write(metadata, filename):
+        t = pa.Table.from_pandas(table, preserve_index=False)
+        t = t.replace_schema_metadata(metadata)
+        with pa.ipc.new_file(filename, t.schema) as writer:
+            writer.write_table(t)
+
+    # a file written in a newer version of the format is rejected
+    newer = os.path.join(str(tmpdir), 'newer.arrow')
+    write({b'sfrmaker.version': str(format_version + 1).encode(), b'sfrmaker.geometry': b'none'}, newer)
+    with pytest.raises(IOError) as e:
+        read_table(newer)
+    assert 'version {}'.format(format_version + 1) in str(e.value)
+    # an Arrow file that wasn't written by write_table
+    other = os.path.join(str(tmpdir), 'other.arrow')
+    write({}, other)
+    with pytest.raises(IOError):
+        read_table(other)
+    # the current version
+    write({b'sfrmaker.version': str(format_version).encode(), b'sfrmaker.geometry': b'none'}, newer)
+    assert read_table(newer).equals(table)
+
+
+def test_is_binary_table(tmpdir):
+    filename = os.path.join(str(tmpdir), 'Mat1.csv')
+    mat1().to_csv(filename, index=False)
+    assert not is_binary_table(filename)
+
+
+def test_sfrdata_binary_tables(tmpdir):
+    pytest.importorskip('GISio')
+    from postproc import SFRdata
+    m1 = mat1().drop(['upsegs', 'name'], axis=1)
+    # reaches not in order, to test the sorting
+    m1 = m1.iloc[np.random.RandomState(1).permutation(len(m1))]
+    segments = np.unique(m1.segment)
+    m2 = pd.DataFrame({'segment': segments, 'icalc': 1,
+                       'outseg': np.append(segments[1:], 0), 'Max': 200., 'Min': 100.})
+    m2['upsegs'] = [[s - 1] if s > 1 else [] for s in m2.segment]
+    tables = {}
+    for ext in ['arrow', 'csv']:
+        tables[ext] = [os.path.join(str(tmpdir), 'Mat{}.{}'.format(i, ext)) for i in [1, 2]]
+    write_table(m1, tables['arrow'][0], reach_geoms=LineArray.from_geoms(m1.geometry), table_name='Mat1')
+    write_table(m2, tables['arrow'][1], table_name='Mat2')
+    m1.to_csv(tables['csv'][0], index=False)
+    m2.drop('upsegs', axis=1).to_csv(tables['csv'][1], index=False)
+
+    sfr = SFRdata(Mat1=tables['arrow'][0], Mat2=tables['arrow'][1])
+    expected = SFRdata(Mat1=tables['csv'][0], Mat2=tables['csv'][1])
+    assert sfr.Mat1 == tables['arrow'][0]
+    assert sfr.outpath == str(tmpdir)
+    # the geometries aren't loaded (only their positions in the table)
+    assert 'geometry' not in sfr.m1.columns
+    assert np.array_equal(sfr.m1.geom_id, sfr.m1.index)
+    pd.testing.assert_frame_equal(sfr.m1.drop('geom_id', axis=1), expected.m1, check_dtype=False)
+    pd.testing.assert_frame_equal(sfr.m2, expected.m2, check_dtype=False)
+    assert sfr.m1[['segment', 'reach']].values.tolist() == sorted(m1[['segment', 'reach']].values.tolist())
+    assert sfr.m2.upsegs.tolist() == m2.upsegs.tolist()
@@ -0,0 +1,107 @@
+__author__ = 'aleaf'
+"""
+Tests for the cell centroids, corners and polygons of grid.StructuredGrid,
+and the grid made by postproc.SFRdata from the model origin (lower left corner) and rotation.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+from grid import StructuredGrid
+
+delr = np.array([10., 12., 8., 10., 15.])
+delc = np.array([9., 10., 11., 10.])
+nrow, ncol = len(delc), len(delr)
+
+
+@pytest.mark.parametrize('rot', [0., 30., -115.])
+def test_cell_geometries(rot):
+    grid = StructuredGrid(delr, delc, xul=100., yul=200., rot=rot, length_mult=2.)
+    polygons = grid.cell_polygons()
+    corners = grid.cell_corners()
+    centroids = grid.cell_centroids()
+    assert len(polygons) == grid.ncells and corners.shape == (grid.ncells, 4, 2)
+    assert centroids.shape == (grid.ncells, 2)
+    areas = 4. * np.outer(delc, delr).ravel()
+    for n, (p, c, xy) in enumerate(zip(polygons, corners, centroids)):
+        assert p.equals_exact(grid.cell_polygon(n + 1), 1e-9)
+        assert np.allclose(p.exterior.coords[:4], c)
+        assert np.allclose(p.centroid.coords[0], xy)
+        assert np.isclose(p.area, areas[n])
+    # the cells tile the grid
+    from shapely.ops import unary_union
+    assert np.isclose(unary_union(polygons).symmetric_difference(grid.outline).area, 0.)
+    # upper left corner of the first cell, and lower right corner of the last cell
+    assert np.allclose(corners[0, 0], (100., 200.))
+    assert np.allclose(corners[-1, 2], grid.corners[2])
+
+    # subsets of cells, in the order given
+    nodes = [20, 3, 3, 8]
+    assert np.allclose(grid.cell_centroids(nodes), centroids[np.array(nodes) - 1])
+    assert np.allclose(grid.cell_corners(nodes), corners[np.array(nodes) - 1])
+    assert all(p.equals_exact(polygons[n - 1], 0) for p, n in zip(grid.cell_polygons(nodes), nodes))
+    assert len(grid.cell_polygons([])) == 0
+
+
+def test_cell_centroids_unrotated():
+    grid = StructuredGrid(delr, delc, xul=100., yul=200.)
+    centroids = grid.cell_centroids().reshape(nrow, ncol, 2)
+    x = 100. + np.cumsum(delr) - 0.5 * delr
+    y = 200. - (np.cumsum(delc) - 0.5 * delc)
+    assert np.allclose(centroids[:, :, 0], x[np.newaxis, :])
+    assert np.allclose(centroids[:, :, 1], y[:, np.newaxis])
+
+
+@pytest.fixture
+def mfdis(tmpdir):
+    flopy = pytest.importorskip('flopy')
+    m = flopy.modflow.Modflow('grid', model_ws=str(tmpdir))
+    flopy.modflow.ModflowDis(m, nlay=1, nrow=nrow, ncol=ncol, delr=delr, delc=delc, top=100., botm=90.)
+    m.write_input()
+    return os.path.join(str(tmpdir), 'grid.dis')
+
+
+def sfrdata(mfdis, **kwargs):
+    pytest.importorskip('GISio')
+    from postproc import SFRdata
+    # a reach in each cell
+    rows, columns = np.divmod(np.arange(nrow * ncol), ncol)
+    m1 = pd.DataFrame({'row': rows + 1, 'column': columns + 1, 'segment': 1, 'reach': np.arange(1, nrow * ncol + 1)})
+    m2 = pd.DataFrame({'segment': [1], 'outseg': [0]})
+    return SFRdata(Mat1=m1, Mat2=m2, mfdis=mfdis, **kwargs)
+
+
+@pytest.mark.parametrize('rotation', [0., 30., -115.])
+def test_sfrdata_structured_grid(mfdis, rotation):
+    xll, yll, GIS_mult = 1000., 5000., 3.28
+    sfr = sfrdata(mfdis, xll=xll, yll=yll, rotation=rotation, GIS_mult=GIS_mult)
+    grid = sfr.structured_grid
+    assert (grid.nrow, grid.ncol) == (nrow, ncol)
+    assert grid.rot == rotation
+    # the model origin is the lower left corner of the bottom left cell
+    assert np.allclose(grid.cell_corners([(nrow - 1) * ncol + 1])[0, 3], (xll, yll))
+    assert np.allclose(grid.corners[3], (xll, yll))
+    # the bottom edge of the grid points along the rotation
+    x, y = np.array(grid.corners[2]) - np.array(grid.corners[3])
+    assert np.isclose(np.degrees(np.arctan2(y, x)), rotation)
+    assert np.isclose(np.hypot(x, y), delr.sum() * GIS_mult)
+    # the upper left corner
+    x, y = np.array(grid.corners[0]) - np.array(grid.corners[3])
+    assert np.isclose(np.degrees(np.arctan2(y, x)), rotation + 90.)
+    assert np.isclose(np.hypot(x, y), delc.sum() * GIS_mult)
+
+
+def test_sfrdata_cell_centroids(mfdis):
+    # the centroids (unrotated) match those from the DIS node coordinates and the model origin
+    xll, yll, GIS_mult = 1000., 5000., 3.28
+    sfr = sfrdata(mfdis, xll=xll, yll=yll, GIS_mult=GIS_mult)
+    sfr.get_cell_centroids()
+    y, x = sfr.dis.get_node_coordinates()
+    expected = [(x[c - 1] * GIS_mult + xll, y[r - 1] * GIS_mult + yll) for r, c in zip(sfr.m1.row, sfr.m1.column)]
+    assert np.allclose(sfr.m1.centroids.tolist(), expected)
+    # cell polygons contain the centroids
+    sfr.get_cell_geometries()
+    from shapely.geometry import Point
+    assert all(g.contains(Point(c)) for g, c in zip(sfr.m1.geometry, sfr.m1.centroids))
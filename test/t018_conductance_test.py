@@ -0,0 +1,152 @@
+__author__ = 'aleaf'
+"""
+Tests for postproc.SFRdata.consolidate_conductance, comparing the results for the widest reach rule
+to those of the loop over shared cells that it replaced, and checking the length and stream order rules.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('GISio')
+from postproc import SFRdata
+
+nseg = [1, 2, 3, 5, 6, 7, 8, 9, 10, 11, 12, 14, 15, 16]
+outseg = [5, 5, 6, 7, 7, 9, 9, 14, 12, 12, 14, 0, 0, 14]
+strahler = dict(zip(nseg, [1, 1, 1, 2, 1, 2, 1, 2, 1, 1, 2, 3, 1, 1]))
+
+
+def sfrdata(m1):
+    """SFRdata instance for the network, with a reach in a cell of its own
+    for each segment that isn't in m1."""
+    missing = np.setdiff1d(nseg, m1.segment)
+    others = pd.DataFrame({'segment': missing, 'reach': 1, 'node': 1000 + missing,
+                           'width': 1., 'length': 1., 'sbK': 1., 'sbthick': 1.},
+                          index=len(m1) + np.arange(len(missing)))
+    m2 = pd.DataFrame({'segment': nseg, 'outseg': outseg})
+    return SFRdata(Mat1=pd.concat([m1, others]), Mat2=m2)
+
+
+def dominant(sfr, m1):
+    """Dominant column for the reaches in m1 (in the order of m1)."""
+    return sfr.m1.Dominant.loc[m1.index].tolist()
+
+
+def random_mat1(nreaches=300, ncells=120, seed=0):
+    """Reaches in random cells (so that many cells have several reaches), with distinct widths."""
+    rs = np.random.RandomState(seed)
+    segment = np.sort(rs.choice(nseg, nreaches))
+    reach = np.concatenate([np.arange(1, np.sum(segment == s) + 1) for s in np.unique(segment)])
+    return pd.DataFrame({'segment': segment, 'reach': reach, 'node': rs.randint(1, ncells + 1, nreaches),
+                         'width': rs.permutation(nreaches) + 1., 'length': rs.uniform(1., 100., nreaches),
+                         'sbK': rs.uniform(0.1, 10., nreaches), 'sbthick': rs.uniform(0.5, 2., nreaches)})
+
+
+def loop_consolidate(m1, bedKmin=1e-8):
+    """SFRdata.consolidate_conductance before it was vectorized (widest reach in each cell)."""
+    m1 = m1.copy()
+    m1['Cond'] = m1.apply(lambda X: X['sbK'] * X['width'] * X['length'] / X['sbthick'], axis=1)
+    m1['Dominant'] = [True] * len(m1)
+    shared_cells = np.unique(m1.loc[m1.node.duplicated(), 'node'])
+    for c in shared_cells:
+        df = m1[m1.node == c].sort_values(by='width', ascending=False)
+        m1.loc[df.index[1:], 'Dominant'] = False
+    Cond_sums = m1[['node', 'Cond']].groupby('node').agg('sum').Cond
+    m1['Cond_sum'] = [Cond_sums[c] for c in m1.node]
+
+    def consolidate_lengths(X):
+        if X['Dominant']:
+            return X['Cond_sum'] * X['sbthick'] / (X['sbK'] * X['width'])
+        return 1.0
+    m1['SFRlength'] = m1.apply(consolidate_lengths, axis=1)
+    m1['sbK'] = [r['sbK'] if r['Dominant'] else bedKmin for i, r in m1.iterrows()]
+    return m1
+
+
+def check_conductance(m1):
+    """Conductance is conserved in each cell, and put in its dominant reach."""
+    assert m1.groupby('node').Dominant.sum().eq(1).all()
+    dominant = m1.loc[m1.Dominant]
+    assert np.allclose(dominant.SFRlength * dominant.sbK * dominant.width / dominant.sbthick,
+                       m1.groupby('node').Cond.sum().loc[dominant.node].values)
+    assert (m1.loc[~m1.Dominant, 'SFRlength'] == 1.).all()
+
+
+def test_consolidate_width():
+    m1 = random_mat1()
+    assert m1.node.duplicated().sum() > 100
+    sfr = sfrdata(m1)
+    expected = loop_consolidate(sfr.m1)
+    sfr.consolidate_conductance()
+    for c in ['Cond', 'Cond_sum', 'SFRlength', 'sbK']:
+        assert np.allclose(sfr.m1[c].values, expected[c].values, rtol=1e-12), c
+    assert sfr.m1.Dominant.tolist() == expected.Dominant.tolist()
+    assert sfr.m1.sbK[~sfr.m1.Dominant].eq(1e-8).all()
+    check_conductance(sfr.m1)
+
+    # another bedKmin; reaches that aren't collocated are unchanged
+    sfr = sfrdata(m1)
+    sbK = sfr.m1.sbK.values.copy()
+    sfr.consolidate_conductance(bedKmin=1e-6)
+    alone = ~sfr.m1.node.duplicated(keep=False).values
+    assert sfr.m1.Dominant.values[alone].all()
+    assert np.allclose(sfr.m1.SFRlength.values[alone], sfr.m1.length.values[alone])
+    assert np.array_equal(sfr.m1.sbK.values[alone], sbK[alone])
+    assert sfr.m1.sbK[~sfr.m1.Dominant].eq(1e-6).all()
+
+
+def test_consolidate_ties():
+    # ties in width go to the first reach in Mat1
+    m1 = pd.DataFrame({'segment': [1, 1, 2, 2, 3], 'reach': [1, 2, 1, 2, 1], 'node': [5, 6, 6, 5, 6],
+                       'width': [2., 3., 3., 2., 1.], 'length': [10., 20., 30., 40., 50.],
+                       'sbK': 1., 'sbthick': 1.})
+    sfr = sfrdata(m1)
+    sfr.consolidate_conductance()
+    assert dominant(sfr, m1) == [True, True, False, False, False]
+    # by length, ties are broken by width
+    m1['length'] = [10., 30., 30., 40., 20.]
+    m1['width'] = [2., 1., 3., 2., 5.]
+    sfr = sfrdata(m1)
+    sfr.consolidate_conductance(dominant='length')
+    assert dominant(sfr, m1) == [False, False, True, True, False]
+
+
+def test_consolidate_length():
+    m1 = random_mat1(seed=1)
+    sfr = sfrdata(m1)
+    sfr.consolidate_conductance(dominant='length')
+    longest = m1.groupby('node').length.idxmax()
+    assert sorted(sfr.m1.index[sfr.m1.Dominant]) == sorted(longest.values)
+    check_conductance(sfr.m1)
+    # the same total conductance as with the widest reach rule
+    sfr2 = sfrdata(m1)
+    sfr2.consolidate_conductance()
+    assert np.allclose(sfr.m1.Cond_sum, sfr2.m1.Cond_sum)
+
+
+def test_consolidate_order():
+    # a narrow reach on the main stem (segment 14; order 3) shares a cell with a wider headwater reach
+    m1 = pd.DataFrame({'segment': [1, 14, 12, 16, 3], 'reach': [1, 1, 1, 1, 1], 'node': [1, 1, 2, 2, 3],
+                       'width': [10., 5., 2., 8., 1.], 'length': [10., 20., 30., 40., 50.],
+                       'sbK': 1., 'sbthick': 1.})
+    sfr = sfrdata(m1)
+    sfr.consolidate_conductance(dominant='order')
+    assert dominant(sfr, m1) == [False, True, True, False, True]
+    assert np.allclose(sfr.m1.SFRlength.loc[m1.index], [1., 20. + 10. * 10. / 5., 30. + 40. * 8. / 2., 1., 50.])
+
+    m1 = random_mat1(seed=2)
+    sfr = sfrdata(m1)
+    sfr.consolidate_conductance(dominant='order')
+    m1['order'] = [strahler[s] for s in m1.segment]
+    # the dominant reach in each cell is the widest of those with the highest order
+    expected = m1.sort_values(by=['order', 'width'], ascending=False).groupby('node').head(1).index
+    assert sorted(sfr.m1.index[sfr.m1.Dominant]) == sorted(expected)
+    check_conductance(sfr.m1)
+
+
+def test_consolidate_dominant_rule():
+    sfr = sfrdata(random_mat1())
+    with pytest.raises(ValueError):
+        sfr.consolidate_conductance(dominant='depth')
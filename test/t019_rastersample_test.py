@@ -0,0 +1,189 @@
+__author__ = 'aleaf'
+"""
+Tests for rastersample.sample_cells, sample_polygons and sample_lines, and linework.LineArray.points_along,
+comparing the statistics to those computed by brute force from the pixel centers
+(or the pixels containing points interpolated along the lines with shapely).
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+rasterio = pytest.importorskip('rasterio')
+from grid import StructuredGrid
+from linework import LineArray
+from rastersample import sample_cells, sample_polygons, sample_lines
+
+# raster with 7.3 m pixels, and some pixels without data
+xul, yul, pixel_size = 1000., 5000., 7.3
+height, width = 90, 110
+nodata = -9999.
+
+
+@pytest.fixture(scope='module')
+def raster(tmpdir_factory):
+    from rasterio.transform import from_origin
+    rs = np.random.RandomState(0)
+    data = rs.uniform(100., 200., (height, width))
+    data[rs.uniform(size=data.shape) < 0.05] = nodata
+    data[:10, :10] = nodata
+    filename = os.path.join(str(tmpdir_factory.mktemp('raster')), 'dem.tif')
+    with rasterio.open(filename, 'w', driver='GTiff', height=height, width=width, count=1, dtype='float64',
+                       crs='epsg:26915', transform=from_origin(xul, yul, pixel_size, pixel_size),
+                       nodata=nodata) as dst:
+        dst.write(data, 1)
+    return filename
+
+
+def pixel_values(raster):
+    """x, y coordinates of the pixel centers and the values (with nan for no data), as 1-D arrays."""
+    with rasterio.open(raster) as src:
+        data = src.read(1)
+    x = xul + pixel_size * (np.arange(width) + 0.5)
+    y = yul - pixel_size * (np.arange(height) + 0.5)
+    x, y = np.meshgrid(x, y)
+    return x.ravel(), y.ravel(), np.where(data == nodata, np.nan, data).ravel()
+
+
+def brute_force_stats(values):
+    """min, max, mean and count for lists of values (nan values are skipped)."""
+    stats = []
+    for v in values:
+        v = np.asarray(v, dtype=float)
+        v = v[~np.isnan(v)]
+        if len(v) == 0:
+            stats.append((np.nan, np.nan, np.nan, 0))
+        else:
+            stats.append((v.min(), v.max(), v.mean(), len(v)))
+    return pd.DataFrame(stats, columns=['min', 'max', 'mean', 'count'])
+
+
+def check_stats(stats, expected):
+    assert stats.columns.tolist() == ['min', 'max', 'mean', 'count']
+    assert len(stats) == len(expected)
+    assert np.array_equal(stats['count'].values, expected['count'].values)
+    for c in ['min', 'max', 'mean']:
+        assert np.allclose(stats[c].values, expected[c].values, equal_nan=True), c
+
+
+def polygon_stats(raster, polygons):
+    from shapely import contains_xy
+    x, y, values = pixel_values(raster)
+    return brute_force_stats([values[contains_xy(p, x, y)] for p in polygons])
+
+
+def model_grid():
+    """Rotated grid extending past the edges of the raster (and over the pixels without data)."""
+    delr = np.linspace(20., 35., 30)
+    delc = np.linspace(25., 15., 25)
+    return StructuredGrid(delr, delc, xul=950., yul=4850., rot=17.)
+
+
+@pytest.mark.parametrize('block_size, n_workers', [(1024, 1), (16, 1), (16, 3)])
+def test_sample_cells(raster, block_size, n_workers):
+    grid = model_grid()
+    rs = np.random.RandomState(1)
+    nodes = np.concatenate([rs.choice(grid.ncells, 200, replace=False) + 1, [5, 5, grid.ncells]])
+    stats = sample_cells(raster, grid, nodes, block_size=block_size, n_workers=n_workers)
+    expected = polygon_stats(raster, grid.cell_polygons(nodes))
+    check_stats(stats, expected)
+    # cells partly outside of the raster, and cells without any pixels with data
+    assert (stats['count'] > 0).sum() > 100
+    assert (stats['count'] == 0).any()
+
+
+@pytest.mark.parametrize('block_size, n_workers', [(1024, 1), (16, 3)])
+def test_sample_polygons(raster, block_size, n_workers):
+    grid = model_grid()
+    polygons = grid.cell_polygons(np.arange(1, grid.ncells + 1, 3))
+    stats = sample_polygons(raster, polygons, block_size=block_size, n_workers=n_workers)
+    check_stats(stats, polygon_stats(raster, polygons))
+    # the same as sampling the grid cells
+    check_stats(stats, sample_cells(raster, grid, np.arange(1, grid.ncells + 1, 3)))
+
+
+def random_lines(n=60, seed=2):
+    """Random lines over the raster, including lines that leave it, a line with a zero-length segment,
+    and a line outside of the raster."""
+    rs = np.random.RandomState(seed)
+    lines = []
+    for i in range(n):
+        start = rs.uniform([xul - 50., yul - height * pixel_size], [xul + width * pixel_size, yul + 50.])
+        xy = start + np.cumsum(rs.uniform(-40., 40., (rs.randint(2, 6), 2)), axis=0)
+        lines.append(LineString(xy))
+    lines.append(LineString([(1100., 4900.), (1100., 4900.), (1130., 4870.)]))
+    lines.append(LineString([(0., 0.), (10., 10.)]))
+    return lines
+
+
+def points_along(line, spacing):
+    """Points along a line, interpolated with shapely."""
+    npoints = max(int(np.ceil(line.length / spacing)), 1) + 1
+    return np.array([line.interpolate(d).coords[0] for d in np.linspace(0., line.length, npoints)])
+
+
+@pytest.mark.parametrize('spacing', [1., 3.65, 100.])
+def test_points_along(spacing):
+    lines = random_lines()
+    points, line = LineArray.from_geoms(lines).points_along(spacing)
+    assert np.array_equal(np.unique(line), np.arange(len(lines)))
+    for i, g in enumerate(lines):
+        expected = points_along(g, spacing)
+        assert np.allclose(points[line == i], expected)
+        if len(expected) > 1:
+            assert np.all(np.hypot(*np.diff(expected, axis=0).T) <= spacing + 1e-9)
+
+
+@pytest.mark.parametrize('spacing, block_size, n_workers', [(None, 1024, 1), (None, 16, 3), (2., 16, 1)])
+def test_sample_lines(raster, spacing, block_size, n_workers):
+    lines = random_lines()
+    with rasterio.open(raster) as src:
+        data = src.read(1)
+    values = []
+    for g in lines:
+        x, y = points_along(g, pixel_size / 2. if spacing is None else spacing).T
+        col = np.floor((x - xul) / pixel_size).astype(int)
+        row = np.floor((yul - y) / pixel_size).astype(int)
+        inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+        v = data[row[inside], col[inside]]
+        values.append(np.where(v == nodata, np.nan, v))
+    stats = sample_lines(raster, lines, spacing=spacing, block_size=block_size, n_workers=n_workers)
+    check_stats(stats, brute_force_stats(values))
+    assert stats['count'].values[-1] == 0
+    # the same for a LineArray
+    check_stats(sample_lines(raster, LineArray.from_geoms(lines), spacing=spacing), stats)
+
+
+def test_reset_streambed_tops_along_reaches(raster, tmpdir):
+    # reach geometries are matched to the rows of Mat1 by geom_id
+    pytest.importorskip('GISio')
+    from postproc import SFRdata
+    from mattables import write_table
+    lines = random_lines()[:-1]
+    n = len(lines)
+    segment = np.repeat(np.arange(1, n // 4 + 2), 4)[:n]
+    m1 = pd.DataFrame({'segment': segment, 'reach': np.tile([1, 2, 3, 4], n // 4 + 1)[:n],
+                       'node': np.arange(1, n + 1), 'sbtop': 0.})
+    # reaches listed out of order
+    order = np.random.RandomState(3).permutation(n)
+    m1, lines = m1.iloc[order], [lines[i] for i in order]
+    m2 = pd.DataFrame({'segment': np.unique(segment), 'outseg': 0})
+    mat1, mat2 = [os.path.join(str(tmpdir), 'Mat{}.arrow'.format(i)) for i in [1, 2]]
+    write_table(m1, mat1, reach_geoms=LineArray.from_geoms(lines), table_name='Mat1')
+    write_table(m2, mat2, table_name='Mat2')
+
+    sfr = SFRdata(Mat1=mat1, Mat2=mat2)
+    # the table is sorted by segment and reach, and may be re-indexed
+    sfr.m1 = sfr.m1.reset_index(drop=True)
+    sfr.reset_m1_streambed_top_from_dem(dem=raster, sample='reaches')
+    by_reach = dict(zip(zip(m1.segment, m1.reach), sample_lines(raster, lines)['min']))
+    expected = [by_reach[sr] for sr in zip(sfr.m1.segment, sfr.m1.reach)]
+    assert np.allclose(sfr.m1.sbtop, expected, equal_nan=True)
+
+    # without geom_id (e.g. a table written without reach geometries)
+    sfr.m1 = sfr.m1.drop('geom_id', axis=1)
+    with pytest.raises(ValueError):
+        sfr.reset_m1_streambed_top_from_dem(sample='reaches')